@@ -0,0 +1,1109 @@
+/*
+ * Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+ *
+ * https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+ *
+ * Optional compiled implementation of the hot paths of the codec: decoding
+ * and encoding of field tables, frame boundaries, and the default header
+ * frame properties. Each function mirrors the pure-Python implementation in
+ * reader.py, writer.py and frames/, which remain the reference; anything
+ * this module doesn't handle natively is passed back to Python. See
+ * haigha2/speedups.py for how it is selected.
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <string.h>
+
+#if PY_MAJOR_VERSION >= 3
+#define IS_PY3 1
+#define NativeInt_FromLong PyLong_FromLong
+#define Bytes_FromStringAndSize PyBytes_FromStringAndSize
+#define Bytes_CheckExact PyBytes_CheckExact
+#define Bytes_AS_STRING PyBytes_AS_STRING
+#define Bytes_GET_SIZE PyBytes_GET_SIZE
+#else
+#define NativeInt_FromLong PyInt_FromLong
+#define Bytes_FromStringAndSize PyString_FromStringAndSize
+#define Bytes_CheckExact PyString_CheckExact
+#define Bytes_AS_STRING PyString_AS_STRING
+#define Bytes_GET_SIZE PyString_GET_SIZE
+#endif
+
+/* Types of the default header frame properties, see HeaderFrame */
+#define PROP_SHORTSTR 0
+#define PROP_OCTET 1
+#define PROP_TABLE 2
+#define PROP_TIMESTAMP 3
+
+static PyObject *StructError;
+static PyObject *DecimalType;
+static PyObject *UtcFromTimestamp;
+
+/* Fetched from haigha2.reader on first use, as it imports this module */
+static PyObject *BufferUnderflow;
+static PyObject *FieldError;
+
+static int
+load_reader_errors(void)
+{
+    PyObject *module, *reader;
+
+    if (BufferUnderflow != NULL)
+        return 0;
+    module = PyImport_ImportModule("haigha2.reader");
+    if (module == NULL)
+        return -1;
+    reader = PyObject_GetAttrString(module, "Reader");
+    Py_DECREF(module);
+    if (reader == NULL)
+        return -1;
+    BufferUnderflow = PyObject_GetAttrString(reader, "BufferUnderflow");
+    FieldError = PyObject_GetAttrString(reader, "FieldError");
+    Py_DECREF(reader);
+    if (BufferUnderflow == NULL || FieldError == NULL) {
+        Py_CLEAR(BufferUnderflow);
+        Py_CLEAR(FieldError);
+        return -1;
+    }
+    return 0;
+}
+
+/*
+ * Decoding
+ */
+
+typedef struct {
+    const unsigned char *buf;
+    Py_ssize_t len;     /* length of the whole underlying buffer */
+    Py_ssize_t pos;
+    Py_ssize_t end;     /* Reader._end_pos */
+#ifdef IS_PY3
+    Py_buffer view;
+#endif
+} cursor_t;
+
+static int
+cursor_open(cursor_t *c, PyObject *input, Py_ssize_t pos, Py_ssize_t end)
+{
+#ifdef IS_PY3
+    if (PyObject_GetBuffer(input, &c->view, PyBUF_SIMPLE) < 0)
+        return -1;
+    c->buf = (const unsigned char *)c->view.buf;
+    c->len = c->view.len;
+#else
+    const void *buf;
+    if (PyObject_AsReadBuffer(input, &buf, &c->len) < 0)
+        return -1;
+    c->buf = (const unsigned char *)buf;
+#endif
+    c->pos = pos;
+    c->end = end;
+    return load_reader_errors();
+}
+
+static void
+cursor_close(cursor_t *c)
+{
+#ifdef IS_PY3
+    PyBuffer_Release(&c->view);
+#endif
+}
+
+/* Like Reader._check_underflow */
+static int
+check_underflow(cursor_t *c, Py_ssize_t n)
+{
+    if (c->pos + n > c->end) {
+        PyErr_SetNone(BufferUnderflow);
+        return -1;
+    }
+    return 0;
+}
+
+/* Like struct.unpack_from, which is bounded by the underlying buffer */
+static int
+check_unpack(cursor_t *c, Py_ssize_t n)
+{
+    if (c->pos < 0 || c->pos + n > c->len) {
+        PyErr_Format(StructError,
+                     "unpack_from requires a buffer of at least %zd bytes",
+                     c->pos + n);
+        return -1;
+    }
+    return 0;
+}
+
+static unsigned long
+unpack_u16(const unsigned char *p)
+{
+    return ((unsigned long)p[0] << 8) | p[1];
+}
+
+static unsigned long
+unpack_u32(const unsigned char *p)
+{
+    return ((unsigned long)p[0] << 24) | ((unsigned long)p[1] << 16) |
+           ((unsigned long)p[2] << 8) | p[3];
+}
+
+static unsigned PY_LONG_LONG
+unpack_u64(const unsigned char *p)
+{
+    return ((unsigned PY_LONG_LONG)unpack_u32(p) << 32) | unpack_u32(p + 4);
+}
+
+/* An unsigned 64-bit value, as an int where struct would return one */
+static PyObject *
+native_from_u64(unsigned PY_LONG_LONG v)
+{
+#ifndef IS_PY3
+    if (v <= (unsigned PY_LONG_LONG)LONG_MAX)
+        return PyInt_FromLong((long)v);
+#endif
+    return PyLong_FromUnsignedLongLong(v);
+}
+
+static PyObject *
+native_from_s64(PY_LONG_LONG v)
+{
+#ifndef IS_PY3
+    if (v >= LONG_MIN && v <= LONG_MAX)
+        return PyInt_FromLong((long)v);
+#endif
+    return PyLong_FromLongLong(v);
+}
+
+/* Slice of the buffer, clamped to its end as Python slicing is */
+static void
+clamp_slice(cursor_t *c, Py_ssize_t n, const char **start, Py_ssize_t *size)
+{
+    Py_ssize_t avail = c->len - c->pos;
+    if (avail < 0)
+        avail = 0;
+    *start = (const char *)c->buf + (avail ? c->pos : 0);
+    *size = n < avail ? n : avail;
+}
+
+/* A short string as a native str, decoding it on Python 3 */
+static PyObject *
+native_text(const char *start, Py_ssize_t size)
+{
+#ifdef IS_PY3
+    return PyUnicode_DecodeUTF8(start, size, NULL);
+#else
+    return PyString_FromStringAndSize(start, size);
+#endif
+}
+
+static PyObject *decode_table(cursor_t *c);
+static PyObject *decode_field(cursor_t *c);
+
+/* Reader.read_long */
+static int
+read_long(cursor_t *c, unsigned long *rval)
+{
+    if (check_underflow(c, 4) < 0 || check_unpack(c, 4) < 0)
+        return -1;
+    *rval = unpack_u32(c->buf + c->pos);
+    c->pos += 4;
+    return 0;
+}
+
+/* Reader._field_shortstr */
+static PyObject *
+field_shortstr(cursor_t *c)
+{
+    Py_ssize_t slen, size;
+    const char *start;
+
+    if (check_unpack(c, 1) < 0)
+        return NULL;
+    slen = c->buf[c->pos++];
+    clamp_slice(c, slen, &start, &size);
+    c->pos += slen;
+    return native_text(start, size);
+}
+
+/* Reader._field_longstr and _field_bytearray */
+static PyObject *
+field_longstr(cursor_t *c, int as_bytearray)
+{
+    Py_ssize_t slen, size;
+    const char *start;
+
+    if (check_unpack(c, 4) < 0)
+        return NULL;
+    slen = (Py_ssize_t)unpack_u32(c->buf + c->pos);
+    c->pos += 4;
+    clamp_slice(c, slen, &start, &size);
+    c->pos += slen;
+    if (as_bytearray)
+        return PyByteArray_FromStringAndSize(start, size);
+    return Bytes_FromStringAndSize(start, size);
+}
+
+static PyObject *
+timestamp_from_u64(unsigned PY_LONG_LONG v)
+{
+    PyObject *seconds, *rval;
+
+    seconds = native_from_u64(v);
+    if (seconds == NULL)
+        return NULL;
+    rval = PyObject_CallFunctionObjArgs(UtcFromTimestamp, seconds, NULL);
+    Py_DECREF(seconds);
+    return rval;
+}
+
+/* Reader._field_decimal */
+static PyObject *
+field_decimal(cursor_t *c)
+{
+    PyObject *digits, *n, *num = NULL, *den = NULL, *rval = NULL;
+    long d, v;
+
+    if (check_unpack(c, 5) < 0)
+        return NULL;
+    d = c->buf[c->pos];
+    v = (long)(int)unpack_u32(c->buf + c->pos + 1);
+    c->pos += 5;
+
+    n = NativeInt_FromLong(10);
+    digits = NativeInt_FromLong(d);
+    if (n != NULL && digits != NULL) {
+        PyObject *scale = PyNumber_Power(n, digits, Py_None);
+        if (scale != NULL) {
+            den = PyObject_CallFunctionObjArgs(DecimalType, scale, NULL);
+            Py_DECREF(scale);
+        }
+    }
+    Py_XDECREF(n);
+    Py_XDECREF(digits);
+    if (den == NULL)
+        return NULL;
+
+    n = NativeInt_FromLong(v);
+    if (n != NULL) {
+        num = PyObject_CallFunctionObjArgs(DecimalType, n, NULL);
+        Py_DECREF(n);
+    }
+    if (num != NULL)
+        rval = PyNumber_TrueDivide(num, den);
+    Py_XDECREF(num);
+    Py_DECREF(den);
+    return rval;
+}
+
+/* Reader._field_array */
+static PyObject *
+field_array(cursor_t *c)
+{
+    unsigned long alen;
+    Py_ssize_t end_pos;
+    PyObject *rval, *value;
+
+    if (read_long(c, &alen) < 0)
+        return NULL;
+    end_pos = c->pos + (Py_ssize_t)alen;
+    rval = PyList_New(0);
+    if (rval == NULL)
+        return NULL;
+    while (c->pos < end_pos) {
+        value = decode_field(c);
+        if (value == NULL || PyList_Append(rval, value) < 0) {
+            Py_XDECREF(value);
+            Py_DECREF(rval);
+            return NULL;
+        }
+        Py_DECREF(value);
+    }
+    return rval;
+}
+
+static void
+raise_unknown_field(unsigned char ftype)
+{
+    PyObject *args;
+
+#ifdef IS_PY3
+    args = Py_BuildValue("(si)", "Unknown field type %s", (int)ftype);
+#else
+    args = Py_BuildValue("(ss#)", "Unknown field type %s", &ftype, 1);
+#endif
+    if (args != NULL) {
+        PyErr_SetObject(FieldError, args);
+        Py_DECREF(args);
+    }
+}
+
+/* Reader._read_field, for the types in Reader.field_type_map */
+static PyObject *
+decode_field(cursor_t *c)
+{
+    const unsigned char *p;
+    unsigned char ftype;
+    PyObject *rval;
+    union {
+        PY_UINT32_T i;
+        float f;
+    } f32;
+    union {
+        unsigned PY_LONG_LONG i;
+        double d;
+    } f64;
+
+    if (c->pos < 0 || c->pos >= c->len) {
+        PyErr_SetString(PyExc_IndexError, "index out of range");
+        return NULL;
+    }
+    ftype = c->buf[c->pos++];
+    p = c->buf + c->pos;
+
+    switch (ftype) {
+    case 't':
+        if (check_unpack(c, 1) < 0)
+            return NULL;
+        c->pos += 1;
+        return NativeInt_FromLong(p[0] & 1);
+    case 'b':
+        if (check_unpack(c, 1) < 0)
+            return NULL;
+        c->pos += 1;
+        return NativeInt_FromLong((signed char)p[0]);
+    case 's':
+        if (check_unpack(c, 2) < 0)
+            return NULL;
+        c->pos += 2;
+        return NativeInt_FromLong((short)unpack_u16(p));
+    case 'I':
+        if (check_unpack(c, 4) < 0)
+            return NULL;
+        c->pos += 4;
+        return NativeInt_FromLong((int)unpack_u32(p));
+    case 'l':
+        if (check_unpack(c, 8) < 0)
+            return NULL;
+        c->pos += 8;
+        return native_from_s64((PY_LONG_LONG)unpack_u64(p));
+    case 'f':
+        if (check_unpack(c, 4) < 0)
+            return NULL;
+        c->pos += 4;
+        f32.i = (PY_UINT32_T)unpack_u32(p);
+        return PyFloat_FromDouble(f32.f);
+    case 'd':
+        if (check_unpack(c, 8) < 0)
+            return NULL;
+        c->pos += 8;
+        f64.i = unpack_u64(p);
+        return PyFloat_FromDouble(f64.d);
+    case 'D':
+        return field_decimal(c);
+    case 'S':
+        return field_longstr(c, 0);
+    case 'A':
+        if (Py_EnterRecursiveCall(" in AMQP table"))
+            return NULL;
+        rval = field_array(c);
+        Py_LeaveRecursiveCall();
+        return rval;
+    case 'T':
+        if (check_unpack(c, 8) < 0)
+            return NULL;
+        c->pos += 8;
+        return timestamp_from_u64(unpack_u64(p));
+    case 'F':
+        if (Py_EnterRecursiveCall(" in AMQP table"))
+            return NULL;
+        rval = decode_table(c);
+        Py_LeaveRecursiveCall();
+        return rval;
+    case 'V':
+        Py_RETURN_NONE;
+    case 'x':
+        return field_longstr(c, 1);
+    default:
+        raise_unknown_field(ftype);
+        return NULL;
+    }
+}
+
+/* Reader.read_table */
+static PyObject *
+decode_table(cursor_t *c)
+{
+    unsigned long tlen;
+    Py_ssize_t end_pos;
+    PyObject *result, *name, *value;
+
+    if (read_long(c, &tlen) < 0 || check_underflow(c, (Py_ssize_t)tlen) < 0)
+        return NULL;
+    end_pos = c->pos + (Py_ssize_t)tlen;
+
+    result = PyDict_New();
+    if (result == NULL)
+        return NULL;
+    while (c->pos < end_pos) {
+        name = field_shortstr(c);
+        if (name == NULL)
+            goto error;
+        value = decode_field(c);
+        if (value == NULL) {
+            Py_DECREF(name);
+            goto error;
+        }
+        if (PyDict_SetItem(result, name, value) < 0) {
+            Py_DECREF(name);
+            Py_DECREF(value);
+            goto error;
+        }
+        Py_DECREF(name);
+        Py_DECREF(value);
+    }
+    return result;
+
+error:
+    Py_DECREF(result);
+    return NULL;
+}
+
+/* read_table(input, pos, end) -> (table, pos) */
+static PyObject *
+codec_read_table(PyObject *self, PyObject *args)
+{
+    PyObject *input, *table;
+    cursor_t c;
+
+    if (!PyArg_ParseTuple(args, "Onn:read_table", &input, &c.pos, &c.end))
+        return NULL;
+    if (cursor_open(&c, input, c.pos, c.end) < 0)
+        return NULL;
+    table = decode_table(&c);
+    cursor_close(&c);
+    if (table == NULL)
+        return NULL;
+    return Py_BuildValue("(Nn)", table, c.pos);
+}
+
+/*
+ * read_frame_header(input, pos, end) -> (frame_type, channel_id, size, footer)
+ *
+ * The fixed-size fields of the frame at pos, as read by Frame._read_frame,
+ * and its footer byte.
+ */
+static PyObject *
+codec_read_frame_header(PyObject *self, PyObject *args)
+{
+    PyObject *input;
+    cursor_t c;
+    unsigned long size;
+    const unsigned char *p;
+    PyObject *rval = NULL;
+
+    if (!PyArg_ParseTuple(args, "Onn:read_frame_header", &input, &c.pos,
+                          &c.end))
+        return NULL;
+    if (cursor_open(&c, input, c.pos, c.end) < 0)
+        return NULL;
+
+    if (check_underflow(&c, 7) < 0 || check_unpack(&c, 7) < 0)
+        goto done;
+    p = c.buf + c.pos;
+    size = unpack_u32(p + 3);
+    c.pos += 7 + (Py_ssize_t)size;
+    if (c.pos >= c.end) {
+        PyErr_SetNone(BufferUnderflow);
+        goto done;
+    }
+    if (check_unpack(&c, 1) < 0)
+        goto done;
+    rval = Py_BuildValue("(NNNN)", NativeInt_FromLong(p[0]),
+                         NativeInt_FromLong((long)unpack_u16(p + 1)),
+                         native_from_u64(size),
+                         NativeInt_FromLong(c.buf[c.pos]));
+
+done:
+    cursor_close(&c);
+    return rval;
+}
+
+/*
+ * scan_frames(input, pos, end, frame_types) -> (entries, pos)
+ *
+ * The (frame_type, channel_id, offset, size) of each complete frame from pos
+ * on, packed as native longs for an array('l'), and the position after the
+ * last one. Stops at the first frame that is incomplete or has a bad footer
+ * or a frame type that isn't in frame_types, leaving the errors to
+ * Frame.scan_frames.
+ */
+static PyObject *
+codec_scan_frames(PyObject *self, PyObject *args)
+{
+    PyObject *input, *frame_types, *key, *frame_class, *rval = NULL;
+    cursor_t c;
+    const unsigned char *p;
+    Py_ssize_t footer_pos, count = 0, alloc = 64;
+    unsigned long size;
+    long *entries, *grown;
+
+    if (!PyArg_ParseTuple(args, "OnnO!:scan_frames", &input, &c.pos, &c.end,
+                          &PyDict_Type, &frame_types))
+        return NULL;
+    if (cursor_open(&c, input, c.pos, c.end) < 0)
+        return NULL;
+    entries = PyMem_New(long, alloc);
+    if (entries == NULL) {
+        PyErr_NoMemory();
+        goto done;
+    }
+
+    while (c.pos >= 0 && c.pos + 8 <= c.end && c.pos + 8 <= c.len) {
+        p = c.buf + c.pos;
+        size = unpack_u32(p + 3);
+        footer_pos = c.pos + 7 + (Py_ssize_t)size;
+        if (footer_pos >= c.end || footer_pos >= c.len ||
+                c.buf[footer_pos] != 0xce)
+            break;
+
+        key = NativeInt_FromLong(p[0]);
+        if (key == NULL)
+            goto done;
+        frame_class = PyDict_GetItem(frame_types, key);
+        Py_DECREF(key);
+        if (frame_class == NULL)
+            break;
+
+        if (count + 4 > alloc) {
+            alloc *= 2;
+            grown = PyMem_Resize(entries, long, alloc);
+            if (grown == NULL) {
+                PyErr_NoMemory();
+                goto done;
+            }
+            entries = grown;
+        }
+        entries[count++] = p[0];
+        entries[count++] = (long)unpack_u16(p + 1);
+        entries[count++] = (long)(c.pos + 7);
+        entries[count++] = (long)size;
+        c.pos = footer_pos + 1;
+    }
+
+    rval = Py_BuildValue("(Nn)", Bytes_FromStringAndSize(
+        (const char *)entries, count * (Py_ssize_t)sizeof(long)), c.pos);
+
+done:
+    PyMem_Free(entries);
+    cursor_close(&c);
+    return rval;
+}
+
+/*
+ * read_properties(input, pos, end, spec) -> (properties, pos)
+ *
+ * The flags and default properties of a header frame, as read by
+ * HeaderFrame.parse with DEFAULT_PROPERTIES. spec is a sequence of
+ * (key, type, mask, wfunc) for each property.
+ */
+static PyObject *
+codec_read_properties(PyObject *self, PyObject *args)
+{
+    PyObject *input, *spec, *properties = NULL, *item, *value;
+    cursor_t c;
+    unsigned long flag_bits, mask;
+    Py_ssize_t i, n, slen, size;
+    const char *start;
+    long ptype;
+
+    if (!PyArg_ParseTuple(args, "OnnO:read_properties", &input, &c.pos,
+                          &c.end, &spec))
+        return NULL;
+    spec = PySequence_Fast(spec, "spec must be a sequence");
+    if (spec == NULL)
+        return NULL;
+    if (cursor_open(&c, input, c.pos, c.end) < 0) {
+        Py_DECREF(spec);
+        return NULL;
+    }
+
+    if (check_underflow(&c, 2) < 0 || check_unpack(&c, 2) < 0)
+        goto error;
+    flag_bits = unpack_u16(c.buf + c.pos);
+    c.pos += 2;
+
+    properties = PyDict_New();
+    if (properties == NULL)
+        goto error;
+    n = PySequence_Fast_GET_SIZE(spec);
+    for (i = 0; i < n; i++) {
+        item = PySequence_Fast_GET_ITEM(spec, i);
+        ptype = PyLong_AsLong(PyTuple_GET_ITEM(item, 1));
+        mask = PyLong_AsUnsignedLongMask(PyTuple_GET_ITEM(item, 2));
+        if (PyErr_Occurred())
+            goto error;
+        if (!(flag_bits & mask))
+            continue;
+
+        switch (ptype) {
+        case PROP_SHORTSTR:
+            if (c.pos >= c.end) {
+                PyErr_SetNone(BufferUnderflow);
+                goto error;
+            }
+            if (check_unpack(&c, 1) < 0)
+                goto error;
+            slen = c.buf[c.pos++];
+            if (check_underflow(&c, slen) < 0)
+                goto error;
+            /* end may lie past the buffer, which slicing tolerates */
+            clamp_slice(&c, slen, &start, &size);
+            value = native_text(start, size);
+            c.pos += slen;
+            break;
+        case PROP_OCTET:
+            if (c.pos >= c.end) {
+                PyErr_SetNone(BufferUnderflow);
+                goto error;
+            }
+            if (check_unpack(&c, 1) < 0)
+                goto error;
+            value = NativeInt_FromLong(c.buf[c.pos++]);
+            break;
+        case PROP_TABLE:
+            value = decode_table(&c);
+            break;
+        case PROP_TIMESTAMP:
+            if (check_underflow(&c, 8) < 0 || check_unpack(&c, 8) < 0)
+                goto error;
+            value = timestamp_from_u64(unpack_u64(c.buf + c.pos));
+            c.pos += 8;
+            break;
+        default:
+            PyErr_Format(PyExc_ValueError, "unknown property type %ld",
+                         ptype);
+            goto error;
+        }
+        if (value == NULL)
+            goto error;
+        if (PyDict_SetItem(properties, PyTuple_GET_ITEM(item, 0), value) < 0) {
+            Py_DECREF(value);
+            goto error;
+        }
+        Py_DECREF(value);
+    }
+
+    cursor_close(&c);
+    Py_DECREF(spec);
+    return Py_BuildValue("(Nn)", properties, c.pos);
+
+error:
+    cursor_close(&c);
+    Py_DECREF(spec);
+    Py_XDECREF(properties);
+    return NULL;
+}
+
+/*
+ * Encoding
+ *
+ * Values are appended to a bytearray, which may be reallocated whenever
+ * Python code is called, so positions rather than pointers are kept.
+ */
+
+static int
+out_append(PyObject *out, const void *data, Py_ssize_t n)
+{
+    Py_ssize_t size = PyByteArray_GET_SIZE(out);
+
+    if (PyByteArray_Resize(out, size + n) < 0)
+        return -1;
+    memcpy(PyByteArray_AS_STRING(out) + size, data, n);
+    return 0;
+}
+
+static int
+out_byte(PyObject *out, unsigned char b)
+{
+    return out_append(out, &b, 1);
+}
+
+static void
+pack_u32(unsigned char *p, unsigned long v)
+{
+    p[0] = (unsigned char)(v >> 24);
+    p[1] = (unsigned char)(v >> 16);
+    p[2] = (unsigned char)(v >> 8);
+    p[3] = (unsigned char)v;
+}
+
+static void
+pack_u64(unsigned char *p, unsigned PY_LONG_LONG v)
+{
+    pack_u32(p, (unsigned long)(v >> 32));
+    pack_u32(p + 4, (unsigned long)(v & 0xffffffffUL));
+}
+
+/* A type tag followed by a 32-bit length and the data */
+static int
+out_longstr(PyObject *out, unsigned char tag, const char *data, Py_ssize_t n)
+{
+    unsigned char head[5];
+
+    head[0] = tag;
+    pack_u32(head + 1, (unsigned long)n);
+    if (out_append(out, head, 5) < 0)
+        return -1;
+    return out_append(out, data, n);
+}
+
+static int encode_table(PyObject *out, PyObject *d, PyObject *fallback);
+
+/*
+ * Writer._write_field for the types in Writer.field_type_map that can be
+ * encoded without calling back into Python; everything else, including
+ * subclasses and out of range integers, is passed to fallback (the
+ * Writer's _write_field) so that errors match too.
+ */
+static int
+encode_field(PyObject *out, PyObject *value, PyObject *fallback)
+{
+    unsigned char buf[9];
+    PyObject *rval;
+
+    if (value == Py_None)
+        return out_byte(out, 'V');
+
+    if (Py_TYPE(value) == &PyBool_Type) {
+        buf[0] = 't';
+        buf[1] = value == Py_True;
+        return out_append(out, buf, 2);
+    }
+
+#ifndef IS_PY3
+    if (PyInt_CheckExact(value) || PyLong_CheckExact(value)) {
+#else
+    if (PyLong_CheckExact(value)) {
+#endif
+        int overflow;
+        PY_LONG_LONG v = PyLong_AsLongLongAndOverflow(value, &overflow);
+        if (v == -1 && PyErr_Occurred())
+            return -1;
+        if (!overflow) {
+            if (-32768 <= v && v < 32768) {
+                buf[0] = 's';
+                buf[1] = (unsigned char)((v >> 8) & 0xff);
+                buf[2] = (unsigned char)(v & 0xff);
+                return out_append(out, buf, 3);
+            }
+            if (-2147483648LL <= v && v < 2147483648LL) {
+                buf[0] = 'I';
+                pack_u32(buf + 1, (unsigned long)(v & 0xffffffffUL));
+                return out_append(out, buf, 5);
+            }
+            buf[0] = 'l';
+            pack_u64(buf + 1, (unsigned PY_LONG_LONG)v);
+            return out_append(out, buf, 9);
+        }
+    }
+    else if (PyFloat_CheckExact(value)) {
+        union {
+            double d;
+            unsigned PY_LONG_LONG i;
+        } f64;
+        f64.d = PyFloat_AS_DOUBLE(value);
+        buf[0] = 'd';
+        pack_u64(buf + 1, f64.i);
+        return out_append(out, buf, 9);
+    }
+    else if (Bytes_CheckExact(value)) {
+        if ((size_t)Bytes_GET_SIZE(value) <= 0xffffffffUL)
+            return out_longstr(out, 'S', Bytes_AS_STRING(value),
+                               Bytes_GET_SIZE(value));
+    }
+    else if (PyUnicode_CheckExact(value)) {
+        int rc = -1;
+        PyObject *encoded = PyUnicode_AsUTF8String(value);
+        if (encoded == NULL)
+            return -1;
+        if ((size_t)Bytes_GET_SIZE(encoded) <= 0xffffffffUL) {
+            rc = out_longstr(out, 'S', Bytes_AS_STRING(encoded),
+                             Bytes_GET_SIZE(encoded));
+            Py_DECREF(encoded);
+            return rc;
+        }
+        Py_DECREF(encoded);
+    }
+    else if (PyDict_CheckExact(value)) {
+        int rc;
+        if (out_byte(out, 'F') < 0)
+            return -1;
+        if (Py_EnterRecursiveCall(" in AMQP table"))
+            return -1;
+        rc = encode_table(out, value, fallback);
+        Py_LeaveRecursiveCall();
+        return rc;
+    }
+    else if (PyByteArray_CheckExact(value)) {
+        if ((size_t)PyByteArray_GET_SIZE(value) <= 0xffffffffUL)
+            return out_longstr(out, 'x', PyByteArray_AS_STRING(value),
+                               PyByteArray_GET_SIZE(value));
+    }
+
+    rval = PyObject_CallFunctionObjArgs(fallback, value, NULL);
+    if (rval == NULL)
+        return -1;
+    Py_DECREF(rval);
+    return 0;
+}
+
+/* Writer._write_table_items for a dict */
+static int
+encode_table(PyObject *out, PyObject *d, PyObject *fallback)
+{
+    static const unsigned char zero[4] = {0, 0, 0, 0};
+    Py_ssize_t table_len_pos, i = 0, klen;
+    PyObject *key, *value, *encoded;
+    unsigned char klen_byte;
+
+    table_len_pos = PyByteArray_GET_SIZE(out);
+    if (out_append(out, zero, 4) < 0)
+        return -1;
+
+    while (PyDict_Next(d, &i, &key, &value)) {
+        if (PyUnicode_Check(key)) {
+            encoded = PyUnicode_AsUTF8String(key);
+            if (encoded == NULL)
+                return -1;
+        }
+        else if (PyBytes_Check(key)) {
+            Py_INCREF(key);
+            encoded = key;
+        }
+        else {
+            PyErr_Format(PyExc_TypeError,
+                         "table keys must be strings, not %.200s",
+                         Py_TYPE(key)->tp_name);
+            return -1;
+        }
+
+        klen = PyBytes_GET_SIZE(encoded);
+        if (klen > 255) {
+            PyObject *args = Py_BuildValue(
+                "(sn)", "Octet %d out of range 0..255", klen);
+            if (args != NULL) {
+                PyErr_SetObject(PyExc_ValueError, args);
+                Py_DECREF(args);
+            }
+            Py_DECREF(encoded);
+            return -1;
+        }
+        klen_byte = (unsigned char)klen;
+        if (out_byte(out, klen_byte) < 0 ||
+                out_append(out, PyBytes_AS_STRING(encoded), klen) < 0) {
+            Py_DECREF(encoded);
+            return -1;
+        }
+        Py_DECREF(encoded);
+
+        /* fallback may run arbitrary code, so hold on to the value */
+        Py_INCREF(value);
+        if (encode_field(out, value, fallback) < 0) {
+            Py_DECREF(value);
+            return -1;
+        }
+        Py_DECREF(value);
+    }
+
+    pack_u32((unsigned char *)PyByteArray_AS_STRING(out) + table_len_pos,
+             (unsigned long)(PyByteArray_GET_SIZE(out) - table_len_pos - 4));
+    return 0;
+}
+
+/* write_table(out, d, fallback): append the table d to the bytearray out */
+static PyObject *
+codec_write_table(PyObject *self, PyObject *args)
+{
+    PyObject *out, *d, *fallback;
+
+    if (!PyArg_ParseTuple(args, "O!O!O:write_table", &PyByteArray_Type, &out,
+                          &PyDict_Type, &d, &fallback))
+        return NULL;
+    if (encode_table(out, d, fallback) < 0)
+        return NULL;
+    Py_RETURN_NONE;
+}
+
+/*
+ * write_properties(out, properties, spec, writer, write_field) -> flag_bits
+ *
+ * Append the default header frame properties to the bytearray out, as
+ * HeaderFrame.write_frame does with DEFAULT_PROPERTIES. Values that aren't
+ * encoded here are written with the property's wfunc(writer, value).
+ */
+static PyObject *
+codec_write_properties(PyObject *self, PyObject *args)
+{
+    PyObject *out, *properties, *spec, *writer, *write_field, *item, *value;
+    PyObject *encoded, *rval;
+    Py_ssize_t i, n, size;
+    unsigned long flag_bits = 0, mask;
+    long ptype;
+    int rc;
+
+    if (!PyArg_ParseTuple(args, "O!O!OOO:write_properties", &PyByteArray_Type,
+                          &out, &PyDict_Type, &properties, &spec, &writer,
+                          &write_field))
+        return NULL;
+    spec = PySequence_Fast(spec, "spec must be a sequence");
+    if (spec == NULL)
+        return NULL;
+
+    n = PySequence_Fast_GET_SIZE(spec);
+    for (i = 0; i < n; i++) {
+        item = PySequence_Fast_GET_ITEM(spec, i);
+        value = PyDict_GetItem(properties, PyTuple_GET_ITEM(item, 0));
+        if (value == NULL || value == Py_None)
+            continue;
+        ptype = PyLong_AsLong(PyTuple_GET_ITEM(item, 1));
+        mask = PyLong_AsUnsignedLongMask(PyTuple_GET_ITEM(item, 2));
+        if (PyErr_Occurred())
+            goto error;
+        flag_bits |= mask;
+
+        Py_INCREF(value);
+        rc = 1;
+        if (ptype == PROP_SHORTSTR &&
+                (PyUnicode_CheckExact(value) || Bytes_CheckExact(value))) {
+            if (PyUnicode_CheckExact(value))
+                encoded = PyUnicode_AsUTF8String(value);
+            else {
+                Py_INCREF(value);
+                encoded = value;
+            }
+            if (encoded == NULL)
+                rc = -1;
+            else {
+                size = PyBytes_GET_SIZE(encoded);
+                if (size <= 255) {
+                    rc = out_byte(out, (unsigned char)size);
+                    if (rc == 0)
+                        rc = out_append(out, PyBytes_AS_STRING(encoded), size);
+                }
+                Py_DECREF(encoded);
+            }
+        }
+        else if (ptype == PROP_OCTET) {
+#ifndef IS_PY3
+            if (PyInt_CheckExact(value)) {
+                long v = PyInt_AS_LONG(value);
+#else
+            if (PyLong_CheckExact(value)) {
+                long v = PyLong_AsLong(value);
+                if (v == -1 && PyErr_Occurred())
+                    PyErr_Clear();
+                else
+#endif
+                if (0 <= v && v <= 255)
+                    rc = out_byte(out, (unsigned char)v);
+            }
+        }
+        else if (ptype == PROP_TABLE && PyDict_CheckExact(value)) {
+            rc = encode_table(out, value, write_field);
+        }
+
+        if (rc == 1) {
+            /* Not handled here, including the values that should raise */
+            rval = PyObject_CallFunctionObjArgs(PyTuple_GET_ITEM(item, 3),
+                                                writer, value, NULL);
+            rc = rval == NULL ? -1 : 0;
+            Py_XDECREF(rval);
+        }
+        Py_DECREF(value);
+        if (rc < 0)
+            goto error;
+    }
+
+    Py_DECREF(spec);
+    return NativeInt_FromLong((long)flag_bits);
+
+error:
+    Py_DECREF(spec);
+    return NULL;
+}
+
+static PyMethodDef codec_methods[] = {
+    {"read_table", codec_read_table, METH_VARARGS,
+     "read_table(input, pos, end) -> (table, pos)"},
+    {"read_frame_header", codec_read_frame_header, METH_VARARGS,
+     "read_frame_header(input, pos, end) -> "
+     "(frame_type, channel_id, size, footer)"},
+    {"scan_frames", codec_scan_frames, METH_VARARGS,
+     "scan_frames(input, pos, end, frame_types) -> (entries, pos)"},
+    {"read_properties", codec_read_properties, METH_VARARGS,
+     "read_properties(input, pos, end, spec) -> (properties, pos)"},
+    {"write_table", codec_write_table, METH_VARARGS,
+     "write_table(out, d, fallback)"},
+    {"write_properties", codec_write_properties, METH_VARARGS,
+     "write_properties(out, properties, spec, writer, write_field) -> "
+     "flag_bits"},
+    {NULL, NULL, 0, NULL}
+};
+
+static int
+codec_init(void)
+{
+    PyObject *module, *datetime_type;
+
+    module = PyImport_ImportModule("struct");
+    if (module == NULL)
+        return -1;
+    StructError = PyObject_GetAttrString(module, "error");
+    Py_DECREF(module);
+    if (StructError == NULL)
+        return -1;
+
+    module = PyImport_ImportModule("decimal");
+    if (module == NULL)
+        return -1;
+    DecimalType = PyObject_GetAttrString(module, "Decimal");
+    Py_DECREF(module);
+    if (DecimalType == NULL)
+        return -1;
+
+    module = PyImport_ImportModule("datetime");
+    if (module == NULL)
+        return -1;
+    datetime_type = PyObject_GetAttrString(module, "datetime");
+    Py_DECREF(module);
+    if (datetime_type == NULL)
+        return -1;
+    UtcFromTimestamp = PyObject_GetAttrString(datetime_type,
+                                              "utcfromtimestamp");
+    Py_DECREF(datetime_type);
+    if (UtcFromTimestamp == NULL)
+        return -1;
+    return 0;
+}
+
+#ifdef IS_PY3
+static struct PyModuleDef codec_module = {
+    PyModuleDef_HEAD_INIT, "_codec", NULL, -1, codec_methods
+};
+
+PyMODINIT_FUNC
+PyInit__codec(void)
+{
+    if (codec_init() < 0)
+        return NULL;
+    return PyModule_Create(&codec_module);
+}
+#else
+PyMODINIT_FUNC
+init_codec(void)
+{
+    if (codec_init() < 0)
+        return;
+    Py_InitModule("_codec", codec_methods);
+}
+#endif
@@ -0,0 +1,181 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+import time
+
+
+class AckBatcher(object):
+
+    '''
+    Coalesces basic.ack calls on a channel. Acks are held locally and, when
+    flushed, every contiguous run of acknowledged delivery tags starting at the
+    lowest unsettled tag is sent as a single basic.ack with multiple=True. Acks
+    that follow a gap (a delivery which has not been acked yet) are sent
+    individually, since a multiple ack would also cover the gap.
+
+    Delivery tags are assigned by the broker in sequence per channel, so the
+    batcher only needs to track the highest tag below which everything has
+    been settled. Deliveries that don't need an ack (no_ack=True) and
+    deliveries that were rejected or nacked are reported with `settle()` so
+    that they don't hold back the run.
+
+    Install with BasicClass.enable_ack_batching(); see there for when acks are
+    flushed.
+
+    When batching is enabled on a channel that has already received
+    deliveries, acks for those are sent immediately, as the batcher doesn't
+    know which of them are still outstanding. A coalesced ack also covers any
+    of them that haven't been acked yet, so batching should be enabled before
+    consuming, or once earlier deliveries have been acked.
+    '''
+
+    def __init__(self, basic, max_pending=100, max_delay=0.1,
+                 last_delivered=0):
+        '''
+        :param basic: the BasicClass through which acks are sent
+        :param max_pending: flush when this many acks are held
+        :param max_delay: flush on the next ack when the oldest held ack is
+          older than this many seconds
+        :param last_delivered: highest delivery tag received on the channel
+          before batching was enabled
+        '''
+        self._basic = basic
+        self._max_pending = max_pending
+        self._max_delay = max_delay
+
+        # Every delivery tag <= _base has been settled, and tags <= _start
+        # were delivered before batching was enabled
+        self._base = last_delivered
+        self._start = last_delivered
+
+        # Tags > _base acked by the user and not yet sent
+        self._pending = set()
+
+        # Tags > _base settled some other way, including acks already sent
+        # individually
+        self._settled = set()
+
+        # When the oldest of the pending acks was added
+        self._pending_since = None
+
+        # Highest delivery tag received on the channel
+        self._last_delivered = last_delivered
+
+    @property
+    def pending(self):
+        '''Number of acks held and not yet sent.'''
+        return len(self._pending)
+
+    def delivered(self, delivery_tag, no_ack):
+        '''
+        Record a delivery received on the channel. If it was delivered with
+        no_ack=True, it is settled immediately.
+        '''
+        if delivery_tag > self._last_delivered:
+            self._last_delivered = delivery_tag
+        if no_ack:
+            self.settle(delivery_tag)
+
+    def ack(self, delivery_tag, multiple=False):
+        '''
+        Hold an ack for delivery_tag, flushing if the count or time threshold
+        has been reached. If multiple=True, all deliveries up to and including
+        delivery_tag are acked immediately.
+        '''
+        if delivery_tag <= self._start:
+            self._basic._send_ack(delivery_tag, multiple)
+            return
+
+        if multiple:
+            self._basic._send_ack(delivery_tag, True)
+            self._settle_through(delivery_tag)
+            return
+
+        if delivery_tag <= self._base or delivery_tag in self._settled:
+            # Already covered, sending it again would be a protocol error
+            return
+
+        now = time.time()
+        if not self._pending:
+            self._pending_since = now
+        self._pending.add(delivery_tag)
+
+        if len(self._pending) >= self._max_pending or \
+                now - self._pending_since >= self._max_delay:
+            self.flush()
+
+    def settle(self, delivery_tag, multiple=False):
+        '''
+        Record that a delivery no longer needs an ack from the batcher, either
+        because it was delivered with no_ack=True or because it was rejected.
+        '''
+        if multiple:
+            self._settle_through(delivery_tag)
+        elif delivery_tag > self._base:
+            self._pending.discard(delivery_tag)
+            self._settled.add(delivery_tag)
+            self._advance()
+
+    def settle_all(self):
+        '''
+        Settle every delivery received so far, e.g. after basic.recover has
+        asked the broker to redeliver them under new tags. Held acks are
+        flushed first.
+        '''
+        self.flush()
+        self._settle_through(self._last_delivered)
+
+    def flush(self):
+        '''
+        Send all held acks.
+        '''
+        if not self._pending:
+            return
+
+        # Find the contiguous run above _base and the highest acked tag in it
+        tag = self._base + 1
+        last_acked = None
+        count = 0
+        while tag in self._pending or tag in self._settled:
+            if tag in self._pending:
+                self._pending.remove(tag)
+                last_acked = tag
+                count += 1
+            else:
+                self._settled.remove(tag)
+            tag += 1
+        self._base = tag - 1
+
+        if last_acked is not None:
+            self._basic._send_ack(last_acked, count > 1)
+
+        # Whatever is left is behind a gap
+        for tag in sorted(self._pending):
+            self._basic._send_ack(tag, False)
+            self._settled.add(tag)
+        self._pending = set()
+        self._pending_since = None
+
+    def _settle_through(self, delivery_tag):
+        '''
+        Mark every tag up to and including delivery_tag as settled. Held acks
+        in that range are dropped because the caller has covered them.
+        '''
+        if delivery_tag > self._base:
+            self._base = delivery_tag
+            self._pending = set(t for t in self._pending if t > delivery_tag)
+            self._settled = set(t for t in self._settled if t > delivery_tag)
+            if not self._pending:
+                self._pending_since = None
+        self._advance()
+
+    def _advance(self):
+        '''
+        Move _base past any settled tags that immediately follow it.
+        '''
+        while self._base + 1 in self._settled:
+            self._base += 1
+            self._settled.remove(self._base)
@@ -0,0 +1,141 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+
+Capture files of the bytes read and written by a connection.
+
+A capture starts with a header of the magic bytes 'HCAP', a version octet
+and the time the capture started as a double, followed by one record per
+read or write:
+
+    direction    1 byte, '<' for inbound or '>' for outbound
+    offset       unsigned 64 bits, microseconds since the capture started
+    length       unsigned 32 bits
+    data         length bytes
+
+Captures are written by `Connection(capture=path)`, see CaptureTransport,
+and replayed by `Connection(transport='replay', replay=path)`, see
+ReplayTransport.
+'''
+
+import struct
+import time
+
+MAGIC = b'HCAP'
+VERSION = 1
+
+INBOUND = b'<'
+OUTBOUND = b'>'
+
+HEADER = struct.Struct('>4sBd')
+RECORD = struct.Struct('>cQI')
+
+
+class CaptureError(ValueError):
+
+    '''The file is not a capture, or is truncated.'''
+
+
+class CaptureWriter(object):
+
+    '''
+    Writes records to a capture file. Closing the writer closes the file
+    if it was opened from a path.
+    '''
+
+    def __init__(self, capture, start=None):
+        if hasattr(capture, 'write'):
+            self._file = capture
+            self._owns_file = False
+        else:
+            self._file = open(capture, 'wb')
+            self._owns_file = True
+        self._start = time.time() if start is None else start
+        self._file.write(HEADER.pack(MAGIC, VERSION, self._start))
+
+    @property
+    def start(self):
+        return self._start
+
+    @property
+    def closed(self):
+        return self._file is None
+
+    def record(self, direction, data, timestamp=None):
+        '''
+        Record data read (INBOUND) or written (OUTBOUND) at timestamp, which
+        defaults to now.
+        '''
+        if self._file is None:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        offset = max(0, int((timestamp - self._start) * 1e6))
+        self._file.write(RECORD.pack(direction, offset, len(data)))
+        self._file.write(data)
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        '''
+        Flush the capture, and close its file if the writer opened it.
+        '''
+        if self._file is None:
+            return
+        try:
+            if self._owns_file:
+                self._file.close()
+            else:
+                self._file.flush()
+        finally:
+            self._file = None
+
+
+class CaptureReader(object):
+
+    '''
+    Iterates over the records of a capture as (direction, timestamp, data).
+    '''
+
+    def __init__(self, capture):
+        if hasattr(capture, 'read'):
+            self._file = capture
+            self._owns_file = False
+        else:
+            self._file = open(capture, 'rb')
+            self._owns_file = True
+
+        header = self._file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise CaptureError('not a capture: header is truncated')
+        magic, version, self._start = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise CaptureError('not a capture: bad magic %r' % (magic))
+        if version != VERSION:
+            raise CaptureError('unsupported capture version %d' % (version))
+
+    @property
+    def start(self):
+        '''The time at which the capture started.'''
+        return self._start
+
+    def __iter__(self):
+        read = self._file.read
+        while True:
+            prefix = read(RECORD.size)
+            if not prefix:
+                return
+            if len(prefix) < RECORD.size:
+                raise CaptureError('record is truncated')
+            direction, offset, length = RECORD.unpack(prefix)
+            data = read(length)
+            if len(data) < length:
+                raise CaptureError('record is truncated')
+            yield direction, self._start + offset / 1e6, data
+
+    def close(self):
+        if self._owns_file:
+            self._file.close()
@@ -4,6 +4,7 @@ Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
 https://github.com/agoragames/haigha/blob/master/LICENSE.txt
 '''
 
+import time
 from collections import deque
 
 from haigha2.classes.protocol_class import ProtocolClass
@@ -12,6 +13,8 @@ from haigha2.frames.content_frame import ContentFrame
 from haigha2.frames.header_frame import HeaderFrame
 from haigha2.frames.method_frame import MethodFrame
 from haigha2.exceptions import ChannelError, ChannelClosed, ConnectionClosed
+from haigha2.tracing import Span
+from haigha2.writer import Writer
 
 # Defined here so it's easier to test
 
@@ -97,8 +100,35 @@ class Channel(object):
         }
         self._active = True
 
+        # Installed by BasicClass.enable_ack_batching(); flushed after each
+        # pass over the frame buffer in `Channel.process_frames()`
+        self._ack_batcher = None
+
+        # Set by BasicClass while the content of a message is being received;
+        # header and content frames are passed to it as they arrive instead
+        # of being dispatched. See `BasicClass.dispatch()`.
+        self._content_receiver = None
+
         self._synchronous = kwargs.get('synchronous', False)
 
+        # ChannelMetrics if the connection records metrics, else None
+        self._metrics = kwargs.get('metrics')
+
+        # Start times of the synchronous callbacks in _pending_events, in
+        # the same order, when recording metrics
+        self._sync_started = deque()
+
+        # Tracer if the connection traces methods, else None
+        self._tracer = kwargs.get('tracer')
+
+        # When tracing, the last method frame sent, and the spans of the
+        # synchronous callbacks in _pending_events, in the same order
+        self._last_method = None
+        self._spans = deque()
+
+        # StageProfiler if the connection profiles, else None
+        self._profiler = kwargs.get('profiler')
+
     @property
     def connection(self):
         return self._connection
@@ -230,6 +260,27 @@ class Channel(object):
         '''
         self._frame_buffer.append(frame)
 
+    def buffer_scanned(self, scan, i):
+        '''
+        Buffer the i'th frame of a FrameScan. The frame is parsed when it's
+        taken off the buffer, so frames that are never processed, such as
+        those of a closed channel, are never parsed.
+        '''
+        self._frame_buffer.append((scan, i))
+
+    def peek_frame(self):
+        '''
+        Return the next frame on the input queue without popping it, or None
+        if the queue is empty.
+        '''
+        if len(self._frame_buffer):
+            frame = self._frame_buffer[0]
+            if type(frame) is tuple:
+                frame = self._frame_buffer[0] = \
+                    self.connection._parse_frame(*frame)
+            return frame
+        return None
+
     def process_frames(self):
         '''
         Process the input buffer.
@@ -238,6 +289,8 @@ class Channel(object):
             # It would make sense to call next_frame, but it's
             # technically faster to repeat the code here.
             frame = self._frame_buffer.popleft()
+            if type(frame) is tuple:
+                frame = self.connection._parse_frame(*frame)
 
             if self._emergency_close_pending:
                 # Implement stability rule from AMQP 0.9.1 section 1.5.2.5.
@@ -255,9 +308,13 @@ class Channel(object):
                                      "frame %.255s", frame)
                     continue
             try:
-                self.dispatch(frame)
+                if self._content_receiver is not None and \
+                        not isinstance(frame, MethodFrame):
+                    self._content_receiver(frame)
+                else:
+                    self.dispatch(frame)
             except ProtocolClass.FrameUnderflow:
-                return
+                break
             except (ConnectionClosed, ChannelClosed):
                 # Immediately raise if connection or channel is closed
                 raise
@@ -284,20 +341,27 @@ class Channel(object):
                         self.logger.exception("Channel close failed")
                         pass
 
+        # Coalesce acks made by consumers while processing the buffered frames
+        if self._ack_batcher is not None:
+            self._ack_batcher.flush()
+
     def next_frame(self):
         '''
         Pop the next frame off the input queue. If the queue is empty, will
         return None.
         '''
         if len(self._frame_buffer):
-            return self._frame_buffer.popleft()
+            frame = self._frame_buffer.popleft()
+            if type(frame) is tuple:
+                frame = self.connection._parse_frame(*frame)
+            return frame
         return None
 
     def requeue_frames(self, frames):
         '''
         Requeue a list of frames. Will append to the head of the frame buffer.
-        Frames should be in reverse order. Really only used to support
-        BasicClass content consumers.
+        Frames should be in reverse order. Kept for protocol classes that
+        raise FrameUnderflow; BasicClass assembles content incrementally.
         '''
         self._frame_buffer.extendleft(frames)
 
@@ -315,6 +379,9 @@ class Channel(object):
                     self.close_info['reply_text'])
             raise ChannelClosed()
 
+        if self._tracer is not None and isinstance(frame, MethodFrame):
+            self._last_method = frame
+
         # If there's any pending event at all, then it means that when the
         # current dispatch loop started, all possible frames were flushed
         # and the remaining item(s) starts with a sync callback. After careful
@@ -333,6 +400,11 @@ class Channel(object):
         '''
         Add an expectation of a callback to release a synchronous transaction.
         '''
+        if self._metrics is not None:
+            self._sync_started.append(time.time())
+        if self._tracer is not None:
+            self._start_sync_span()
+
         if self.connection.synchronous or self._synchronous:
             wrapper = SyncWrapper(cb)
             self._pending_events.append(wrapper)
@@ -357,11 +429,12 @@ class Channel(object):
         else:
             self._pending_events.append(cb)
 
-    def clear_synchronous_cb(self, cb):
+    def clear_synchronous_cb(self, cb, method_frame=None):
         '''
         If the callback is the current expected callback, will clear it off the
         stack.  Else will raise in exception if there's an expectation but this
-        doesn't satisfy it.
+        doesn't satisfy it. The method frame being dispatched, if supplied,
+        is recorded as the reply when tracing.
         '''
         if len(self._pending_events):
             ev = self._pending_events[0]
@@ -375,6 +448,11 @@ class Channel(object):
             # on any broker-initiated message.
             if ev == cb:
                 self._pending_events.popleft()
+                if self._metrics is not None and self._sync_started:
+                    self._metrics.sync_latency.observe(
+                        time.time() - self._sync_started.popleft())
+                if self._tracer is not None and self._spans:
+                    self._end_sync_span(self._spans.popleft(), method_frame)
                 self._flush_pending_events()
                 return ev
 
@@ -384,6 +462,33 @@ class Channel(object):
         # Return the passed-in callback by default
         return cb
 
+    def _start_sync_span(self):
+        '''
+        Start the span of a synchronous method, which is the last method
+        frame sent. The methods that the broker initiates, like
+        connection.start, have no method frame and are traced as method 0.0.
+        '''
+        frame, self._last_method = self._last_method, None
+        if frame is None:
+            span = Span('sync', self._channel_id, 0, 0)
+        else:
+            span = Span('sync', self._channel_id, frame.class_id,
+                        frame.method_id, _args_size(frame.args))
+        self._spans.append(span)
+        self._tracer.start(span)
+
+    def _end_sync_span(self, span, method_frame=None, error=None):
+        '''
+        End the span of a synchronous method with its reply or an error.
+        '''
+        span.end = time.time()
+        if method_frame is not None:
+            span.reply_class_id = method_frame.class_id
+            span.reply_method_id = method_frame.method_id
+            span.bytes_in = _args_size(method_frame.args)
+        span.error = error
+        self._tracer.end(span)
+
     def _flush_pending_events(self):
         '''
         Send pending frames that are in the event queue.
@@ -406,11 +511,22 @@ class Channel(object):
         if final_frame:
             self._connection.send_frame(final_frame)
 
+        if self._tracer is not None:
+            error = '%s: %s' % (self._close_info['reply_code'],
+                                self._close_info['reply_text'])
+            while self._spans:
+                self._end_sync_span(self._spans.popleft(), error=error)
+
         try:
             self._notify_close_listeners()
         finally:
             self._pending_events = deque()
+            self._sync_started = deque()
+            self._spans = deque()
+            self._last_method = None
             self._frame_buffer = deque()
+            self._ack_batcher = None
+            self._content_receiver = None
 
             # clear out other references for faster cleanup
             for protocol_class in self._class_map.values():
@@ -419,3 +535,15 @@ class Channel(object):
             self._connection = None
             self._class_map = None
             self._close_listeners = set()
+
+
+def _args_size(args):
+    '''
+    Size of the arguments of a method frame, which are a Writer when sending
+    and a Reader when received.
+    '''
+    if args is None:
+        return 0
+    if isinstance(args, Writer):
+        return len(args.buffer())
+    return len(args)
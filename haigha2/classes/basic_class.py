@@ -4,9 +4,14 @@ Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
 https://github.com/agoragames/haigha/blob/master/LICENSE.txt
 '''
 
+import time
 from collections import deque
 
-from haigha2.message import Message
+from haigha2.ack_batcher import AckBatcher
+from haigha2.profiling import REASSEMBLY, CALLBACK
+from haigha2.tracing import Span
+from haigha2.message import Message, StreamingMessage, BodyStream
+from haigha2.reader import ArgumentSchema
 from haigha2.writer import Writer
 from haigha2.frames.method_frame import MethodFrame
 from haigha2.frames.header_frame import HeaderFrame
@@ -20,6 +25,22 @@ class BasicClass(ProtocolClass):
     Implements the AMQP Basic class
     '''
 
+    # Methods that are followed by a content header and body
+    CONTENT_METHOD_IDS = frozenset([50, 60, 71])
+
+    # Arguments of basic.deliver (with the consumer tag) and basic.get_ok
+    # (with the message count), keyed by (with_consumer_tag,
+    # with_message_count); see _read_delivery_info
+    DELIVERY_ARGS = dict(
+        ((consumer_tag, message_count), ArgumentSchema(
+            *(('shortstr',) * consumer_tag +
+              ('longlong', 'bit', 'shortstr', 'shortstr') +
+              ('long',) * message_count)))
+        for consumer_tag in (False, True) for message_count in (False, True))
+
+    # Arguments of basic.return
+    RETURN_ARGS = ArgumentSchema('short', 'shortstr', 'shortstr', 'shortstr')
+
     def __init__(self, *args, **kwargs):
         super(BasicClass, self).__init__(*args, **kwargs)
         self.dispatch_map = {
@@ -36,11 +57,20 @@ class BasicClass(ProtocolClass):
         self._consumer_tag_id = 0
         self._pending_consumers = deque()
         self._consumer_cb = {}
+        self._no_ack_consumer_tags = set()
+        self._stream_consumer_tags = set()
         self._get_cb = deque()
         self._recover_cb = deque()
         self._cancel_cb = deque()
         self._return_listener = None
 
+        # Highest delivery tag received, see `enable_ack_batching()`
+        self._last_delivery_tag = 0
+
+        # Header frame and body of the content-bearing method being
+        # dispatched; see `_dispatch_content()`
+        self._content = None
+
     @property
     def name(self):
         return 'basic'
@@ -51,12 +81,56 @@ class BasicClass(ProtocolClass):
         '''
         self._pending_consumers = None
         self._consumer_cb = None
+        self._no_ack_consumer_tags = None
+        self._stream_consumer_tags = None
         self._get_cb = None
         self._recover_cb = None
         self._cancel_cb = None
         self._return_listener = None
+        self._content = None
         super(BasicClass, self)._cleanup()
 
+    def dispatch(self, method_frame):
+        '''
+        Dispatch a method. Methods that carry content are held on the channel
+        by a _ContentAssembler until their header and body have arrived, and
+        then dispatched as usual; deliveries to streaming consumers start
+        streaming straight away.
+        '''
+        method_id = method_frame.method_id
+        if method_id in self.CONTENT_METHOD_IDS:
+            if method_id == 60 and self._stream_consumer_tags and \
+                    self._peek_consumer_tag(method_frame) in \
+                    self._stream_consumer_tags:
+                self._stream_msg(method_frame)
+            else:
+                self.channel._content_receiver = _ContentAssembler(
+                    self, method_frame)
+        else:
+            super(BasicClass, self).dispatch(method_frame)
+
+    def _dispatch_content(self, method_frame, header_frame, body):
+        '''
+        Dispatch a content-bearing method once its content has arrived. The
+        content is available to the handler through `_reap_msg_frames()`.
+        '''
+        self._content = (header_frame, body)
+        try:
+            super(BasicClass, self).dispatch(method_frame)
+        finally:
+            self._content = None
+
+    def _peek_consumer_tag(self, method_frame):
+        '''
+        Read the consumer tag of a basic.deliver, leaving the arguments to be
+        read again in full.
+        '''
+        args = method_frame.args
+        pos = args.tell()
+        consumer_tag = args.read_shortstr()
+        args.seek(pos - args.tell(), 1)
+        return consumer_tag
+
     def set_return_listener(self, cb):
         '''
         Set a callback for basic.return listening. Will be called with a single
@@ -111,10 +185,14 @@ class BasicClass(ProtocolClass):
 
     def consume(self, queue, consumer, consumer_tag='', no_local=False,
                 no_ack=True, exclusive=False, nowait=True, ticket=None,
-                cb=None):
+                cb=None, stream=False):
         '''
         Start a queue consumer. If `cb` is supplied, will be called when
         broker confirms that consumer is registered.
+
+        If `stream` is True, the consumer is called with a StreamingMessage as
+        soon as the header of each delivery arrives, and the body is received
+        through its BodyStream rather than buffered in full.
         '''
         nowait = nowait and self.allow_nowait() and not cb
 
@@ -130,16 +208,24 @@ class BasicClass(ProtocolClass):
         self.send_frame(MethodFrame(self.channel_id, 60, 20, args))
 
         if not nowait:
-            self._pending_consumers.append((consumer, cb))
+            self._pending_consumers.append((consumer, cb, no_ack, stream))
             self.channel.add_synchronous_cb(self._recv_consume_ok)
         else:
             self._consumer_cb[consumer_tag] = consumer
+            if no_ack:
+                self._no_ack_consumer_tags.add(consumer_tag)
+            if stream:
+                self._stream_consumer_tags.add(consumer_tag)
 
     def _recv_consume_ok(self, method_frame):
         consumer_tag = method_frame.args.read_shortstr()
-        consumer, cb = self._pending_consumers.popleft()
+        consumer, cb, no_ack, stream = self._pending_consumers.popleft()
 
         self._consumer_cb[consumer_tag] = consumer
+        if no_ack:
+            self._no_ack_consumer_tags.add(consumer_tag)
+        if stream:
+            self._stream_consumer_tags.add(consumer_tag)
         if cb:
             cb()
 
@@ -197,6 +283,8 @@ class BasicClass(ProtocolClass):
 
         :param str consumer_tag:
         '''
+        self._no_ack_consumer_tags.discard(consumer_tag)
+        self._stream_consumer_tags.discard(consumer_tag)
         try:
             del self._consumer_cb[consumer_tag]
         except KeyError:
@@ -210,20 +298,56 @@ class BasicClass(ProtocolClass):
         '''
         publish a message.
         '''
+        return self._send_publish(
+            msg, HeaderFrame(self.channel_id, 60, 0, len(msg), msg.properties),
+            exchange, routing_key, mandatory, immediate, ticket)
+
+    def publish_raw(self, msg, exchange, routing_key, mandatory=False,
+                    immediate=False, ticket=None):
+        '''
+        Forward a received message. Its header frame is written as it was
+        received, and its body is re-framed for this connection, so that only
+        the method frame is encoded. Requires that the message was received
+        with HeaderFrame.KEEP_RAW_PAYLOAD set; a message without a raw header
+        is published as with publish().
+        '''
+        return self._send_publish(
+            msg, HeaderFrame(self.channel_id, 60, 0, len(msg), msg.properties,
+                             msg.raw_header),
+            exchange, routing_key, mandatory, immediate, ticket)
+
+    def _send_publish(self, msg, header_frame, exchange, routing_key,
+                      mandatory, immediate, ticket):
+        '''
+        Send the frames of a publish of msg with the given header frame, and
+        return what publish() and publish_raw() return.
+
+        NOTE: this protected method may be called by derived classes
+        '''
         args = Writer()
         args.write_short(ticket or self.default_ticket).\
             write_shortstr(exchange).\
             write_shortstr(routing_key).\
             write_bits(mandatory, immediate)
 
+        tracer = self.channel._tracer
+        if tracer is not None:
+            span = Span('publish', self.channel_id, 60, 40, len(msg))
+            tracer.start(span)
+
         self.send_frame(MethodFrame(self.channel_id, 60, 40, args))
-        self.send_frame(
-            HeaderFrame(self.channel_id, 60, 0, len(msg), msg.properties))
+        self.send_frame(header_frame)
 
         f_max = self.channel.connection.frame_max
         for f in ContentFrame.create_frames(self.channel_id, msg.body, f_max):
             self.send_frame(f)
 
+        if self.channel._metrics is not None:
+            self.channel._metrics.published.inc()
+        if tracer is not None:
+            span.end = time.time()
+            tracer.end(span)
+
     def return_msg(self, reply_code, reply_text, exchange, routing_key):
         '''
         Return a failed message.  Not named "return" because python interpreter
@@ -239,9 +363,8 @@ class BasicClass(ProtocolClass):
 
     def _recv_return(self, method_frame):
         '''
-        Handle basic.return method. If we have a complete message, will call the
-        user's return listener callabck (if any). If there are not enough
-        frames, will re-queue current frames and raise a FrameUnderflow
+        Handle basic.return method once its content has arrived. Will call the
+        user's return listener callabck (if any).
 
         NOTE: if the channel was in confirmation mode when the message was
         published, then this will still be followed by basic.ack later
@@ -258,10 +381,22 @@ class BasicClass(ProtocolClass):
     def _recv_deliver(self, method_frame):
         msg = self._read_msg(method_frame,
                              with_consumer_tag=True, with_message_count=False)
-
-        func = self._consumer_cb.get(msg.delivery_info['consumer_tag'], None)
-        if func:
-            func(msg)
+        consumer_tag = msg.delivery_info['consumer_tag']
+
+        if self.channel._ack_batcher is not None:
+            self.channel._ack_batcher.delivered(
+                msg.delivery_info['delivery_tag'],
+                consumer_tag in self._no_ack_consumer_tags)
+
+        func = self._consumer_cb.get(consumer_tag, None)
+        if self.channel._metrics is None and self.channel._tracer is None \
+                and self.channel._profiler is None:
+            if func:
+                func(msg)
+        else:
+            if self.channel._metrics is not None:
+                self.channel._metrics.delivered.inc()
+            _call_consumer(self.channel, func, msg)
 
     def get(self, queue, consumer=None, no_ack=True, ticket=None):
         '''
@@ -270,14 +405,57 @@ class BasicClass(ProtocolClass):
         there is no message in queue. If a synchronous transport, Message or
         None is returned.
         '''
+        self._send_get(queue, consumer, no_ack, ticket)
+        return self.channel.add_synchronous_cb(self._recv_get_response)
+
+    def get_many(self, queue, max_messages, max_bytes=None, consumer=None,
+                 no_ack=True, depth=8, ticket=None):
+        '''
+        Drain up to `max_messages` messages from a queue with basic.get,
+        keeping up to `depth` requests in flight so that the cost is one round
+        trip per window rather than one per message; the next request is sent
+        as each reply arrives. Stops requesting when the queue reports
+        get-empty, when `max_messages` have been requested, or when the bodies
+        received add up to `max_bytes` or more. Replies to requests already in
+        flight are still collected, so the result may exceed `max_bytes` by up
+        to `depth - 1` messages, which with no_ack=True have been removed from
+        the queue.
+
+        If a consumer is supplied, it will be called with the list of
+        messages, in queue order, when all replies are in. If a synchronous
+        channel, the list is returned.
+        '''
+        if max_messages < 1:
+            raise ValueError('max_messages must be positive, got %r' % (
+                max_messages,))
+
+        if depth < 1:
+            raise ValueError('depth must be positive, got %r' % (depth,))
+
+        request = _GetManyRequest(
+            self, queue, max_messages, max_bytes, depth, no_ack, ticket,
+            consumer)
+        request.start()
+
+        if self.channel.synchronous:
+            # Wait for the replies one at a time; the requests are already
+            # in flight, and each reply sends the next one
+            while not request.done:
+                self.channel.add_synchronous_cb(self._recv_get_response)
+            return request.messages
+
+    def _send_get(self, queue, consumer, no_ack, ticket):
+        '''
+        Send basic.get without waiting for the reply, which will be passed to
+        consumer.
+        '''
         args = Writer()
         args.write_short(ticket or self.default_ticket).\
             write_shortstr(queue).\
             write_bit(no_ack)
 
-        self._get_cb.append(consumer)
+        self._get_cb.append((consumer, no_ack))
         self.send_frame(MethodFrame(self.channel_id, 60, 70, args))
-        return self.channel.add_synchronous_cb(self._recv_get_response)
 
     def _recv_get_response(self, method_frame):
         '''
@@ -294,7 +472,15 @@ class BasicClass(ProtocolClass):
     def _recv_get_ok(self, method_frame):
         msg = self._read_msg(method_frame,
                              with_consumer_tag=False, with_message_count=True)
-        cb = self._get_cb.popleft()
+        cb, no_ack = self._get_cb.popleft()
+
+        if self.channel._ack_batcher is not None:
+            self.channel._ack_batcher.delivered(
+                msg.delivery_info['delivery_tag'], no_ack)
+
+        if self.channel._metrics is not None:
+            self.channel._metrics.delivered.inc()
+
         if cb:
             cb(msg)
         return msg
@@ -302,14 +488,69 @@ class BasicClass(ProtocolClass):
     def _recv_get_empty(self, _method_frame):
         # On empty, call back with None as the argument so that user code knows
         # it's empty and can take next action
-        cb = self._get_cb.popleft()
+        cb, _no_ack = self._get_cb.popleft()
         if cb:
             cb(None)
 
+    def enable_ack_batching(self, max_pending=100, max_delay=0.1):
+        '''
+        Coalesce acks on this channel; see `AckBatcher`. Once enabled, `ack()`
+        holds acks locally and they are sent, as few basic.ack frames as the
+        order of acknowledgement allows, when any of the following happens:
+
+        * `max_pending` acks are held
+        * an ack is made more than `max_delay` seconds after the oldest held
+          ack
+        * the channel has dispatched all of the frames it has read, so acks
+          made from consumer callbacks go out once per read
+        * a reject, nack, recover, tx.commit, tx.rollback or channel close is
+          sent, so that acks keep their order relative to those
+        * `flush_acks()` is called
+
+        Acks made outside of consumer callbacks, e.g. from a worker pool, are
+        only sent on the above so the application may need to call
+        `flush_acks()` when it goes idle.
+        '''
+        if self.channel._ack_batcher is None:
+            self.channel._ack_batcher = AckBatcher(
+                self, max_pending=max_pending, max_delay=max_delay,
+                last_delivered=self._last_delivery_tag)
+
+    def disable_ack_batching(self):
+        '''
+        Flush any held acks and send acks immediately from now on.
+        '''
+        batcher = self.channel._ack_batcher
+        if batcher is not None:
+            self.channel._ack_batcher = None
+            batcher.flush()
+
+    def flush_acks(self):
+        '''
+        Send any acks held by ack batching.
+        '''
+        if self.channel._ack_batcher is not None:
+            self.channel._ack_batcher.flush()
+
     def ack(self, delivery_tag, multiple=False):
         '''
         Acknowledge delivery of a message.  If multiple=True, acknowledge up-to
-        and including delivery_tag.
+        and including delivery_tag. If ack batching is enabled, the ack may be
+        held and sent later; see `enable_ack_batching()`.
+        '''
+        if self.channel._metrics is not None:
+            self.channel._metrics.acked.inc()
+
+        if self.channel._ack_batcher is not None:
+            self.channel._ack_batcher.ack(delivery_tag, multiple)
+        else:
+            self._send_ack(delivery_tag, multiple)
+
+    def _send_ack(self, delivery_tag, multiple):
+        '''
+        Send basic.ack.
+
+        NOTE: this protected method is called by AckBatcher
         '''
         args = Writer()
         args.write_longlong(delivery_tag).\
@@ -321,6 +562,11 @@ class BasicClass(ProtocolClass):
         '''
         Reject a message.
         '''
+        batcher = self.channel._ack_batcher
+        if batcher is not None:
+            batcher.flush()
+            batcher.settle(delivery_tag)
+
         args = Writer()
         args.write_longlong(delivery_tag).\
             write_bit(requeue)
@@ -334,6 +580,9 @@ class BasicClass(ProtocolClass):
         This method is deprecated in favour of the synchronous
         recover/recover-ok
         '''
+        if self.channel._ack_batcher is not None:
+            self.channel._ack_batcher.settle_all()
+
         args = Writer()
         args.write_bit(requeue)
 
@@ -343,6 +592,9 @@ class BasicClass(ProtocolClass):
         '''
         Ask server to redeliver all unacknowledged messages.
         '''
+        if self.channel._ack_batcher is not None:
+            self.channel._ack_batcher.settle_all()
+
         args = Writer()
         args.write_bit(requeue)
 
@@ -360,21 +612,64 @@ class BasicClass(ProtocolClass):
     def _read_msg(self, method_frame, with_consumer_tag=False,
                   with_message_count=False):
         '''
-        Support method to read a Message from the current frame buffer.
-        Will return a Message, or re-queue current frames and raise a
-        FrameUnderflow. Takes an optional argument on whether to read the
-        consumer tag so it can be used for both deliver and get-ok.
+        Support method to read a Message from a method frame and its assembled
+        content. Takes an optional argument on whether to read the consumer
+        tag so it can be used for both deliver and get-ok.
         '''
-        header_frame, body = self._reap_msg_frames(method_frame)
+        profiler = self.channel._profiler
+        if profiler is not None:
+            profiler.enter(REASSEMBLY)
+        try:
+            header_frame, body = self._reap_msg_frames(method_frame)
+            delivery_info = self._read_delivery_info(
+                method_frame, with_consumer_tag, with_message_count)
+
+            return Message(body=body, delivery_info=delivery_info,
+                           raw_header=header_frame.raw_payload,
+                           **header_frame.properties)
+        finally:
+            if profiler is not None:
+                profiler.exit()
+
+    def _stream_msg(self, method_frame):
+        '''
+        Support method to start streaming a basic.deliver to its consumer.
+        The header and content frames that follow are passed to a
+        _StreamReceiver installed on the channel as they arrive.
+        '''
+        delivery_info = self._read_delivery_info(
+            method_frame, with_consumer_tag=True, with_message_count=False)
+        consumer_tag = delivery_info['consumer_tag']
 
+        if self.channel._ack_batcher is not None:
+            self.channel._ack_batcher.delivered(
+                delivery_info['delivery_tag'],
+                consumer_tag in self._no_ack_consumer_tags)
+
+        if self.channel._metrics is not None:
+            self.channel._metrics.delivered.inc()
+
+        self.channel._content_receiver = _StreamReceiver(
+            self.channel, self._consumer_cb.get(consumer_tag, None),
+            delivery_info)
+
+    def _read_delivery_info(self, method_frame, with_consumer_tag=False,
+                            with_message_count=False):
+        '''
+        Support method to read the delivery_info of a basic.deliver or
+        basic.get_ok from the arguments of its method frame.
+        '''
+        values = method_frame.args.read_args(
+            self.DELIVERY_ARGS[bool(with_consumer_tag),
+                               bool(with_message_count)])
         if with_consumer_tag:
-            consumer_tag = method_frame.args.read_shortstr()
-        delivery_tag = method_frame.args.read_longlong()
-        redelivered = method_frame.args.read_bit()
-        exchange = method_frame.args.read_shortstr()
-        routing_key = method_frame.args.read_shortstr()
+            consumer_tag = values[0]
+            values = values[1:]
+        delivery_tag, redelivered, exchange, routing_key = values[:4]
         if with_message_count:
-            message_count = method_frame.args.read_long()
+            message_count = values[4]
+        if delivery_tag > self._last_delivery_tag:
+            self._last_delivery_tag = delivery_tag
 
         delivery_info = {
             'channel': self.channel,
@@ -387,15 +682,13 @@ class BasicClass(ProtocolClass):
             delivery_info['consumer_tag'] = consumer_tag
         if with_message_count:
             delivery_info['message_count'] = message_count
-
-        return Message(body=body, delivery_info=delivery_info,
-                       **header_frame.properties)
+        return delivery_info
 
     def _read_returned_msg(self, method_frame):
         '''
-        Support method to read a returned (basic.return) Message from the
-        current frame buffer. Will return a Message with return_info, or
-        re-queue current frames and raise a FrameUnderflow.
+        Support method to read a returned (basic.return) Message from a method
+        frame and its assembled content. Will return a Message with
+        return_info.
 
         :returns: Message with the return_info attribute set, where return_info
           is a dict with the following properties:
@@ -407,46 +700,207 @@ class BasicClass(ProtocolClass):
         '''
         header_frame, body = self._reap_msg_frames(method_frame)
 
+        reply_code, reply_text, exchange, routing_key = \
+            method_frame.args.read_args(self.RETURN_ARGS)
         return_info = {
             'channel': self.channel,
-            'reply_code': method_frame.args.read_short(),
-            'reply_text': method_frame.args.read_shortstr(),
-            'exchange': method_frame.args.read_shortstr(),
-            'routing_key': method_frame.args.read_shortstr()
+            'reply_code': reply_code,
+            'reply_text': reply_text,
+            'exchange': exchange,
+            'routing_key': routing_key
         }
 
         return Message(body=body, return_info=return_info,
+                       raw_header=header_frame.raw_payload,
                        **header_frame.properties)
 
     def _reap_msg_frames(self, method_frame):
         '''
-        Support method to reap header frame and body from current frame buffer.
-        Used in processing of basic.return, basic.deliver, and basic.get_ok.
-        Will return a pair (<header frame>, <body>), or re-queue current frames
-        and raise a FrameUnderflow.
+        Support method to fetch the header frame and body assembled for the
+        method being dispatched. Used in processing of basic.return,
+        basic.deliver, and basic.get_ok.
 
         :returns: pair (<header frame>, <body>)
         :rtype: tuple of (HeaderFrame, bytearray)
         '''
-        # No need to assert that is instance of Header or Content frames
-        # because failure to access as such will result in exception that
-        # channel will pick up and handle accordingly.
-        header_frame = self.channel.next_frame()
-        if header_frame:
-            size = header_frame.size
-            body = bytearray()
-            rbuf_frames = deque([header_frame, method_frame])
-
-            while len(body) < size:
-                content_frame = self.channel.next_frame()
-                if content_frame:
-                    rbuf_frames.appendleft(content_frame)
-                    body.extend(content_frame.payload.buffer())
+        return self._content
+
+
+def _call_consumer(channel, consumer, msg, size=None):
+    '''
+    Call the consumer, if any, of a delivered message, recording the time it
+    takes, tracing it as basic.deliver and profiling it when the channel
+    records metrics, traces or profiles. The size of the message defaults to
+    the length of its body.
+    '''
+    metrics = channel._metrics
+    tracer = channel._tracer
+    profiler = channel._profiler
+    if tracer is not None:
+        if size is None:
+            size = len(msg.body)
+        span = Span('deliver', channel.channel_id, 60, 60, bytes_in=size)
+        tracer.start(span)
+
+    if profiler is not None:
+        profiler.enter(CALLBACK)
+    start = time.time()
+    try:
+        if consumer:
+            consumer(msg)
+    finally:
+        end = time.time()
+        if profiler is not None:
+            profiler.exit()
+        if metrics is not None and consumer:
+            metrics.consumer_time.observe(end - start)
+        if tracer is not None:
+            span.end = end
+            tracer.end(span)
+
+
+class _ContentAssembler(object):
+
+    '''
+    Accumulates the header and content frames that follow a content-bearing
+    method on behalf of the channel, so that each frame is handled once as it
+    arrives, and dispatches the method when the body is complete.
+    '''
+
+    def __init__(self, basic, method_frame):
+        self._basic = basic
+        self._method_frame = method_frame
+        self._header_frame = None
+        self._body = None
+
+        # When the method arrived, if recording metrics
+        self._metrics = basic.channel._metrics
+        if self._metrics is not None:
+            self._started = time.time()
+        self._profiler = basic.channel._profiler
+
+    def __call__(self, frame):
+        profiler = self._profiler
+        if profiler is not None:
+            profiler.enter(REASSEMBLY)
+        try:
+            # No need to assert that frames are Header or Content frames
+            # because failure to access them as such will result in an
+            # exception that the channel will pick up and handle accordingly.
+            if self._header_frame is None:
+                self._header_frame = frame
+                self._body = bytearray()
+            else:
+                self._body.extend(frame.payload.buffer())
+        finally:
+            if profiler is not None:
+                profiler.exit()
+
+        if len(self._body) >= self._header_frame.size:
+            self._basic.channel._content_receiver = None
+            if self._metrics is not None:
+                self._metrics.reassembly_time.observe(
+                    time.time() - self._started)
+            self._basic._dispatch_content(
+                self._method_frame, self._header_frame, self._body)
+
+
+class _StreamReceiver(object):
+
+    '''
+    Receives the header and content frames of a streamed delivery on behalf
+    of the channel, passing the message to the consumer when the header
+    arrives and each content frame to its BodyStream.
+    '''
+
+    def __init__(self, channel, consumer, delivery_info):
+        self._channel = channel
+        self._consumer = consumer
+        self._delivery_info = delivery_info
+        self._body = None
+
+    def __call__(self, frame):
+        if self._body is None:
+            self._body = BodyStream(self._channel, frame.size)
+            if self._body.complete:
+                self._channel._content_receiver = None
+            if self._consumer:
+                msg = StreamingMessage(
+                    self._body, delivery_info=self._delivery_info,
+                    **frame.properties)
+                if self._channel._metrics is None and \
+                        self._channel._tracer is None and \
+                        self._channel._profiler is None:
+                    self._consumer(msg)
                 else:
-                    self.channel.requeue_frames(rbuf_frames)
-                    raise self.FrameUnderflow()
+                    _call_consumer(
+                        self._channel, self._consumer, msg, frame.size)
         else:
-            self.channel.requeue_frames([method_frame])
-            raise self.FrameUnderflow()
+            chunk = bytes(frame.payload.buffer())
+            # Uninstall before feeding the last chunk, in case the consumer
+            # reads further frames from within its listener.
+            if self._body.received + len(chunk) >= self._body.size:
+                self._channel._content_receiver = None
+            self._body._feed(chunk)
 
-        return (header_frame, body)
+
+class _GetManyRequest(object):
+
+    '''
+    State of a BasicClass.get_many call. Keeps a window of basic.get requests
+    in flight and collects their replies, which arrive in request order.
+    '''
+
+    def __init__(self, basic, queue, max_messages, max_bytes, depth, no_ack,
+                 ticket, consumer):
+        self._basic = basic
+        self._queue = queue
+        self._max_messages = max_messages
+        self._max_bytes = max_bytes
+        self._depth = depth
+        self._no_ack = no_ack
+        self._ticket = ticket
+        self._consumer = consumer
+
+        self._requested = 0
+        self._outstanding = 0
+        self._bytes = 0
+        self._stopped = False
+        self.messages = []
+        self.done = False
+
+    def start(self):
+        '''
+        Send the first window of requests.
+        '''
+        while self._outstanding < self._depth and \
+                self._requested < self._max_messages:
+            self._request()
+
+    def _request(self):
+        self._requested += 1
+        self._outstanding += 1
+        self._basic._send_get(
+            self._queue, self._on_reply, self._no_ack, self._ticket)
+
+    def _on_reply(self, msg):
+        '''
+        Collect a get-ok (msg) or get-empty (None) reply and top up the
+        window unless a stop condition has been met.
+        '''
+        self._outstanding -= 1
+        if msg is None:
+            self._stopped = True
+        else:
+            self.messages.append(msg)
+            self._bytes += len(msg)
+            if self._max_bytes is not None and \
+                    self._bytes >= self._max_bytes:
+                self._stopped = True
+
+        if not self._stopped and self._requested < self._max_messages:
+            self._request()
+        elif not self._outstanding:
+            self.done = True
+            if self._consumer:
+                self._consumer(self.messages)
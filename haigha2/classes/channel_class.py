@@ -6,6 +6,7 @@ https://github.com/agoragames/haigha/blob/master/LICENSE.txt
 
 from haigha2.classes.protocol_class import ProtocolClass
 from haigha2.frames.method_frame import MethodFrame
+from haigha2.reader import ArgumentSchema
 from haigha2.writer import Writer
 
 
@@ -17,6 +18,9 @@ class ChannelClass(ProtocolClass):
 
     CLASS_ID = 20
 
+    # Arguments of channel.close
+    CLOSE_ARGS = ArgumentSchema('short', 'shortstr', 'short', 'short')
+
     # Channel method ids for error-recovery code in Channel
     CLOSE_METHOD_ID = 40
     CLOSE_OK_METHOD_ID = 41
@@ -114,6 +118,10 @@ class ChannelClass(ProtocolClass):
         if not getattr(self, 'channel', None) or self.channel._closed:
             return
 
+        # Send any batched acks while the channel can still carry them
+        if self.channel._ack_batcher is not None:
+            self.channel._ack_batcher.flush()
+
         self.channel._close_info = {
             'reply_code': reply_code,
             'reply_text': reply_text,
@@ -144,11 +152,13 @@ class ChannelClass(ProtocolClass):
         '''
         Receive a close command from the broker.
         '''
+        reply_code, reply_text, class_id, method_id = \
+            method_frame.args.read_args(self.CLOSE_ARGS)
         self.channel._close_info = {
-            'reply_code': method_frame.args.read_short(),
-            'reply_text': method_frame.args.read_shortstr(),
-            'class_id': method_frame.args.read_short(),
-            'method_id': method_frame.args.read_short()
+            'reply_code': reply_code,
+            'reply_text': reply_text,
+            'class_id': class_id,
+            'method_id': method_id
         }
 
         self.channel._closed = True
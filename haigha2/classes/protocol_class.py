@@ -76,7 +76,7 @@ class ProtocolClass(object):
         '''
         method = self.dispatch_map.get(method_frame.method_id)
         if method:
-            callback = self.channel.clear_synchronous_cb(method)
+            callback = self.channel.clear_synchronous_cb(method, method_frame)
             callback(method_frame)
         else:
             raise self.InvalidMethod(
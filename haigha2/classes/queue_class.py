@@ -4,6 +4,7 @@ Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
 https://github.com/agoragames/haigha/blob/master/LICENSE.txt
 '''
 
+from haigha2.reader import ArgumentSchema
 from haigha2.writer import Writer
 from haigha2.frames.method_frame import MethodFrame
 from haigha2.classes.protocol_class import ProtocolClass
@@ -17,6 +18,9 @@ class QueueClass(ProtocolClass):
     Implements the AMQP Queue class
     '''
 
+    # Arguments of queue.declare_ok
+    DECLARE_OK_ARGS = ArgumentSchema('shortstr', 'long', 'long')
+
     def __init__(self, *args, **kwargs):
         super(QueueClass, self).__init__(*args, **kwargs)
         self.dispatch_map = {
@@ -74,9 +78,8 @@ class QueueClass(ProtocolClass):
             return self.channel.add_synchronous_cb(self._recv_declare_ok)
 
     def _recv_declare_ok(self, method_frame):
-        queue = method_frame.args.read_shortstr()
-        message_count = method_frame.args.read_long()
-        consumer_count = method_frame.args.read_long()
+        queue, message_count, consumer_count = \
+            method_frame.args.read_args(self.DECLARE_OK_ARGS)
 
         cb = self._declare_cb.popleft()
         if cb:
@@ -75,6 +75,10 @@ class TransactionClass(ProtocolClass):
         if not self.enabled:
             raise self.TransactionsNotEnabled()
 
+        # Batched acks belong to this transaction
+        if self.channel._ack_batcher is not None:
+            self.channel._ack_batcher.flush()
+
         self.send_frame(MethodFrame(self.channel_id, 90, 20))
         self._commit_cb.append(cb)
         self.channel.add_synchronous_cb(self._recv_commit_ok)
@@ -94,6 +98,10 @@ class TransactionClass(ProtocolClass):
         if not self.enabled:
             raise self.TransactionsNotEnabled()
 
+        # Batched acks belong to this transaction
+        if self.channel._ack_batcher is not None:
+            self.channel._ack_batcher.flush()
+
         self.send_frame(MethodFrame(self.channel_id, 90, 30))
         self._rollback_cb.append(cb)
         self.channel.add_synchronous_cb(self._recv_rollback_ok)
@@ -0,0 +1,94 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+
+Python 2 and 3 compatibility for the codec (Reader, Writer and frames).
+
+On Python 2, input is read through `buffer` objects, which slice to str; on
+Python 3 through `memoryview`, which slices without copying and is
+converted to bytes only where a value is returned to the caller.
+'''
+
+import sys
+
+PY2 = sys.version_info[0] == 2
+
+if PY2:
+    from collections import Mapping
+
+    text_type = unicode
+    binary_type = str
+    integer_types = (int, long)
+    range = xrange
+
+    def iteritems(d):
+        return d.iteritems()
+
+    def get_unbound_function(method):
+        return method.im_func
+
+    def as_buffer(source):
+        '''Read-only, zero-copy view of a bytes-like object.'''
+        if isinstance(source, memoryview):
+            # buffer() doesn't take a memoryview, so this one is copied
+            source = source.tobytes()
+        return buffer(source)
+
+    def buffer_slice(buf, start, size):
+        '''Zero-copy view of size bytes of a buffer from start.'''
+        return buffer(buf, start, size)
+
+    # Slices of a buffer are already strings
+    buffer_bytes = str
+
+    # Short strings are native (byte) strings
+    buffer_text = str
+
+    def array_frombytes(arr, data):
+        '''Append the items packed in a byte string to an array.'''
+        arr.fromstring(data)
+
+    exec('''def reraise(tp, value, tb=None):
+    raise tp, value, tb
+''')
+
+else:
+    from collections.abc import Mapping
+
+    text_type = str
+    binary_type = bytes
+    integer_types = (int,)
+    range = range
+
+    def iteritems(d):
+        return iter(d.items())
+
+    def get_unbound_function(method):
+        return method
+
+    def as_buffer(source):
+        '''Read-only, zero-copy view of a bytes-like object.'''
+        return memoryview(source).cast('B').toreadonly()
+
+    def buffer_slice(buf, start, size):
+        '''Zero-copy view of size bytes of a buffer from start.'''
+        return buf[start:start + size]
+
+    # Copy a slice of a memoryview into bytes
+    buffer_bytes = memoryview.tobytes
+
+    def buffer_text(view):
+        '''Decode a slice of a memoryview as a native (unicode) string.'''
+        return str(view, 'utf-8')
+
+    def array_frombytes(arr, data):
+        '''Append the items packed in a byte string to an array.'''
+        arr.frombytes(data)
+
+    def reraise(tp, value, tb=None):
+        if value is None:
+            value = tp()
+        if value.__traceback__ is not tb:
+            raise value.with_traceback(tb)
+        raise value
@@ -14,12 +14,16 @@ from haigha2.classes.exchange_class import ExchangeClass
 from haigha2.classes.queue_class import QueueClass
 from haigha2.classes.transaction_class import TransactionClass
 from haigha2.writer import Writer
-from haigha2.reader import Reader
+from haigha2.reader import Reader, ArgumentSchema
+from haigha2.metrics import Metrics
+from haigha2.heartbeat import Heartbeat
+from haigha2.profiling import StageProfiler, DECODE, DISPATCH, WRITE
 from haigha2.transports.transport import Transport
 from exceptions import ConnectionError, ConnectionClosed
 
 import haigha2
 import time
+import weakref
 
 from logging import root as root_logger
 
@@ -67,6 +71,7 @@ class Connection(object):
         self._heartbeat = kwargs.get('heartbeat')
         self._open_cb = kwargs.get('open_cb')
         self._close_cb = kwargs.get('close_cb')
+        self._drain_cb = kwargs.get('drain_cb')
 
         self._login_method = kwargs.get('login_method', 'AMQPLAIN')
         self._locale = kwargs.get('locale', 'en_US')
@@ -94,12 +99,38 @@ class Connection(object):
         self._class_map.setdefault(60, BasicClass)
         self._class_map.setdefault(90, TransactionClass)
 
+        # Metrics are off unless asked for, see haigha2.metrics
+        self._metrics = kwargs.get('metrics')
+        if self._metrics is True:
+            self._metrics = Metrics()
+        elif not self._metrics:
+            self._metrics = None
+        self._metrics_prefix = None
+        if self._metrics is not None:
+            self._metrics_prefix = self._metrics.connection_prefix()
+
+        # Tracing is off unless a Tracer is given, see haigha2.tracing
+        self._tracer = kwargs.get('tracer')
+
+        # Profiling is off unless asked for, see haigha2.profiling
+        self._profiler = kwargs.get('profiler')
+        if self._profiler is True:
+            self._profiler = StageProfiler(logger=self._logger)
+        elif not self._profiler:
+            self._profiler = None
+
         self._channels = {
-            0: ConnectionChannel(self, 0, {})
+            0: ConnectionChannel(self, 0, {}, metrics=self._channel_metrics(0),
+                                 tracer=self._tracer, profiler=self._profiler)
         }
 
         self._last_octet_time = None
 
+        # Heartbeats are sent from timers of the transport if it has them,
+        # see haigha2.heartbeat, which count reads rather than time them
+        self._heartbeat_timer = None
+        self._reads = 0
+
         # Login response seems a total hack of protocol
         # Skip the length at the beginning
         login_response = Writer()
@@ -114,33 +145,56 @@ class Connection(object):
         self._frames_read = 0
         self._frames_written = 0
 
+        self._transport = self._create_transport(kwargs)
+
+        # Record the bytes read and written, see haigha2.capture
+        capture = kwargs.get('capture')
+        if capture:
+            from haigha2.transports.capture_transport import CaptureTransport
+            self._transport = CaptureTransport(self, self._transport, capture)
+
+        # Set these after the transport is initialized, so that we can access
+        # the synchronous property
+        self._synchronous = kwargs.get('synchronous', False)
+        self._synchronous_connect = kwargs.get(
+            'synchronous_connect', False) or self.synchronous
+
+        self._output_frame_buffer = []
+        self._gauges = ()
+        if self._metrics is not None:
+            self._register_gauges()
+        self.connect(self._host, self._port)
+
+    def _create_transport(self, kwargs):
+        '''
+        Create the transport named by the `transport` keyword argument,
+        'socket' by default, or return the Transport passed in it.
+        '''
         # Default to the socket strategy
         transport = kwargs.get('transport', 'socket')
         if not isinstance(transport, Transport):
             if transport == 'event':
                 from haigha2.transports.event_transport import EventTransport
-                self._transport = EventTransport(self)
+                return EventTransport(self)
             elif transport == 'gevent':
                 from haigha2.transports.gevent_transport import GeventTransport
-                self._transport = GeventTransport(self)
+                return GeventTransport(self, **kwargs)
             elif transport == 'gevent_pool':
                 from haigha2.transports.gevent_transport import \
                     GeventPoolTransport
-                self._transport = GeventPoolTransport(self, **kwargs)
+                return GeventPoolTransport(self, **kwargs)
             elif transport == 'socket':
                 from haigha2.transports.socket_transport import SocketTransport
-                self._transport = SocketTransport(self)
-        else:
-            self._transport = transport
-
-        # Set these after the transport is initialized, so that we can access
-        # the synchronous property
-        self._synchronous = kwargs.get('synchronous', False)
-        self._synchronous_connect = kwargs.get(
-            'synchronous_connect', False) or self.synchronous
-
-        self._output_frame_buffer = []
-        self.connect(self._host, self._port)
+                return SocketTransport(self)
+            elif transport == 'selector':
+                from haigha2.transports.selector_transport import \
+                    SelectorTransport
+                return SelectorTransport(self, **kwargs)
+            elif transport == 'replay':
+                from haigha2.transports.replay_transport import \
+                    ReplayTransport
+                return ReplayTransport(self, **kwargs)
+        return transport
 
     @property
     def logger(self):
@@ -168,6 +222,32 @@ class Connection(object):
         '''Number of frames written in the lifetime of this connection.'''
         return self._frames_written
 
+    @property
+    def metrics(self):
+        '''The Metrics recorded by this connection, or None if disabled.'''
+        return self._metrics
+
+    @property
+    def tracer(self):
+        '''The Tracer of this connection, or None if disabled.'''
+        return self._tracer
+
+    @property
+    def profiler(self):
+        '''The StageProfiler of this connection, or None if disabled.'''
+        return self._profiler
+
+    @property
+    def queued_bytes(self):
+        '''
+        Number of bytes written to the transport that it hasn't sent yet.
+        Publishers can stop publishing while it's high, and resume in the
+        drain_cb, which is called once the transport has sent them all.
+        '''
+        if self._transport is None:
+            return 0
+        return self._transport.queued
+
     @property
     def closed(self):
         '''Return the closed state of the connection.'''
@@ -263,6 +343,9 @@ class Connection(object):
 
         '''
         self._connected = False
+        self._stop_heartbeat()
+        if self._closed:
+            self._unregister_gauges()
         if self._transport is not None:
             try:
                 self._transport.disconnect()
@@ -296,11 +379,20 @@ class Connection(object):
         # We're not connected any more, but we're not closed without an
         # explicit close call.
         self._connected = False
+        self._stop_heartbeat()
         self._transport = None
 
         # Call back to a user-provided close function
         self._callback_close()
 
+    def transport_drained(self):
+        '''
+        Called by Transports that queue writes when they've sent everything
+        that was queued.
+        '''
+        if self._drain_cb:
+            self._drain_cb()
+
     ###
     # Connection methods
     ###
@@ -341,12 +433,82 @@ class Connection(object):
         # Call open() here so that ConnectionChannel doesn't have it called.
         # Could also solve this other ways, but it's a HACK regardless.
         rval = Channel(
-            self, channel_id, self._class_map, synchronous=synchronous)
+            self, channel_id, self._class_map, synchronous=synchronous,
+            metrics=self._channel_metrics(channel_id), tracer=self._tracer,
+            profiler=self._profiler)
         self._channels[channel_id] = rval
         rval.add_close_listener(self._channel_closed)
         rval.open()
         return rval
 
+    def _write_queue_depth(self):
+        '''
+        Number of frames waiting to be sent, either for the connection to
+        open or behind a synchronous method on their channel.
+        '''
+        depth = len(self._output_frame_buffer)
+        for channel in self._channels.values():
+            depth += sum(1 for event in channel._pending_events
+                         if isinstance(event, Frame))
+        return depth
+
+    def _start_heartbeat(self):
+        '''
+        Start sending heartbeats from timers of the transport, once they've
+        been negotiated. Transports without timers leave it to read_frames.
+        '''
+        self._stop_heartbeat()
+        if not self._heartbeat or self._transport is None:
+            return
+        heartbeat_timer = Heartbeat(self, self._heartbeat)
+        if heartbeat_timer.start():
+            self._heartbeat_timer = heartbeat_timer
+
+    def _stop_heartbeat(self):
+        if self._heartbeat_timer is not None:
+            self._heartbeat_timer.stop()
+            self._heartbeat_timer = None
+
+    def _channel_metrics(self, channel_id):
+        '''
+        The ChannelMetrics for a new channel, or None if metrics are disabled.
+        '''
+        if self._metrics is None:
+            return None
+        return self._metrics.channel(channel_id, self._metrics_prefix)
+
+    def _register_gauges(self):
+        '''
+        Register the gauges of this connection. They only hold a weak
+        reference to it, and are removed when it's closed or collected.
+        '''
+        metrics = self._metrics
+        prefix = self._metrics_prefix
+        names = (prefix + 'write_queue_depth', prefix + 'write_queue_bytes')
+
+        def collected(ref):
+            for name in names:
+                metrics.remove(name)
+            metrics.remove_channels(prefix)
+
+        # The callback mustn't reference self, or it would never be called
+        ref = weakref.ref(self, collected)
+
+        metrics.gauge(names[0], lambda: ref()._write_queue_depth())
+        metrics.gauge(names[1], lambda: ref().queued_bytes)
+        self._gauges = names
+
+    def _unregister_gauges(self):
+        '''
+        Remove the gauges of this connection, and the metrics of its
+        channels, from its Metrics.
+        '''
+        if self._metrics is not None:
+            for name in self._gauges:
+                self._metrics.remove(name)
+            self._metrics.remove_channels(self._metrics_prefix)
+        self._gauges = ()
+
     def _channel_closed(self, channel):
         '''
         Close listener on a channel.
@@ -355,6 +517,9 @@ class Connection(object):
             del self._channels[channel.channel_id]
         except KeyError:
             pass
+        if self._metrics is not None:
+            self._metrics.remove_channel(channel.channel_id,
+                                         self._metrics_prefix)
 
     def close(self, reply_code=0, reply_text='', class_id=0, method_id=0,
               disconnect=False):
@@ -405,42 +570,79 @@ class Connection(object):
         if self._transport is None:
             return
 
-        # Send a heartbeat (if needed)
-        self._channels[0].send_heartbeat()
+        # Unless the transport's timers send heartbeats, send one (if needed)
+        heartbeat_timer = self._heartbeat_timer
+        if heartbeat_timer is None:
+            self._channels[0].send_heartbeat()
 
         data = self._transport.read(self._heartbeat)
-        current_time = time.time()
-
-        if data is None:
-            # Wait for 2 heartbeat intervals before giving up. See AMQP 4.2.7:
-            # "If a peer detects no incoming traffic (i.e. received octets) for two heartbeat intervals or longer,
-            # it should close the connection"
-            if self._heartbeat and (current_time-self._last_octet_time > 2*self._heartbeat):
-                msg = 'Heartbeats not received from %s for %d seconds' % (self._host, 2*self._heartbeat)
-                self.transport_closed(msg=msg)
-                raise ConnectionClosed('Connection is closed: ' + msg)
-            return
-        self._last_octet_time = current_time
+
+        if heartbeat_timer is not None:
+            if self._transport is None and heartbeat_timer.expired:
+                # The timers found the broker dead while reading, so raise as
+                # below rather than leave synchronous callers waiting
+                raise ConnectionClosed(
+                    'Connection is closed: ' + self._close_info['reply_text'])
+            if data is None:
+                return
+            self._reads += 1
+        else:
+            current_time = time.time()
+            if data is None:
+                # Wait for 2 heartbeat intervals before giving up. See AMQP 4.2.7:
+                # "If a peer detects no incoming traffic (i.e. received octets) for two heartbeat intervals or longer,
+                # it should close the connection"
+                if self._heartbeat and (current_time-self._last_octet_time > 2*self._heartbeat):
+                    msg = 'Heartbeats not received from %s for %d seconds' % (self._host, 2*self._heartbeat)
+                    self.transport_closed(msg=msg)
+                    raise ConnectionClosed('Connection is closed: ' + msg)
+                return
+            self._last_octet_time = current_time
+
+        profiler = self._profiler
+        if profiler is not None and profiler.begin():
+            try:
+                self._process_data(data, profiler)
+            finally:
+                profiler.end()
+        else:
+            self._process_data(data, None)
+
+    def _process_data(self, data, profiler):
+        '''
+        Scan the frames in data, buffering any partial frame, and process
+        them on their channels. Stages are timed if profiler is not None.
+        '''
         reader = Reader(data)
         p_channels = set()
 
+        if profiler is not None:
+            profiler.enter(DECODE)
+        metrics = self._metrics
         try:
-            for frame in Frame.read_frames(reader):
-                if self._debug > 1:
-                    self.logger.debug("READ: %s", frame)
-                self._frames_read += 1
-                ch = self.channel(frame.channel_id)
-                ch.buffer_frame(frame)
-                p_channels.add(ch)
+            scan = Frame.scan_frames(reader)
         except Frame.FrameError as e:
-            # Frame error in the peer, disconnect
-            self.close(reply_code=501,
-                       reply_text='frame error from %s : %s' % (
-                           self._host, str(e)),
-                       class_id=0, method_id=0, disconnect=True)
-            raise ConnectionClosed("connection is closed: %s : %s" %
-                                   (self._close_info['reply_code'],
-                                    self._close_info['reply_text']))
+            self._frame_error(e)
+
+        # Frames are buffered on their channels as scanned and only parsed
+        # when the channels process them
+        for i, (frame_type, channel_id) in enumerate(scan.headers()):
+            self._frames_read += 1
+            if metrics is not None:
+                metrics.frames_in[frame_type].inc()
+            ch = self.channel(channel_id)
+            if self._debug > 1:
+                frame = self._parse_frame(scan, i)
+                self.logger.debug("READ: %s", frame)
+                ch.buffer_frame(frame)
+            else:
+                ch.buffer_scanned(scan, i)
+            p_channels.add(ch)
+
+        # Partial frames are rebuffered and read again, so only count the
+        # bytes of complete frames
+        if metrics is not None:
+            metrics.bytes_in.inc(reader.tell())
 
         # NOTE: we process channels after buffering unused data in order to
         # preserve the integrity of the input stream in case a channel needs to
@@ -454,9 +656,35 @@ class Connection(object):
         # awesome if we could free that memory without a new allocation.
         if reader.tell() < len(data):
             self._transport.buffer(data[reader.tell():])
+        if profiler is not None:
+            profiler.exit()
+            profiler.enter(DISPATCH)
 
         self._transport.process_channels(p_channels)
 
+    def _parse_frame(self, scan, i):
+        '''
+        Parse the i'th frame of a FrameScan, closing the connection if it's
+        malformed.
+        '''
+        try:
+            return scan.frame(i)
+        except Frame.FrameError as e:
+            self._frame_error(e)
+
+    def _frame_error(self, e):
+        '''
+        Close the connection on a frame error from the peer and raise
+        ConnectionClosed.
+        '''
+        self.close(reply_code=501,
+                   reply_text='frame error from %s : %s' % (
+                       self._host, str(e)),
+                   class_id=0, method_id=0, disconnect=True)
+        raise ConnectionClosed("connection is closed: %s : %s" %
+                               (self._close_info['reply_code'],
+                                self._close_info['reply_text']))
+
     def _flush_buffered_frames(self):
         '''
         Callback when protocol has been initialized on channel 0 and we're
@@ -491,6 +719,20 @@ class Connection(object):
         if self._debug > 1:
             self.logger.debug("WRITE: %s", frame)
 
+        profiler = self._profiler
+        if profiler is not None and profiler.begin():
+            profiler.enter(WRITE)
+            try:
+                self._write_frame(frame)
+            finally:
+                profiler.end()
+        else:
+            self._write_frame(frame)
+
+    def _write_frame(self, frame):
+        '''
+        Encode a frame and write it to the transport.
+        '''
         buf = bytearray()
         frame.write_frame(buf)
         if len(buf) > self._frame_max:
@@ -506,6 +748,9 @@ class Connection(object):
         self._transport.write(buf)
 
         self._frames_written += 1
+        if self._metrics is not None:
+            self._metrics.bytes_out.inc(len(buf))
+            self._metrics.frames_out[frame.type()].inc()
 
 
 class ConnectionChannel(Channel):
@@ -518,8 +763,12 @@ class ConnectionChannel(Channel):
     a handle to a Channel's Connection object.
     '''
 
-    def __init__(self, *args):
-        super(ConnectionChannel, self).__init__(*args)
+    # Arguments of connection.tune and connection.close
+    TUNE_ARGS = ArgumentSchema('short', 'long', 'short')
+    CLOSE_ARGS = ArgumentSchema('short', 'shortstr', 'short', 'short')
+
+    def __init__(self, *args, **kwargs):
+        super(ConnectionChannel, self).__init__(*args, **kwargs)
 
         self._method_map = {
             10: self._recv_start,
@@ -537,13 +786,14 @@ class ConnectionChannel(Channel):
         the stack.
         '''
         if frame.type() == HeartbeatFrame.type():
-            self.send_heartbeat()
+            if self.connection._heartbeat_timer is None:
+                self.send_heartbeat()
 
         elif frame.type() == MethodFrame.type():
             if frame.class_id == 10:
                 cb = self._method_map.get(frame.method_id)
                 if cb:
-                    method = self.clear_synchronous_cb(cb)
+                    method = self.clear_synchronous_cb(cb, frame)
                     method(frame)
                 else:
                     raise Channel.InvalidMethod(
@@ -598,14 +848,15 @@ class ConnectionChannel(Channel):
         self.add_synchronous_cb(self._recv_tune)
 
     def _recv_tune(self, method_frame):
-        self.connection._channel_max = method_frame.args.read_short(
-        ) or self.connection._channel_max
-        self.connection._frame_max = method_frame.args.read_long(
-        ) or self.connection._frame_max
+        channel_max, frame_max, heartbeat = \
+            method_frame.args.read_args(self.TUNE_ARGS)
+        self.connection._channel_max = \
+            channel_max or self.connection._channel_max
+        self.connection._frame_max = frame_max or self.connection._frame_max
 
         # Note that 'is' test is required here, as 0 and None are distinct
         if self.connection._heartbeat is None:
-            self.connection._heartbeat = method_frame.args.read_short()
+            self.connection._heartbeat = heartbeat
 
         self._send_tune_ok()
         self._send_open()
@@ -613,6 +864,7 @@ class ConnectionChannel(Channel):
         # 4.2.7: The client should start sending heartbeats after receiving a
         # Connection.Tune method
         self.send_heartbeat()
+        self.connection._start_heartbeat()
 
     def _send_tune_ok(self):
         args = Writer()
@@ -653,11 +905,13 @@ class ConnectionChannel(Channel):
         self.add_synchronous_cb(self._recv_close_ok)
 
     def _recv_close(self, method_frame):
+        reply_code, reply_text, class_id, method_id = \
+            method_frame.args.read_args(self.CLOSE_ARGS)
         self.connection._close_info = {
-            'reply_code': method_frame.args.read_short(),
-            'reply_text': method_frame.args.read_shortstr(),
-            'class_id': method_frame.args.read_short(),
-            'method_id': method_frame.args.read_short()
+            'reply_code': reply_code,
+            'reply_text': reply_text,
+            'class_id': class_id,
+            'method_id': method_id
         }
 
         # TODO: wait to disconnect until the close_ok has been flushed, but
@@ -11,6 +11,7 @@ from haigha2.connection import Connection
 from haigha2.classes.basic_class import BasicClass
 from haigha2.classes.exchange_class import ExchangeClass
 from haigha2.classes.protocol_class import ProtocolClass
+from haigha2.reader import ArgumentSchema
 from haigha2.writer import Writer
 from haigha2.frames.method_frame import MethodFrame
 
@@ -147,6 +148,10 @@ class RabbitBasicClass(BasicClass):
     Support Rabbit extensions to Basic class.
     '''
 
+    # Arguments of basic.ack and basic.nack
+    ACK_ARGS = ArgumentSchema('longlong', 'bit')
+    NACK_ARGS = ArgumentSchema('longlong', 'bit', 'bit')
+
     def __init__(self, *args, **kwargs):
         super(RabbitBasicClass, self).__init__(*args, **kwargs)
         self.dispatch_map[30] = self._recv_cancel
@@ -192,22 +197,21 @@ class RabbitBasicClass(BasicClass):
         '''
         self._nack_listener = cb
 
-    # Probably a better solution here, like functools
-    def publish(self, *args, **kwargs):
+    def _send_publish(self, *args, **kwargs):
         '''
-        Publish a message. Will return the id of the message if publisher
-        confirmations are enabled, else will return 0.
+        Publish a message. publish() and publish_raw() will return the id of
+        the message if publisher confirmations are enabled, else will return 0.
         '''
         if self.channel.confirm._enabled:
             self._msg_id += 1
-        super(RabbitBasicClass, self).publish(*args, **kwargs)
+        super(RabbitBasicClass, self)._send_publish(*args, **kwargs)
         return self._msg_id
 
     def _recv_ack(self, method_frame):
         '''Receive an ack from the broker.'''
         if self._ack_listener:
-            delivery_tag = method_frame.args.read_longlong()
-            multiple = method_frame.args.read_bit()
+            delivery_tag, multiple = \
+                method_frame.args.read_args(self.ACK_ARGS)
             if multiple:
                 while self._last_ack_id < delivery_tag:
                     self._last_ack_id += 1
@@ -218,6 +222,11 @@ class RabbitBasicClass(BasicClass):
 
     def nack(self, delivery_tag, multiple=False, requeue=False):
         '''Send a nack to the broker.'''
+        batcher = self.channel._ack_batcher
+        if batcher is not None:
+            batcher.flush()
+            batcher.settle(delivery_tag, multiple)
+
         args = Writer()
         args.write_longlong(delivery_tag).\
             write_bits(multiple, requeue)
@@ -227,8 +236,8 @@ class RabbitBasicClass(BasicClass):
     def _recv_nack(self, method_frame):
         '''Receive a nack from the broker.'''
         if self._nack_listener:
-            delivery_tag = method_frame.args.read_longlong()
-            multiple, requeue = method_frame.args.read_bits(2)
+            delivery_tag, multiple, requeue = \
+                method_frame.args.read_args(self.NACK_ARGS)
             if multiple:
                 while self._last_ack_id < delivery_tag:
                     self._last_ack_id += 1
@@ -239,7 +248,7 @@ class RabbitBasicClass(BasicClass):
 
     def consume(self, queue, consumer, consumer_tag='', no_local=False,
                 no_ack=True, exclusive=False, nowait=True, ticket=None,
-                cb=None, cancel_cb=None):
+                cb=None, cancel_cb=None, stream=False):
         '''Start a queue consumer.
 
         Accepts the following optional arg in addition to those of
@@ -263,7 +272,7 @@ class RabbitBasicClass(BasicClass):
         # Start consumer
         super(RabbitBasicClass, self).consume(queue, consumer, consumer_tag,
                                               no_local, no_ack, exclusive,
-                                              nowait, ticket, cb)
+                                              nowait, ticket, cb, stream)
 
     def cancel(self, consumer_tag='', nowait=True, consumer=None, cb=None):
         '''
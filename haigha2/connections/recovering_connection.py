@@ -0,0 +1,981 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+from collections import OrderedDict, deque
+import random
+import time
+
+from haigha2.channel import SyncWrapper
+from haigha2.classes.queue_class import QueueClass
+from haigha2.connections.rabbit_connection import RabbitConnection, \
+    RabbitExchangeClass, RabbitBasicClass, RabbitConfirmClass
+from haigha2.exceptions import ChannelClosed, ConnectionClosed
+from haigha2.frames.header_frame import HeaderFrame
+from haigha2.message import Message
+from haigha2.reader import Reader
+from haigha2.writer import Writer
+
+# Reply code of the connection.close a broker sends when it shuts down
+CONNECTION_FORCED = 320
+
+# Prefix of the names RabbitMQ gives to queues declared without one, which
+# clients can't use for their own queues
+BROKER_NAMED_PREFIX = 'amq.gen-'
+
+# Attributes of protocol classes that are kept when a channel is reset:
+# listeners set by the application, and the consumer tag counter so that
+# new consumer tags don't clash with those of recovered consumers, and the
+# outbox
+_KEPT_ATTRIBUTES = ('_flow_control_cb', '_return_listener', '_ack_listener',
+                    '_nack_listener', '_consumer_tag_id', '_outbox')
+
+
+class RecoveringConnection(RabbitConnection):
+
+    '''
+    A RabbitConnection that reconnects when its transport is lost or the
+    broker shuts down, and recovers its channels along with the exchanges,
+    queues, bindings, qos, confirms and consumers declared on them.
+
+    Accepts the following keyword arguments in addition to those of
+    Connection:
+
+      hosts - list of (host, port) tuples or "host:port" strings, which are
+        tried in turn; defaults to host and port
+      reconnect_delay - base of the exponential backoff between attempts to
+        reconnect, 1 second by default
+      max_reconnect_delay - limit of the backoff, 30 seconds by default
+      max_reconnect_attempts - attempts after which the connection gives up
+        and closes, or None (the default) to keep trying
+      recover_cb - called once the connection has reconnected and resumed
+        its consumers
+
+    The delay before each attempt is drawn at random between 0 and the
+    backoff, so that clients of a broker that went away don't all come back
+    at once. Asynchronous transports wait from their timers; synchronous
+    ones, like `socket`, sleep and reconnect before returning from the read
+    or write that found the connection lost.
+
+    Once reconnected, the Channel objects are opened again with the same
+    ids, everything recorded is declared again with nowait, in one write on
+    a temporary channel, and the consumers are resumed with their tags once
+    the broker has processed the declarations. Queues named by the broker
+    aren't recovered, as their names change, nor are the bindings and
+    consumers of them or of the last queue declared on a channel
+    (queue=''). Synchronous calls waiting for a reply when the
+    connection is lost return None, deliveries that weren't acked are
+    redelivered (acks, nacks and rejects of them after a reconnect are
+    dropped, see RecoveringBasicClass), and until the
+    connection has been recovered, writes to channels raise ConnectionClosed,
+    except for publishes on channels with an outbox, see
+    RecoveringBasicClass.set_outbox().
+    '''
+
+    def __init__(self, **kwargs):
+        '''
+        Initialize the connection
+        '''
+        hosts = kwargs.pop('hosts', None)
+        if hosts:
+            self._hosts = [_parse_host(host) for host in hosts]
+            kwargs['host'], kwargs['port'] = self._hosts[0]
+        else:
+            self._hosts = [(kwargs.get('host', 'localhost'),
+                            kwargs.get('port', 5672))]
+        self._host_index = 0
+
+        self._reconnect_delay = kwargs.get('reconnect_delay', 1.0)
+        self._max_reconnect_delay = kwargs.get('max_reconnect_delay', 30.0)
+        self._max_reconnect_attempts = kwargs.get('max_reconnect_attempts')
+        self._recover_cb = kwargs.get('recover_cb')
+
+        self._topology = Topology()
+        self._channel_records = {}
+
+        # Recovery state: _recovering from the loss of the connection until
+        # it's open again, _resuming from then until the topology has been
+        # declared, _reconnecting while an attempt is connecting
+        self._recovering = False
+        self._resuming = False
+        self._reconnecting = False
+        self._attempts = 0
+        self._reconnect_timer = None
+        self._closing = False
+        self._timer_transport = None
+
+        class_map = kwargs.get('class_map', {}).copy()
+        class_map.setdefault(40, RecoveringExchangeClass)
+        class_map.setdefault(50, RecoveringQueueClass)
+        class_map.setdefault(60, RecoveringBasicClass)
+        class_map.setdefault(85, RecoveringConfirmClass)
+        kwargs['class_map'] = class_map
+        self._kwargs = kwargs
+
+        super(RecoveringConnection, self).__init__(**kwargs)
+
+    @property
+    def hosts(self):
+        '''The (host, port) tuples that the connection tries in turn.'''
+        return list(self._hosts)
+
+    @property
+    def recovering(self):
+        '''True while the connection is lost and being recovered.'''
+        return self._recovering
+
+    @property
+    def topology(self):
+        '''The Topology recorded on this connection.'''
+        return self._topology
+
+    def connect(self, host, port):
+        '''
+        Connect to a host and port.
+        '''
+        # Timers to reconnect with are scheduled on the last transport, as
+        # the connection has none while it's lost
+        self._timer_transport = self._transport
+        super(RecoveringConnection, self).connect(host, port)
+
+    def close(self, reply_code=0, reply_text='', class_id=0, method_id=0,
+              disconnect=False):
+        '''
+        Close this connection and stop recovering it.
+        '''
+        self._closing = True
+        self._recovering = False
+        if self._reconnect_timer is not None:
+            self._reconnect_timer.cancel()
+            self._reconnect_timer = None
+        if self._transport is None:
+            disconnect = True
+        super(RecoveringConnection, self).close(
+            reply_code, reply_text, class_id, method_id, disconnect)
+
+    def channel(self, channel_id=None, synchronous=False):
+        '''
+        Fetch or create a channel, see Connection.channel. Raises
+        ConnectionClosed for new channels while the connection is being
+        recovered.
+        '''
+        if channel_id is None and self._recovering:
+            self._raise_recovering()
+        return super(RecoveringConnection, self).channel(
+            channel_id, synchronous)
+
+    def send_frame(self, frame):
+        '''
+        Send a frame, see Connection.send_frame. Frames on channels raise
+        ConnectionClosed while the connection is being recovered, as the
+        channels are only opened again once it's done.
+        '''
+        if self._recovering and not self._connected and frame.channel_id:
+            self._raise_recovering()
+        super(RecoveringConnection, self).send_frame(frame)
+
+    def _raise_recovering(self):
+        raise ConnectionClosed(
+            'connection is closed: recovering connection to %s' % (
+                self._host))
+
+    def _channel_record(self, channel):
+        '''
+        The ChannelRecord of a channel, created on first use.
+        '''
+        record = self._channel_records.get(channel.channel_id)
+        if record is None:
+            record = self._channel_records[channel.channel_id] = \
+                ChannelRecord()
+        return record
+
+    def _channel_closed(self, channel):
+        '''
+        Close listener on a channel.
+        '''
+        self._channel_records.pop(channel.channel_id, None)
+        super(RecoveringConnection, self)._channel_closed(channel)
+
+    ###
+    # Recovery
+    ###
+    def _callback_close(self):
+        '''
+        Recover the connection if it was lost rather than closed, else call
+        back to the close_cb.
+        '''
+        if self._closing or (self._closed and
+                             self._close_info['reply_code'] !=
+                             CONNECTION_FORCED):
+            self._recovering = False
+            self._closed = True
+            for channel in self._channels.values():
+                _release_sync_calls(channel)
+            super(RecoveringConnection, self)._callback_close()
+            return
+
+        if not self._recovering:
+            self._recovering = True
+            self._attempts = 0
+            self.logger.warning('recovering connection to %s', self._host)
+        self._closed = False
+        self._reset()
+
+        # An attempt that failed while connecting is retried by _reconnect
+        if not self._reconnecting:
+            self._reconnect_later()
+
+    def _reset(self):
+        '''
+        Forget the state of the lost connection on every channel, releasing
+        synchronous calls that wait for a reply.
+        '''
+        self._output_frame_buffer = []
+        self._resuming = False
+        for channel in self._channels.values():
+            _reset_channel(channel)
+
+        names = self._topology.forget_broker_named()
+        for queue in sorted(names):
+            if queue:
+                self.logger.warning('not recovering the bindings and '
+                                    'consumers of queue %s, which was named '
+                                    'by the broker', queue)
+        for record in self._channel_records.values():
+            record.forget_consumers(names)
+
+    def _backoff(self):
+        '''
+        Seconds to wait before the next attempt to reconnect.
+        '''
+        limit = min(self._max_reconnect_delay,
+                    self._reconnect_delay * 2 ** self._attempts)
+        return random.uniform(0, limit)
+
+    def _reconnect_later(self):
+        '''
+        Schedule the next attempt to reconnect, or give up after
+        max_reconnect_attempts.
+        '''
+        if self._max_reconnect_attempts is not None and \
+                self._attempts >= self._max_reconnect_attempts:
+            self._give_up()
+            return
+
+        delay = self._backoff()
+        self._attempts += 1
+        transport = self._timer_transport
+        if transport is not None and not transport.synchronous:
+            self._reconnect_timer = transport.call_later(
+                delay, self._reconnect_timeout)
+            if self._reconnect_timer is not None:
+                return
+
+        # Transports without timers reconnect before returning
+        while True:
+            time.sleep(delay)
+            if self._reconnect() or not self._recovering:
+                return
+            if self._max_reconnect_attempts is not None and \
+                    self._attempts >= self._max_reconnect_attempts:
+                self._give_up()
+                return
+            delay = self._backoff()
+            self._attempts += 1
+
+    def _reconnect_timeout(self):
+        self._reconnect_timer = None
+        if self._recovering and not self._reconnect():
+            self._reconnect_later()
+
+    def _reconnect(self):
+        '''
+        Connect to the next host. Returns False if it failed.
+        '''
+        self._host_index = (self._host_index + 1) % len(self._hosts)
+        host, port = self._hosts[self._host_index]
+
+        synchronous_connect = self._synchronous_connect
+        self._synchronous_connect = False
+        self._reconnecting = True
+        try:
+            self._transport = self._create_transport(self._kwargs)
+            self.connect(host, port)
+            if synchronous_connect:
+                while not self._connected and self._transport is not None:
+                    self.read_frames()
+        except Exception as e:
+            self.logger.warning('failed to reconnect to %s:%d: %s',
+                                host, port, e)
+            if self._transport is not None:
+                try:
+                    self._transport.disconnect()
+                except Exception:
+                    pass
+                self._transport = None
+        finally:
+            self._reconnecting = False
+            self._synchronous_connect = synchronous_connect
+        return self._transport is not None
+
+    def _give_up(self):
+        '''
+        Close the connection after the last attempt to reconnect failed.
+        '''
+        self.logger.error('giving up on recovering connection to %s after '
+                          '%d attempts', self._host, self._attempts)
+        self._recovering = False
+        self._closed = True
+        super(RecoveringConnection, self)._callback_close()
+
+    def _flush_buffered_frames(self):
+        '''
+        Callback when the connection is open. After a reconnect, recover the
+        channels before anything else is sent on them.
+        '''
+        if self._recovering:
+            try:
+                self._recover()
+            except ConnectionClosed:
+                # Lost again while recovering, which starts over
+                if not self._recovering:
+                    raise
+                return
+        super(RecoveringConnection, self)._flush_buffered_frames()
+        self._flush_outboxes()
+
+    def _flush_outboxes(self):
+        '''
+        Publish what the outboxes of the channels hold.
+        '''
+        for channel_id, channel in sorted(self._channels.items()):
+            if channel_id and not channel.closed and \
+                    isinstance(channel.basic, RecoveringBasicClass):
+                channel.basic._flush_outbox()
+
+    def _recover(self):
+        '''
+        Open the channels again, declare the topology, and resume the
+        consumers and outboxes once it's declared.
+        '''
+        self._recovering = False
+        self._resuming = True
+        self._attempts = 0
+        self.logger.info('recovered connection to %s', self._host)
+
+        channels = [self._channels[channel_id]
+                    for channel_id in sorted(self._channels) if channel_id]
+        for channel in channels:
+            channel.open()
+            record = self._channel_records.get(channel.channel_id)
+            if record is not None:
+                record.restore(channel)
+
+        if not len(self._topology):
+            self._resume()
+            return
+
+        # Declare on a channel opened for the purpose, so that a declaration
+        # the broker refuses doesn't close a channel of the application, and
+        # consume and publish on every channel once the broker has processed
+        # it, or closed the channel over it
+        channel = self.channel()
+
+        def declared(*args):
+            channel.remove_close_listener(self._declaring_channel_closed)
+            channel.close()
+            try:
+                self._resume()
+            except ConnectionClosed:
+                if not self._recovering:
+                    raise
+        channel.add_close_listener(self._declaring_channel_closed)
+        self._topology.declare(channel, declared)
+
+    def _declaring_channel_closed(self, channel):
+        '''
+        Close listener on the channel that the topology is declared on.
+        '''
+        if self._resuming:
+            self.logger.warning('channel %d closed while declaring topology '
+                                'on %s', channel.channel_id, self._host)
+            self._resume()
+
+    def _resume(self):
+        '''
+        Resume the consumers, then publish what the outboxes hold.
+        '''
+        if not self._resuming:
+            return
+        self._resuming = False
+        for channel_id, record in sorted(self._channel_records.items()):
+            channel = self._channels.get(channel_id)
+            if channel is not None and not channel.closed:
+                record.resume(channel)
+        self._flush_outboxes()
+        if self._recover_cb:
+            self._recover_cb()
+
+
+class Topology(object):
+
+    '''
+    The exchanges, queues and bindings declared on a connection, in the
+    order they were declared, except for those deleted since.
+    '''
+
+    def __init__(self):
+        self._exchanges = OrderedDict()
+        self._queues = OrderedDict()
+        self._bindings = OrderedDict()
+        self._broker_named = set()
+
+    def __len__(self):
+        return len(self._exchanges) + len(self._queues) + len(self._bindings)
+
+    @property
+    def exchanges(self):
+        return list(self._exchanges)
+
+    @property
+    def queues(self):
+        return list(self._queues)
+
+    @property
+    def bindings(self):
+        '''
+        (destination, source, routing_key) of each binding, of a queue or
+        an exchange.
+        '''
+        return [key[1:4] for key in self._bindings]
+
+    def exchange_declared(self, exchange, **kwargs):
+        self._exchanges[exchange] = dict(kwargs, exchange=exchange)
+
+    def exchange_deleted(self, exchange):
+        self._exchanges.pop(exchange, None)
+        for key in list(self._bindings):
+            _kind, destination, source = key[:3]
+            if exchange == source or (_kind == 'exchange' and
+                                      exchange == destination):
+                del self._bindings[key]
+
+    def queue_declared(self, queue, **kwargs):
+        self._queues[queue] = dict(kwargs, queue=queue)
+
+    def queue_named(self, queue):
+        '''
+        Note that the broker named a queue, so that it isn't recovered.
+        '''
+        self._broker_named.add(queue)
+
+    def forget_broker_named(self):
+        '''
+        Forget the bindings of the queues named by the broker, which are
+        named anew when they're declared again, and of the last queue
+        declared on a channel. Returns the names of those queues, including
+        '' for the latter.
+        '''
+        names = self._broker_named
+        names.add('')
+        self._broker_named = set()
+        for key in list(self._bindings):
+            if key[0] == 'queue' and key[1] in names:
+                del self._bindings[key]
+        return names
+
+    def queue_deleted(self, queue):
+        self._queues.pop(queue, None)
+        self._broker_named.discard(queue)
+        for key in list(self._bindings):
+            if key[0] == 'queue' and key[1] == queue:
+                del self._bindings[key]
+
+    def queue_bound(self, queue, exchange, routing_key, arguments):
+        key = ('queue', queue, exchange, routing_key, _args_key(arguments))
+        self._bindings[key] = dict(queue=queue, exchange=exchange,
+                                   routing_key=routing_key,
+                                   arguments=arguments)
+
+    def queue_unbound(self, queue, exchange, routing_key, arguments):
+        self._bindings.pop(
+            ('queue', queue, exchange, routing_key, _args_key(arguments)),
+            None)
+
+    def exchange_bound(self, exchange, source, routing_key, arguments):
+        key = ('exchange', exchange, source, routing_key,
+               _args_key(arguments))
+        self._bindings[key] = dict(exchange=exchange, source=source,
+                                   routing_key=routing_key,
+                                   arguments=arguments)
+
+    def exchange_unbound(self, exchange, source, routing_key, arguments):
+        self._bindings.pop(
+            ('exchange', exchange, source, routing_key, _args_key(arguments)),
+            None)
+
+    def declare(self, channel, cb):
+        '''
+        Declare the exchanges, then the queues, then the bindings on a
+        channel, without waiting for replies except to the last declaration,
+        which calls cb. Returns False if there's nothing to declare.
+        '''
+        calls = [(channel.exchange.declare, kwargs)
+                 for kwargs in self._exchanges.values()]
+        calls.extend((channel.queue.declare, kwargs)
+                     for kwargs in self._queues.values())
+        calls.extend(
+            (channel.queue.bind if key[0] == 'queue' else
+             channel.exchange.bind, kwargs)
+            for key, kwargs in self._bindings.items())
+        if not calls:
+            return False
+
+        for method, kwargs in calls[:-1]:
+            method(**kwargs)
+        method, kwargs = calls[-1]
+        method(cb=cb, **kwargs)
+        return True
+
+
+class ChannelRecord(object):
+
+    '''
+    The qos, confirms and consumers of a channel.
+    '''
+
+    def __init__(self):
+        self.qos = None
+        self.confirm = False
+        self.consumers = OrderedDict()
+
+    def restore(self, channel):
+        '''
+        Set the qos and confirms of a channel that was opened again.
+        '''
+        if self.qos is not None:
+            channel.basic.qos(*self.qos)
+        if self.confirm:
+            channel.confirm.select()
+
+    def resume(self, channel):
+        '''
+        Consume again with the consumers of a channel, with their tags.
+        '''
+        for consumer_tag, kwargs in list(self.consumers.items()):
+            channel.basic.consume(consumer_tag=consumer_tag, **kwargs)
+
+    def forget_consumers(self, queues):
+        '''
+        Forget the consumers of any of the named queues.
+        '''
+        for consumer_tag, kwargs in list(self.consumers.items()):
+            if kwargs['queue'] in queues:
+                del self.consumers[consumer_tag]
+
+
+class RecoveringExchangeClass(RabbitExchangeClass):
+
+    '''
+    Records the exchanges and exchange bindings declared.
+    '''
+
+    def declare(self, exchange, type, passive=False, durable=False,
+                auto_delete=True, internal=False, nowait=True,
+                arguments=None, ticket=None, cb=None):
+        topology = self.channel.connection._topology
+        super(RecoveringExchangeClass, self).declare(
+            exchange, type, passive, durable, auto_delete, internal, nowait,
+            arguments, ticket, cb)
+        if not passive:
+            topology.exchange_declared(
+                exchange, type=type, durable=durable,
+                auto_delete=auto_delete, internal=internal,
+                arguments=arguments)
+
+    def delete(self, exchange, if_unused=False, nowait=True, ticket=None,
+               cb=None):
+        topology = self.channel.connection._topology
+        super(RecoveringExchangeClass, self).delete(
+            exchange, if_unused, nowait, ticket, cb)
+        topology.exchange_deleted(exchange)
+
+    def bind(self, exchange, source, routing_key='', nowait=True,
+             arguments={}, ticket=None, cb=None):
+        topology = self.channel.connection._topology
+        super(RecoveringExchangeClass, self).bind(
+            exchange, source, routing_key, nowait, arguments, ticket, cb)
+        topology.exchange_bound(
+            exchange, source, routing_key, arguments)
+
+    def unbind(self, exchange, source, routing_key='', nowait=True,
+               arguments={}, ticket=None, cb=None):
+        topology = self.channel.connection._topology
+        super(RecoveringExchangeClass, self).unbind(
+            exchange, source, routing_key, nowait, arguments, ticket, cb)
+        topology.exchange_unbound(
+            exchange, source, routing_key, arguments)
+
+
+class RecoveringQueueClass(QueueClass):
+
+    '''
+    Records the queues and queue bindings declared.
+    '''
+
+    def declare(self, queue='', passive=False, durable=False,
+                exclusive=False, auto_delete=True, nowait=True,
+                arguments={}, ticket=None, cb=None):
+        # Looked up first, as the channel is cleaned up if the broker closes
+        # it before a synchronous declaration returns
+        topology = self.channel.connection._topology
+        rval = super(RecoveringQueueClass, self).declare(
+            queue, passive, durable, exclusive, auto_delete, nowait,
+            arguments, ticket, cb)
+        if queue and not passive:
+            topology.queue_declared(
+                queue, durable=durable, exclusive=exclusive,
+                auto_delete=auto_delete, arguments=arguments)
+        return rval
+
+    def _recv_declare_ok(self, method_frame):
+        topology = self.channel.connection._topology
+        rval = super(RecoveringQueueClass, self)._recv_declare_ok(method_frame)
+        if rval[0].startswith(BROKER_NAMED_PREFIX):
+            topology.queue_named(rval[0])
+        return rval
+
+    def delete(self, queue, if_unused=False, if_empty=False, nowait=True,
+               ticket=None, cb=None):
+        topology = self.channel.connection._topology
+        rval = super(RecoveringQueueClass, self).delete(
+            queue, if_unused, if_empty, nowait, ticket, cb)
+        topology.queue_deleted(queue)
+        return rval
+
+    def bind(self, queue, exchange, routing_key='', nowait=True, arguments={},
+             ticket=None, cb=None):
+        topology = self.channel.connection._topology
+        super(RecoveringQueueClass, self).bind(
+            queue, exchange, routing_key, nowait, arguments, ticket, cb)
+        topology.queue_bound(queue, exchange, routing_key, arguments)
+
+    def unbind(self, queue, exchange, routing_key='', arguments={},
+               ticket=None, cb=None):
+        topology = self.channel.connection._topology
+        super(RecoveringQueueClass, self).unbind(
+            queue, exchange, routing_key, arguments, ticket, cb)
+        topology.queue_unbound(queue, exchange, routing_key, arguments)
+
+
+class RecoveringBasicClass(RabbitBasicClass):
+
+    '''
+    Records the qos and consumers of a channel, and publishes through its
+    outbox if it has one.
+
+    The broker numbers deliveries from 1 again on each connection, so the
+    delivery tags of a channel are offset by the highest one received on
+    the connections before, and keep increasing across reconnects. Acks,
+    nacks and rejects of tags received on a lost connection are dropped, as
+    the broker redelivers those messages.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(RecoveringBasicClass, self).__init__(*args, **kwargs)
+        self._outbox = None
+
+        # Added to the delivery tags of this connection, see _reset_channel
+        self._tag_offset = 0
+
+        # (message id, outbox sequence number) of the messages published
+        # with confirms that the broker hasn't acked or nacked yet
+        self._unconfirmed = deque()
+
+    def set_outbox(self, outbox):
+        '''
+        Publish through an outbox (see haigha2.outbox), which holds the
+        messages published while the connection is down or being recovered,
+        and those the broker hadn't confirmed when it was lost, and
+        publishes them again in order once it's recovered. Messages are
+        removed from the outbox when the broker acks or nacks them if
+        confirms are selected, else once they're written. With an outbox,
+        publish() returns the sequence number of the message in the outbox,
+        which is what the ack and nack listeners are called with.
+
+        Messages that were in the outbox when the connection was lost may
+        be published twice.
+        '''
+        self._outbox = outbox
+        self._unconfirmed = deque()
+        self._flush_outbox()
+
+    def publish(self, msg, exchange, routing_key, mandatory=False,
+                immediate=False, ticket=None):
+        '''
+        Publish a message, see RabbitBasicClass.publish. With an outbox, the
+        message is appended to it, and published if the connection is open,
+        and its sequence number in the outbox is returned. Raises
+        Outbox.Full if the outbox is full.
+        '''
+        outbox = self._outbox
+        if outbox is None:
+            return super(RecoveringBasicClass, self).publish(
+                msg, exchange, routing_key, mandatory, immediate, ticket)
+
+        if self.channel.closed:
+            raise ChannelClosed('channel %d is closed' % (self.channel_id))
+        if self.channel.connection.closed:
+            raise ConnectionClosed('connection is closed')
+        seq = outbox.append(
+            _encode_publish(msg, exchange, routing_key, mandatory, immediate))
+        self._flush_outbox()
+        return seq
+
+    def _flush_outbox(self):
+        '''
+        Publish what the outbox holds, unless the connection is down or
+        being recovered.
+        '''
+        outbox = self._outbox
+        connection = self.channel.connection
+        if outbox is None or not connection._connected or \
+                connection._recovering or connection._resuming or \
+                self.channel.closed:
+            return
+
+        confirm = self.channel.confirm._enabled
+        for seq, data in outbox.unsent():
+            msg_id = self.publish_raw(*_decode_publish(data))
+            if confirm:
+                self._unconfirmed.append((msg_id, seq))
+            else:
+                outbox.remove(seq)
+
+    def _confirmed(self, delivery_tag, multiple):
+        '''
+        Pop the outbox sequence numbers of the messages that an ack or a
+        nack confirms.
+        '''
+        unconfirmed = self._unconfirmed
+        seqs = []
+        if multiple:
+            while unconfirmed and unconfirmed[0][0] <= delivery_tag:
+                seqs.append(unconfirmed.popleft()[1])
+        else:
+            for i, (msg_id, seq) in enumerate(unconfirmed):
+                if msg_id == delivery_tag:
+                    del unconfirmed[i]
+                    seqs.append(seq)
+                    break
+        self._last_ack_id = delivery_tag
+        return seqs
+
+    def _recv_ack(self, method_frame):
+        if self._outbox is None:
+            return super(RecoveringBasicClass, self)._recv_ack(method_frame)
+
+        delivery_tag, multiple = method_frame.args.read_args(self.ACK_ARGS)
+        for seq in self._confirmed(delivery_tag, multiple):
+            self._outbox.remove(seq)
+            if self._ack_listener:
+                self._ack_listener(seq)
+
+    def _recv_nack(self, method_frame):
+        if self._outbox is None:
+            return super(RecoveringBasicClass, self)._recv_nack(method_frame)
+
+        delivery_tag, multiple, requeue = \
+            method_frame.args.read_args(self.NACK_ARGS)
+        for seq in self._confirmed(delivery_tag, multiple):
+            self._outbox.remove(seq)
+            if self._nack_listener:
+                self._nack_listener(seq, requeue)
+
+    def _read_delivery_info(self, method_frame, with_consumer_tag=False,
+                            with_message_count=False):
+        delivery_info = super(RecoveringBasicClass, self)._read_delivery_info(
+            method_frame, with_consumer_tag, with_message_count)
+        delivery_info['delivery_tag'] += self._tag_offset
+        return delivery_info
+
+    def _stale(self, delivery_tag, method):
+        '''
+        Whether a delivery tag was received on a lost connection, which is
+        logged.
+        '''
+        if delivery_tag > self._tag_offset:
+            return False
+        self.logger.warning('dropping %s of delivery tag %d on channel %d, '
+                            'received on a lost connection', method,
+                            delivery_tag, self.channel_id)
+        return True
+
+    def ack(self, delivery_tag, multiple=False):
+        if not self._stale(delivery_tag, 'ack'):
+            super(RecoveringBasicClass, self).ack(
+                delivery_tag - self._tag_offset, multiple)
+
+    def nack(self, delivery_tag, multiple=False, requeue=False):
+        if not self._stale(delivery_tag, 'nack'):
+            super(RecoveringBasicClass, self).nack(
+                delivery_tag - self._tag_offset, multiple, requeue)
+
+    def reject(self, delivery_tag, requeue=False):
+        if not self._stale(delivery_tag, 'reject'):
+            super(RecoveringBasicClass, self).reject(
+                delivery_tag - self._tag_offset, requeue)
+
+    def _record(self):
+        return self.channel.connection._channel_record(self.channel)
+
+    def qos(self, prefetch_size=0, prefetch_count=0, is_global=False):
+        record = self._record()
+        super(RecoveringBasicClass, self).qos(
+            prefetch_size, prefetch_count, is_global)
+        record.qos = (prefetch_size, prefetch_count, is_global)
+
+    def consume(self, queue, consumer, consumer_tag='', no_local=False,
+                no_ack=True, exclusive=False, nowait=True, ticket=None,
+                cb=None, cancel_cb=None, stream=False):
+        # The tag is chosen here so that the consumer resumes with it
+        if not consumer_tag:
+            consumer_tag = self._generate_consumer_tag()
+        record = self._record()
+        super(RecoveringBasicClass, self).consume(
+            queue, consumer, consumer_tag, no_local, no_ack, exclusive,
+            nowait, ticket, cb, cancel_cb, stream)
+        record.consumers[consumer_tag] = dict(
+            queue=queue, consumer=consumer, no_local=no_local, no_ack=no_ack,
+            exclusive=exclusive, cancel_cb=cancel_cb, stream=stream)
+
+    def cancel(self, consumer_tag='', nowait=True, consumer=None, cb=None):
+        if consumer:
+            consumer_tag = self._lookup_consumer_tag_by_consumer(consumer) \
+                or consumer_tag
+        record = self._record()
+        super(RecoveringBasicClass, self).cancel(
+            consumer_tag, nowait, consumer, cb)
+        record.consumers.pop(consumer_tag, None)
+
+    def _recv_cancel(self, method_frame):
+        self._record().consumers.pop(
+            self._peek_consumer_tag(method_frame), None)
+        super(RecoveringBasicClass, self)._recv_cancel(method_frame)
+
+
+class RecoveringConfirmClass(RabbitConfirmClass):
+
+    '''
+    Records that a channel publishes with confirms.
+    '''
+
+    def select(self, nowait=True, cb=None):
+        record = self.channel.connection._channel_record(self.channel)
+        super(RecoveringConfirmClass, self).select(nowait, cb)
+        record.confirm = True
+
+
+def _reset_channel(channel):
+    '''
+    Forget the state of a channel on a lost connection, so that it can be
+    opened again on a new one. Its protocol classes are replaced, keeping
+    the listeners set on them.
+    '''
+    _release_sync_calls(channel)
+    if channel._tracer is not None:
+        while channel._spans:
+            channel._end_sync_span(channel._spans.popleft(),
+                                   error='connection lost')
+    channel._pending_events = deque()
+    channel._sync_started = deque()
+    channel._spans = deque()
+    channel._last_method = None
+    channel._frame_buffer = deque()
+    channel._content_receiver = None
+    channel._emergency_close_pending = False
+    channel._active = True
+
+    batcher = channel._ack_batcher
+    channel._ack_batcher = None
+    for class_id, impl in channel._class_map.items():
+        replacement = type(impl)(channel)
+        for name in _KEPT_ATTRIBUTES:
+            if hasattr(impl, name):
+                setattr(replacement, name, getattr(impl, name))
+        setattr(channel, replacement.name, replacement)
+        channel._class_map[class_id] = replacement
+        # Tags of the new connection follow those of the lost one
+        if isinstance(replacement, RecoveringBasicClass):
+            replacement._tag_offset = \
+                impl._tag_offset + impl._last_delivery_tag
+        # What wasn't confirmed on the lost connection is published again
+        outbox = getattr(replacement, '_outbox', None)
+        if outbox is not None:
+            outbox.rewind()
+    if batcher is not None:
+        channel.basic.enable_ack_batching(batcher._max_pending,
+                                          batcher._max_delay)
+
+
+def _release_sync_calls(channel):
+    '''
+    Return from the synchronous calls of a channel that wait for a reply on
+    a connection that's gone.
+    '''
+    for event in channel._pending_events:
+        if isinstance(event, SyncWrapper):
+            event._read = False
+
+
+def _parse_host(host):
+    '''
+    (host, port) of a "host:port" string or a tuple.
+    '''
+    if isinstance(host, basestring):
+        name, _, port = host.rpartition(':')
+        if not name:
+            return (port, 5672)
+        return (name, int(port))
+    return tuple(host)
+
+
+def _encode_publish(msg, exchange, routing_key, mandatory, immediate):
+    '''
+    Encode a publish as an outbox entry: its arguments, the payload of its
+    header frame and its body.
+    '''
+    header = bytearray()
+    HeaderFrame(0, 60, 0, len(msg), msg.properties,
+                msg.raw_header).write_frame(header)
+    writer = Writer()
+    writer.write_shortstr(exchange).\
+        write_shortstr(routing_key).\
+        write_bits(mandatory, immediate).\
+        write_longstr(bytes(header[7:-1])).\
+        write_longstr(msg.body)
+    return writer.buffer()
+
+
+def _decode_publish(data):
+    '''
+    The (msg, exchange, routing_key, mandatory, immediate) of an outbox
+    entry, where msg has the raw header of the publish.
+    '''
+    reader = Reader(data)
+    exchange = reader.read_shortstr()
+    routing_key = reader.read_shortstr()
+    mandatory, immediate = reader.read_bits(2)
+    header = reader.read_longstr()
+    body = reader.read_longstr()
+    return (Message(body, raw_header=header), exchange, routing_key,
+            mandatory, immediate)
+
+
+def _args_key(arguments):
+    '''
+    A hashable key of the arguments of a binding.
+    '''
+    return repr(sorted((arguments or {}).items()))
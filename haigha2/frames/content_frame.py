@@ -4,6 +4,7 @@ Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
 https://github.com/agoragames/haigha/blob/master/LICENSE.txt
 '''
 
+from haigha2.compat import binary_type
 from haigha2.writer import Writer
 from haigha2.frames.frame import Frame
 
@@ -49,9 +50,9 @@ class ContentFrame(Frame):
         self._payload = payload
 
     def __str__(self):
-        if isinstance(self._payload, str):
-            payload = ''.join(['\\x%s' % (c.encode('hex'))
-                               for c in self._payload])
+        if isinstance(self._payload, binary_type):
+            payload = ''.join(['\\x%02x' % c
+                               for c in bytearray(self._payload)])
         else:
             payload = str(self._payload)
 
@@ -6,7 +6,10 @@ https://github.com/agoragames/haigha/blob/master/LICENSE.txt
 
 import struct
 import sys
+from array import array
 from collections import deque
+from haigha2 import speedups
+from haigha2.compat import reraise, range, array_frombytes
 from haigha2.reader import Reader
 
 
@@ -71,9 +74,11 @@ class Frame(object):
                 frame = None
             except Reader.ReaderError as e:
                 # Some other format error
-                raise Frame.FormatError, str(e), sys.exc_info()[-1]
+                reraise(Frame.FormatError, Frame.FormatError(str(e)),
+                        sys.exc_info()[-1])
             except struct.error as e:
-                raise Frame.FormatError, str(e), sys.exc_info()[-1]
+                reraise(Frame.FormatError, Frame.FormatError(str(e)),
+                        sys.exc_info()[-1])
 
             if frame is None:
                 reader.seek(frame_start_pos)
@@ -83,6 +88,56 @@ class Frame(object):
 
         return rval
 
+    @classmethod
+    def scan_frames(cls, reader, header_unpack=struct.Struct('>BHI').unpack_from,
+                    footer_unpack=struct.Struct('B').unpack_from):
+        '''
+        Find the boundaries of all the complete frames in a Reader in one
+        pass, validating their footers and types, and return them as a
+        FrameScan. Frames are only parsed as the FrameScan is iterated over
+        or fetched with `frame()`; Connection buffers the scanned frames on
+        their channels, which parse them when they dispatch them.
+
+        Like read_frames, the Reader is left at the start of the first
+        incomplete frame. Raises FormatError or InvalidFrameType if a frame
+        is malformed, without returning any frames.
+        '''
+        data = reader._input
+        pos = reader._pos
+        end = reader._end_pos
+        type_map = cls._frame_type_map
+        entries = array('l')
+
+        # The compiled codec scans up to the first incomplete or invalid
+        # frame, the loop below finishes the job or raises the error.
+        codec = speedups.codec
+        if codec is not None:
+            packed, pos = codec.scan_frames(data, pos, end, type_map)
+            array_frombytes(entries, packed)
+
+        try:
+            while pos + 8 <= end:
+                frame_type, channel_id, size = header_unpack(data, pos)
+                footer_pos = pos + 7 + size
+                if footer_pos >= end:
+                    break
+                ch = footer_unpack(data, footer_pos)[0]
+                if ch != 0xce:
+                    raise Frame.FormatError(
+                        'Framing error, unexpected byte: %x.  frame type %x. channel %d, payload size %d',
+                        ch, frame_type, channel_id, size)
+                if frame_type not in type_map:
+                    raise Frame.InvalidFrameType(
+                        "Unknown frame type %x", frame_type)
+                entries.extend((frame_type, channel_id, pos + 7, size))
+                pos = footer_pos + 1
+        except struct.error as e:
+            reraise(Frame.FormatError, Frame.FormatError(str(e)),
+                    sys.exc_info()[-1])
+
+        reader._pos = pos
+        return FrameScan(reader, entries)
+
     @classmethod
     def _read_frame(cls, reader):
         '''
@@ -91,16 +146,22 @@ class Frame(object):
 
         Raise MissingFooter if there's a problem reading the footer byte.
         '''
-        frame_type = reader.read_octet()
-        channel_id = reader.read_short()
-        size = reader.read_long()
+        codec = speedups.codec
+        if codec is not None and type(reader) is Reader:
+            frame_type, channel_id, size, ch = codec.read_frame_header(
+                reader._input, reader._pos, reader._end_pos)
+            payload = Reader(reader, reader._pos + 7, size)
+            reader._pos += size + 8
+        else:
+            frame_type, channel_id, size = reader.read_struct('>BHI')
 
-        payload = Reader(reader, reader.tell(), size)
+            payload = Reader(reader, reader.tell(), size)
 
-        # Seek to end of payload
-        reader.seek(size, 1)
+            # Seek to end of payload
+            reader.seek(size, 1)
+
+            ch = reader.read_octet()  # footer
 
-        ch = reader.read_octet()  # footer
         if ch != 0xce:
             raise Frame.FormatError(
                 'Framing error, unexpected byte: %x.  frame type %x. channel %d, payload size %d',
@@ -140,3 +201,68 @@ class Frame(object):
         Write this frame.
         '''
         raise NotImplementedError()
+
+
+class FrameScan(object):
+
+    '''
+    The complete frames in a buffer, as found by Frame.scan_frames. The
+    boundaries of the frames are held in an array of (frame_type, channel_id,
+    offset, size) for each frame, and a frame is only parsed when it is
+    fetched with `frame()` or iterated over. The frames reference the
+    buffer, so it must not be reused while they're in use.
+    '''
+
+    def __init__(self, reader, entries):
+        self._reader = reader
+        self._entries = entries
+
+    def __len__(self):
+        return len(self._entries) // 4
+
+    def __iter__(self):
+        reader = self._reader
+        type_map = Frame._frame_type_map
+        fields = iter(self._entries)
+        try:
+            for frame_type, channel_id, offset, size in \
+                    zip(fields, fields, fields, fields):
+                yield type_map[frame_type].parse(
+                    channel_id, Reader(reader, offset, size))
+        except (Reader.ReaderError, struct.error) as e:
+            reraise(Frame.FormatError, Frame.FormatError(str(e)),
+                    sys.exc_info()[-1])
+
+    def headers(self):
+        '''
+        The (frame_type, channel_id) of each frame, without parsing them.
+        '''
+        entries = self._entries
+        return zip(entries[0::4], entries[1::4])
+
+    def entry(self, i):
+        '''
+        The (frame_type, channel_id, offset, size) of the i'th frame, where
+        offset is the position of its payload in the buffer.
+        '''
+        return tuple(self._entries[4 * i:4 * i + 4])
+
+    def entries(self):
+        '''
+        The (frame_type, channel_id, offset, size) of each frame.
+        '''
+        entries = self._entries
+        return [tuple(entries[i:i + 4]) for i in range(0, len(entries), 4)]
+
+    def frame(self, i):
+        '''
+        Parse the i'th frame. Raises FormatError if its payload is malformed.
+        '''
+        frame_type, channel_id, offset, size = self.entry(i)
+        try:
+            return Frame._frame_type_map[frame_type].parse(
+                channel_id, Reader(self._reader, offset, size))
+        except (Reader.ReaderError, struct.error) as e:
+            # The frame is complete, so running out of payload is an error too
+            reraise(Frame.FormatError, Frame.FormatError(str(e)),
+                    sys.exc_info()[-1])
@@ -6,6 +6,7 @@ https://github.com/agoragames/haigha/blob/master/LICENSE.txt
 
 from collections import deque
 
+from haigha2 import speedups
 from haigha2.writer import Writer
 from haigha2.reader import Reader
 from haigha2.frames.frame import Frame
@@ -47,6 +48,20 @@ class HeaderFrame(Frame):
     ]
     DEFAULT_PROPERTIES = True
 
+    # Set to True to parse table properties (application_headers) with
+    # Reader.read_lazy_table, so that they are only decoded as far as they
+    # are used.
+    LAZY_TABLES = False
+
+    # Set to True to keep the encoded payload of parsed header frames, so that
+    # received messages can be forwarded without re-encoding with
+    # BasicClass.publish_raw.
+    KEEP_RAW_PAYLOAD = False
+
+    # PROPERTIES as passed to the compiled codec, see speedups. Set below.
+    _codec_properties = None
+    _codec_spec = None
+
     @classmethod
     def type(cls):
         return 2
@@ -67,14 +82,25 @@ class HeaderFrame(Frame):
     def properties(self):
         return self._properties
 
+    @property
+    def raw_payload(self):
+        '''
+        The encoded payload of the frame as received, if parsed with
+        KEEP_RAW_PAYLOAD, or to be written in place of encoding the
+        properties. None otherwise.
+        '''
+        return self._raw_payload
+
     @classmethod
     def parse(self, channel_id, payload):
         '''
         Parse a header frame for a channel given a Reader payload.
         '''
-        class_id = payload.read_short()
-        weight = payload.read_short()
-        size = payload.read_longlong()
+        raw_payload = None
+        if self.KEEP_RAW_PAYLOAD:
+            raw_payload = bytes(payload.buffer())
+
+        class_id, weight, size = payload.read_struct('>HHQ')
         properties = {}
 
         # The AMQP spec is overly-complex when it comes to handling header
@@ -88,10 +114,20 @@ class HeaderFrame(Frame):
         # branches for both a fast parse which assumes no changes to the
         # properties and a slow parse. For now it's up to someone using custom
         # headers to flip the flag.
-        if self.DEFAULT_PROPERTIES:
+        lazy_tables = self.LAZY_TABLES
+        codec = speedups.codec
+        if codec is not None and self.DEFAULT_PROPERTIES and \
+                not lazy_tables and type(payload) is Reader and \
+                self.PROPERTIES is self._codec_properties:
+            properties, payload._pos = codec.read_properties(
+                payload._input, payload._pos, payload._end_pos,
+                self._codec_spec)
+        elif self.DEFAULT_PROPERTIES:
             flag_bits = payload.read_short()
             for key, proptype, rfunc, wfunc, mask in self.PROPERTIES:
                 if flag_bits & mask:
+                    if lazy_tables and proptype == 'table':
+                        rfunc = Reader.read_lazy_table
                     properties[key] = rfunc(payload)
         else:
             flags = []
@@ -109,17 +145,22 @@ class HeaderFrame(Frame):
                     flag_bits, flags = flags[0], flags[1:]
                     shift = 15
                 if flag_bits & (1 << shift):
+                    if lazy_tables and proptype == 'table':
+                        rfunc = Reader.read_lazy_table
                     properties[key] = rfunc(payload)
                 shift -= 1
 
-        return HeaderFrame(channel_id, class_id, weight, size, properties)
+        return HeaderFrame(channel_id, class_id, weight, size, properties,
+                           raw_payload)
 
-    def __init__(self, channel_id, class_id, weight, size, properties={}):
+    def __init__(self, channel_id, class_id, weight, size, properties={},
+                 raw_payload=None):
         Frame.__init__(self, channel_id)
         self._class_id = class_id
         self._weight = weight
         self._size = size
         self._properties = properties
+        self._raw_payload = raw_payload
 
     def __str__(self):
         return "%s[channel: %d, class_id: %d, weight: %d, size: %d, properties: %s]" % (
@@ -134,6 +175,13 @@ class HeaderFrame(Frame):
         writer.write_octet(self.type())
         writer.write_short(self.channel_id)
 
+        # A received payload being forwarded is written as is
+        if self._raw_payload is not None:
+            writer.write_long(len(self._raw_payload)).\
+                write(self._raw_payload).\
+                write_octet(0xce)
+            return
+
         # Track the position where we're going to write the total length
         # of the frame arguments.
         stream_args_len_pos = len(buf)
@@ -146,7 +194,18 @@ class HeaderFrame(Frame):
         writer.write_longlong(self._size)
 
         # Like frame parsing, branch to faster code for default properties
-        if self.DEFAULT_PROPERTIES:
+        codec = speedups.codec
+        if codec is not None and self.DEFAULT_PROPERTIES and \
+                type(buf) is bytearray and \
+                type(self._properties) is dict and \
+                self.PROPERTIES is self._codec_properties:
+            flags_pos = len(buf)
+            writer.write_short(0)
+            flag_bits = codec.write_properties(
+                buf, self._properties, self._codec_spec, writer,
+                writer._write_field)
+            writer.write_short_at(flag_bits, flags_pos)
+        elif self.DEFAULT_PROPERTIES:
             # Track the position where we're going to write the flags.
             flags_pos = len(buf)
             writer.write_short(0)
@@ -187,4 +246,12 @@ class HeaderFrame(Frame):
 
         writer.write_octet(0xce)
 
+# The compiled codec reads and writes the default PROPERTIES as a
+# (key, type, mask, wfunc) tuple for each property, with the types numbered.
+HeaderFrame._codec_properties = HeaderFrame.PROPERTIES
+HeaderFrame._codec_spec = tuple(
+    (key, ('shortstr', 'octet', 'table', 'timestamp').index(proptype), mask,
+     wfunc)
+    for key, proptype, rfunc, wfunc, mask in HeaderFrame.PROPERTIES)
+
 HeaderFrame.register()
@@ -33,8 +33,7 @@ class MethodFrame(Frame):
 
     @classmethod
     def parse(self, channel_id, payload):
-        class_id = payload.read_short()
-        method_id = payload.read_short()
+        class_id, method_id = payload.read_struct('>HH')
         return MethodFrame(channel_id, class_id, method_id, payload)
 
     def __init__(self, channel_id, class_id, method_id, args=None):
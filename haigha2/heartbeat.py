@@ -0,0 +1,87 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+from haigha2.frames.heartbeat_frame import HeartbeatFrame
+
+
+class Heartbeat(object):
+
+    '''
+    Sends heartbeats on a connection and checks that the broker is alive,
+    see AMQP 4.2.7, from timers of its transport rather than on every read.
+
+    Every half heartbeat interval, as RabbitMQ does, a heartbeat is sent if
+    no frame has been written since the last check, so that busy
+    connections don't send any, and the connection is closed if nothing has
+    been read for two intervals. Reads and writes are counted rather than
+    timed, so they cost nothing more than an increment.
+    '''
+
+    # Checks without reads after which the broker is presumed dead
+    IDLE_CHECKS = 4
+
+    def __init__(self, connection, interval):
+        self._connection = connection
+        self._interval = interval
+        self._timer = None
+        self._frames_written = connection.frames_written
+        self._reads = connection._reads
+        self._idle_checks = 0
+        self._expired = False
+
+    @property
+    def interval(self):
+        return self._interval
+
+    @property
+    def expired(self):
+        '''Whether the broker was presumed dead and the transport closed.'''
+        return self._expired
+
+    def start(self):
+        '''
+        Schedule the first check. Returns False if the transport doesn't
+        have timers, in which case the connection sends heartbeats itself.
+        '''
+        self._timer = self._connection.transport.call_later(
+            self._interval / 2.0, self._check)
+        return self._timer is not None
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _check(self):
+        connection = self._connection
+        transport = connection.transport
+        if self._timer is None or transport is None or connection.closed:
+            return
+
+        reads = connection._reads
+        if reads != self._reads:
+            self._reads = reads
+            self._idle_checks = 0
+        else:
+            self._idle_checks += 1
+            if self._idle_checks >= self.IDLE_CHECKS:
+                self._timer = None
+                self._expired = True
+                msg = 'Heartbeats not received from %s for %d seconds' % (
+                    connection._host, 2 * self._interval)
+                try:
+                    transport.disconnect()
+                except Exception:
+                    connection.logger.exception(
+                        'error disconnecting from %s', connection._host)
+                connection.transport_closed(msg=msg)
+                return
+
+        if connection.frames_written == self._frames_written:
+            connection.send_frame(HeartbeatFrame(0))
+        self._frames_written = connection.frames_written
+
+        self._timer = transport.call_later(self._interval / 2.0, self._check)
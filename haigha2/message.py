@@ -4,6 +4,11 @@ Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
 https://github.com/agoragames/haigha/blob/master/LICENSE.txt
 '''
 
+from collections import deque
+
+from haigha2.exceptions import ChannelClosed
+from haigha2.frames.content_frame import ContentFrame
+
 
 class Message(object):
 
@@ -12,12 +17,14 @@ class Message(object):
     '''
 
     def __init__(self, body='', delivery_info=None, return_info=None,
-                 **properties):
+                 raw_header=None, **properties):
         '''
         :param delivery_info: pass only if messages was received via
           basic.deliver or basic.get_ok; MUST be None otherwise; default: None
         :param return_info: pass only if message was returned via basic.return;
           MUST be None otherwise; default: None
+        :param raw_header: the encoded header frame payload the message was
+          received with, if kept; see BasicClass.publish_raw; default: None
         '''
         if isinstance(body, unicode):
             if 'content_encoding' not in properties:
@@ -30,6 +37,7 @@ class Message(object):
         self._body = body
         self._delivery_info = delivery_info
         self._return_info = return_info
+        self._raw_header = raw_header
         self._properties = properties
 
     @property
@@ -74,8 +82,156 @@ class Message(object):
     def properties(self):
         return self._properties
 
+    @property
+    def raw_header(self):
+        '''The encoded header frame payload if the message was received with
+        HeaderFrame.KEEP_RAW_PAYLOAD set; None otherwise.
+        '''
+        return self._raw_header
+
     def __str__(self):
         return ("Message[body: %s, delivery_info: %s, return_info: %s, "
                 "properties: %s]") %\
             (str(self._body).encode('string_escape'),
              self._delivery_info, self.return_info, self._properties)
+
+
+class StreamingMessage(Message):
+
+    '''
+    A message received by a streaming consumer. It is passed to the consumer
+    as soon as its header arrives; the body is a BodyStream which receives the
+    content as it arrives, so that large bodies need never be held in memory
+    in full.
+    '''
+
+    def __init__(self, body, delivery_info=None, return_info=None,
+                 **properties):
+        if not isinstance(body, BodyStream):
+            raise TypeError("Invalid message content type %s" % (type(body)))
+
+        self._body = body
+        self._delivery_info = delivery_info
+        self._return_info = return_info
+        self._raw_header = None
+        self._properties = properties
+
+    def __len__(self):
+        return self._body.size
+
+    def __str__(self):
+        return ("StreamingMessage[body: %s, delivery_info: %s, "
+                "return_info: %s, properties: %s]") %\
+            (self._body, self._delivery_info, self.return_info,
+             self._properties)
+
+
+class BodyStream(object):
+
+    '''
+    File-like body of a StreamingMessage. Content is appended as content
+    frames arrive on the channel and is released as it is read.
+
+    On a synchronous channel, `read()` and iteration block, reading frames
+    from the connection, until the requested content has arrived. Otherwise
+    they return only what has arrived so far, and `set_listener()` should be
+    used to be called back as content arrives.
+    '''
+
+    def __init__(self, channel, size):
+        self._channel = channel
+        self._size = size
+        self._received = 0
+        self._chunks = deque()
+        self._listener = None
+
+    @property
+    def size(self):
+        '''Total size of the body.'''
+        return self._size
+
+    @property
+    def received(self):
+        '''Number of bytes of the body that have arrived.'''
+        return self._received
+
+    @property
+    def complete(self):
+        '''Whether all of the body has arrived.'''
+        return self._received >= self._size
+
+    def __str__(self):
+        return "BodyStream[size: %d, received: %d]" % (
+            self._size, self._received)
+
+    def set_listener(self, listener):
+        '''
+        Set a callable to be called with each chunk of the body as it arrives,
+        and with None once the body is complete. Chunks that have already
+        arrived and not been read are passed to it immediately.
+        '''
+        self._listener = listener
+        while self._chunks:
+            listener(self._chunks.popleft())
+        if self.complete:
+            listener(None)
+
+    def read(self, size=-1):
+        '''
+        Read up to size bytes, or the rest of the body if size is negative.
+        Returns an empty string at the end of the body.
+        '''
+        rval = []
+        remaining = size
+        while remaining != 0:
+            if not self._chunks and not self._wait():
+                break
+            chunk = self._chunks.popleft()
+            if 0 < remaining < len(chunk):
+                self._chunks.appendleft(chunk[remaining:])
+                chunk = chunk[:remaining]
+            rval.append(chunk)
+            remaining -= len(chunk)
+        return b''.join(rval)
+
+    def __iter__(self):
+        '''
+        Iterate over the chunks of the body, one per content frame.
+        '''
+        while self._chunks or self._wait():
+            yield self._chunks.popleft()
+
+    def _wait(self):
+        '''
+        Wait for another chunk if on a synchronous channel and the body is
+        incomplete. Returns whether a chunk is available.
+        '''
+        channel = self._channel
+        if not channel.synchronous:
+            return bool(self._chunks)
+        while not self._chunks and not self.complete:
+            if channel.closed:
+                raise ChannelClosed(
+                    "channel %d closed before message body was received",
+                    channel.channel_id)
+            # Content frames read along with the header are already buffered
+            # on the channel, and mustn't be waited for on the socket
+            if isinstance(channel.peek_frame(), ContentFrame) and \
+                    channel._content_receiver is not None:
+                channel._content_receiver(channel.next_frame())
+            else:
+                channel.connection.read_frames()
+        return bool(self._chunks)
+
+    def _feed(self, chunk):
+        '''
+        Append a chunk of the body as it arrives on the channel.
+        '''
+        self._received += len(chunk)
+        if self._listener:
+            if chunk:
+                self._listener(chunk)
+            if self.complete:
+                self._listener(None)
+        elif chunk:
+            self._chunks.append(chunk)
@@ -0,0 +1,292 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+
+Metrics for the hot paths of connections, channels and consumers.
+
+Metrics are disabled unless a Connection is created with `metrics=True`, or
+with a Metrics instance to share between connections, in which case the
+cost on the hot paths is an attribute check. When enabled, recording an
+event increments a counter or a bucket of a histogram that was created up
+front. A snapshot of all metrics is passed to the registered exporters on
+each call to `Metrics.export()`:
+
+    metrics = Metrics(exporters=[LoggingExporter(logger)])
+    connection = Connection(metrics=metrics, ...)
+    ...
+    metrics.export()
+
+The counters of connections that share a Metrics are summed, while their
+gauges and the counters of their channels are named per connection, e.g.
+`connection.1.write_queue_bytes` and `connection.1.channel.2.published`.
+'''
+
+import itertools
+import logging
+from bisect import bisect_left
+
+# Bounds of the buckets of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Names of the frame types counted separately; others are counted as 'other'
+FRAME_TYPE_NAMES = {
+    1: 'method',
+    2: 'header',
+    3: 'content',
+    8: 'heartbeat',
+}
+
+
+class Counter(object):
+
+    '''
+    A count of events, or of bytes.
+    '''
+
+    __slots__ = ('name', 'value')
+
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge(object):
+
+    '''
+    A value that is only sampled when a snapshot is taken, by calling func.
+    '''
+
+    __slots__ = ('name', 'func')
+
+    def __init__(self, name, func):
+        self.name = name
+        self.func = func
+
+    def snapshot(self):
+        return self.func()
+
+
+class Histogram(object):
+
+    '''
+    The distribution of observed values over fixed buckets. Bucket i counts
+    the values v where bounds[i-1] < v <= bounds[i], and an extra bucket
+    counts the values above the last bound.
+    '''
+
+    __slots__ = ('name', 'bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, name, bounds=LATENCY_BUCKETS):
+        self.name = name
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        '''
+        Return a dict of the count and sum of the observed values, and of
+        the buckets as a list of (upper bound, count), where the upper bound
+        of the last bucket is None.
+        '''
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': list(zip(self.bounds + (None,), self.counts)),
+        }
+
+
+class ChannelMetrics(object):
+
+    '''
+    The metrics recorded by a channel and its protocol classes. Histograms
+    are shared by all the channels of a Metrics.
+    '''
+
+    def __init__(self, metrics, channel_id, prefix=''):
+        prefix = '%schannel.%d.' % (prefix, channel_id)
+        self.published = metrics.counter(prefix + 'published')
+        self.delivered = metrics.counter(prefix + 'delivered')
+        self.acked = metrics.counter(prefix + 'acked')
+        self.sync_latency = metrics.sync_latency
+        self.reassembly_time = metrics.reassembly_time
+        self.consumer_time = metrics.consumer_time
+
+
+class Metrics(object):
+
+    '''
+    A registry of counters, gauges and histograms, by name. The metrics that
+    the connection, channels and consumers record are attributes, so that
+    they are not looked up by name on the hot paths.
+    '''
+
+    def __init__(self, exporters=()):
+        self._metrics = {}
+        self._channels = {}
+        self._exporters = list(exporters)
+        self._connection_ids = itertools.count(1)
+
+        self.bytes_in = self.counter('connection.bytes_in')
+        self.bytes_out = self.counter('connection.bytes_out')
+
+        # Frames read and written, indexed by frame type
+        self.frames_in = self._frame_counters('connection.frames_in')
+        self.frames_out = self._frame_counters('connection.frames_out')
+
+        # From sending a synchronous method to the callback on its reply
+        self.sync_latency = self.histogram('channel.sync_latency')
+
+        # From receiving a content-bearing method to its last content frame
+        self.reassembly_time = self.histogram('basic.reassembly_time')
+
+        # Time spent in consumer callbacks
+        self.consumer_time = self.histogram('basic.consumer_time')
+
+    def _frame_counters(self, prefix):
+        other = self.counter(prefix + '.other')
+        counters = [other] * 256
+        for frame_type, name in FRAME_TYPE_NAMES.items():
+            counters[frame_type] = self.counter('%s.%s' % (prefix, name))
+        return counters
+
+    def _register(self, name, cls, *args):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, *args)
+        elif not isinstance(metric, cls):
+            raise ValueError('%s is a %s, not a %s' % (
+                name, type(metric).__name__, cls.__name__))
+        return metric
+
+    def counter(self, name):
+        '''
+        Get or create the Counter called name.
+        '''
+        return self._register(name, Counter)
+
+    def histogram(self, name, bounds=LATENCY_BUCKETS):
+        '''
+        Get or create the Histogram called name. The bounds only apply when
+        it is created.
+        '''
+        return self._register(name, Histogram, bounds)
+
+    def gauge(self, name, func):
+        '''
+        Register a Gauge called name whose value is func(), replacing any
+        gauge of that name.
+        '''
+        gauge = self._register(name, Gauge, func)
+        gauge.func = func
+        return gauge
+
+    def remove(self, name):
+        '''
+        Remove the metric called name, if there is one.
+        '''
+        self._metrics.pop(name, None)
+
+    def connection_prefix(self):
+        '''
+        Return a prefix for the names of the metrics of a new connection,
+        `connection.<n>.`, which no other connection of this Metrics has.
+        '''
+        return 'connection.%d.' % (next(self._connection_ids))
+
+    def channel(self, channel_id, prefix=''):
+        '''
+        Get or create the ChannelMetrics for a channel id of the connection
+        whose metrics are named with prefix.
+        '''
+        key = (prefix, channel_id)
+        channel = self._channels.get(key)
+        if channel is None:
+            channel = self._channels[key] = \
+                ChannelMetrics(self, channel_id, prefix)
+        return channel
+
+    def remove_channel(self, channel_id, prefix=''):
+        '''
+        Remove the ChannelMetrics for a channel id of the connection whose
+        metrics are named with prefix, and its counters, if there is one. A
+        channel that reuses the id starts counting from zero.
+        '''
+        channel = self._channels.pop((prefix, channel_id), None)
+        if channel is not None:
+            for counter in (channel.published, channel.delivered,
+                            channel.acked):
+                self.remove(counter.name)
+
+    def remove_channels(self, prefix=''):
+        '''
+        Remove the ChannelMetrics of every channel of the connection whose
+        metrics are named with prefix, and their counters.
+        '''
+        for key in [key for key in self._channels if key[0] == prefix]:
+            self.remove_channel(key[1], prefix)
+
+    def snapshot(self):
+        '''
+        Return a dict of the current value of every metric, by name.
+        '''
+        return dict((name, metric.snapshot())
+                    for name, metric in self._metrics.items())
+
+    def add_exporter(self, exporter):
+        self._exporters.append(exporter)
+
+    def remove_exporter(self, exporter):
+        self._exporters.remove(exporter)
+
+    def export(self):
+        '''
+        Take a snapshot and pass it to every exporter. Returns the snapshot.
+        '''
+        snapshot = self.snapshot()
+        for exporter in self._exporters:
+            exporter.export(snapshot)
+        return snapshot
+
+
+class Exporter(object):
+
+    '''
+    Interface of the exporters passed snapshots by Metrics.export(), e.g. to
+    send them to a monitoring system.
+    '''
+
+    def export(self, snapshot):
+        '''
+        Export a snapshot, a dict of the values of metrics by name.
+        '''
+        raise NotImplementedError()
+
+
+class LoggingExporter(Exporter):
+
+    '''
+    Logs every metric of a snapshot, one per line.
+    '''
+
+    def __init__(self, logger, level=logging.INFO):
+        self._logger = logger
+        self._level = level
+
+    def export(self, snapshot):
+        for name in sorted(snapshot):
+            self._logger.log(self._level, 'metric %s %s', name,
+                             snapshot[name])
@@ -0,0 +1,336 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+
+Bounded logs of messages to publish, which keep them until the broker has
+confirmed them, so that publishes made while a connection is down, or not
+confirmed when it was lost, are published again once it's recovered. See
+RecoveringBasicClass.set_outbox().
+
+Entries are opaque byte strings numbered in the order they were appended.
+They're handed out in that order by unsent(), and again after rewind(), until
+they're removed:
+
+    outbox = Outbox(max_messages=10000)
+    seq = outbox.append(data)
+    for seq, data in outbox.unsent():
+        send(data)
+    outbox.remove(seq)
+'''
+
+from collections import OrderedDict, deque
+import mmap
+import os
+import struct
+
+
+class Outbox(object):
+
+    '''
+    An outbox in memory, limited to max_messages entries and max_bytes bytes
+    of entries if they're given. When it's full, append() raises
+    Outbox.Full, or drops the oldest entries if drop_oldest is True.
+    '''
+
+    class Full(Exception):
+        '''The outbox can't take another entry.'''
+
+    def __init__(self, max_messages=None, max_bytes=None, drop_oldest=False):
+        self._max_messages = max_messages
+        self._max_bytes = max_bytes
+        self._drop_oldest = drop_oldest
+
+        # Handles of the entries by sequence number, in order
+        self._entries = OrderedDict()
+        # Sequence numbers of the entries to hand out, some of which may
+        # have been removed since
+        self._unsent = deque()
+        self._next_seq = 1
+        self._size = 0
+        self._dropped = 0
+
+    def __len__(self):
+        '''The number of entries.'''
+        return len(self._entries)
+
+    @property
+    def size(self):
+        '''The number of bytes of the entries.'''
+        return self._size
+
+    @property
+    def dropped(self):
+        '''The number of entries dropped to make room for new ones.'''
+        return self._dropped
+
+    def append(self, data):
+        '''
+        Append an entry and return its sequence number.
+        '''
+        size = len(data)
+        if not self._fits(size):
+            raise Outbox.Full('entry of %d bytes is larger than the outbox' %
+                              (size))
+        while self._full(size):
+            if not self._drop_oldest:
+                raise Outbox.Full('outbox is full with %d entries of %d bytes'
+                                  % (len(self._entries), self._size))
+            self.remove(next(iter(self._entries)))
+            self._dropped += 1
+
+        seq = self._next_seq
+        self._next_seq += 1
+        self._entries[seq] = self._store(seq, data)
+        self._size += size
+        self._unsent.append(seq)
+        return seq
+
+    def unsent(self):
+        '''
+        Iterate over the (seq, data) of the entries that haven't been handed
+        out since they were appended or since rewind(), in order. An entry is
+        handed out once the next one is asked for.
+        '''
+        unsent = self._unsent
+        while unsent:
+            seq = unsent[0]
+            handle = self._entries.get(seq)
+            if handle is not None:
+                yield seq, self._load(handle)
+            unsent.popleft()
+
+    def rewind(self):
+        '''
+        Hand out all of the entries again.
+        '''
+        self._unsent = deque(self._entries)
+
+    def remove(self, seq):
+        '''
+        Remove an entry. Returns False if there's no entry with that
+        sequence number.
+        '''
+        handle = self._entries.pop(seq, None)
+        if handle is None:
+            return False
+        self._size -= self._discard(seq, handle)
+        return True
+
+    def close(self):
+        '''
+        Release the storage of the outbox.
+        '''
+
+    def _full(self, size):
+        '''
+        Whether an entry of size bytes has to wait for others to be removed.
+        '''
+        if self._max_messages is not None and \
+                len(self._entries) >= self._max_messages:
+            return True
+        if self._max_bytes is not None and \
+                self._size + size > self._max_bytes:
+            return True
+        return False
+
+    def _fits(self, size):
+        '''
+        Whether an entry of size bytes fits in the empty outbox.
+        '''
+        return self._max_bytes is None or size <= self._max_bytes
+
+    def _store(self, seq, data):
+        '''
+        Store an entry, and return the handle to load it with.
+        '''
+        return bytes(data)
+
+    def _load(self, handle):
+        return handle
+
+    def _discard(self, seq, handle):
+        '''
+        Release the storage of an entry, and return its size.
+        '''
+        return len(handle)
+
+
+class MmapOutbox(Outbox):
+
+    '''
+    An outbox in a memory-mapped file of capacity bytes, so that entries
+    that were never removed are kept when the process exits, and loaded by
+    the next MmapOutbox on the same file. The file is a ring of records in
+    the order they were appended; the space of a record is reused once it
+    and all the records before it have been removed.
+
+    Writes reach the file when the operating system writes the pages back,
+    or on flush().
+    '''
+
+    MAGIC = b'HGOB'
+    VERSION = 1
+
+    # magic, version, capacity, head, tail, next sequence number, wrapped
+    HEADER = struct.Struct('>4sHQQQQ?')
+
+    # length of the data, sequence number, live
+    RECORD = struct.Struct('>IQ?')
+
+    def __init__(self, path, capacity=16 * 1024 * 1024, max_messages=None,
+                 drop_oldest=False):
+        super(MmapOutbox, self).__init__(max_messages=max_messages,
+                                         drop_oldest=drop_oldest)
+        self._path = path
+        self._capacity = capacity
+        self._base = self.HEADER.size
+
+        # Offsets in the ring of the oldest record and of the end of the
+        # newest one, which is before the oldest when the ring has wrapped
+        self._head = 0
+        self._tail = 0
+        self._wrapped = False
+
+        length = self._base + capacity
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            existing = os.fstat(fd).st_size
+            if existing != length:
+                os.ftruncate(fd, length)
+            self._mmap = mmap.mmap(fd, length)
+        finally:
+            os.close(fd)
+
+        if existing == length and self._load_ring():
+            self.rewind()
+        else:
+            self._write_header()
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    def flush(self):
+        '''
+        Write the entries to the file.
+        '''
+        self._mmap.flush()
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _load_ring(self):
+        '''
+        Load the live records of the file. Returns False if it isn't an
+        outbox of the same capacity.
+        '''
+        magic, version, capacity, head, tail, next_seq, wrapped = \
+            self.HEADER.unpack_from(self._mmap, 0)
+        if magic != self.MAGIC or version != self.VERSION or \
+                capacity != self._capacity:
+            return False
+
+        offset = head
+        end = self._capacity if wrapped else tail
+        before_wrap = wrapped
+        while True:
+            if offset >= end or end - offset < self.RECORD.size:
+                if not before_wrap:
+                    break
+                offset, end, before_wrap = 0, tail, False
+                continue
+            size, seq, live = self.RECORD.unpack_from(
+                self._mmap, self._base + offset)
+            if not size and not seq:
+                # Marks where the ring wrapped
+                offset = end
+                continue
+            if live:
+                self._entries[seq] = offset
+                self._size += size
+            offset += self.RECORD.size + size
+
+        self._head, self._tail, self._wrapped = head, tail, bool(wrapped)
+        self._next_seq = next_seq
+        if self._entries:
+            self._head = next(iter(self._entries.values()))
+        return True
+
+    def _write_header(self):
+        self.HEADER.pack_into(
+            self._mmap, 0, self.MAGIC, self.VERSION, self._capacity,
+            self._head, self._tail, self._next_seq, self._wrapped)
+
+    def _allocate(self, length):
+        '''
+        The offset at which to write a record of length bytes, or None if
+        there's no room for it.
+        '''
+        if not self._entries:
+            return 0 if length <= self._capacity else None
+        if self._wrapped:
+            return self._tail if self._head - self._tail >= length else None
+        if self._capacity - self._tail >= length:
+            return self._tail
+        if self._head >= length:
+            return 0
+        return None
+
+    def _fits(self, size):
+        return self.RECORD.size + size <= self._capacity
+
+    def _full(self, size):
+        return super(MmapOutbox, self)._full(size) or \
+            self._allocate(self.RECORD.size + size) is None
+
+    def _store(self, seq, data):
+        length = self.RECORD.size + len(data)
+        offset = self._allocate(length)
+        if not self._entries:
+            self._head = offset
+            self._wrapped = False
+        elif offset < self._tail:
+            # Mark the end of the records before wrapping, unless there's
+            # no room for a record there
+            if self._capacity - self._tail >= self.RECORD.size:
+                self.RECORD.pack_into(self._mmap, self._base + self._tail,
+                                      0, 0, False)
+            self._wrapped = True
+
+        position = self._base + offset
+        self.RECORD.pack_into(self._mmap, position, len(data), seq, True)
+        position += self.RECORD.size
+        self._mmap[position:position + len(data)] = bytes(data)
+        self._tail = offset + length
+        self._next_seq = seq + 1
+        self._write_header()
+        return offset
+
+    def _load(self, offset):
+        size = self.RECORD.unpack_from(self._mmap, self._base + offset)[0]
+        position = self._base + offset + self.RECORD.size
+        return self._mmap[position:position + size]
+
+    def _discard(self, seq, offset):
+        position = self._base + offset
+        size = self.RECORD.unpack_from(self._mmap, position)[0]
+        self.RECORD.pack_into(self._mmap, position, size, seq, False)
+
+        if offset == self._head:
+            if self._entries:
+                head = next(iter(self._entries.values()))
+                if head < self._head:
+                    self._wrapped = False
+                self._head = head
+            else:
+                self._head = self._tail = 0
+                self._wrapped = False
+            self._write_header()
+        return size
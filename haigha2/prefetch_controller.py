@@ -0,0 +1,220 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+import time
+
+
+class PrefetchController(object):
+
+    '''
+    Adaptive prefetch for a consumer. Wraps a consumer callback, tracks the
+    deliveries that it holds unacknowledged and how long each of them takes
+    from delivery to ack, and re-issues basic.qos using additive-increase /
+    multiplicative-decrease against a latency target. While deliveries are
+    completed faster than `target_latency`, the prefetch window grows by
+    `increase` every adjustment round; when they are slower, it is multiplied
+    by `decrease`.
+
+    The controller is itself the consumer that should be passed to
+    basic.consume, which must be called with no_ack=False. Deliveries must be
+    acked or rejected through the controller, either explicitly from the
+    consumer via `ack()` and `reject()`, or implicitly after the consumer
+    returns when constructed with auto_ack=True:
+
+        controller = PrefetchController(ch, consumer, auto_ack=True)
+        ch.basic.consume('queue', controller, no_ack=False)
+
+    RabbitMQ NOTE: RabbitMQ applies a per-consumer prefetch (is_global=False)
+    only to consumers started after it, so adjustments would never reach the
+    consumer being controlled. The default, is_global=True, sets the limit of
+    the channel instead, which RabbitMQ applies immediately; give each
+    controlled consumer its own channel.
+    '''
+
+    def __init__(self, channel, consumer, initial_prefetch=10,
+                 min_prefetch=1, max_prefetch=1000, target_latency=1.0,
+                 increase=1, decrease=0.5, is_global=True, auto_ack=False):
+        '''
+        Initialize the controller on a channel and immediately set the
+        initial prefetch count with basic.qos.
+
+        :param channel: Channel on which the consumer will be started
+        :param consumer: callable consumer(Message)
+        :param initial_prefetch: prefetch count to start with
+        :param min_prefetch: lower bound for the prefetch count
+        :param max_prefetch: upper bound for the prefetch count
+        :param target_latency: seconds from delivery to ack above which the
+          prefetch window is reduced
+        :param increase: additive increase of the window per round
+        :param decrease: multiplicative decrease of the window, 0 < x < 1
+        :param is_global: passed through to basic.qos, see the note above
+        :param auto_ack: ack each delivery after the consumer returns
+        '''
+        if not 0 < min_prefetch <= initial_prefetch <= max_prefetch:
+            raise ValueError(
+                'expected 0 < min_prefetch <= initial_prefetch <= '
+                'max_prefetch, got %r, %r, %r' % (
+                    min_prefetch, initial_prefetch, max_prefetch))
+        if not 0 < decrease < 1:
+            raise ValueError('decrease must be between 0 and 1, got %r' % (
+                decrease,))
+
+        self._channel = channel
+        self._consumer = consumer
+        self._min_prefetch = min_prefetch
+        self._max_prefetch = max_prefetch
+        self._target_latency = target_latency
+        self._increase = increase
+        self._decrease = decrease
+        self._is_global = is_global
+        self._auto_ack = auto_ack
+
+        # Mapping of unacked delivery tags to the time they were delivered
+        self._in_flight = {}
+
+        self._delivered = 0
+        self._completed = 0
+
+        # State for the current adjustment round
+        self._round_start = time.time()
+        self._round_completed = 0
+        self._round_latency = 0.0
+        self._round_callback_time = 0.0
+
+        # Results of the last completed round
+        self._processing_rate = 0.0
+        self._avg_latency = 0.0
+        self._avg_callback_time = 0.0
+
+        self._prefetch_count = None
+        self._set_prefetch(initial_prefetch)
+
+    @property
+    def channel(self):
+        return self._channel
+
+    @property
+    def prefetch_count(self):
+        '''The prefetch count most recently requested with basic.qos.'''
+        return self._prefetch_count
+
+    @property
+    def in_flight(self):
+        '''Number of deliveries that have not yet been acked or rejected.'''
+        return len(self._in_flight)
+
+    @property
+    def delivered(self):
+        '''Number of deliveries in the lifetime of this controller.'''
+        return self._delivered
+
+    @property
+    def completed(self):
+        '''Number of deliveries acked or rejected through this controller.'''
+        return self._completed
+
+    @property
+    def processing_rate(self):
+        '''Completions per second measured over the last adjustment round.'''
+        return self._processing_rate
+
+    @property
+    def avg_latency(self):
+        '''Mean seconds from delivery to ack over the last round.'''
+        return self._avg_latency
+
+    @property
+    def avg_callback_time(self):
+        '''Mean seconds spent in the consumer over the last round.'''
+        return self._avg_callback_time
+
+    def __call__(self, msg):
+        '''
+        Consumer entry point for basic.consume.
+        '''
+        delivery_tag = msg.delivery_info['delivery_tag']
+        start = time.time()
+        self._in_flight[delivery_tag] = start
+        self._delivered += 1
+
+        try:
+            self._consumer(msg)
+        finally:
+            self._round_callback_time += time.time() - start
+
+        if self._auto_ack and delivery_tag in self._in_flight:
+            self.ack(delivery_tag)
+
+    def ack(self, delivery_tag, multiple=False):
+        '''
+        Acknowledge a delivery through basic.ack and account for it. If
+        multiple=True, acknowledge up to and including delivery_tag.
+        '''
+        self._channel.basic.ack(delivery_tag, multiple=multiple)
+        self._complete(delivery_tag, multiple)
+
+    def reject(self, delivery_tag, requeue=False):
+        '''
+        Reject a delivery through basic.reject and account for it.
+        '''
+        self._channel.basic.reject(delivery_tag, requeue=requeue)
+        self._complete(delivery_tag, False)
+
+    def _complete(self, delivery_tag, multiple):
+        '''
+        Record completion of one or more deliveries and adjust the prefetch
+        count at the end of each round.
+        '''
+        now = time.time()
+        if multiple:
+            tags = [t for t in self._in_flight if t <= delivery_tag]
+        elif delivery_tag in self._in_flight:
+            tags = [delivery_tag]
+        else:
+            return
+
+        for tag in tags:
+            self._round_latency += now - self._in_flight.pop(tag)
+        self._completed += len(tags)
+        self._round_completed += len(tags)
+
+        # A round is one window's worth of completions, so the window is
+        # adjusted about once per round trip of the pipeline.
+        if self._round_completed >= self._prefetch_count:
+            self._end_round(now)
+
+    def _end_round(self, now):
+        '''
+        Compute the metrics for the round that just completed and apply
+        AIMD to the prefetch count.
+        '''
+        elapsed = now - self._round_start
+        if elapsed > 0:
+            self._processing_rate = self._round_completed / elapsed
+        self._avg_latency = self._round_latency / self._round_completed
+        self._avg_callback_time = \
+            self._round_callback_time / self._round_completed
+
+        self._round_start = now
+        self._round_completed = 0
+        self._round_latency = 0.0
+        self._round_callback_time = 0.0
+
+        if self._avg_latency > self._target_latency:
+            prefetch = int(self._prefetch_count * self._decrease)
+        else:
+            prefetch = self._prefetch_count + self._increase
+        self._set_prefetch(
+            max(self._min_prefetch, min(self._max_prefetch, prefetch)))
+
+    def _set_prefetch(self, prefetch_count):
+        '''
+        Issue basic.qos if the prefetch count changed.
+        '''
+        if prefetch_count != self._prefetch_count:
+            self._prefetch_count = prefetch_count
+            self._channel.basic.qos(prefetch_count=prefetch_count,
+                                    is_global=self._is_global)
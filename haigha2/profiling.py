@@ -0,0 +1,200 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+
+A sampling profiler of the stages that frames go through in a connection.
+
+Profiling is disabled unless a Connection is created with `profiler=True`,
+or with a StageProfiler, in which case a random sample of the calls to
+`Connection.read_frames()` and `Connection.send_frame()` are profiled. The
+wall and CPU time of a sampled call are attributed to the stage it was in:
+
+    decode       finding the frames in the bytes read
+    dispatch     parsing and handling frames on their channels, other than
+                 the stages below
+    reassembly   accumulating the content of messages and building Message
+                 objects
+    callback     consumer callbacks, other than the stages that they call
+    write        encoding and writing frames
+
+Each stage is timed apart from the stages nested in it, so that the time
+of a consumer that acks a message is split between callback and write.
+Unsampled calls cost a random number and an attribute check per stage:
+
+    profiler = StageProfiler(sample_rate=0.01, interval=60, logger=logger)
+    connection = Connection(profiler=profiler, ...)
+    ...
+    profiler.snapshot()
+'''
+
+import logging
+import random
+import time
+from timeit import default_timer
+
+DECODE = 0
+DISPATCH = 1
+REASSEMBLY = 2
+CALLBACK = 3
+WRITE = 4
+
+STAGES = ('decode', 'dispatch', 'reassembly', 'callback', 'write')
+
+# CPU time of the current thread where available, else of the process
+if hasattr(time, 'thread_time'):
+    cpu_timer = time.thread_time
+elif hasattr(time, 'process_time'):
+    cpu_timer = time.process_time
+else:
+    cpu_timer = time.clock
+
+
+class StageProfiler(object):
+
+    '''
+    Attributes the wall and CPU time of a sample of reads and writes to the
+    stages in STAGES. If a logger is given, a summary is logged every
+    `interval` seconds, checked at the end of each sample.
+    '''
+
+    def __init__(self, sample_rate=0.01, interval=60.0, logger=None,
+                 level=logging.INFO):
+        self._sample_rate = sample_rate
+        self._interval = interval
+        self._logger = logger
+        self._level = level
+        self._random = random.random
+
+        # True while a read or write is being sampled
+        self.sampling = False
+
+        # Nested reads and writes of the current sample, the stages that
+        # they're in, and the depth of the stage stack at the start of each
+        self._depth = 0
+        self._stack = []
+        self._bases = []
+        self._wall_mark = 0.0
+        self._cpu_mark = 0.0
+
+        self.reset()
+        self._last_log = default_timer()
+
+    @property
+    def sample_rate(self):
+        return self._sample_rate
+
+    def reset(self):
+        '''
+        Clear the times recorded so far.
+        '''
+        self._operations = 0
+        self._samples = 0
+        self._calls = [0] * len(STAGES)
+        self._wall = [0.0] * len(STAGES)
+        self._cpu = [0.0] * len(STAGES)
+
+    def begin(self):
+        '''
+        Called at the start of a read or write. Returns True if it's sampled,
+        in which case end() must be called after it.
+        '''
+        if self._depth:
+            self._depth += 1
+            self._bases.append(len(self._stack))
+            return True
+
+        self._operations += 1
+        if self._random() >= self._sample_rate:
+            return False
+        self.sampling = True
+        self._depth = 1
+        self._bases.append(0)
+        return True
+
+    def end(self):
+        '''
+        Called at the end of a sampled read or write. Ends any stages that
+        it entered and didn't exit, such as when an exception was raised.
+        '''
+        base = self._bases.pop()
+        while len(self._stack) > base:
+            self.exit()
+        self._depth -= 1
+        if self._depth:
+            return
+
+        self.sampling = False
+        self._samples += 1
+        if self._logger is not None:
+            now = default_timer()
+            if now - self._last_log >= self._interval:
+                self._last_log = now
+                self.log()
+
+    def enter(self, stage):
+        '''
+        Enter a stage, if sampling. The time since the last stage was
+        entered or exited is attributed to the stage that was current.
+        '''
+        if not self.sampling:
+            return
+        wall = default_timer()
+        cpu = cpu_timer()
+        stack = self._stack
+        if stack:
+            current = stack[-1]
+            self._wall[current] += wall - self._wall_mark
+            self._cpu[current] += cpu - self._cpu_mark
+        stack.append(stage)
+        self._calls[stage] += 1
+        self._wall_mark = wall
+        self._cpu_mark = cpu
+
+    def exit(self):
+        '''
+        Exit the current stage, if sampling, and resume the stage that it
+        was entered from.
+        '''
+        if not self.sampling:
+            return
+        wall = default_timer()
+        cpu = cpu_timer()
+        stage = self._stack.pop()
+        self._wall[stage] += wall - self._wall_mark
+        self._cpu[stage] += cpu - self._cpu_mark
+        self._wall_mark = wall
+        self._cpu_mark = cpu
+
+    def snapshot(self):
+        '''
+        Return a dict of the reads and writes seen, those sampled, and the
+        calls, wall and CPU seconds of each stage over the samples.
+        '''
+        return {
+            'sample_rate': self._sample_rate,
+            'operations': self._operations,
+            'samples': self._samples,
+            'stages': dict(
+                (name, {
+                    'calls': self._calls[i],
+                    'wall': self._wall[i],
+                    'cpu': self._cpu[i],
+                }) for i, name in enumerate(STAGES)),
+        }
+
+    def log(self):
+        '''
+        Log the share of the wall time of each stage, and its wall and CPU
+        milliseconds per sample.
+        '''
+        samples = self._samples
+        total = sum(self._wall)
+        self._logger.log(
+            self._level, 'profile %d of %d operations: %s', samples,
+            self._operations, ', '.join(
+                '%s %.1f%% %.3f/%.3fms' % (
+                    name, 100.0 * self._wall[i] / total if total else 0.0,
+                    1000.0 * self._wall[i] / samples if samples else 0.0,
+                    1000.0 * self._cpu[i] / samples if samples else 0.0)
+                for i, name in enumerate(STAGES)))
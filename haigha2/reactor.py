@@ -0,0 +1,202 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+
+An event loop that runs many connections in one thread.
+
+A Reactor owns a selector (epoll on Linux) shared by the connections that
+are created on it, reads frames from them when they're readable, writes
+their buffered output when they're writable, and runs timers, including
+the heartbeats of its connections, from a single heap:
+
+    reactor = Reactor()
+    for host in hosts:
+        connection = Connection(host=host, transport='selector',
+                                reactor=reactor)
+        ...
+    reactor.call_every(60, report)
+    reactor.run()
+'''
+
+import heapq
+import itertools
+import time
+from logging import root as root_logger
+
+from haigha2.transports.selector_transport import DefaultSelector, \
+    EVENT_READ, EVENT_WRITE
+
+
+class Timer(object):
+
+    '''
+    A callback scheduled on a Reactor. Periodic timers have an interval.
+    '''
+
+    __slots__ = ('deadline', 'interval', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline, interval, callback, args):
+        self.deadline = deadline
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        '''
+        Cancel the timer. It's removed from the heap when it's due.
+        '''
+        self.cancelled = True
+
+
+class Reactor(object):
+
+    '''
+    Runs the connections of SelectorTransports created with
+    `reactor=reactor`, and timers, including the heartbeats of the
+    connections, until stop() is called or there's nothing left to run.
+    Exceptions raised while handling a connection or running a timer are
+    logged, so that they don't stop the others.
+    '''
+
+    def __init__(self, selector=None, logger=None):
+        self._selector = selector or DefaultSelector()
+        self._logger = logger or root_logger
+        self._timers = []
+        self._counter = itertools.count()
+        self._transports = set()
+        self._running = False
+
+    @property
+    def selector(self):
+        return self._selector
+
+    @property
+    def running(self):
+        return self._running
+
+    @property
+    def transports(self):
+        '''The transports of the connections run by this reactor.'''
+        return list(self._transports)
+
+    ###
+    # Timers
+    ###
+    def _schedule(self, timer):
+        heapq.heappush(
+            self._timers, (timer.deadline, next(self._counter), timer))
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        '''
+        Call callback(*args) in delay seconds. Returns a Timer.
+        '''
+        return self._schedule(
+            Timer(time.time() + delay, None, callback, args))
+
+    def call_every(self, interval, callback, *args):
+        '''
+        Call callback(*args) every interval seconds, the first time in
+        interval seconds. Returns a Timer.
+        '''
+        return self._schedule(
+            Timer(time.time() + interval, interval, callback, args))
+
+    def _run_timers(self):
+        '''
+        Run the timers that are due.
+        '''
+        timers = self._timers
+        now = time.time()
+        while timers and timers[0][0] <= now:
+            timer = heapq.heappop(timers)[2]
+            if timer.cancelled:
+                continue
+            if timer.interval is not None:
+                timer.deadline += timer.interval
+                # Don't run a periodic timer repeatedly to catch up
+                if timer.deadline <= now:
+                    timer.deadline = now + timer.interval
+                self._schedule(timer)
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                self._logger.exception('error in timer %r', timer.callback)
+
+    def _next_timeout(self):
+        '''
+        Seconds until the next timer is due, or None if there are none.
+        '''
+        timers = self._timers
+        while timers and timers[0][2].cancelled:
+            heapq.heappop(timers)
+        if not timers:
+            return None
+        return max(timers[0][0] - time.time(), 0)
+
+    ###
+    # Connections
+    ###
+    def add_transport(self, transport):
+        '''
+        Called by a SelectorTransport when it connects.
+        '''
+        self._transports.add(transport)
+
+    def remove_transport(self, transport):
+        '''
+        Called by a SelectorTransport when it disconnects.
+        '''
+        self._transports.discard(transport)
+
+    ###
+    # Loop
+    ###
+    def run_once(self, timeout=None):
+        '''
+        Wait up to timeout seconds, or until the next timer is due, for
+        sockets to be ready, handle them, and run the timers that are due.
+        Returns the number of sockets that were ready.
+        '''
+        next_timeout = self._next_timeout()
+        if timeout is None or \
+                (next_timeout is not None and next_timeout < timeout):
+            timeout = next_timeout
+
+        events = self._selector.select(timeout)
+        for key, mask in events:
+            transport = key.data
+            try:
+                if mask & EVENT_WRITE:
+                    transport.handle_write()
+                if mask & EVENT_READ:
+                    transport.handle_read()
+            except Exception:
+                self._logger.exception(
+                    'error handling connection to %s',
+                    transport.connection._host)
+
+        self._run_timers()
+        return len(events)
+
+    def run(self):
+        '''
+        Run until stop() is called, or there are no connections or timers
+        left to run.
+        '''
+        self._running = True
+        try:
+            while self._running and \
+                    (self._selector.get_map() or self._next_timeout()
+                     is not None):
+                self.run_once()
+        finally:
+            self._running = False
+
+    def stop(self):
+        '''
+        Stop run() after the current iteration.
+        '''
+        self._running = False
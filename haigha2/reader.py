@@ -8,6 +8,10 @@ from struct import Struct
 from datetime import datetime
 from decimal import Decimal
 
+from haigha2 import speedups
+from haigha2.compat import PY2, binary_type, text_type, range, Mapping, \
+    as_buffer, buffer_slice, buffer_bytes, buffer_text
+
 
 class Reader(object):
 
@@ -27,22 +31,21 @@ class Reader(object):
 
     def __init__(self, source, start_pos=0, size=None):
         """
-        source should be a bytearray, io object with a read() method, another
-        Reader, a plain or unicode string. Can be allocated over a slice
-        of source.
+        source should be a bytearray, memoryview, io object with a read()
+        method, another Reader, a byte or unicode string. Can be allocated
+        over a slice of source.
         """
-        # Note: buffer used here because unpack_from can't accept an array,
-        # which I think is related to http://bugs.python.org/issue7827
-        if isinstance(source, bytearray):
-            self._input = buffer(source)
+        # Note: a buffer (Python 2) or memoryview (Python 3) is used here
+        # because unpack_from can't accept an array, which I think is related
+        # to http://bugs.python.org/issue7827, and so that slicing doesn't copy
+        if isinstance(source, (bytearray, binary_type, memoryview)):
+            self._input = as_buffer(source)
         elif isinstance(source, Reader):
             self._input = source._input
         elif hasattr(source, 'read'):
-            self._input = buffer(source.read())
-        elif isinstance(source, str):
-            self._input = buffer(source)
-        elif isinstance(source, unicode):
-            self._input = buffer(source.encode('utf8'))
+            self._input = as_buffer(source.read())
+        elif isinstance(source, text_type):
+            self._input = as_buffer(source.encode('utf8'))
         else:
             raise ValueError(
                 'Reader needs a bytearray, io object or plain string')
@@ -53,8 +56,8 @@ class Reader(object):
             self._end_pos = self._start_pos + size
 
     def __str__(self):
-        return ''.join(['\\x%s' % (c.encode('hex')) for c in
-                       self._input[self._start_pos:self._end_pos]])
+        return ''.join(['\\x%02x' % c for c in
+                        bytearray(self._input[self._start_pos:self._end_pos])])
 
     def tell(self):
         '''
@@ -89,11 +92,11 @@ class Reader(object):
 
     def buffer(self):
         '''
-        Get a copy of the buffer that this is reading from. Returns a
-        buffer object
+        Get a view of the buffer that this is reading from, without copying.
+        Returns a buffer object on Python 2 and a memoryview on Python 3.
         '''
-        return buffer(self._input, self._start_pos,
-                      (self._end_pos - self._start_pos))
+        return buffer_slice(self._input, self._start_pos,
+                            (self._end_pos - self._start_pos))
 
     def read(self, n):
         """
@@ -102,11 +105,11 @@ class Reader(object):
         Will raise BufferUnderflow if there's not enough bytes in the buffer.
         """
         self._check_underflow(n)
-        rval = self._input[self._pos:self._pos + n]
+        rval = buffer_bytes(self._input[self._pos:self._pos + n])
         self._pos += n
         return rval
 
-    def read_bit(self):
+    def read_bit(self, unpacker=Struct('B').unpack_from):
         """
         Read a single boolean value, returns 0 or 1. Convience for single
         bit fields.
@@ -116,11 +119,11 @@ class Reader(object):
         # Perform a faster check on underflow
         if self._pos >= self._end_pos:
             raise self.BufferUnderflow()
-        result = ord(self._input[self._pos]) & 1
+        result = unpacker(self._input, self._pos)[0] & 1
         self._pos += 1
         return result
 
-    def read_bits(self, num):
+    def read_bits(self, num, unpacker=Struct('B').unpack_from):
         '''
         Read several bits packed into the same field. Will return as a list.
         The bit field itself is little-endian, though the order of the
@@ -139,8 +142,8 @@ class Reader(object):
             raise self.BufferUnderflow()
         if num < 0 or num >= 9:
             raise ValueError("8 bits per field")
-        field = ord(self._input[self._pos])
-        result = map(lambda x: field >> x & 1, xrange(num))
+        field = unpacker(self._input, self._pos)[0]
+        result = [field >> x & 1 for x in range(num)]
         self._pos += 1
         return result
 
@@ -199,17 +202,77 @@ class Reader(object):
         self._pos += size
         return rval
 
+    # Compiled Structs for read_struct, keyed by format string
+    _structs = {}
+
+    def read_struct(self, fmt):
+        """
+        Read a fixed-size run of values described by a struct format string,
+        e.g. '>HH' for two shorts, and return them as a tuple. The format is
+        compiled once and cached, and the buffer is checked for underflow once
+        for the whole run rather than once per value.
+
+        Will raise BufferUnderflow if there's not enough bytes in the buffer.
+        Will raise struct.error if the format is malformed
+        """
+        struct = self._structs.get(fmt)
+        if struct is None:
+            struct = self._structs[fmt] = Struct(fmt)
+        size = struct.size
+        if self._pos + size > self._end_pos:
+            raise self.BufferUnderflow()
+        rval = struct.unpack_from(self._input, self._pos)
+        self._pos += size
+        return rval
+
+    def read_args(self, schema, unpack_octet=Struct('B').unpack_from):
+        """
+        Read the arguments of a method described by an ArgumentSchema and
+        return them as a tuple, in the order given by the schema.
+
+        Will raise BufferUnderflow if there's not enough bytes in the buffer.
+        Will raise struct.error if the data is malformed
+        """
+        rval = []
+        data = self._input
+        for size, unpack_from, convert in schema._steps:
+            pos = self._pos
+            if unpack_from is not None:
+                if pos + size > self._end_pos:
+                    raise self.BufferUnderflow()
+                values = unpack_from(data, pos)
+                self._pos = pos + size
+                if convert is not None:
+                    values = convert(values)
+                rval.extend(values)
+            elif convert is not None:
+                rval.append(convert(self))
+            else:
+                # Inlined read_shortstr, the most common variable-size type
+                if pos >= self._end_pos:
+                    raise self.BufferUnderflow()
+                end = pos + 1 + unpack_octet(data, pos)[0]
+                if end > self._end_pos:
+                    raise self.BufferUnderflow()
+                rval.append(buffer_text(data[pos + 1:end]))
+                self._pos = end
+        return tuple(rval)
+
     def read_shortstr(self):
         """
         Read a utf-8 encoded string that's stored in up to
-        255 bytes.
+        255 bytes. Returned as a native string, i.e. undecoded on Python 2
+        and decoded on Python 3.
 
         Will raise BufferUnderflow if there's not enough bytes in the buffer.
         Will raise UnicodeDecodeError if the text is mal-formed.
         Will raise struct.error if the data is malformed
         """
         slen = self.read_octet()
-        return self.read(slen)
+        self._check_underflow(slen)
+        rval = buffer_text(self._input[self._pos:self._pos + slen])
+        self._pos += slen
+        return rval
 
     def read_longstr(self):
         """
@@ -242,6 +305,12 @@ class Reader(object):
         Will raise UnicodeDecodeError if the text is mal-formed.
         Will raise struct.error if the data is malformed
         """
+        codec = speedups.codec
+        if codec is not None and type(self) is Reader:
+            result, self._pos = codec.read_table(
+                self._input, self._pos, self._end_pos)
+            return result
+
         # Only need to check underflow on the table once
         tlen = self.read_long()
         self._check_underflow(tlen)
@@ -252,6 +321,33 @@ class Reader(object):
             result[name] = self._read_field()
         return result
 
+    def read_lazy_table(self):
+        """
+        Read an AMQP table without decoding it, and return it as a LazyTable.
+
+        Will raise BufferUnderflow if there's not enough bytes in the buffer.
+        """
+        start_pos = self._pos
+        tlen = self.read_long()
+        self._check_underflow(tlen)
+        self._pos += tlen
+        return LazyTable(self, start_pos, self._pos)
+
+    def _skip_field(self, unpacker=Struct('>I').unpack_from):
+        '''
+        Read a single byte for field type, then skip the value.
+        '''
+        ftype = self._input[self._pos]
+        self._pos += 1
+
+        size = self.field_size_map.get(ftype)
+        if size is None:
+            if ftype not in self.field_type_map:
+                raise Reader.FieldError('Unknown field type %s', ftype)
+            # Variable length, prefixed with a 32-bit length
+            size = 4 + unpacker(self._input, self._pos)[0]
+        self._pos += size
+
     def _read_field(self):
         '''
         Read a single byte for field type, then read the value.
@@ -265,8 +361,8 @@ class Reader(object):
 
         raise Reader.FieldError('Unknown field type %s', ftype)
 
-    def _field_bool(self):
-        result = ord(self._input[self._pos]) & 1
+    def _field_bool(self, unpacker=Struct('B').unpack_from):
+        result = unpacker(self._input, self._pos)[0] & 1
         self._pos += 1
         return result
 
@@ -337,17 +433,32 @@ class Reader(object):
         n = self._field_long_int()
         return Decimal(n) / Decimal(10 ** d)
 
-    def _field_shortstr(self):
-        slen = self._field_short_short_uint()
-        rval = self._input[self._pos:self._pos + slen]
-        self._pos += slen
-        return rval
-
-    def _field_longstr(self):
-        slen = self._field_long_uint()
-        rval = self._input[self._pos:self._pos + slen]
-        self._pos += slen
-        return rval
+    if PY2:
+        # Table keys and strings are the bulk of most tables, so on Python 2,
+        # where slicing a buffer already gives a str, skip the conversion.
+        def _field_shortstr(self):
+            slen = self._field_short_short_uint()
+            rval = self._input[self._pos:self._pos + slen]
+            self._pos += slen
+            return rval
+
+        def _field_longstr(self):
+            slen = self._field_long_uint()
+            rval = self._input[self._pos:self._pos + slen]
+            self._pos += slen
+            return rval
+    else:
+        def _field_shortstr(self):
+            slen = self._field_short_short_uint()
+            rval = buffer_text(self._input[self._pos:self._pos + slen])
+            self._pos += slen
+            return rval
+
+        def _field_longstr(self):
+            slen = self._field_long_uint()
+            rval = buffer_bytes(self._input[self._pos:self._pos + slen])
+            self._pos += slen
+            return rval
 
     def _field_array(self):
         alen = self.read_long()
@@ -397,6 +508,20 @@ class Reader(object):
         'x': _field_bytearray,
     }
 
+    # Encoded sizes of the fixed-length field types in field_type_map
+    field_size_map = {
+        't': 1,
+        'b': 1,
+        's': 2,
+        'I': 4,
+        'l': 8,
+        'f': 4,
+        'd': 8,
+        'D': 5,
+        'T': 8,
+        'V': 0,
+    }
+
     # 0.9.1 spec mapping
     #  field_type_map = {
     #   't' : _field_bool,
@@ -418,3 +543,199 @@ class Reader(object):
     #   'F' : read_table,
     #   'V' : _field_none,
     # }
+
+
+if not PY2:
+    # Indexing a memoryview gives the field type as an int
+    Reader.field_type_map = dict(
+        (ord(k), v) for k, v in Reader.field_type_map.items())
+    Reader.field_size_map = dict(
+        (ord(k), v) for k, v in Reader.field_size_map.items())
+
+# Field type of a nested table, as found in the buffer
+_TABLE_FIELD_TYPE = 'F' if PY2 else ord('F')
+
+
+class ArgumentSchema(object):
+
+    '''
+    Declares the argument types of an AMQP method so that they can be read
+    with Reader.read_args. Types are named after the Reader methods:
+    'octet', 'short', 'long', 'longlong', 'timestamp', 'bit', 'shortstr',
+    'longstr' and 'table'.
+
+    Runs of fixed-size arguments are compiled into a single Struct and read
+    with one underflow check, and consecutive bits share an octet as they do
+    on the wire:
+
+        _close_args = ArgumentSchema('short', 'shortstr', 'short', 'short')
+        code, text, class_id, method_id = frame.args.read_args(_close_args)
+    '''
+
+    # Struct codes of the fixed-size types
+    fixed_types = {
+        'octet': 'B',
+        'short': 'H',
+        'long': 'I',
+        'longlong': 'Q',
+        'timestamp': 'Q',
+    }
+
+    # Readers for the variable-size types
+    variable_types = {
+        'shortstr': None,
+        'longstr': Reader.read_longstr,
+        'table': Reader.read_table,
+    }
+
+    def __init__(self, *types):
+        self._types = types
+
+        # List of (size, unpack_from, convert) tuples. A Struct run has
+        # unpack_from and an optional converter for its values; a
+        # variable-size field has only convert, a Reader method, except for
+        # shortstr which read_args reads inline and which has neither.
+        self._steps = []
+
+        # The Struct run being built. Each entry in fields is None for a plain
+        # value, 'timestamp', or the number of bits packed into an octet.
+        fmt = ''
+        fields = []
+        for typ in types:
+            if typ == 'bit':
+                if fields and isinstance(fields[-1], int) and fields[-1] < 8:
+                    fields[-1] += 1
+                else:
+                    fmt += 'B'
+                    fields.append(1)
+            elif typ in self.fixed_types:
+                fmt += self.fixed_types[typ]
+                fields.append('timestamp' if typ == 'timestamp' else None)
+            elif typ in self.variable_types:
+                if fmt:
+                    self._add_struct(fmt, fields)
+                    fmt, fields = '', []
+                self._steps.append((None, None, self.variable_types[typ]))
+            else:
+                raise ValueError('unknown argument type %r' % (typ,))
+        if fmt:
+            self._add_struct(fmt, fields)
+
+    def __repr__(self):
+        return 'ArgumentSchema%r' % (self._types,)
+
+    def _add_struct(self, fmt, fields):
+        '''
+        Append a Struct run to the steps, with a converter if any of its
+        fields is not a plain integer.
+        '''
+        struct = Struct('>' + fmt)
+        convert = None
+        if any(field is not None for field in fields):
+            convert = self._converter(fields)
+        self._steps.append((struct.size, struct.unpack_from, convert))
+
+    @staticmethod
+    def _converter(fields):
+        '''
+        Return a function that maps the values unpacked by a Struct run to
+        argument values, expanding bit octets and timestamps.
+        '''
+        def convert(values):
+            rval = []
+            for value, field in zip(values, fields):
+                if field is None:
+                    rval.append(value)
+                elif field == 1:
+                    rval.append(value & 1)
+                elif field == 'timestamp':
+                    rval.append(datetime.utcfromtimestamp(value))
+                else:
+                    rval.extend([value >> x & 1 for x in range(field)])
+            return rval
+        return convert
+
+
+class LazyTable(Mapping):
+
+    '''
+    A read-only mapping over an encoded AMQP table, returned by
+    Reader.read_lazy_table. The table is scanned for its keys on first access
+    without decoding any values; values are decoded when they are looked up,
+    and nested tables are themselves returned as LazyTables. A LazyTable is
+    written back to the wire by Writer.write_table as the bytes it was read
+    from, so forwarding a message doesn't re-encode its headers.
+
+    NOTE: a LazyTable holds a reference to the buffer that it was read from.
+    '''
+
+    def __init__(self, source, start_pos, end_pos):
+        '''
+        :param source: Reader over the buffer holding the encoded table
+        :param start_pos: position of the table length in the buffer
+        :param end_pos: position in the buffer after the end of the table
+        '''
+        self._source = source
+        self._start_pos = start_pos
+        self._end_pos = end_pos
+
+        # Mapping of keys to the position of their field type in _input
+        self._offsets = None
+
+        # Values decoded so far
+        self._values = {}
+
+    def _index(self):
+        '''
+        Scan the table for the position of each field.
+        '''
+        offsets = {}
+        reader = Reader(self._source, self._start_pos + 4,
+                        self._end_pos - self._start_pos - 4)
+        while reader._pos < self._end_pos:
+            key = reader._field_shortstr()
+            offsets[key] = reader._pos
+            reader._skip_field()
+        self._offsets = offsets
+        return offsets
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+
+        offsets = self._offsets
+        if offsets is None:
+            offsets = self._index()
+        pos = offsets[key]
+
+        reader = Reader(self._source, pos)
+        if reader._input[pos] == _TABLE_FIELD_TYPE:
+            reader._pos += 1
+            value = reader.read_lazy_table()
+        else:
+            value = reader._read_field()
+        self._values[key] = value
+        return value
+
+    def __iter__(self):
+        offsets = self._offsets
+        if offsets is None:
+            offsets = self._index()
+        return iter(offsets)
+
+    def __len__(self):
+        offsets = self._offsets
+        if offsets is None:
+            offsets = self._index()
+        return len(offsets)
+
+    def __repr__(self):
+        return 'LazyTable(%r)' % (dict(self),)
+
+    def encoded_table(self):
+        '''
+        Return the encoded table, including its length, as read.
+        '''
+        return self._source._input[self._start_pos:self._end_pos]
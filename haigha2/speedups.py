@@ -0,0 +1,51 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+
+Selection of the optional compiled codec, haigha2._codec.
+
+When the extension was built, Reader.read_table, Writer.write_table and the
+parsing and writing of frames use it, falling back to the pure-Python
+implementation for anything it doesn't handle, e.g. subclasses of Reader,
+Writer or of the field types. Both implementations decode to and encode
+from the same values and raise the same errors.
+
+Set HAIGHA2_NO_SPEEDUPS in the environment to never use the extension, or
+call `enable(False)` at runtime.
+'''
+
+import os
+
+try:
+    from haigha2 import _codec
+except ImportError:
+    _codec = None
+
+# The compiled codec in use, or None for pure Python
+codec = None if os.environ.get('HAIGHA2_NO_SPEEDUPS') else _codec
+
+
+def available():
+    '''
+    Whether the compiled codec was built.
+    '''
+    return _codec is not None
+
+
+def enabled():
+    '''
+    Whether the compiled codec is in use.
+    '''
+    return codec is not None
+
+
+def enable(flag=True):
+    '''
+    Use the compiled codec, or the pure-Python one if flag is False. Raises
+    ImportError if the compiled codec wasn't built.
+    '''
+    global codec
+    if flag and _codec is None:
+        raise ImportError('haigha2._codec is not available')
+    codec = _codec if flag else None
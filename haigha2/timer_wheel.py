@@ -0,0 +1,158 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+
+A hashed timing wheel, for the timers of transports that don't have an
+event loop of their own, such as heartbeats.
+
+Timers are placed in one of a fixed ring of slots, each of which spans
+`resolution` seconds, so scheduling and cancelling a timer is constant
+time. The wheel is advanced by whoever drives the transport; advancing it
+before the next slot that has timers is due costs a clock read and a
+comparison:
+
+    wheel = TimerWheel()
+    timer = wheel.schedule(5, callback, arg)
+    ...
+    read(timeout=wheel.timeout())
+    wheel.advance()
+'''
+
+import time
+from logging import root as root_logger
+
+
+class WheelTimer(object):
+
+    '''
+    A callback scheduled on a TimerWheel.
+    '''
+
+    __slots__ = ('tick', 'callback', 'args', 'cancelled')
+
+    def __init__(self, tick, callback, args):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        '''
+        Cancel the timer. It's removed from its slot when it's due.
+        '''
+        self.cancelled = True
+
+
+class TimerWheel(object):
+
+    '''
+    Runs callbacks after a delay, rounded up to the next multiple of
+    resolution seconds. Delays longer than the ring of slots go around it
+    more than once. Exceptions raised by callbacks are logged.
+    '''
+
+    def __init__(self, resolution=0.1, slots=256, logger=None):
+        self._resolution = float(resolution)
+        self._slots = [[] for _ in range(slots)]
+        self._logger = logger or root_logger
+        self._start = time.time()
+        self._tick = 0
+        self._count = 0
+
+        # The earliest tick with timers, or None if there are none
+        self._next_tick = None
+
+    def __len__(self):
+        '''The number of timers scheduled, including cancelled ones.'''
+        return self._count
+
+    @property
+    def resolution(self):
+        return self._resolution
+
+    def _now_tick(self, now):
+        return int((now - self._start) / self._resolution)
+
+    def schedule(self, delay, callback, *args):
+        '''
+        Call callback(*args) in delay seconds. Returns a WheelTimer.
+        '''
+        # Round up, so timers never run early
+        ticks = int(-(-delay // self._resolution))
+        tick = self._now_tick(time.time()) + max(ticks, 1)
+        timer = WheelTimer(tick, callback, args)
+        self._slots[tick % len(self._slots)].append(timer)
+        self._count += 1
+        if self._next_tick is None or tick < self._next_tick:
+            self._next_tick = tick
+        return timer
+
+    def timeout(self):
+        '''
+        Seconds until the next timer is due, 0 if one is overdue, or None if
+        there are none.
+        '''
+        if self._next_tick is None:
+            return None
+        deadline = self._start + self._next_tick * self._resolution
+        return max(deadline - time.time(), 0)
+
+    def advance(self, now=None):
+        '''
+        Run the timers that are due by now. Returns the number that ran.
+        '''
+        if self._next_tick is None:
+            return 0
+        if now is None:
+            now = time.time()
+        target = self._now_tick(now)
+        if target < self._next_tick:
+            return 0
+
+        slots = self._slots
+        due = []
+        # Visit each slot at most once, however far the wheel has to turn
+        first = max(self._tick + 1, self._next_tick)
+        for tick in range(first, min(target, first + len(slots) - 1) + 1):
+            slot = slots[tick % len(slots)]
+            if not slot:
+                continue
+            remaining = [t for t in slot if t.tick > target]
+            if len(remaining) < len(slot):
+                due.extend(t for t in slot if t.tick <= target)
+                slot[:] = remaining
+        self._tick = target
+        self._count -= len(due)
+        self._next_tick = self._find_next_tick()
+
+        ran = 0
+        due.sort(key=lambda t: t.tick)
+        for timer in due:
+            if timer.cancelled:
+                continue
+            ran += 1
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                self._logger.exception('error in timer %r', timer.callback)
+        return ran
+
+    def _find_next_tick(self):
+        '''
+        The earliest tick of the timers left, by searching the slots after
+        the current tick.
+        '''
+        if not self._count:
+            return None
+        slots = self._slots
+        best = None
+        for offset in range(1, len(slots) + 1):
+            slot = slots[(self._tick + offset) % len(slots)]
+            for timer in slot:
+                if best is None or timer.tick < best:
+                    best = timer.tick
+            # Timers in later rounds are in the slots searched so far
+            if best is not None and best <= self._tick + offset:
+                break
+        return best
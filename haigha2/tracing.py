@@ -0,0 +1,177 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+
+Tracing hooks for synchronous methods, publishes and deliveries.
+
+Tracing is disabled unless a Connection is created with a Tracer, in which
+case a Span is started and ended around:
+
+  * every synchronous method, from sending the method (or queueing it behind
+    an earlier synchronous method) to dispatching its reply;
+  * every basic.publish, while its frames are sent or queued;
+  * every basic.deliver, while its consumer is called.
+
+A Tracer can, for example, export the spans to a tracing system:
+
+    class MyTracer(Tracer):
+        def end(self, span):
+            record(span.name, span.start, span.end, span.bytes_out)
+
+    connection = Connection(tracer=MyTracer(), ...)
+'''
+
+import logging
+import time
+
+# Names of the methods of AMQP 0.9.1, by (class_id, method_id)
+METHOD_NAMES = {
+    (10, 10): 'connection.start',
+    (10, 11): 'connection.start_ok',
+    (10, 20): 'connection.secure',
+    (10, 21): 'connection.secure_ok',
+    (10, 30): 'connection.tune',
+    (10, 31): 'connection.tune_ok',
+    (10, 40): 'connection.open',
+    (10, 41): 'connection.open_ok',
+    (10, 50): 'connection.close',
+    (10, 51): 'connection.close_ok',
+    (20, 10): 'channel.open',
+    (20, 11): 'channel.open_ok',
+    (20, 20): 'channel.flow',
+    (20, 21): 'channel.flow_ok',
+    (20, 40): 'channel.close',
+    (20, 41): 'channel.close_ok',
+    (40, 10): 'exchange.declare',
+    (40, 11): 'exchange.declare_ok',
+    (40, 20): 'exchange.delete',
+    (40, 21): 'exchange.delete_ok',
+    (50, 10): 'queue.declare',
+    (50, 11): 'queue.declare_ok',
+    (50, 20): 'queue.bind',
+    (50, 21): 'queue.bind_ok',
+    (50, 30): 'queue.purge',
+    (50, 31): 'queue.purge_ok',
+    (50, 40): 'queue.delete',
+    (50, 41): 'queue.delete_ok',
+    (50, 50): 'queue.unbind',
+    (50, 51): 'queue.unbind_ok',
+    (60, 10): 'basic.qos',
+    (60, 11): 'basic.qos_ok',
+    (60, 20): 'basic.consume',
+    (60, 21): 'basic.consume_ok',
+    (60, 30): 'basic.cancel',
+    (60, 31): 'basic.cancel_ok',
+    (60, 40): 'basic.publish',
+    (60, 50): 'basic.return',
+    (60, 60): 'basic.deliver',
+    (60, 70): 'basic.get',
+    (60, 71): 'basic.get_ok',
+    (60, 72): 'basic.get_empty',
+    (60, 80): 'basic.ack',
+    (60, 90): 'basic.reject',
+    (60, 100): 'basic.recover_async',
+    (60, 110): 'basic.recover',
+    (60, 111): 'basic.recover_ok',
+    (60, 120): 'basic.nack',
+    (85, 10): 'confirm.select',
+    (85, 11): 'confirm.select_ok',
+    (90, 10): 'tx.select',
+    (90, 11): 'tx.select_ok',
+    (90, 20): 'tx.commit',
+    (90, 21): 'tx.commit_ok',
+    (90, 30): 'tx.rollback',
+    (90, 31): 'tx.rollback_ok',
+}
+
+
+def method_name(class_id, method_id):
+    '''
+    Return the name of a method, e.g. 'queue.declare'.
+    '''
+    name = METHOD_NAMES.get((class_id, method_id))
+    if name is None:
+        name = '%d.%d' % (class_id, method_id)
+    return name
+
+
+class Span(object):
+
+    '''
+    A traced operation on a channel. `kind` is 'sync' for a synchronous
+    method, 'publish' or 'deliver'. Times are from time.time(), and `end` is
+    None until the span ends. `bytes_out` is the size of the arguments of a
+    synchronous method or of the body of a published message, and
+    `bytes_in` of the arguments of the reply or of the body of a delivered
+    message. If the channel closes before a synchronous method is answered,
+    its span is ended with `error` set to the reason for the close.
+    '''
+
+    __slots__ = ('kind', 'channel_id', 'class_id', 'method_id', 'start',
+                 'end', 'bytes_out', 'bytes_in', 'reply_class_id',
+                 'reply_method_id', 'error')
+
+    def __init__(self, kind, channel_id, class_id, method_id, bytes_out=0,
+                 bytes_in=0):
+        self.kind = kind
+        self.channel_id = channel_id
+        self.class_id = class_id
+        self.method_id = method_id
+        self.start = time.time()
+        self.end = None
+        self.bytes_out = bytes_out
+        self.bytes_in = bytes_in
+        self.reply_class_id = None
+        self.reply_method_id = None
+        self.error = None
+
+    @property
+    def name(self):
+        return method_name(self.class_id, self.method_id)
+
+    @property
+    def duration(self):
+        '''Seconds from start to end, or None if the span has not ended.'''
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    def __str__(self):
+        return "%s[%s channel: %d, duration: %s, bytes_out: %d, " \
+            "bytes_in: %d, error: %s]" % (
+                self.__class__.__name__, self.name, self.channel_id,
+                self.duration, self.bytes_out, self.bytes_in, self.error)
+
+
+class Tracer(object):
+
+    '''
+    Receives spans as they start and end. Both hooks are called on the
+    thread or greenlet that runs the connection, so should be quick; the
+    default implementations do nothing.
+    '''
+
+    def start(self, span):
+        '''
+        Called when a span starts.
+        '''
+
+    def end(self, span):
+        '''
+        Called when a span ends, with `end` set.
+        '''
+
+
+class LoggingTracer(Tracer):
+
+    '''
+    Logs every span when it ends.
+    '''
+
+    def __init__(self, logger, level=logging.DEBUG):
+        self._logger = logger
+        self._level = level
+
+    def end(self, span):
+        self._logger.log(self._level, 'trace %s', span)
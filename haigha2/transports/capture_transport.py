@@ -0,0 +1,90 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+from haigha2.capture import CaptureWriter, INBOUND, OUTBOUND
+from haigha2.transports.transport import Transport
+
+
+class CaptureTransport(Transport):
+
+    '''
+    Wraps another transport and records the bytes that it reads and writes
+    to a capture, see haigha2.capture. Used by `Connection(capture=path)`.
+
+    Bytes that the connection buffers are prepended to the next read by
+    the wrapped transport, so only the bytes that follow them are recorded
+    as inbound.
+    '''
+
+    def __init__(self, connection, transport, capture):
+        super(CaptureTransport, self).__init__(connection)
+        self._transport = transport
+        if isinstance(capture, CaptureWriter):
+            self._writer = capture
+        else:
+            self._writer = CaptureWriter(capture)
+        self._buffered = 0
+
+    @property
+    def synchronous(self):
+        return self._transport.synchronous
+
+    @property
+    def queued(self):
+        return self._transport.queued
+
+    @property
+    def transport(self):
+        '''The transport that this captures.'''
+        return self._transport
+
+    @property
+    def writer(self):
+        return self._writer
+
+    def __getattr__(self, name):
+        # Transport specific attributes, such as the pool of a
+        # GeventPoolTransport
+        if name.startswith('__') or name == '_transport':
+            raise AttributeError(name)
+        return getattr(self._transport, name)
+
+    ###
+    # Transport API
+    ###
+    def connect(self, address):
+        self._transport.connect(address)
+
+    def call_later(self, delay, callback):
+        return self._transport.call_later(delay, callback)
+
+    def process_channels(self, channels):
+        self._transport.process_channels(channels)
+
+    def read(self, timeout=None):
+        data = self._transport.read(timeout)
+        if data is not None:
+            if len(data) > self._buffered:
+                self._writer.record(INBOUND, data[self._buffered:])
+            self._buffered = 0
+        if self.connection.transport is None:
+            # The wrapped transport closed
+            self._writer.close()
+        return data
+
+    def buffer(self, data):
+        self._buffered += len(data)
+        self._transport.buffer(data)
+
+    def write(self, data):
+        self._writer.record(OUTBOUND, data)
+        self._transport.write(data)
+
+    def disconnect(self):
+        try:
+            self._transport.disconnect()
+        finally:
+            self._writer.close()
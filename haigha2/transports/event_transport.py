@@ -17,6 +17,19 @@ except ImportError:
     event = None
 
 
+class _EventTimer(object):
+
+    '''
+    A timer of EventTransport.call_later().
+    '''
+
+    def __init__(self, ev):
+        self._event = ev
+
+    def cancel(self):
+        self._event.delete()
+
+
 class EventTransport(Transport):
 
     '''
@@ -67,6 +80,12 @@ class EventTransport(Transport):
             (host, port), timeout=self.connection._connect_timeout)
         self._heartbeat_timeout = None
 
+    def call_later(self, delay, callback):
+        '''
+        Call callback from the libevent loop in delay seconds.
+        '''
+        return _EventTimer(event.timeout(delay, callback))
+
     def read(self, timeout=None):
         '''
         Read from the transport. If no data is available, should return None.
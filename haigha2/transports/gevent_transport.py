@@ -6,6 +6,7 @@ https://github.com/agoragames/haigha/blob/master/LICENSE.txt
 
 import warnings
 
+from haigha2.transports.output_queue import OutputQueue
 from haigha2.transports.socket_transport import SocketTransport
 
 try:
@@ -30,12 +31,30 @@ except ImportError:
     socket = None
     pool = None
 
+class _GreenletTimer(object):
+
+    '''
+    A timer of GeventTransport.call_later().
+    '''
+
+    def __init__(self, greenlet):
+        self._greenlet = greenlet
+
+    def cancel(self):
+        self._greenlet.kill(block=False)
+
+
 class GeventTransport(SocketTransport):
 
     '''
     Transport using gevent backend. It relies on gevent's implementation of
     sendall to send whole frames at a time. On the input side, it uses a gevent
     semaphore to ensure exclusive access to the socket and input buffer.
+
+    With the `write_queue=True` keyword argument, writes are queued and
+    return immediately rather than wait for the socket to accept the whole
+    frame, and a greenlet sends the queue, see `queued`, calling the
+    drain_cb of the connection once it's all sent.
     '''
 
     def __init__(self, *args, **kwargs):
@@ -46,6 +65,15 @@ class GeventTransport(SocketTransport):
         self._write_lock = Semaphore()
         self._read_wait = Event()
 
+        self._write_queue = kwargs.get('write_queue', False)
+        self._output = OutputQueue()
+        self._writer = None
+
+    @property
+    def queued(self):
+        '''The number of bytes written that haven't been sent yet.'''
+        return len(self._output)
+
     ###
     # Transport API
     ###
@@ -56,6 +84,12 @@ class GeventTransport(SocketTransport):
         '''
         super(GeventTransport, self).connect((host, port), klass=socket.socket)
 
+    def call_later(self, delay, callback):
+        '''
+        Call callback in a new greenlet in delay seconds.
+        '''
+        return _GreenletTimer(gevent.spawn_later(delay, callback))
+
     def read(self, timeout=None):
         '''
         Read from the transport. If no data is available, should return None.
@@ -97,6 +131,14 @@ class GeventTransport(SocketTransport):
         '''
         Write some bytes to the transport.
         '''
+        if self._write_queue:
+            if getattr(self, '_sock', None) is None:
+                return
+            self._output.append(data)
+            if self._writer is None:
+                self._writer = gevent.spawn(self._send_output)
+            return
+
         # MUST use a lock here else gevent could raise an exception if 2
         # greenlets try to write at the same time. I was hoping that
         # sendall() would do that blocking for me, but I guess not. May
@@ -107,6 +149,38 @@ class GeventTransport(SocketTransport):
         finally:
             self._write_lock.release()
 
+    def _send_output(self):
+        '''
+        Send the queued output until it's all sent, in a greenlet.
+        '''
+        try:
+            while self._output and self._sock is not None:
+                self._output.send(self._sock)
+        except EnvironmentError:
+            self._writer = None
+            self._output.clear()
+            if self._sock is not None:
+                self.connection.logger.exception(
+                    'error writing to %s' % (self._host))
+                self.connection.transport_closed(
+                    msg='error writing to %s' % (self._host))
+            return
+
+        self._writer = None
+        if self._sock is not None:
+            self.connection.transport_drained()
+
+    def disconnect(self):
+        '''
+        Wait up to the connect_timeout for queued output to be sent, and
+        disconnect.
+        '''
+        writer = self._writer
+        if writer is not None and writer is not gevent.getcurrent():
+            writer.join(self.connection._connect_timeout)
+        self._output.clear()
+        super(GeventTransport, self).disconnect()
+
 
 class GeventPoolTransport(GeventTransport):
 
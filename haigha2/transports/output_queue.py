@@ -0,0 +1,84 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+from collections import deque
+
+# Segments smaller than this are joined before sending, so that a queue of
+# small frames isn't sent with a system call per frame
+COALESCE_SIZE = 65536
+
+
+class OutputQueue(object):
+
+    '''
+    The bytes written to a transport that the socket hasn't accepted yet, as
+    a queue of memoryview segments of the buffers written. Buffers are
+    queued without being copied, and the part of a segment that the socket
+    didn't accept is kept as a view of it, so a buffer mustn't be modified
+    after it's written. len() is the number of bytes queued.
+    '''
+
+    def __init__(self):
+        self._segments = deque()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def segments(self):
+        '''The number of segments queued.'''
+        return len(self._segments)
+
+    def append(self, data, offset=0):
+        '''
+        Queue the bytes of data from offset onwards.
+        '''
+        segment = memoryview(data)
+        if offset:
+            segment = segment[offset:]
+        if len(segment):
+            self._segments.append(segment)
+            self._size += len(segment)
+
+    def clear(self):
+        self._segments.clear()
+        self._size = 0
+
+    def _coalesce(self):
+        '''
+        Join the small segments at the head of the queue into one.
+        '''
+        segments = self._segments
+        pieces = []
+        size = 0
+        while segments and size < COALESCE_SIZE and \
+                len(segments[0]) < COALESCE_SIZE:
+            segment = segments.popleft()
+            pieces.append(segment.tobytes())
+            size += len(segment)
+        segments.appendleft(memoryview(b''.join(pieces)))
+
+    def send(self, sock):
+        '''
+        Send as much of the queue as sock accepts, until it accepts part of a
+        segment or raises an error, which is raised to the caller. Returns
+        the number of bytes sent.
+        '''
+        segments = self._segments
+        total = 0
+        while segments:
+            if len(segments) > 1 and len(segments[0]) < COALESCE_SIZE:
+                self._coalesce()
+            segment = segments[0]
+            sent = sock.send(segment)
+            total += sent
+            self._size -= sent
+            if sent < len(segment):
+                segments[0] = segment[sent:]
+                break
+            segments.popleft()
+        return total
@@ -0,0 +1,110 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+import time
+
+from haigha2.capture import CaptureReader, INBOUND
+from haigha2.transports.transport import Transport
+
+
+class ReplayTransport(Transport):
+
+    '''
+    Feeds the inbound bytes of a capture, see haigha2.capture, to the
+    connection in place of a broker, for profiling and testing the client
+    offline. Bytes written by the connection are discarded. Used by
+    `Connection(transport='replay', replay=path)`, with the options:
+
+        replay_timing        'fast' to return each read as soon as asked, or
+                             'original' to wait until the time it was read
+                             at in the capture; default 'fast'
+        replay_speed         multiplies the speed of 'original' timing;
+                             default 1.0
+        replay_outbound_cb   called with the bytes of each outbound record
+                             of the capture as it's passed, which is where
+                             the captured client sent them
+
+    It's not synchronous, so that a connection doesn't block on reading
+    replies to calls that the capture didn't record.
+    '''
+
+    def __init__(self, connection, **kwargs):
+        super(ReplayTransport, self).__init__(connection)
+        self._synchronous = False
+        self._reader = CaptureReader(kwargs['replay'])
+        self._records = iter(self._reader)
+        self._timing = kwargs.get('replay_timing', 'fast')
+        if self._timing not in ('fast', 'original'):
+            raise ValueError('unknown replay_timing %r' % (self._timing))
+        self._speed = kwargs.get('replay_speed', 1.0)
+        self._outbound_cb = kwargs.get('replay_outbound_cb')
+        self._buffer = bytearray()
+        self._first = None
+        self._exhausted = False
+
+    @property
+    def exhausted(self):
+        '''True once every record of the capture has been read.'''
+        return self._exhausted
+
+    ###
+    # Transport API
+    ###
+    def connect(self, address):
+        '''
+        Nothing to connect to.
+        '''
+
+    def read(self, timeout=None):
+        '''
+        Return the next inbound record, or None if the capture has been
+        read. The timeout is ignored.
+        '''
+        data = None
+        for direction, timestamp, record in self._records:
+            if direction == INBOUND:
+                data = record
+                break
+            if self._outbound_cb is not None:
+                self._outbound_cb(record)
+        else:
+            self._exhausted = True
+
+        if data is None:
+            return None
+
+        if self._timing == 'original':
+            if self._first is None:
+                self._first = (time.time(), timestamp)
+            started, first = self._first
+            delay = started + (timestamp - first) / self._speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        if len(self._buffer):
+            self._buffer.extend(data)
+            data = self._buffer
+            self._buffer = bytearray()
+        return data
+
+    def buffer(self, data):
+        '''
+        Buffer unused bytes from the input stream.
+        '''
+        if len(self._buffer):
+            self._buffer.extend(data)
+        else:
+            self._buffer = bytearray(data)
+
+    def write(self, data):
+        '''
+        Discard the bytes, there's no broker.
+        '''
+
+    def disconnect(self):
+        self._exhausted = True
+        self._records = iter(())
+        self._reader.close()
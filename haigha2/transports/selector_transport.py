@@ -0,0 +1,493 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+from haigha2.timer_wheel import TimerWheel
+from haigha2.transports.output_queue import OutputQueue
+from haigha2.transports.socket_transport import SocketTransport
+
+from collections import namedtuple
+import errno
+import select
+import socket
+import time
+import weakref
+
+# Errors of non-blocking sockets that mean "try again later"
+RETRY_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+###
+# A minimal `selectors` for Pythons without it, using epoll where available
+###
+SelectorKey = namedtuple('SelectorKey', ['fileobj', 'fd', 'events', 'data'])
+
+
+class _Selector(object):
+
+    '''
+    The part of the API of selectors.BaseSelector that's used here.
+    '''
+
+    def __init__(self):
+        self._keys = {}
+
+    def register(self, fileobj, events, data=None):
+        fd = fileobj.fileno()
+        key = self._keys[fd] = SelectorKey(fileobj, fd, events, data)
+        return key
+
+    def unregister(self, fileobj):
+        return self._keys.pop(fileobj.fileno())
+
+    def modify(self, fileobj, events, data=None):
+        self.unregister(fileobj)
+        return self.register(fileobj, events, data)
+
+    def get_map(self):
+        return self._keys
+
+    def close(self):
+        self._keys.clear()
+
+
+class _SelectSelector(_Selector):
+
+    '''
+    Selector on select.select(), limited to descriptors below FD_SETSIZE.
+    '''
+
+    def select(self, timeout=None):
+        readers = [fd for fd, key in self._keys.items()
+                   if key.events & EVENT_READ]
+        writers = [fd for fd, key in self._keys.items()
+                   if key.events & EVENT_WRITE]
+        if timeout is not None:
+            timeout = max(timeout, 0)
+        try:
+            readers, writers, _ = select.select(readers, writers, [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+        ready = {}
+        for fd in readers:
+            ready[fd] = EVENT_READ
+        for fd in writers:
+            ready[fd] = ready.get(fd, 0) | EVENT_WRITE
+        return [(self._keys[fd], events) for fd, events in ready.items()
+                if fd in self._keys]
+
+
+class _EpollSelector(_Selector):
+
+    '''
+    Selector on select.epoll().
+    '''
+
+    def __init__(self):
+        super(_EpollSelector, self).__init__()
+        self._epoll = select.epoll()
+
+    def _mask(self, events):
+        mask = 0
+        if events & EVENT_READ:
+            mask |= select.EPOLLIN
+        if events & EVENT_WRITE:
+            mask |= select.EPOLLOUT
+        return mask
+
+    def register(self, fileobj, events, data=None):
+        key = super(_EpollSelector, self).register(fileobj, events, data)
+        self._epoll.register(key.fd, self._mask(events))
+        return key
+
+    def unregister(self, fileobj):
+        key = super(_EpollSelector, self).unregister(fileobj)
+        self._epoll.unregister(key.fd)
+        return key
+
+    def modify(self, fileobj, events, data=None):
+        fd = fileobj.fileno()
+        key = self._keys[fd] = SelectorKey(fileobj, fd, events, data)
+        self._epoll.modify(fd, self._mask(events))
+        return key
+
+    def select(self, timeout=None):
+        if timeout is None:
+            timeout = -1
+        else:
+            timeout = max(timeout, 0)
+        try:
+            polled = self._epoll.poll(timeout, max(len(self._keys), 1))
+        except IOError as e:
+            if e.errno == errno.EINTR:
+                return []
+            raise
+
+        ready = []
+        for fd, mask in polled:
+            events = 0
+            # Errors and hangups are read as the end of the stream
+            if mask & ~select.EPOLLOUT:
+                events |= EVENT_READ
+            if mask & ~select.EPOLLIN:
+                events |= EVENT_WRITE
+            key = self._keys.get(fd)
+            if key is not None:
+                ready.append((key, events & key.events))
+        return ready
+
+    def close(self):
+        super(_EpollSelector, self).close()
+        self._epoll.close()
+
+
+try:
+    import selectors
+    DefaultSelector = selectors.DefaultSelector
+    EVENT_READ = selectors.EVENT_READ
+    EVENT_WRITE = selectors.EVENT_WRITE
+except ImportError:
+    EVENT_READ = 1
+    EVENT_WRITE = 2
+    if hasattr(select, 'epoll'):
+        DefaultSelector = _EpollSelector
+    else:
+        DefaultSelector = _SelectSelector
+
+
+def _wait(sock, write, timeout):
+    '''
+    Wait up to timeout seconds for a socket to be readable, or writable if
+    write is True. Returns a pair of booleans (readable, writable).
+    '''
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        poller.register(sock, select.POLLIN | (select.POLLOUT if write else 0))
+        try:
+            polled = poller.poll(
+                None if timeout is None else int(timeout * 1000))
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return False, False
+            raise
+        mask = polled[0][1] if polled else 0
+        return bool(mask & ~select.POLLOUT), bool(mask & ~select.POLLIN)
+
+    try:
+        readers, writers, _ = select.select(
+            [sock], [sock] if write else [], [], timeout)
+    except select.error as e:
+        if e.args[0] == errno.EINTR:
+            return False, False
+        raise
+    return bool(readers), bool(writers)
+
+
+# The timers of the transports on each selector, advanced by poll()
+_timer_wheels = weakref.WeakKeyDictionary()
+
+
+def timer_wheel(selector):
+    '''
+    Return the TimerWheel shared by the SelectorTransports on selector.
+    '''
+    wheel = _timer_wheels.get(selector)
+    if wheel is None:
+        wheel = _timer_wheels[selector] = TimerWheel()
+    return wheel
+
+
+def poll(selector, timeout=None):
+    '''
+    Wait up to timeout seconds, or until the next timer of its transports is
+    due, for the sockets of the SelectorTransports registered with selector
+    to be ready, read or write them, and run the timers that are due.
+    Returns the number of sockets that were ready.
+    '''
+    wheel = _timer_wheels.get(selector)
+    if wheel is not None and len(wheel):
+        due = wheel.timeout()
+        if timeout is None or due < timeout:
+            timeout = due
+
+    events = selector.select(timeout)
+    for key, mask in events:
+        transport = key.data
+        if mask & EVENT_WRITE:
+            transport.handle_write()
+        if mask & EVENT_READ:
+            transport.handle_read()
+
+    if wheel is not None:
+        wheel.advance()
+    return len(events)
+
+
+class SelectorTransport(SocketTransport):
+
+    '''
+    A non-blocking socket transport driven by a selector, which can be
+    shared by many connections in one thread. The `selector` keyword
+    argument is a DefaultSelector (epoll on Linux) or any selectors
+    selector; each transport has its own if it's not given. The connections
+    are driven by calling `poll()` on the selector, which reads frames from
+    the sockets that are readable and writes output to those that are
+    writable:
+
+        selector = DefaultSelector()
+        connections = [Connection(transport='selector', selector=selector)
+                       for _ in range(100)]
+        while True:
+            poll(selector, 1.0)
+
+    Writes send as much as the socket accepts and queue the remainder
+    until the socket is writable, see `queued`, calling the drain_cb of the
+    connection once it's all sent. Reads from outside of poll(), such as
+    when a synchronous callback reads frames, wait up to their timeout for
+    the socket to be readable, writing buffered output meanwhile. The
+    connection itself is made with a blocking connect() within the
+    connect_timeout.
+
+    Timers of the transport, such as heartbeats, are run by poll() from a
+    TimerWheel shared by the transports on the selector. With the `reactor`
+    keyword argument, a haigha2.reactor.Reactor, the transport uses the
+    selector and the timers of the reactor instead.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(SelectorTransport, self).__init__(*args)
+        self._synchronous = False
+        self._reactor = kwargs.get('reactor')
+        if self._reactor is not None:
+            self._selector = self._reactor.selector
+            self._timers = None
+        else:
+            self._selector = kwargs.get('selector') or DefaultSelector()
+            self._timers = timer_wheel(self._selector)
+        self._sock = None
+        self._events = 0
+        self._output = OutputQueue()
+
+        # True while poll() handles readiness to read
+        self._readable = False
+
+    @property
+    def selector(self):
+        return self._selector
+
+    @property
+    def queued(self):
+        '''The number of bytes written that haven't been sent yet.'''
+        return len(self._output)
+
+    def call_later(self, delay, callback):
+        '''
+        Call callback in delay seconds, from poll() or the reactor.
+        '''
+        if self._reactor is not None:
+            return self._reactor.call_later(delay, callback)
+        return self._timers.schedule(delay, callback)
+
+    ###
+    # Selector events
+    ###
+    def _set_events(self, events):
+        if events == self._events:
+            return
+        if self._events:
+            self._selector.modify(self._sock, events, self)
+        else:
+            self._selector.register(self._sock, events, self)
+        self._events = events
+
+    def handle_read(self):
+        '''
+        Called by poll() when the socket is readable.
+        '''
+        if self._sock is None:
+            return
+        self._readable = True
+        try:
+            self.connection.read_frames()
+        finally:
+            self._readable = False
+
+    def handle_write(self):
+        '''
+        Called by poll() when the socket is writable.
+        '''
+        if self._sock is not None:
+            self._flush()
+
+    def _flush(self):
+        '''
+        Send as much of the buffered output as the socket accepts, and tell
+        the connection when it's all sent.
+        '''
+        try:
+            self._output.send(self._sock)
+        except EnvironmentError as e:
+            if e.errno in RETRY_ERRNOS:
+                return
+            self.connection.logger.exception(
+                'error writing to %s' % (self._host))
+            self._close('error writing to %s' % (self._host))
+            return
+
+        if not self._output:
+            self._set_events(EVENT_READ)
+            self.connection.transport_drained()
+
+    def _run_timers(self, timeout):
+        '''
+        Run the timers of the wheel that are due, when reading outside of
+        poll(), and return timeout or the time until the next timer if it's
+        sooner.
+        '''
+        timers = self._timers
+        if timers is None or not len(timers):
+            return timeout
+        timers.advance()
+        due = timers.timeout()
+        if due is not None and (timeout is None or due < timeout):
+            return due
+        return timeout
+
+    def _close(self, msg):
+        '''
+        Close the socket after an error or the end of the stream, and notify
+        the connection.
+        '''
+        self._disconnect()
+        self.connection.transport_closed(msg=msg)
+
+    def _disconnect(self):
+        sock = self._sock
+        self._sock = None
+        self._output.clear()
+        if self._reactor is not None:
+            self._reactor.remove_transport(self)
+        try:
+            if self._events:
+                self._events = 0
+                self._selector.unregister(sock)
+        finally:
+            sock.close()
+
+    ###
+    # Transport API
+    ###
+    def connect(self, (host, port)):
+        '''
+        Connect using a host,port tuple, and register the socket with the
+        selector.
+        '''
+        super(SelectorTransport, self).connect((host, port))
+        self._sock.setblocking(False)
+        self._read_size = self._sock.getsockopt(
+            socket.SOL_SOCKET, socket.SO_RCVBUF)
+        self._set_events(EVENT_READ)
+        if self._reactor is not None:
+            self._reactor.add_transport(self)
+
+    def read(self, timeout=None):
+        '''
+        Read the bytes available on the socket, or None if there are none.
+        If called outside of poll(), waits up to timeout seconds for the
+        socket to be readable.
+        '''
+        if self._sock is None:
+            return None
+
+        if self._readable:
+            self._readable = False
+        else:
+            deadline = None if timeout is None else time.time() + timeout
+            while True:
+                remaining = None if deadline is None else \
+                    max(deadline - time.time(), 0)
+                wait = self._run_timers(remaining)
+                if self._sock is None:
+                    return None
+                readable, writable = _wait(
+                    self._sock, bool(self._output), wait)
+                if writable:
+                    self._flush()
+                    if self._sock is None:
+                        return None
+                if readable:
+                    break
+                if not writable and wait == remaining:
+                    return None
+
+        try:
+            data = self._sock.recv(self._read_size)
+        except EnvironmentError as e:
+            if e.errno in RETRY_ERRNOS:
+                return None
+            self.connection.logger.exception(
+                'error reading from %s' % (self._host))
+            self._close('error reading from %s' % (self._host))
+            return None
+
+        if not data:
+            self._close('connection to %s closed' % (self._host))
+            return None
+
+        if self.connection.debug > 1:
+            self.connection.logger.debug(
+                'read %d bytes from %s' % (len(data), self._host))
+        if len(self._buffer):
+            self._buffer.extend(data)
+            data = self._buffer
+            self._buffer = bytearray()
+        return data
+
+    def write(self, data):
+        '''
+        Send as much of data as the socket accepts, and queue the rest
+        until poll() finds the socket writable. Data mustn't be modified
+        after it's written, as it's queued without a copy.
+        '''
+        if self._sock is None:
+            return
+
+        if self._output:
+            self._output.append(data)
+            return
+
+        try:
+            sent = self._sock.send(data)
+        except EnvironmentError as e:
+            if e.errno not in RETRY_ERRNOS:
+                self.connection.logger.exception(
+                    'error writing to %s' % (self._host))
+                self._close('error writing to %s' % (self._host))
+                return
+            sent = 0
+
+        if self.connection.debug > 1:
+            self.connection.logger.debug(
+                'sent %d of %d bytes to %s' % (sent, len(data), self._host))
+        if sent < len(data):
+            self._output.append(data, sent)
+            self._set_events(EVENT_READ | EVENT_WRITE)
+
+    def disconnect(self):
+        '''
+        Send what output the socket accepts without blocking, unregister the
+        socket from the selector and close it.
+        '''
+        if self._sock is None:
+            return
+        if self._output:
+            try:
+                self._output.send(self._sock)
+            except EnvironmentError:
+                pass
+        self._disconnect()
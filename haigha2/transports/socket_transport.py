@@ -4,6 +4,7 @@ Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
 https://github.com/agoragames/haigha/blob/master/LICENSE.txt
 '''
 
+from haigha2.timer_wheel import TimerWheel
 from haigha2.transports.transport import Transport
 
 import errno
@@ -20,6 +21,14 @@ class SocketTransport(Transport):
         super(SocketTransport, self).__init__(*args)
         self._synchronous = True
         self._buffer = bytearray()
+        self._timers = TimerWheel()
+
+    def call_later(self, delay, callback):
+        '''
+        Call callback in delay seconds, from read() as the timer wheel of
+        the transport is advanced by reads.
+        '''
+        return self._timers.schedule(delay, callback)
 
     ###
     # Transport API
@@ -73,6 +82,16 @@ class SocketTransport(Transport):
         if not hasattr(self, '_sock'):
             return None
 
+        # Run the timers that are due, and wait no longer than the next one
+        timers = self._timers
+        if len(timers):
+            timers.advance()
+            if self._sock is None:
+                return None
+            due = timers.timeout()
+            if due is not None and (not timeout or due < timeout):
+                timeout = due or timers.resolution
+
         try:
             # Note that we ignore both None and 0, i.e. we either block with a
             # timeout or block completely and let gevent sort it out.
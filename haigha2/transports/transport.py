@@ -27,6 +27,23 @@ class Transport(object):
     def connection(self):
         return self._connection
 
+    @property
+    def queued(self):
+        '''
+        Return the number of bytes written that haven't been sent yet, for
+        transports that queue writes rather than block on them.
+        '''
+        return 0
+
+    def call_later(self, delay, callback):
+        '''
+        Call callback in delay seconds from the loop that drives this
+        transport, and return a timer with a cancel() method. Returns None
+        if the transport doesn't have timers, as is the default, in which
+        case the connection sends heartbeats as it reads frames.
+        '''
+        return None
+
     def process_channels(self, channels):
         '''
         Process a set of channels by calling Channel.process_frames() on each.
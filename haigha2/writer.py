@@ -8,8 +8,13 @@ from struct import Struct
 from calendar import timegm
 from datetime import datetime
 from decimal import Decimal
+from functools import reduce
 from operator import xor
 
+from haigha2 import speedups
+from haigha2.compat import binary_type, text_type, integer_types, range, \
+    iteritems, get_unbound_function
+
 
 class Writer(object):
 
@@ -26,8 +31,7 @@ class Writer(object):
             self._output_buffer = bytearray()
 
     def __str__(self):
-        return ''.join([
-            '\\x%s' % (chr(c).encode('hex')) for c in self._output_buffer])
+        return ''.join(['\\x%02x' % c for c in self._output_buffer])
 
     __repr__ = __str__
 
@@ -44,7 +48,8 @@ class Writer(object):
 
     def write(self, s):
         """
-        Write a plain Python string, with no special encoding.
+        Write a byte string or other bytes-like object, with no special
+        encoding.
         """
         self._output_buffer.extend(s)
         return self
@@ -61,24 +66,24 @@ class Writer(object):
         if len(args) > 8:
             raise ValueError("Can only write 8 bits at a time")
 
-        self._output_buffer.append(chr(
-            reduce(lambda x, y: xor(x, args[y] << y), xrange(len(args)), 0)))
+        self._output_buffer.append(
+            reduce(lambda x, y: xor(x, args[y] << y), range(len(args)), 0))
 
         return self
 
-    def write_bit(self, b, pack=Struct('B').pack):
+    def write_bit(self, b):
         '''
         Write a single bit. Convenience method for single bit args.
         '''
-        self._output_buffer.append(pack(True if b else False))
+        self._output_buffer.append(1 if b else 0)
         return self
 
-    def write_octet(self, n, pack=Struct('B').pack):
+    def write_octet(self, n):
         """
         Write an integer as an unsigned 8-bit value.
         """
         if 0 <= n <= 255:
-            self._output_buffer.append(pack(n))
+            self._output_buffer.append(n)
         else:
             raise ValueError('Octet %d out of range 0..255', n)
         return self
@@ -141,7 +146,7 @@ class Writer(object):
         Write a string up to 255 bytes long after encoding.  If passed
         a unicode string, encode as UTF-8.
         """
-        if isinstance(s, unicode):
+        if isinstance(s, text_type):
             s = s.encode('utf-8')
         self.write_octet(len(s))
         self.write(s)
@@ -152,7 +157,7 @@ class Writer(object):
         Write a string up to 2**32 bytes long after encoding.  If passed
         a unicode string, encode as UTF-8.
         """
-        if isinstance(s, unicode):
+        if isinstance(s, text_type):
             s = s.encode('utf-8')
         self.write_long(len(s))
         self.write(s)
@@ -164,7 +169,7 @@ class Writer(object):
         representing seconds since the Unix UTC epoch.
         """
         # Double check timestamp, can't imagine why it would be signed
-        self._output_buffer.extend(pack(long(timegm(t.timetuple()))))
+        self._output_buffer.extend(pack(timegm(t.timetuple())))
         return self
 
     # NOTE: coding to http://dev.rabbitmq.com/wiki/Amqp091Errata#section_3 and
@@ -175,23 +180,51 @@ class Writer(object):
         Write out a Python dictionary made of up string keys, and values
         that are strings, signed integers, Decimal, datetime.datetime, or
         sub-dictionaries following the same constraints.
+
+        A mapping that already holds its own encoding, i.e. one that provides
+        an `encoded_table()` method returning the complete table including
+        its length prefix, is written with a single extend.
         """
+        if type(d) is not dict:
+            encoded_table = getattr(d, 'encoded_table', None)
+            if encoded_table is not None:
+                self._output_buffer.extend(encoded_table())
+                return self
+        return self._write_table_items(d)
+
+    def _write_table_items(self, d, len_pack_into=Struct('>I').pack_into):
+        '''
+        Encode the items of a mapping as a table. See `write_table()`.
+        '''
+        buf = self._output_buffer
+
+        codec = speedups.codec
+        if codec is not None and type(d) is dict and type(self) is Writer \
+                and type(buf) is bytearray:
+            codec.write_table(buf, d, self._write_field)
+            return self
+
         # HACK: encoding of AMQP tables is broken because it requires the
         # length of the /encoded/ data instead of the number of items. To
         # support streaming, fiddle with cursor position, rewinding to write
         # the real length of the data. Generally speaking, I'm not a fan of
         # the AMQP encoding scheme, it could be much faster.
-        table_len_pos = len(self._output_buffer)
-        self.write_long(0)
-        table_data_pos = len(self._output_buffer)
-
-        for key, value in d.iteritems():
-            self._write_item(key, value)
-
-        table_end_pos = len(self._output_buffer)
-        table_len = table_end_pos - table_data_pos
-
-        self.write_long_at(table_len, table_len_pos)
+        table_len_pos = len(buf)
+        buf.extend(b'\x00\x00\x00\x00')
+
+        # Keys are written inline and the field writers bound once, as this
+        # loop runs for every header table of every message published.
+        write_field = self._write_field
+        for key, value in iteritems(d):
+            if isinstance(key, text_type):
+                key = key.encode('utf-8')
+            if len(key) > 255:
+                raise ValueError('Octet %d out of range 0..255', len(key))
+            buf.append(len(key))
+            buf.extend(key)
+            write_field(value)
+
+        len_pack_into(buf, table_len_pos, len(buf) - table_len_pos - 4)
         return self
 
     def _write_item(self, key, value):
@@ -199,94 +232,113 @@ class Writer(object):
         self._write_field(value)
 
     def _write_field(self, value):
-        writer = self.field_type_map.get(type(value))
-        if writer:
-            writer(self, value)
+        value_type = type(value)
+        writer = self.field_type_map.get(value_type) or \
+            self._subclass_writers.get(value_type)
+        if writer is None:
+            writer = self._lookup_field_writer(value_type)
+        writer(self, value)
+
+    @classmethod
+    def _lookup_field_writer(cls, value_type):
+        '''
+        Find the writer for a type that is not in field_type_map by scanning
+        it for a base class, and remember it in _subclass_writers so that the
+        scan is done once per type.
+        '''
+        for kls, writer in cls.field_type_map.items():
+            if issubclass(value_type, kls):
+                break
         else:
-            for kls, writer in self.field_type_map.items():
-                if isinstance(value, kls):
-                    writer(self, value)
-                    break
+            if hasattr(value_type, 'encoded_table'):
+                # A table that isn't a dict, e.g. a LazyTable
+                writer = get_unbound_function(cls._field_table)
             else:
                 # Write a None because we've already written a key
-                self._field_none(value)
+                writer = get_unbound_function(cls._field_none)
+        cls._subclass_writers[value_type] = writer
+        return writer
 
-    def _field_bool(self, val, pack=Struct('B').pack):
-        self._output_buffer.append('t')
-        self._output_buffer.append(pack(True if val else False))
+    def _field_bool(self, val):
+        self._output_buffer.extend(b't')
+        self._output_buffer.append(1 if val else 0)
 
     def _field_int(self, val, short_pack=Struct('>h').pack,
                    int_pack=Struct('>i').pack, long_pack=Struct('>q').pack):
         if -2 ** 15 <= val < 2 ** 15:
-            self._output_buffer.append('s')
+            self._output_buffer.extend(b's')
             self._output_buffer.extend(short_pack(val))
         elif -2 ** 31 <= val < 2 ** 31:
-            self._output_buffer.append('I')
+            self._output_buffer.extend(b'I')
             self._output_buffer.extend(int_pack(val))
         else:
-            self._output_buffer.append('l')
+            self._output_buffer.extend(b'l')
             self._output_buffer.extend(long_pack(val))
 
     def _field_double(self, val, pack=Struct('>d').pack):
-        self._output_buffer.append('d')
+        self._output_buffer.extend(b'd')
         self._output_buffer.extend(pack(val))
 
     # Coding to http://dev.rabbitmq.com/wiki/Amqp091Errata#section_3 which
     # differs from spec in that the value is signed.
     def _field_decimal(self, val, exp_pack=Struct('B').pack,
                        dig_pack=Struct('>i').pack):
-        self._output_buffer.append('D')
+        self._output_buffer.extend(b'D')
         sign, digits, exponent = val.as_tuple()
         v = 0
         for d in digits:
             v = (v * 10) + d
         if sign:
             v = -v
-        self._output_buffer.append(exp_pack(-exponent))
+        self._output_buffer.extend(exp_pack(-exponent))
         self._output_buffer.extend(dig_pack(v))
 
     def _field_str(self, val):
-        self._output_buffer.append('S')
+        self._output_buffer.extend(b'S')
         self.write_longstr(val)
 
     def _field_unicode(self, val):
         val = val.encode('utf-8')
-        self._output_buffer.append('S')
+        self._output_buffer.extend(b'S')
         self.write_longstr(val)
 
     def _field_timestamp(self, val):
-        self._output_buffer.append('T')
+        self._output_buffer.extend(b'T')
         self.write_timestamp(val)
 
     def _field_table(self, val):
-        self._output_buffer.append('F')
+        self._output_buffer.extend(b'F')
         self.write_table(val)
 
     def _field_none(self, val):
-        self._output_buffer.append('V')
+        self._output_buffer.extend(b'V')
 
     def _field_bytearray(self, val):
-        self._output_buffer.append('x')
+        self._output_buffer.extend(b'x')
         self.write_longstr(val)
 
     def _field_iterable(self, val):
-        self._output_buffer.append('A')
+        self._output_buffer.extend(b'A')
         for x in val:
             self._write_field(x)
 
     field_type_map = {
         bool: _field_bool,
-        int: _field_int,
-        long: _field_int,
         float: _field_double,
         Decimal: _field_decimal,
-        str: _field_str,
-        unicode: _field_unicode,
+        binary_type: _field_str,
+        text_type: _field_unicode,
         datetime: _field_timestamp,
         dict: _field_table,
         type(None): _field_none,
         bytearray: _field_bytearray,
     }
+    field_type_map.update(dict.fromkeys(integer_types, _field_int))
+
+    # Writers found by `_lookup_field_writer()` for types which aren't in
+    # field_type_map. A subclass that overrides field_type_map should also
+    # define its own _subclass_writers.
+    _subclass_writers = {}
 
     # 0.9.1 spec mapping
     # field_type_map = {
@@ -305,3 +357,58 @@ class Writer(object):
     #   tuple     : _field_iterable,
     #   set       : _field_iterable,
     # }
+
+
+class FrozenTable(dict):
+
+    '''
+    An immutable table that is encoded once, on first use, and thereafter
+    written by Writer.write_table with a single extend. Use for tables that
+    are sent repeatedly, e.g. the application_headers that a publisher
+    attaches to every message:
+
+        BASE_HEADERS = FrozenTable({'x-service': 'orders', 'x-version': 3})
+        headers = BASE_HEADERS.merge({'x-trace-id': trace_id})
+        msg = Message(body, application_headers=headers)
+
+    Mutating methods raise TypeError.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._encoded = None
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('FrozenTable is immutable')
+
+    # dict has __ior__ from Python 3.9
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = \
+        setdefault = update = _immutable
+
+    def __repr__(self):
+        return 'FrozenTable(%s)' % (dict.__repr__(self))
+
+    def __reduce__(self):
+        return (FrozenTable, (dict(self),))
+
+    def encoded_table(self):
+        '''
+        Return the encoded table, including its length.
+        '''
+        if self._encoded is None:
+            self._encoded = bytes(Writer()._write_table_items(self).buffer())
+        return self._encoded
+
+    def merge(self, overlay, len_pack=Struct('>I').pack):
+        '''
+        Return a FrozenTable of this table updated with the items of overlay.
+        Unless overlay replaces some of its keys, the encoding of this table
+        is reused as is and only overlay is encoded.
+        '''
+        merged = FrozenTable(self)
+        dict.update(merged, overlay)
+        if not any(key in self for key in overlay):
+            entries = self.encoded_table()[4:] + \
+                bytes(Writer()._write_table_items(overlay).buffer()[4:])
+            merged._encoded = len_pack(len(entries)) + entries
+        return merged
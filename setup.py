@@ -1,20 +1,58 @@
 import haigha2
 import os
 
+import platform
+import sys
+
 try:
-    from setuptools import setup
+    from setuptools import setup, Extension
 except ImportError:
-    from distutils.core import setup
+    from distutils.core import setup, Extension
+from distutils.command.build_ext import build_ext
+from distutils.errors import CCompilerError, DistutilsError
 
 
 requirements = map(str.strip, open('requirements.txt').readlines())
 
+
+
+class optional_build_ext(build_ext):
+
+    '''
+    The compiled codec is optional; if it can't be built, e.g. for lack of a
+    compiler, the pure-Python codec is used.
+    '''
+
+    def run(self):
+        try:
+            build_ext.run(self)
+        except DistutilsError as e:
+            self._skip(e)
+
+    def build_extension(self, ext):
+        try:
+            build_ext.build_extension(self, ext)
+        except (CCompilerError, DistutilsError, IOError, ValueError) as e:
+            self._skip(e)
+
+    def _skip(self, e):
+        sys.stderr.write('WARNING: not building haigha2._codec (%s), '
+                         'falling back to pure Python\n' % (e,))
+
+
+ext_modules = []
+if platform.python_implementation() == 'CPython' and \
+        not os.environ.get('HAIGHA2_NO_SPEEDUPS'):
+    ext_modules.append(Extension('haigha2._codec', ['haigha2/_codec.c']))
+
 setup(
     name='haigha2',
     version=haigha2.__version__,
     author='Vitaly Babiy, Aaron Westendorf',
     author_email="vbabiy@agoragames.com, aaron@agoragames.com",
     packages = ['haigha2', 'haigha2.frames', 'haigha2.classes', 'haigha2.transports', 'haigha2.connections'],
+    ext_modules = ext_modules,
+    cmdclass = {'build_ext': optional_build_ext},
     install_requires = requirements,
     url='https://github.com/agoragames/haigha2',
     license="LICENSE.txt",
@@ -0,0 +1,709 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+
+An in-process AMQP 0.9.1 broker for benchmarks and tests.
+
+FakeBroker listens on loopback and speaks enough of the protocol for a
+Connection on any transport to connect, open channels, declare and bind
+exchanges and queues, publish with or without confirms, consume, get and
+ack messages, and close. It runs on threads, so the client and the broker
+share the interpreter; it is meant to give reproducible numbers for
+comparing versions of haigha2, not to model a real broker:
+
+  * messages are kept in memory and forgotten once delivered, so acks,
+    rejects and recovers are accepted but have no effect;
+  * exchanges route on an exact match of the routing key, or to every bound
+    queue for a fanout exchange, and the default exchange routes to the
+    queue named by the routing key;
+  * publisher confirms are sent with multiple=True once per read from the
+    socket, rather than once per message;
+  * authentication, vhosts, flow control, heartbeats and exclusivity are
+    ignored.
+
+    with FakeBroker() as broker:
+        host, port = broker.address
+        connection = Connection(host=host, port=port)
+'''
+
+import itertools
+import logging
+import socket
+import struct
+import threading
+import time
+from collections import deque
+
+from haigha2.reader import Reader
+from haigha2.writer import Writer
+from haigha2.frames.method_frame import MethodFrame
+
+PROTOCOL_HEADER = b'AMQP\x00\x00\x09\x01'
+
+FRAME_HEADER = struct.Struct('>BHI')
+CONTENT_HEADER = struct.Struct('>HHQH')
+
+FRAME_END = 0xce
+
+
+class FakeBroker(object):
+
+    '''
+    An AMQP broker running on threads in this process. Call start() to
+    listen, or use it as a context manager.
+    '''
+
+    def __init__(self, host='127.0.0.1', port=0, frame_max=131072,
+                 channel_max=2047, logger=None):
+        self._host = host
+        self._port = port
+        self._frame_max = frame_max
+        self._channel_max = channel_max
+        self._logger = logger or logging.getLogger('haigha2.fake_broker')
+
+        # Exchanges, queues and the counters are guarded by _lock; waiters
+        # on the number of published messages by _published_cond.
+        self._lock = threading.Lock()
+        self._published_cond = threading.Condition(self._lock)
+        self._exchanges = {
+            '': 'direct',
+            'amq.direct': 'direct',
+            'amq.fanout': 'fanout',
+            'amq.topic': 'topic',
+        }
+        self._bindings = {}
+        self._queues = {}
+        self._queue_ids = itertools.count(1)
+        self._published = 0
+        self._delivered = 0
+        self._acked = 0
+
+        self._sock = None
+        self._thread = None
+        self._connections = set()
+
+    @property
+    def address(self):
+        '''The (host, port) on which the broker is listening.'''
+        return self._sock.getsockname()[:2]
+
+    @property
+    def frame_max(self):
+        return self._frame_max
+
+    @property
+    def published(self):
+        '''Number of messages published to the broker.'''
+        return self._published
+
+    @property
+    def delivered(self):
+        '''Number of messages delivered to consumers or by basic.get.'''
+        return self._delivered
+
+    @property
+    def acked(self):
+        '''Number of basic.ack methods received.'''
+        return self._acked
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        '''
+        Listen and start accepting connections. Returns self.
+        '''
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((self._host, self._port))
+        self._sock.listen(16)
+
+        self._thread = threading.Thread(target=self._accept_loop,
+                                        name='fake-broker-accept')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        '''
+        Stop listening and close all connections.
+        '''
+        if self._sock is None:
+            return
+        sock, self._sock = self._sock, None
+        try:
+            # Wakes the accept loop on platforms where close() doesn't
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        sock.close()
+        self._thread.join(1)
+        for connection in list(self._connections):
+            connection.close()
+
+    def wait_published(self, count, timeout=None):
+        '''
+        Block until at least count messages have been published, or timeout
+        seconds have passed. Returns whether count was reached.
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        with self._published_cond:
+            while self._published < count:
+                if deadline is None:
+                    self._published_cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._published_cond.wait(remaining)
+            return self._published >= count
+
+    def preload(self, queue, body, count, properties=None):
+        '''
+        Declare a queue and add count copies of a message to it, as if they
+        had been published to the default exchange.
+        '''
+        message = Message('', queue, encode_content_header(
+            len(body), properties), bytes(body))
+        with self._lock:
+            q = self._declare_queue(queue)
+            q.messages.extend(itertools.repeat(message, count))
+
+    def queue_depth(self, queue):
+        '''
+        Number of messages waiting in a queue.
+        '''
+        with self._lock:
+            return len(self._queues[queue].messages)
+
+    def _accept_loop(self):
+        sock = self._sock
+        while True:
+            try:
+                client, _address = sock.accept()
+            except (socket.error, AttributeError):
+                return
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = BrokerConnection(self, client)
+            self._connections.add(connection)
+            connection.start()
+
+    def _connection_closed(self, connection):
+        with self._lock:
+            for queue in self._queues.values():
+                queue.consumers = [
+                    c for c in queue.consumers if c.connection is not connection]
+        self._connections.discard(connection)
+
+    ###
+    # State that connections act upon, called with _lock held
+    ###
+
+    def _declare_queue(self, name):
+        if name == '':
+            name = 'amq.gen-%d' % (next(self._queue_ids))
+        queue = self._queues.get(name)
+        if queue is None:
+            queue = self._queues[name] = Queue(name)
+        return queue
+
+    def _route(self, exchange, routing_key):
+        '''
+        The queues to which a message is routed.
+        '''
+        if exchange == '':
+            queue = self._queues.get(routing_key)
+            return [queue] if queue else []
+        fanout = self._exchanges.get(exchange) == 'fanout'
+        return [self._queues[queue]
+                for key, queue in self._bindings.get(exchange, ())
+                if (fanout or key == routing_key) and queue in self._queues]
+
+    def _publish(self, message):
+        '''
+        Route a message. Returns the queues to drain.
+        '''
+        queues = self._route(message.exchange, message.routing_key)
+        for queue in queues:
+            queue.messages.append(message)
+        self._published += 1
+        self._published_cond.notify_all()
+        return queues
+
+    def _drain(self, queue, limit=256):
+        '''
+        Pop up to limit messages for the consumers of a queue, round robin.
+        Returns a list of (consumer, message).
+        '''
+        batch = []
+        consumers = queue.consumers
+        while consumers and queue.messages and len(batch) < limit:
+            consumer = consumers[queue.next_consumer % len(consumers)]
+            queue.next_consumer += 1
+            batch.append((consumer, queue.messages.popleft()))
+        self._delivered += len(batch)
+        return batch
+
+    def _deliver(self, queues):
+        '''
+        Deliver the messages in queues to their consumers, outside _lock.
+        A queue is drained by one thread at a time so that its consumers
+        receive messages in order.
+        '''
+        for queue in queues:
+            with queue.drain_lock:
+                while True:
+                    with self._lock:
+                        batch = self._drain(queue)
+                    if not batch:
+                        break
+                    out = {}
+                    for consumer, message in batch:
+                        buf = out.get(consumer.connection)
+                        if buf is None:
+                            buf = out[consumer.connection] = bytearray()
+                        consumer.deliver(buf, message, self._frame_max)
+                    for connection, buf in out.items():
+                        connection.send(buf)
+
+
+class Message(object):
+
+    '''
+    A published message, with its content header as it was received.
+    '''
+
+    __slots__ = ('exchange', 'routing_key', 'header', 'body')
+
+    def __init__(self, exchange, routing_key, header, body):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.header = header
+        self.body = body
+
+
+class Queue(object):
+
+    __slots__ = ('name', 'messages', 'consumers', 'next_consumer',
+                 'drain_lock')
+
+    def __init__(self, name):
+        self.name = name
+        self.messages = deque()
+        self.consumers = []
+        self.next_consumer = 0
+        self.drain_lock = threading.Lock()
+
+
+class Consumer(object):
+
+    __slots__ = ('connection', 'channel', 'tag')
+
+    def __init__(self, connection, channel, tag):
+        self.connection = connection
+        self.channel = channel
+        self.tag = tag
+
+    def deliver(self, buf, message, frame_max):
+        '''
+        Write the frames of a basic.deliver of message into buf.
+        '''
+        channel = self.channel
+        channel.delivery_tag += 1
+        args = Writer().write_shortstr(self.tag).\
+            write_longlong(channel.delivery_tag).\
+            write_bit(False).\
+            write_shortstr(message.exchange).\
+            write_shortstr(message.routing_key)
+        MethodFrame(channel.channel_id, 60, 60, args).write_frame(buf)
+        write_content(buf, channel.channel_id, message, frame_max)
+
+
+class BrokerChannel(object):
+
+    '''
+    The state of a channel of a BrokerConnection.
+    '''
+
+    def __init__(self, channel_id):
+        self.channel_id = channel_id
+        self.delivery_tag = 0
+        self.confirm = False
+        self.publish_seq = 0
+        self.confirmed_seq = 0
+
+        # The basic.publish whose content is being received, and its header
+        # and body so far
+        self.publishing = None
+        self.header = None
+        self.body_size = 0
+        self.body = None
+
+
+class BrokerConnection(threading.Thread):
+
+    '''
+    Serves one client connection, reading and handling its frames on a
+    thread.
+    '''
+
+    def __init__(self, broker, sock):
+        super(BrokerConnection, self).__init__(name='fake-broker-connection')
+        self.daemon = True
+        self._broker = broker
+        self._sock = sock
+        self._write_lock = threading.Lock()
+        self._channels = {}
+        self._consumer_ids = itertools.count(1)
+        self._closed = False
+
+    def send(self, data):
+        with self._write_lock:
+            if self._closed:
+                return
+            try:
+                self._sock.sendall(data)
+            except socket.error:
+                self._closed = True
+
+    def close(self):
+        self._closed = True
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._sock.close()
+
+    def run(self):
+        try:
+            self._serve()
+        except Exception:
+            self._broker._logger.exception('fake broker connection failed')
+        finally:
+            self._closed = True
+            self._sock.close()
+            self._broker._connection_closed(self)
+
+    def _recv(self):
+        try:
+            return self._sock.recv(262144)
+        except socket.error:
+            return b''
+
+    def _serve(self):
+        data = bytearray()
+        while len(data) < len(PROTOCOL_HEADER):
+            chunk = self._recv()
+            if not chunk:
+                return
+            data.extend(chunk)
+        if bytes(data[:len(PROTOCOL_HEADER)]) != PROTOCOL_HEADER:
+            self.send(PROTOCOL_HEADER)
+            return
+        del data[:len(PROTOCOL_HEADER)]
+
+        args = Writer().write_octet(0).write_octet(9).\
+            write_table({'product': 'haigha2 fake broker',
+                         'capabilities': {'publisher_confirms': True}}).\
+            write_longstr('PLAIN AMQPLAIN').\
+            write_longstr('en_US')
+        self._send_method(0, 10, 10, args)
+
+        while not self._closed:
+            pos = 0
+            end = len(data)
+            out = bytearray()
+            drain = set()
+            while end - pos >= FRAME_HEADER.size:
+                frame_type, channel_id, size = \
+                    FRAME_HEADER.unpack_from(data, pos)
+                frame_end = pos + FRAME_HEADER.size + size
+                if frame_end >= end:
+                    break
+                if data[frame_end] != FRAME_END:
+                    raise ValueError('invalid frame end')
+                payload = bytes(data[pos + FRAME_HEADER.size:frame_end])
+                pos = frame_end + 1
+                self._frame(out, drain, frame_type, channel_id, payload)
+                if self._closed:
+                    break
+            del data[:pos]
+
+            for channel in self._channels.values():
+                if channel.publish_seq > channel.confirmed_seq:
+                    channel.confirmed_seq = channel.publish_seq
+                    self._method(out, channel.channel_id, 60, 80, Writer().
+                                 write_longlong(channel.publish_seq).
+                                 write_bit(True))
+            if out:
+                self.send(out)
+            if drain:
+                self._broker._deliver(drain)
+
+            if self._closed:
+                break
+            chunk = self._recv()
+            if not chunk:
+                return
+            data.extend(chunk)
+
+    def _method(self, out, channel_id, class_id, method_id, args=None):
+        MethodFrame(channel_id, class_id, method_id, args).write_frame(out)
+
+    def _send_method(self, channel_id, class_id, method_id, args=None):
+        out = bytearray()
+        self._method(out, channel_id, class_id, method_id, args)
+        self.send(out)
+
+    def _frame(self, out, drain, frame_type, channel_id, payload):
+        if frame_type == 1:
+            reader = Reader(payload)
+            class_id = reader.read_short()
+            method_id = reader.read_short()
+            self._dispatch(out, drain, channel_id, class_id, method_id,
+                           reader)
+        elif frame_type == 2:
+            channel = self._channels[channel_id]
+            channel.header = payload
+            channel.body_size = CONTENT_HEADER.unpack_from(payload)[2]
+            channel.body = bytearray()
+            if channel.body_size == 0:
+                self._published(drain, channel)
+        elif frame_type == 3:
+            channel = self._channels[channel_id]
+            channel.body.extend(payload)
+            if len(channel.body) >= channel.body_size:
+                self._published(drain, channel)
+
+    def _published(self, drain, channel):
+        exchange, routing_key = channel.publishing
+        message = Message(exchange, routing_key, channel.header,
+                          bytes(channel.body))
+        channel.publishing = channel.header = channel.body = None
+        if channel.confirm:
+            channel.publish_seq += 1
+        broker = self._broker
+        with broker._lock:
+            drain.update(broker._publish(message))
+
+    def _dispatch(self, out, drain, channel_id, class_id, method_id, args):
+        broker = self._broker
+        channel = self._channels.get(channel_id)
+        key = (class_id, method_id)
+
+        if key == (10, 11):
+            args = Writer().write_short(broker._channel_max).\
+                write_long(broker._frame_max).write_short(0)
+            self._method(out, 0, 10, 30, args)
+        elif key == (10, 31):
+            pass
+        elif key == (10, 40):
+            self._method(out, 0, 10, 41, Writer().write_shortstr(''))
+        elif key == (10, 50):
+            self._method(out, 0, 10, 51)
+            self.send(out)
+            del out[:]
+            self._closed = True
+        elif key == (10, 51):
+            self._closed = True
+
+        elif key == (20, 10):
+            self._channels[channel_id] = BrokerChannel(channel_id)
+            self._method(out, channel_id, 20, 11, Writer().write_longstr(''))
+        elif key == (20, 20):
+            active = args.read_bit()
+            self._method(out, channel_id, 20, 21, Writer().write_bit(active))
+        elif key == (20, 40):
+            self._close_channel(channel_id)
+            self._method(out, channel_id, 20, 41)
+        elif key == (20, 41):
+            self._close_channel(channel_id)
+
+        elif key == (40, 10):
+            args.read_short()
+            exchange = args.read_shortstr()
+            exchange_type = args.read_shortstr()
+            nowait = args.read_bits(5)[4]
+            with broker._lock:
+                broker._exchanges.setdefault(exchange, exchange_type)
+            if not nowait:
+                self._method(out, channel_id, 40, 11)
+        elif key == (40, 20):
+            args.read_short()
+            exchange = args.read_shortstr()
+            nowait = args.read_bits(2)[1]
+            with broker._lock:
+                broker._exchanges.pop(exchange, None)
+                broker._bindings.pop(exchange, None)
+            if not nowait:
+                self._method(out, channel_id, 40, 21)
+
+        elif key == (50, 10):
+            args.read_short()
+            name = args.read_shortstr()
+            nowait = args.read_bits(5)[4]
+            with broker._lock:
+                queue = broker._declare_queue(name)
+                reply = Writer().write_shortstr(queue.name).\
+                    write_long(len(queue.messages)).\
+                    write_long(len(queue.consumers))
+            if not nowait:
+                self._method(out, channel_id, 50, 11, reply)
+        elif key in ((50, 20), (50, 50)):
+            args.read_short()
+            queue = args.read_shortstr()
+            exchange = args.read_shortstr()
+            routing_key = args.read_shortstr()
+            nowait = method_id == 20 and args.read_bit()
+            with broker._lock:
+                bindings = broker._bindings.setdefault(exchange, [])
+                if method_id == 20:
+                    if (routing_key, queue) not in bindings:
+                        bindings.append((routing_key, queue))
+                elif (routing_key, queue) in bindings:
+                    bindings.remove((routing_key, queue))
+            if not nowait:
+                self._method(out, channel_id, 50, method_id + 1)
+        elif key == (50, 30):
+            args.read_short()
+            name = args.read_shortstr()
+            nowait = args.read_bit()
+            with broker._lock:
+                queue = broker._queues.get(name)
+                count = len(queue.messages) if queue else 0
+                if queue:
+                    queue.messages.clear()
+            if not nowait:
+                self._method(out, channel_id, 50, 31,
+                             Writer().write_long(count))
+        elif key == (50, 40):
+            args.read_short()
+            name = args.read_shortstr()
+            nowait = args.read_bits(3)[2]
+            with broker._lock:
+                queue = broker._queues.pop(name, None)
+                count = len(queue.messages) if queue else 0
+            if not nowait:
+                self._method(out, channel_id, 50, 41,
+                             Writer().write_long(count))
+
+        elif key == (60, 10):
+            self._method(out, channel_id, 60, 11)
+        elif key == (60, 20):
+            args.read_short()
+            name = args.read_shortstr()
+            tag = args.read_shortstr() or \
+                'amq.ctag-%d' % (next(self._consumer_ids))
+            nowait = args.read_bits(4)[3]
+            if not nowait:
+                self._method(out, channel_id, 60, 21,
+                             Writer().write_shortstr(tag))
+            with broker._lock:
+                queue = broker._declare_queue(name)
+                queue.consumers.append(Consumer(self, channel, tag))
+            drain.add(queue)
+        elif key == (60, 30):
+            tag = args.read_shortstr()
+            nowait = args.read_bit()
+            with broker._lock:
+                for queue in broker._queues.values():
+                    queue.consumers = [c for c in queue.consumers
+                                       if c.tag != tag or c.channel is not
+                                       channel]
+            if not nowait:
+                self._method(out, channel_id, 60, 31,
+                             Writer().write_shortstr(tag))
+        elif key == (60, 40):
+            args.read_short()
+            exchange = args.read_shortstr()
+            routing_key = args.read_shortstr()
+            channel.publishing = (exchange, routing_key)
+        elif key == (60, 70):
+            args.read_short()
+            name = args.read_shortstr()
+            with broker._lock:
+                queue = broker._queues.get(name)
+                message = None
+                if queue and queue.messages:
+                    message = queue.messages.popleft()
+                    broker._delivered += 1
+                count = len(queue.messages) if queue else 0
+            if message is None:
+                self._method(out, channel_id, 60, 72,
+                             Writer().write_shortstr(''))
+            else:
+                channel.delivery_tag += 1
+                reply = Writer().write_longlong(channel.delivery_tag).\
+                    write_bit(False).\
+                    write_shortstr(message.exchange).\
+                    write_shortstr(message.routing_key).\
+                    write_long(count)
+                self._method(out, channel_id, 60, 71, reply)
+                write_content(out, channel_id, message, broker._frame_max)
+        elif key == (60, 80):
+            with broker._lock:
+                broker._acked += 1
+        elif key in ((60, 90), (60, 100), (60, 120)):
+            pass
+        elif key == (60, 110):
+            self._method(out, channel_id, 60, 111)
+
+        elif key == (85, 10):
+            channel.confirm = True
+            if not args.read_bit():
+                self._method(out, channel_id, 85, 11)
+
+        elif key in ((90, 10), (90, 20), (90, 30)):
+            self._method(out, channel_id, 90, method_id + 1)
+
+        else:
+            # 540 NOT_IMPLEMENTED
+            args = Writer().write_short(540).\
+                write_shortstr('NOT_IMPLEMENTED').\
+                write_short(class_id).write_short(method_id)
+            self._method(out, channel_id, 20, 40, args)
+
+    def _close_channel(self, channel_id):
+        channel = self._channels.pop(channel_id, None)
+        if channel is None:
+            return
+        broker = self._broker
+        with broker._lock:
+            for queue in broker._queues.values():
+                queue.consumers = [
+                    c for c in queue.consumers if c.channel is not channel]
+
+
+def encode_content_header(size, properties=None):
+    '''
+    Encode the payload of a content header frame for a message of size
+    bytes. Properties are encoded with HeaderFrame if there are any.
+    '''
+    if not properties:
+        return CONTENT_HEADER.pack(60, 0, size, 0)
+    from haigha2.frames.header_frame import HeaderFrame
+    buf = bytearray()
+    HeaderFrame(0, 60, 0, size, properties).write_frame(buf)
+    return bytes(buf[FRAME_HEADER.size:-1])
+
+
+def write_content(buf, channel_id, message, frame_max):
+    '''
+    Write the content header and body frames of a message into buf.
+    '''
+    header = message.header
+    buf.extend(FRAME_HEADER.pack(2, channel_id, len(header)))
+    buf.extend(header)
+    buf.append(FRAME_END)
+
+    body = message.body
+    step = frame_max - 8
+    for pos in range(0, len(body), step):
+        chunk = body[pos:pos + step]
+        buf.extend(FRAME_HEADER.pack(3, channel_id, len(chunk)))
+        buf.extend(chunk)
+        buf.append(FRAME_END)
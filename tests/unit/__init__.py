@@ -0,0 +1,42 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+import functools
+
+from haigha2 import speedups
+from haigha2.tracing import Tracer
+
+
+def pure_python(func):
+    '''
+    Run a test with the compiled codec disabled, for tests which mock the
+    internals of the pure-Python codec.
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        codec = speedups.codec
+        speedups.codec = None
+        try:
+            return func(*args, **kwargs)
+        finally:
+            speedups.codec = codec
+    return wrapper
+
+
+class RecordingTracer(Tracer):
+
+    '''
+    Records the spans that it is passed as ('start'|'end', span) events.
+    '''
+
+    def __init__(self):
+        self.events = []
+
+    def start(self, span):
+        self.events.append(('start', span))
+
+    def end(self, span):
+        self.events.append(('end', span))
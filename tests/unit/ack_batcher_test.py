@@ -0,0 +1,214 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+import random
+
+from chai import Chai
+
+from haigha2 import ack_batcher
+from haigha2.ack_batcher import AckBatcher
+
+
+class BrokerModel(object):
+
+    '''
+    Stands in for BasicClass and applies acks with broker semantics, failing
+    the way a broker would on an ack for an unknown delivery tag.
+    '''
+
+    def __init__(self):
+        self.unacked = set()
+        self.user_acked = set()
+        self.frames = []
+
+    def _send_ack(self, delivery_tag, multiple):
+        self.frames.append((delivery_tag, multiple))
+        if delivery_tag not in self.unacked:
+            raise AssertionError('unknown delivery tag %d' % delivery_tag)
+        if multiple:
+            covered = set(t for t in self.unacked if t <= delivery_tag)
+        else:
+            covered = set([delivery_tag])
+        if not covered <= self.user_acked:
+            raise AssertionError('acked deliveries %s that were not acked by '
+                                 'the user' % (covered - self.user_acked))
+        self.unacked -= covered
+
+
+class AckBatcherTest(Chai):
+
+    def setUp(self):
+        super(AckBatcherTest, self).setUp()
+        self.basic = mock()
+        self.batcher = AckBatcher(self.basic, max_pending=100, max_delay=60)
+
+    def test_init(self):
+        assert_equals(0, self.batcher.pending)
+        assert_equals(0, self.batcher._base)
+        assert_equals(set(), self.batcher._settled)
+
+    def test_in_order_acks_coalesce(self):
+        for tag in (1, 2, 3):
+            self.batcher.ack(tag)
+        assert_equals(3, self.batcher.pending)
+
+        expect(self.basic._send_ack).args(3, True)
+        self.batcher.flush()
+        assert_equals(0, self.batcher.pending)
+        assert_equals(3, self.batcher._base)
+
+    def test_single_ack_is_not_multiple(self):
+        self.batcher.ack(1)
+        expect(self.basic._send_ack).args(1, False)
+        self.batcher.flush()
+
+    def test_flush_when_empty_sends_nothing(self):
+        self.batcher.flush()
+
+    def test_out_of_order_acks_with_gap(self):
+        self.batcher.ack(3)
+        self.batcher.ack(1)
+        self.batcher.ack(2)
+        self.batcher.ack(5)
+
+        expect(self.basic._send_ack).args(3, True)
+        expect(self.basic._send_ack).args(5, False)
+        self.batcher.flush()
+        assert_equals(3, self.batcher._base)
+        assert_equals(set([5]), self.batcher._settled)
+
+        # Filling the gap moves past the individually acked tag
+        self.batcher.ack(4)
+        expect(self.basic._send_ack).args(4, False)
+        self.batcher.flush()
+        assert_equals(5, self.batcher._base)
+        assert_equals(set(), self.batcher._settled)
+
+    def test_gap_at_start(self):
+        self.batcher.ack(2)
+        self.batcher.ack(3)
+
+        expect(self.basic._send_ack).args(2, False)
+        expect(self.basic._send_ack).args(3, False)
+        self.batcher.flush()
+        assert_equals(0, self.batcher._base)
+
+    def test_ack_of_settled_tag_is_dropped(self):
+        self.batcher.ack(1)
+        expect(self.basic._send_ack).args(1, False)
+        self.batcher.flush()
+
+        self.batcher.ack(1)
+        assert_equals(0, self.batcher.pending)
+
+    def test_no_ack_deliveries_do_not_hold_back_run(self):
+        self.batcher.delivered(1, False)
+        self.batcher.delivered(2, True)
+        self.batcher.delivered(3, False)
+        self.batcher.ack(1)
+        self.batcher.ack(3)
+
+        expect(self.basic._send_ack).args(3, True)
+        self.batcher.flush()
+        assert_equals(3, self.batcher._base)
+
+    def test_settle_rejected(self):
+        self.batcher.ack(1)
+        self.batcher.settle(2)
+        self.batcher.ack(3)
+
+        expect(self.basic._send_ack).args(3, True)
+        self.batcher.flush()
+
+    def test_settle_multiple(self):
+        self.batcher.ack(1)
+        self.batcher.ack(4)
+        self.batcher.settle(3, multiple=True)
+        assert_equals(3, self.batcher._base)
+        assert_equals(set([4]), self.batcher._pending)
+
+    def test_user_multiple_ack_sent_immediately(self):
+        self.batcher.ack(1)
+        self.batcher.ack(5)
+
+        expect(self.basic._send_ack).args(3, True)
+        self.batcher.ack(3, multiple=True)
+        assert_equals(3, self.batcher._base)
+        assert_equals(set([5]), self.batcher._pending)
+
+    def test_settle_all(self):
+        self.batcher.delivered(1, False)
+        self.batcher.delivered(2, False)
+        self.batcher.delivered(3, False)
+        self.batcher.ack(2)
+
+        expect(self.basic._send_ack).args(2, False)
+        self.batcher.settle_all()
+        assert_equals(3, self.batcher._base)
+        assert_equals(set(), self.batcher._settled)
+
+    def test_enabled_mid_stream(self):
+        # Deliveries 1-10 were acked directly before batching was enabled
+        batcher = AckBatcher(self.basic, max_pending=100, max_delay=60,
+                             last_delivered=10)
+        for tag in (11, 12, 13):
+            batcher.delivered(tag, False)
+            batcher.ack(tag)
+
+        expect(self.basic._send_ack).args(13, True)
+        batcher.flush()
+        assert_equals(13, batcher._base)
+
+    def test_ack_for_delivery_before_batching_is_sent(self):
+        batcher = AckBatcher(self.basic, max_pending=100, max_delay=60,
+                             last_delivered=10)
+        expect(self.basic._send_ack).args(4, False)
+        batcher.ack(4)
+        assert_equals(0, batcher.pending)
+
+    def test_flushes_on_count(self):
+        batcher = AckBatcher(self.basic, max_pending=3, max_delay=60)
+        batcher.ack(1)
+        batcher.ack(2)
+        expect(self.basic._send_ack).args(3, True)
+        batcher.ack(3)
+        assert_equals(0, batcher.pending)
+
+    def test_flushes_on_delay(self):
+        batcher = AckBatcher(self.basic, max_pending=100, max_delay=1)
+        expect(ack_batcher.time.time).returns(10)
+        batcher.ack(1)
+        expect(ack_batcher.time.time).returns(10.5)
+        batcher.ack(2)
+        expect(ack_batcher.time.time).returns(11)
+        expect(self.basic._send_ack).args(3, True)
+        batcher.ack(3)
+        assert_equals(None, batcher._pending_since)
+
+    def test_random_order_matches_broker_semantics(self):
+        rand = random.Random(42)
+        for _ in range(50):
+            broker = BrokerModel()
+            batcher = AckBatcher(broker, max_pending=rand.randint(1, 20),
+                                 max_delay=60)
+            tags = list(range(1, rand.randint(2, 200)))
+            for tag in tags:
+                no_ack = rand.random() < 0.1
+                if not no_ack:
+                    broker.unacked.add(tag)
+                batcher.delivered(tag, no_ack)
+
+            outstanding = sorted(broker.unacked)
+            rand.shuffle(outstanding)
+            for tag in outstanding:
+                broker.user_acked.add(tag)
+                batcher.ack(tag)
+                if rand.random() < 0.05:
+                    batcher.flush()
+            batcher.flush()
+
+            assert_equals(set(), broker.unacked)
+            assert_true(len(broker.frames) <= len(outstanding))
@@ -0,0 +1,116 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+import os
+import shutil
+import tempfile
+from io import BytesIO
+
+from chai import Chai
+
+from haigha2.capture import *
+from haigha2.connections.rabbit_connection import RabbitConnection
+from tests.fake_broker import FakeBroker
+
+
+class CaptureTest(Chai):
+
+    def test_round_trip(self):
+        f = BytesIO()
+        writer = CaptureWriter(f, start=100.0)
+        writer.record(OUTBOUND, b'AMQP', timestamp=100.0)
+        writer.record(INBOUND, bytearray(b'frames'), timestamp=100.25)
+        writer.record(INBOUND, b'', timestamp=101.5)
+        writer.close()
+        assert_true(writer.closed)
+        assert_false(f.closed)
+
+        reader = CaptureReader(BytesIO(f.getvalue()))
+        assert_equals(100.0, reader.start)
+        assert_equals([
+            (OUTBOUND, 100.0, b'AMQP'),
+            (INBOUND, 100.25, b'frames'),
+            (INBOUND, 101.5, b''),
+        ], list(reader))
+
+    def test_record_after_close_is_ignored(self):
+        f = BytesIO()
+        writer = CaptureWriter(f)
+        writer.close()
+        writer.record(INBOUND, b'late')
+        assert_equals([], list(CaptureReader(BytesIO(f.getvalue()))))
+
+    def test_writer_closes_file_it_opened(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'session.hcap')
+            writer = CaptureWriter(path)
+            writer.record(INBOUND, b'data')
+            writer.close()
+            assert_true(writer.closed)
+
+            reader = CaptureReader(path)
+            assert_equals([b'data'], [data for _, _, data in reader])
+            reader.close()
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_reader_rejects_bad_header(self):
+        assert_raises(CaptureError, CaptureReader, BytesIO(b'HCA'))
+        assert_raises(CaptureError, CaptureReader,
+                      BytesIO(HEADER.pack(b'PCAP', VERSION, 0.0)))
+        assert_raises(CaptureError, CaptureReader,
+                      BytesIO(HEADER.pack(MAGIC, VERSION + 1, 0.0)))
+
+    def test_reader_raises_on_truncated_record(self):
+        f = BytesIO()
+        CaptureWriter(f).record(INBOUND, b'data')
+        reader = CaptureReader(BytesIO(f.getvalue()[:-1]))
+        assert_raises(CaptureError, list, reader)
+
+        reader = CaptureReader(BytesIO(f.getvalue()[:HEADER.size + 3]))
+        assert_raises(CaptureError, list, reader)
+
+
+class CaptureReplayTest(Chai):
+
+    '''
+    Captures a session with the fake broker and replays it.
+    '''
+
+    def test_replay_delivers_captured_messages(self):
+        capture = BytesIO()
+        with FakeBroker() as broker:
+            broker.preload('q', b'body', 5)
+            host, port = broker.address
+            connection = RabbitConnection(host=host, port=port,
+                                          capture=capture)
+            channel = connection.channel()
+            received = []
+            channel.basic.consume('q', received.append,
+                                  consumer_tag='ctag')
+            while len(received) < 5:
+                connection.read_frames()
+            connection.close()
+        assert_equals(5, len(received))
+
+        replayed = []
+        outbound = []
+        connection = RabbitConnection(
+            transport='replay', replay=BytesIO(capture.getvalue()),
+            replay_outbound_cb=outbound.append)
+        channel = None
+        while connection.transport is not None and \
+                not connection.transport.exhausted:
+            connection.read_frames()
+            if channel is None and connection._connected:
+                channel = connection.channel()
+                # The captured consume waited for consume_ok, as the socket
+                # transport is synchronous
+                channel.basic.consume('q', replayed.append,
+                                      consumer_tag='ctag', nowait=False)
+        assert_equals([b'body'] * 5, [bytes(m.body) for m in replayed])
+        assert_true(outbound[0].startswith(b'AMQP'))
@@ -20,6 +20,11 @@ from haigha2.frames.method_frame import MethodFrame
 from haigha2.frames.heartbeat_frame import HeartbeatFrame
 from haigha2.frames.header_frame import HeaderFrame
 from haigha2.frames.content_frame import ContentFrame
+from haigha2.metrics import Metrics
+from haigha2.reader import Reader
+from haigha2.writer import Writer
+
+from tests.unit import RecordingTracer
 
 
 class SyncWrapperTest(Chai):
@@ -173,10 +178,8 @@ class ChannelTest(Chai):
         on_channel_closed = mock()
         ch.add_close_listener(on_channel_closed)
 
-        expect(rframe.args.read_short).returns('rcode')
-        expect(rframe.args.read_shortstr).returns('reason')
-        expect(rframe.args.read_short).returns('cid')
-        expect(rframe.args.read_short).returns('mid')
+        expect(rframe.args.read_args).args(ChannelClass.CLOSE_ARGS).returns(
+            ('rcode', 'reason', 'cid', 'mid'))
 
         expect(connection.send_frame).once()
 
@@ -259,6 +262,12 @@ class ChannelTest(Chai):
         c.buffer_frame('f2')
         assert_equals(deque(['f1', 'f2']), c._frame_buffer)
 
+    def test_buffer_scanned(self):
+        c = Channel(mock(), None, {})
+        c.buffer_scanned('scan', 0)
+        c.buffer_frame('f1')
+        assert_equals(deque([('scan', 0), 'f1']), c._frame_buffer)
+
     def test_process_frames_when_no_frames(self):
         # Not that this should ever happen, but to be sure
         c = Channel(mock(), None, {})
@@ -288,6 +297,43 @@ class ChannelTest(Chai):
         c.process_frames()
         assert_equals(f1, c._frame_buffer[0])
 
+    def test_process_frames_parses_scanned_frames(self):
+        c = Channel(mock(), None, {})
+        f0 = MethodFrame('ch_id', 'c_id', 'm_id')
+        f1 = MethodFrame('ch_id', 'c_id', 'm_id')
+        c._frame_buffer = deque([('scan', 0), f1])
+
+        expect(c.connection._parse_frame).args('scan', 0).returns(f0)
+        expect(c.dispatch).args(f0)
+        expect(c.dispatch).args(f1)
+
+        c.process_frames()
+
+    def test_process_frames_passes_content_to_receiver(self):
+        c = Channel(mock(), None, {})
+        c._content_receiver = mock()
+        f0 = HeaderFrame('ch_id', 'c_id', 0, 3)
+        f1 = ContentFrame('ch_id', 'abc')
+        f2 = MethodFrame('ch_id', 'c_id', 'm_id')
+        c._frame_buffer = deque([f0, f1, f2])
+
+        expect(c._content_receiver).args(f0)
+        expect(c._content_receiver).args(f1)
+        expect(c.dispatch).args(f2)
+
+        c.process_frames()
+
+    def test_process_frames_flushes_ack_batcher(self):
+        c = Channel(mock(), None, {})
+        c._ack_batcher = mock()
+        f0 = MethodFrame('ch_id', 'c_id', 'm_id')
+        c._frame_buffer = deque([f0])
+
+        expect(c.dispatch).args(f0)
+        expect(c._ack_batcher.flush)
+
+        c.process_frames()
+
     def test_process_frames_when_connectionclosed_on_dispatch(self):
         c = Channel(mock(), None, {})
         c._connection = mock()
@@ -413,6 +459,23 @@ class ChannelTest(Chai):
         c._frame_buffer = deque([f0, f1])
         assert_equals(c.next_frame(), f0)
 
+    def test_next_frame_with_a_scanned_frame(self):
+        c = Channel(mock(), None, {})
+        c._frame_buffer = deque([('scan', 0)])
+        expect(c.connection._parse_frame).args('scan', 0).returns('frame')
+        assert_equals('frame', c.next_frame())
+        assert_equals(deque(), c._frame_buffer)
+
+    def test_peek_frame(self):
+        c = Channel(mock(), None, {})
+        assert_equals(None, c.peek_frame())
+
+        c._frame_buffer = deque([('scan', 0), 'f1'])
+        expect(c.connection._parse_frame).args('scan', 0).returns('frame')
+        assert_equals('frame', c.peek_frame())
+        assert_equals('frame', c.peek_frame())
+        assert_equals(deque(['frame', 'f1']), c._frame_buffer)
+
     def test_next_frame_with_no_frames(self):
         c = Channel(mock(), None, {})
         c._frame_buffer = deque()
@@ -561,6 +624,59 @@ class ChannelTest(Chai):
         assert_equals('foo', c.clear_synchronous_cb('foo'))
         assert_equals(deque([]), c._pending_events)
 
+    def test_synchronous_cb_records_latency(self):
+        conn = mock()
+        conn.synchronous = False
+        metrics = Metrics()
+        c = Channel(conn, None, {}, metrics=metrics.channel(1))
+        expect(c._flush_pending_events)
+
+        expect(channel.time.time).returns(10.0)
+        c.add_synchronous_cb('foo')
+        assert_equals(deque([10.0]), c._sync_started)
+
+        expect(channel.time.time).returns(10.25)
+        c.clear_synchronous_cb('foo')
+        assert_equals(deque(), c._sync_started)
+        assert_equals(1, metrics.sync_latency.count)
+        assert_equals(0.25, metrics.sync_latency.sum)
+
+    def test_synchronous_cb_traces_span(self):
+        conn = mock()
+        conn.synchronous = False
+        tracer = RecordingTracer()
+        c = Channel(conn, 1, {}, tracer=tracer)
+        expect(conn.send_frame)
+        expect(c._flush_pending_events)
+
+        c.send_frame(MethodFrame(1, 50, 10, Writer(bytearray('args'))))
+        c.add_synchronous_cb('foo')
+        span = c._spans[0]
+        assert_equals([('start', span)], tracer.events)
+        assert_equals(None, c._last_method)
+        assert_equals('queue.declare', span.name)
+        assert_equals(4, span.bytes_out)
+
+        c.clear_synchronous_cb('foo', MethodFrame(1, 50, 11, Reader('reply')))
+        assert_equals([('start', span), ('end', span)], tracer.events)
+        assert_equals(deque(), c._spans)
+        assert_equals((50, 11), (span.reply_class_id, span.reply_method_id))
+        assert_equals(5, span.bytes_in)
+        assert_true(span.end >= span.start)
+
+    def test_closed_cb_ends_spans_with_error(self):
+        tracer = RecordingTracer()
+        c = Channel(mock(), 1, {}, tracer=tracer)
+        c._close_info = {'reply_code': 404, 'reply_text': 'not found'}
+        c._start_sync_span()
+        span = c._spans[0]
+        expect(c._notify_close_listeners)
+
+        c._closed_cb()
+        assert_equals(('end', span), tracer.events[-1])
+        assert_equals('404: not found', span.error)
+        assert_equals('0.0', span.name)
+
     def test_clear_synchronous_cb_when_pending_cb_doesnt_match_but_isnt_in_list(self):
         c = Channel(mock(), None, {})
         c._pending_events = deque(['foo'])
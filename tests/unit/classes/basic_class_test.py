@@ -12,8 +12,15 @@ from haigha2.classes.basic_class import BasicClass
 from haigha2.frames.method_frame import MethodFrame
 from haigha2.writer import Writer
 from haigha2.reader import Reader
-from haigha2.message import Message
+from haigha2.message import Message, StreamingMessage
+from haigha2.frames.header_frame import HeaderFrame
+from haigha2.frames.content_frame import ContentFrame
 from haigha2.connection import Connection
+from haigha2.exceptions import ChannelClosed
+from haigha2.metrics import Metrics
+from haigha2.profiling import StageProfiler
+
+from tests.unit import RecordingTracer
 
 from collections import deque
 
@@ -25,6 +32,10 @@ class BasicClassTest(Chai):
         ch = mock()
         ch.channel_id = 42
         ch.logger = mock()
+        ch._ack_batcher = None
+        ch._metrics = None
+        ch._tracer = None
+        ch._profiler = None
         self.klass = BasicClass(ch)
 
     def test_init(self):
@@ -47,6 +58,8 @@ class BasicClassTest(Chai):
         assert_equals(0, klass._consumer_tag_id)
         assert_equals(deque(), klass._pending_consumers)
         assert_equals({}, klass._consumer_cb)
+        assert_equals(set(), klass._no_ack_consumer_tags)
+        assert_equals(set(), klass._stream_consumer_tags)
         assert_equals(deque(), klass._get_cb)
         assert_equals(deque(), klass._recover_cb)
         assert_equals(deque(), klass._cancel_cb)
@@ -56,6 +69,8 @@ class BasicClassTest(Chai):
         self.klass._cleanup()
         assert_equals(None, self.klass._pending_consumers)
         assert_equals(None, self.klass._consumer_cb)
+        assert_equals(None, self.klass._no_ack_consumer_tags)
+        assert_equals(None, self.klass._stream_consumer_tags)
         assert_equals(None, self.klass._get_cb)
         assert_equals(None, self.klass._recover_cb)
         assert_equals(None, self.klass._cancel_cb)
@@ -132,6 +147,23 @@ class BasicClassTest(Chai):
         assert_equals(deque(), self.klass._pending_consumers)
         assert_equals({'ctag': 'consumer'}, self.klass._consumer_cb)
 
+    def test_consume_stream_without_wait(self):
+        w = mock()
+        expect(self.klass.allow_nowait).returns(True)
+        expect(mock(basic_class, 'Writer')).returns(w)
+        expect(w.write_short).returns(w)
+        expect(w.write_shortstr).args('queue').returns(w)
+        expect(w.write_shortstr).args('stag').returns(w)
+        expect(w.write_bits).returns(w)
+        expect(w.write_table).args({})
+        expect(mock(basic_class, 'MethodFrame')).returns('frame')
+        expect(self.klass.send_frame).args('frame')
+
+        self.klass.consume('queue', 'consumer', consumer_tag='stag',
+                           stream=True)
+        assert_equals({'stag': 'consumer'}, self.klass._consumer_cb)
+        assert_equals(set(['stag']), self.klass._stream_consumer_tags)
+
     def test_consume_with_args_including_nowait_and_ticket(self):
         w = mock()
         stub(self.klass.allow_nowait)
@@ -152,7 +184,8 @@ class BasicClassTest(Chai):
         self.klass.consume('queue', 'consumer', consumer_tag='stag', no_local='nloc',
                            no_ack='nack', exclusive='mine', nowait=False, ticket='train')
         assert_equals(
-            deque([('consumer', None)]), self.klass._pending_consumers)
+            deque([('consumer', None, 'nack', False)]),
+            self.klass._pending_consumers)
         assert_equals({}, self.klass._consumer_cb)
 
     def test_consume_with_args_including_nowait_no_ticket_with_callback(self):
@@ -170,12 +203,14 @@ class BasicClassTest(Chai):
         expect(self.klass.channel.add_synchronous_cb).args(
             self.klass._recv_consume_ok)
 
-        self.klass._pending_consumers = deque([('blargh', None)])
+        self.klass._pending_consumers = deque([('blargh', None, True, False)])
         assert_equals({}, self.klass._consumer_cb)
         self.klass.consume('queue', 'consumer', consumer_tag='stag', no_local='nloc',
                            no_ack='nack', exclusive='mine', nowait=False, cb='callback')
         assert_equals(deque(
-            [('blargh', None), ('consumer', 'callback')]), self.klass._pending_consumers)
+            [('blargh', None, True, False),
+             ('consumer', 'callback', 'nack', False)]),
+            self.klass._pending_consumers)
         assert_equals({}, self.klass._consumer_cb)
 
     def test_recv_consume_ok(self):
@@ -183,12 +218,15 @@ class BasicClassTest(Chai):
         cb = mock()
         expect(frame.args.read_shortstr).returns('ctag')
         self.klass._pending_consumers = deque(
-            [('consumer', None), ('blargh', cb)])
+            [('consumer', None, True, False), ('blargh', cb, False, True)])
 
         assert_equals({}, self.klass._consumer_cb)
         self.klass._recv_consume_ok(frame)
         assert_equals({'ctag': 'consumer'}, self.klass._consumer_cb)
-        assert_equals(deque([('blargh', cb)]), self.klass._pending_consumers)
+        assert_equals(set(['ctag']), self.klass._no_ack_consumer_tags)
+        assert_equals(
+            deque([('blargh', cb, False, True)]),
+            self.klass._pending_consumers)
 
         # call again and assert that cb is called
         frame2 = mock()
@@ -197,6 +235,8 @@ class BasicClassTest(Chai):
         self.klass._recv_consume_ok(frame2)
         assert_equals(
             {'ctag': 'consumer', 'ctag2': 'blargh'}, self.klass._consumer_cb)
+        assert_equals(set(['ctag']), self.klass._no_ack_consumer_tags)
+        assert_equals(set(['ctag2']), self.klass._stream_consumer_tags)
         assert_equals(deque(), self.klass._pending_consumers)
 
     def test_cancel_default_args(self):
@@ -369,6 +409,36 @@ class BasicClassTest(Chai):
         expect(self.klass.send_frame).args('f2')
         self.klass.publish(msg, 'exchange', 'routing_key')
 
+    def test_publish_records_metrics(self):
+        metrics = Metrics()
+        self.klass.channel._metrics = metrics.channel(42)
+        self.klass.channel.connection.frame_max = 1024
+        expect(self.klass.send_frame).any_args().at_least(0)
+
+        self.klass.publish(Message('hello'), 'exchange', 'routing_key')
+        self.klass.publish_raw(Message('hello'), 'exchange', 'routing_key')
+        assert_equals(2, metrics.channel(42).published.value)
+
+    def test_publish_traces_span(self):
+        tracer = RecordingTracer()
+        self.klass.channel._tracer = tracer
+        self.klass.channel.connection.frame_max = 1024
+        expect(self.klass.send_frame).any_args().at_least(0)
+
+        self.klass.publish(Message('hello'), 'exchange', 'routing_key')
+        span = tracer.events[0][1]
+        assert_equals([('start', span), ('end', span)], tracer.events)
+        assert_equals('basic.publish', span.name)
+        assert_equals(5, span.bytes_out)
+
+    def test_ack_records_metrics(self):
+        metrics = Metrics()
+        self.klass.channel._metrics = metrics.channel(42)
+        expect(self.klass._send_ack).args(1, False)
+
+        self.klass.ack(1)
+        assert_equals(1, metrics.channel(42).acked.value)
+
     def test_publish_with_args(self):
         w = mock()
         msg = Message('hello, world')
@@ -394,6 +464,29 @@ class BasicClassTest(Chai):
         self.klass.publish(
             msg, 'exchange', 'route', mandatory='m', immediate='i', ticket='ticket')
 
+    def test_publish_raw(self):
+        w = mock()
+        msg = Message('hello, world', raw_header='raw', foo='bar')
+        expect(mock(basic_class, 'Writer')).returns(w)
+        expect(w.write_short).args(self.klass.default_ticket).returns(w)
+        expect(w.write_shortstr).args('exchange').returns(w)
+        expect(w.write_shortstr).args('route').returns(w)
+        expect(w.write_bits).args(False, False)
+        self.klass.channel.connection.frame_max = 3
+
+        expect(mock(basic_class, 'MethodFrame')).args(
+            42, 60, 40, w).returns('methodframe')
+        expect(mock(basic_class, 'HeaderFrame')).args(
+            42, 60, 0, len(msg), {'foo': 'bar'}, 'raw').returns('headerframe')
+        expect(mock(basic_class, 'ContentFrame').create_frames).args(
+            42, msg.body, 3).returns(['f0', 'f1'])
+        expect(self.klass.send_frame).args('methodframe')
+        expect(self.klass.send_frame).args('headerframe')
+        expect(self.klass.send_frame).args('f0')
+        expect(self.klass.send_frame).args('f1')
+
+        self.klass.publish_raw(msg, 'exchange', 'route')
+
     def test_return_msg(self):
         args = Writer()
         args.write_short(3)
@@ -453,6 +546,57 @@ class BasicClassTest(Chai):
 
         self.klass._recv_deliver('frame')
 
+    def test_recv_deliver_traces_span(self):
+        tracer = RecordingTracer()
+        self.klass.channel._tracer = tracer
+        msg = Message('hello', delivery_info={'consumer_tag': 'ctag'})
+        cb = mock()
+        self.klass._consumer_cb['ctag'] = cb
+
+        expect(self.klass._read_msg).args(
+            'frame', with_consumer_tag=True, with_message_count=False).returns(msg)
+        expect(cb).args(msg)
+
+        self.klass._recv_deliver('frame')
+        span = tracer.events[0][1]
+        assert_equals([('start', span), ('end', span)], tracer.events)
+        assert_equals('basic.deliver', span.name)
+        assert_equals(5, span.bytes_in)
+
+    def test_recv_deliver_records_metrics(self):
+        metrics = Metrics()
+        self.klass.channel._metrics = metrics.channel(42)
+        msg = mock()
+        msg.delivery_info = {'consumer_tag': 'ctag'}
+        cb = mock()
+        self.klass._consumer_cb['ctag'] = cb
+
+        expect(self.klass._read_msg).args(
+            'frame', with_consumer_tag=True, with_message_count=False).returns(msg)
+        expect(basic_class.time.time).returns(5.0)
+        expect(cb).args(msg)
+        expect(basic_class.time.time).returns(5.5)
+
+        self.klass._recv_deliver('frame')
+        assert_equals(1, metrics.channel(42).delivered.value)
+        assert_equals(0.5, metrics.consumer_time.sum)
+
+    def test_recv_deliver_profiles_callback(self):
+        profiler = self.klass.channel._profiler = StageProfiler(sample_rate=1)
+        msg = mock()
+        msg.delivery_info = {'consumer_tag': 'ctag'}
+        cb = mock()
+        self.klass._consumer_cb['ctag'] = cb
+
+        expect(self.klass._read_msg).args(
+            'frame', with_consumer_tag=True, with_message_count=False).returns(msg)
+        expect(cb).args(msg)
+
+        assert_true(profiler.begin())
+        self.klass._recv_deliver('frame')
+        profiler.end()
+        assert_equals(1, profiler.snapshot()['stages']['callback']['calls'])
+
     def test_recv_deliver_without_cb(self):
         msg = mock()
         msg.delivery_info = {'consumer_tag': 'ctag'}
@@ -462,6 +606,159 @@ class BasicClassTest(Chai):
 
         self.klass._recv_deliver('frame')
 
+    def _deliver_frame(self, consumer_tag, delivery_tag):
+        args = Writer()
+        args.write_shortstr(consumer_tag).\
+            write_longlong(delivery_tag).\
+            write_bit(False).\
+            write_shortstr('exchange').\
+            write_shortstr('rkey')
+        return MethodFrame(42, 60, 60, Reader(args.buffer()))
+
+    def test_dispatch_assembles_content(self):
+        for method_id in (50, 60, 71):
+            frame = MethodFrame(42, 60, method_id)
+            self.klass.dispatch(frame)
+            receiver = self.klass.channel._content_receiver
+            assert_true(isinstance(receiver, basic_class._ContentAssembler))
+            assert_is(frame, receiver._method_frame)
+
+    def test_dispatch_passes_other_methods_through(self):
+        frame = MethodFrame(42, 60, 11)
+        expect(ProtocolClass.dispatch).args(frame)
+        self.klass.channel._content_receiver = None
+
+        self.klass.dispatch(frame)
+        assert_equals(None, self.klass.channel._content_receiver)
+
+    def test_dispatch_peeks_past_non_stream_consumer(self):
+        self.klass._stream_consumer_tags.add('stag')
+        frame = self._deliver_frame('ctag', 1)
+
+        self.klass.dispatch(frame)
+        assert_true(isinstance(self.klass.channel._content_receiver,
+                               basic_class._ContentAssembler))
+        assert_equals(0, frame.args.tell())
+
+    def test_dispatch_content(self):
+        def check(frame):
+            assert_equals(('header', 'body'), self.klass._content)
+        expect(ProtocolClass.dispatch).args('frame').side_effect(check)
+
+        self.klass._dispatch_content('frame', 'header', 'body')
+        assert_equals(None, self.klass._content)
+
+    def test_content_assembler(self):
+        ch = self.klass.channel
+        method_frame = MethodFrame(42, 60, 60)
+        header_frame = HeaderFrame(42, 60, 0, 6)
+        ch._content_receiver = assembler = basic_class._ContentAssembler(
+            self.klass, method_frame)
+
+        assembler(header_frame)
+        assembler(ContentFrame(42, Reader('abc')))
+        assert_is(assembler, ch._content_receiver)
+
+        expect(self.klass._dispatch_content).args(
+            method_frame, header_frame, bytearray('abcdef'))
+        assembler(ContentFrame(42, Reader('def')))
+        assert_equals(None, ch._content_receiver)
+
+    def test_content_assembler_records_reassembly_time(self):
+        metrics = Metrics()
+        ch = self.klass.channel
+        ch._metrics = metrics.channel(42)
+        header_frame = HeaderFrame(42, 60, 0, 3)
+        expect(basic_class.time.time).returns(1.0)
+        ch._content_receiver = assembler = basic_class._ContentAssembler(
+            self.klass, 'method_frame')
+
+        expect(self.klass._dispatch_content).any_args()
+        assembler(header_frame)
+        expect(basic_class.time.time).returns(1.75)
+        assembler(ContentFrame(42, Reader('abc')))
+        assert_equals(1, metrics.reassembly_time.count)
+        assert_equals(0.75, metrics.reassembly_time.sum)
+
+    def test_content_assembler_exits_profiler_stage_on_error(self):
+        ch = self.klass.channel
+        profiler = ch._profiler = StageProfiler(sample_rate=1)
+        ch._content_receiver = assembler = basic_class._ContentAssembler(
+            self.klass, 'method_frame')
+
+        assert_true(profiler.begin())
+        assembler(HeaderFrame(42, 60, 0, 3))
+        assert_raises(AttributeError, assembler, 'not a content frame')
+        assert_equals([], profiler._stack)
+        profiler.end()
+        assert_equals(2, profiler.snapshot()['stages']['reassembly']['calls'])
+
+    def test_content_assembler_with_empty_body(self):
+        ch = self.klass.channel
+        header_frame = HeaderFrame(42, 60, 0, 0)
+        ch._content_receiver = assembler = basic_class._ContentAssembler(
+            self.klass, 'method_frame')
+
+        expect(self.klass._dispatch_content).args(
+            'method_frame', header_frame, bytearray())
+        assembler(header_frame)
+        assert_equals(None, ch._content_receiver)
+
+    def test_dispatch_streams_to_stream_consumer(self):
+        ch = self.klass.channel
+        ch.synchronous = False
+        consumer = mock()
+        self.klass._consumer_cb['stag'] = consumer
+        self.klass._stream_consumer_tags.add('stag')
+        batcher = ch._ack_batcher = mock()
+
+        expect(batcher.delivered).args(7, False)
+        self.klass.dispatch(self._deliver_frame('stag', 7))
+        receiver = ch._content_receiver
+        assert_true(isinstance(receiver, basic_class._StreamReceiver))
+
+        msgs = []
+        expect(consumer).side_effect(msgs.append)
+        receiver(HeaderFrame(42, 60, 0, 6, {'content_type': 'text/plain'}))
+        msg = msgs[0]
+        assert_true(isinstance(msg, StreamingMessage))
+        assert_equals(6, len(msg))
+        assert_equals({'content_type': 'text/plain'}, msg.properties)
+        assert_equals('stag', msg.delivery_info['consumer_tag'])
+        assert_equals(7, msg.delivery_info['delivery_tag'])
+        assert_equals('rkey', msg.delivery_info['routing_key'])
+
+        receiver(ContentFrame(42, Reader('abc')))
+        assert_equals('abc', msg.body.read())
+        assert_is(receiver, ch._content_receiver)
+
+        receiver(ContentFrame(42, Reader('def')))
+        assert_equals(None, ch._content_receiver)
+        assert_true(msg.body.complete)
+        assert_equals('def', msg.body.read())
+
+    def test_stream_receiver_with_empty_body(self):
+        ch = mock()
+        ch._metrics = None
+        ch._tracer = None
+        ch._profiler = None
+        consumer = mock()
+        ch._content_receiver = receiver = basic_class._StreamReceiver(
+            ch, consumer, {})
+
+        expect(consumer).args(is_a(StreamingMessage))
+        receiver(HeaderFrame(42, 60, 0, 0, {}))
+        assert_equals(None, ch._content_receiver)
+
+    def test_stream_receiver_without_consumer(self):
+        ch = mock()
+        ch._content_receiver = receiver = basic_class._StreamReceiver(
+            ch, None, {})
+
+        receiver(HeaderFrame(42, 60, 0, 3, {}))
+        receiver(ContentFrame(42, Reader('abc')))
+        assert_equals(None, ch._content_receiver)
+
     def test_get_default_args(self):
         w = mock()
         expect(mock(basic_class, 'Writer')).returns(w)
@@ -476,7 +773,7 @@ class BasicClassTest(Chai):
 
         assert_equals(deque(), self.klass._get_cb)
         assert_equals('msg', self.klass.get('queue'))
-        assert_equals(deque([None]), self.klass._get_cb)
+        assert_equals(deque([(None, True)]), self.klass._get_cb)
 
     def test_get_with_args(self):
         w = mock()
@@ -490,10 +787,11 @@ class BasicClassTest(Chai):
         expect(self.klass.channel.add_synchronous_cb).args(
             self.klass._recv_get_response).returns('msg')
 
-        self.klass._get_cb = deque(['blargh'])
+        self.klass._get_cb = deque([('blargh', True)])
         assert_equals(
             'msg', self.klass.get('queue', 'consumer', no_ack='ack', ticket='ticket'))
-        assert_equals(deque(['blargh', 'consumer']), self.klass._get_cb)
+        assert_equals(
+            deque([('blargh', True), ('consumer', 'ack')]), self.klass._get_cb)
 
     def test_recv_get_response(self):
         frame = mock()
@@ -507,8 +805,8 @@ class BasicClassTest(Chai):
 
     def test_recv_get_ok_with_cb(self):
         cb = mock()
-        self.klass._get_cb.append(cb)
-        self.klass._get_cb.append(mock())
+        self.klass._get_cb.append((cb, True))
+        self.klass._get_cb.append((mock(), True))
 
         expect(self.klass._read_msg).args(
             'frame', with_consumer_tag=False, with_message_count=True).returns('msg')
@@ -516,37 +814,148 @@ class BasicClassTest(Chai):
 
         assert_equals('msg', self.klass._recv_get_ok('frame'))
         assert_equals(1, len(self.klass._get_cb))
-        assert_false(cb in self.klass._get_cb)
+        assert_false((cb, True) in self.klass._get_cb)
 
     def test_recv_get_ok_without_cb(self):
-        self.klass._get_cb.append(None)
-        self.klass._get_cb.append(mock())
+        self.klass._get_cb.append((None, True))
+        self.klass._get_cb.append((mock(), True))
 
         expect(self.klass._read_msg).args(
             'frame', with_consumer_tag=False, with_message_count=True).returns('msg')
 
         self.klass._recv_get_ok('frame')
         assert_equals(1, len(self.klass._get_cb))
-        assert_false(None in self.klass._get_cb)
+        assert_false((None, True) in self.klass._get_cb)
 
     def test_recv_get_empty_with_cb(self):
         cb = mock()
-        self.klass._get_cb.append(cb)
-        self.klass._get_cb.append(mock())
+        self.klass._get_cb.append((cb, True))
+        self.klass._get_cb.append((mock(), True))
 
         expect(cb).args(None)
 
         self.klass._recv_get_empty('frame')
         assert_equals(1, len(self.klass._get_cb))
-        assert_false(cb in self.klass._get_cb)
+        assert_false((cb, True) in self.klass._get_cb)
 
     def test_recv_get_empty_without_cb(self):
-        self.klass._get_cb.append(None)
-        self.klass._get_cb.append(mock())
+        self.klass._get_cb.append((None, True))
+        self.klass._get_cb.append((mock(), True))
 
         self.klass._recv_get_empty('frame')
         assert_equals(1, len(self.klass._get_cb))
-        assert_false(None in self.klass._get_cb)
+        assert_false((None, True) in self.klass._get_cb)
+
+    def _fake_get_sends(self):
+        sent = []
+        self.klass._send_get = lambda queue, consumer, no_ack, ticket: \
+            sent.append((queue, consumer, no_ack, ticket))
+        return sent
+
+    def _msg(self, size):
+        return Message('x' * size)
+
+    def test_send_get(self):
+        w = mock()
+        expect(mock(basic_class, 'Writer')).returns(w)
+        expect(w.write_short).args(self.klass.default_ticket).returns(w)
+        expect(w.write_shortstr).args('queue').returns(w)
+        expect(w.write_bit).args(False)
+        expect(mock(basic_class, 'MethodFrame')).args(
+            42, 60, 70, w).returns('frame')
+        expect(self.klass.send_frame).args('frame')
+
+        self.klass._send_get('queue', 'consumer', False, None)
+        assert_equals(deque([('consumer', False)]), self.klass._get_cb)
+
+    def test_get_many_pipelines_and_stops_on_empty(self):
+        self.klass.channel.synchronous = False
+        sent = self._fake_get_sends()
+        cb = mock()
+
+        assert_equals(None, self.klass.get_many('queue', 5, consumer=cb,
+                                                depth=2, ticket='t'))
+        assert_equals(2, len(sent))
+        assert_equals(('queue', sent[0][1], True, 't'), sent[0])
+
+        m1 = self._msg(10)
+        sent[0][1](m1)
+        assert_equals(3, len(sent))
+
+        sent[1][1](None)
+        assert_equals(3, len(sent))
+
+        m3 = self._msg(10)
+        expect(cb).args([m1, m3])
+        sent[2][1](m3)
+
+    def test_get_many_stops_at_max_messages(self):
+        self.klass.channel.synchronous = False
+        sent = self._fake_get_sends()
+        cb = mock()
+
+        self.klass.get_many('queue', 3, consumer=cb, no_ack=False)
+        assert_equals(3, len(sent))
+        assert_false(sent[0][2])
+
+        msgs = [self._msg(1) for _ in range(3)]
+        sent[0][1](msgs[0])
+        sent[1][1](msgs[1])
+        expect(cb).args(msgs)
+        sent[2][1](msgs[2])
+        assert_equals(3, len(sent))
+
+    def test_get_many_stops_at_max_bytes(self):
+        self.klass.channel.synchronous = False
+        sent = self._fake_get_sends()
+        cb = mock()
+
+        self.klass.get_many('queue', 10, max_bytes=15, consumer=cb, depth=2)
+        m1 = self._msg(10)
+        sent[0][1](m1)
+        assert_equals(3, len(sent))
+
+        m2 = self._msg(10)
+        sent[1][1](m2)
+        assert_equals(3, len(sent))
+
+        m3 = self._msg(10)
+        expect(cb).args([m1, m2, m3])
+        sent[2][1](m3)
+
+    def test_get_many_default_depth(self):
+        self.klass.channel.synchronous = False
+        sent = self._fake_get_sends()
+        self.klass.get_many('queue', 100, consumer=mock())
+        assert_equals(8, len(sent))
+
+    def test_get_many_synchronous_waits_for_each_reply(self):
+        ch = self.klass.channel
+        ch.synchronous = True
+        sent = self._fake_get_sends()
+        msg = self._msg(1)
+
+        expect(ch.add_synchronous_cb).args(
+            self.klass._recv_get_response).side_effect(
+            lambda cb: sent[0][1](msg))
+        expect(ch.add_synchronous_cb).args(
+            self.klass._recv_get_response).side_effect(
+            lambda cb: sent[1][1](None))
+
+        assert_equals([msg], self.klass.get_many('queue', 2))
+
+    def test_get_many_synchronous_raises_when_closed(self):
+        ch = self.klass.channel
+        ch.synchronous = True
+        self._fake_get_sends()
+        expect(ch.add_synchronous_cb).args(
+            self.klass._recv_get_response).raises(ChannelClosed())
+
+        assert_raises(ChannelClosed, self.klass.get_many, 'queue', 2)
+
+    def test_get_many_validates_arguments(self):
+        assert_raises(ValueError, self.klass.get_many, 'queue', 0)
+        assert_raises(ValueError, self.klass.get_many, 'queue', 1, depth=0)
 
     def test_ack_default_args(self):
         w = mock()
@@ -570,6 +979,79 @@ class BasicClassTest(Chai):
 
         self.klass.ack(8675309, multiple='many')
 
+    def test_enable_ack_batching(self):
+        self.klass.enable_ack_batching(max_pending=5, max_delay=2)
+        batcher = self.klass.channel._ack_batcher
+        assert_true(isinstance(batcher, basic_class.AckBatcher))
+        assert_equals(5, batcher._max_pending)
+        assert_equals(2, batcher._max_delay)
+
+        # Enabling again keeps the existing batcher
+        self.klass.enable_ack_batching()
+        assert_is(batcher, self.klass.channel._ack_batcher)
+
+    def test_enable_ack_batching_after_deliveries(self):
+        self.klass._last_delivery_tag = 12
+        self.klass.enable_ack_batching()
+        assert_equals(12, self.klass.channel._ack_batcher._base)
+
+    def test_disable_ack_batching(self):
+        batcher = self.klass.channel._ack_batcher = mock()
+        expect(batcher.flush)
+        self.klass.disable_ack_batching()
+        assert_equals(None, self.klass.channel._ack_batcher)
+
+    def test_flush_acks(self):
+        self.klass.flush_acks()
+
+        batcher = self.klass.channel._ack_batcher = mock()
+        expect(batcher.flush)
+        self.klass.flush_acks()
+
+    def test_ack_when_batching(self):
+        batcher = self.klass.channel._ack_batcher = mock()
+        expect(batcher.ack).args(8675309, False)
+        expect(self.klass._send_ack).times(0)
+        self.klass.ack(8675309)
+
+    def test_recv_deliver_notifies_ack_batcher(self):
+        msg = mock()
+        msg.delivery_info = {'consumer_tag': 'ctag', 'delivery_tag': 7}
+        self.klass._no_ack_consumer_tags.add('ctag')
+        batcher = self.klass.channel._ack_batcher = mock()
+
+        expect(self.klass._read_msg).args(
+            'frame', with_consumer_tag=True, with_message_count=False).returns(msg)
+        expect(batcher.delivered).args(7, True)
+
+        self.klass._recv_deliver('frame')
+
+    def test_recv_get_ok_notifies_ack_batcher(self):
+        msg = mock()
+        msg.delivery_info = {'delivery_tag': 7}
+        self.klass._get_cb.append((None, False))
+        batcher = self.klass.channel._ack_batcher = mock()
+
+        expect(self.klass._read_msg).args(
+            'frame', with_consumer_tag=False, with_message_count=True).returns(msg)
+        expect(batcher.delivered).args(7, False)
+
+        self.klass._recv_get_ok('frame')
+
+    def test_reject_when_batching_flushes_and_settles(self):
+        batcher = self.klass.channel._ack_batcher = mock()
+        expect(batcher.flush)
+        expect(batcher.settle).args(8675309)
+        expect(self.klass.send_frame)
+        self.klass.reject(8675309)
+
+    def test_recover_when_batching_settles_all(self):
+        batcher = self.klass.channel._ack_batcher = mock()
+        expect(batcher.settle_all)
+        expect(self.klass.send_frame)
+        expect(self.klass.channel.add_synchronous_cb)
+        self.klass.recover()
+
     def test_reject_default_args(self):
         w = mock()
         expect(mock(basic_class, 'Writer')).returns(w)
@@ -648,27 +1130,12 @@ class BasicClassTest(Chai):
         assert_equals(1, len(self.klass._recover_cb))
         assert_false(None in self.klass._recover_cb)
 
-    def test_read_msg_raises_frameunderflow_when_no_header_frame(self):
-        expect(self.klass.channel.next_frame).returns(None)
-        expect(self.klass.channel.requeue_frames).args(['method_frame'])
-        assert_raises(
-            self.klass.FrameUnderflow, self.klass._read_msg, 'method_frame')
-
-    def test_read_msg_raises_frameunderflow_when_no_content_frames(self):
-        header_frame = mock()
-        header_frame.size = 1000000
-        expect(self.klass.channel.next_frame).returns(header_frame)
-        expect(self.klass.channel.next_frame).returns(None)
-        expect(self.klass.channel.requeue_frames).args(
-            deque([header_frame, 'method_frame']))
-        assert_raises(
-            self.klass.FrameUnderflow, self.klass._read_msg, 'method_frame')
-
     def test_read_msg_when_body_length_0_no_cb(self):
         method_frame = mock()
         header_frame = mock()
         header_frame.size = 0
         header_frame.properties = {'foo': 'bar'}
+        header_frame.raw_payload = None
         delivery_info = {'channel': self.klass.channel,
                          'consumer_tag': 'consumer_tag',
                          'delivery_tag': 9,
@@ -676,25 +1143,24 @@ class BasicClassTest(Chai):
                          'exchange': 'exchange',
                          'routing_key': 'routing_key'}
 
-        expect(self.klass.channel.next_frame).returns(header_frame)
-        expect(method_frame.args.read_shortstr).returns('consumer_tag')
-        expect(method_frame.args.read_longlong).returns(9)
-        expect(method_frame.args.read_bit).returns(False)
-        expect(method_frame.args.read_shortstr).returns('exchange')
-        expect(method_frame.args.read_shortstr).returns('routing_key')
+        self.klass._content = (header_frame, bytearray())
+        expect(method_frame.args.read_args).args(
+            BasicClass.DELIVERY_ARGS[True, False]).returns(
+            ('consumer_tag', 9, False, 'exchange', 'routing_key'))
         expect(Message).args(
-            body=bytearray(), delivery_info=delivery_info, foo='bar').returns('message')
+            body=bytearray(), delivery_info=delivery_info, raw_header=None,
+            foo='bar').returns('message')
 
         assert_equals('message', self.klass._read_msg(
             method_frame, with_consumer_tag=True))
+        assert_equals(9, self.klass._last_delivery_tag)
 
     def test_read_msg_when_body_length_greater_than_0_with_cb(self):
         method_frame = mock()
         header_frame = mock()
         header_frame.size = 100
         header_frame.properties = {}
-        cframe1 = mock()
-        cframe2 = mock()
+        header_frame.raw_payload = 'raw'
         self.klass._consumer_cb['ctag'] = mock()
         delivery_info = {
             'channel': self.klass.channel,
@@ -705,33 +1171,22 @@ class BasicClassTest(Chai):
             'message_count': 8675309,
         }
 
-        expect(self.klass.channel.next_frame).returns(header_frame)
-        expect(self.klass.channel.next_frame).returns(cframe1)
-        expect(cframe1.payload.buffer).returns('x' * 50)
-        expect(self.klass.channel.next_frame).returns(cframe2)
-        expect(cframe2.payload.buffer).returns('x' * 50)
-        expect(method_frame.args.read_longlong).returns('dtag')
-        expect(method_frame.args.read_bit).returns('no')
-        expect(method_frame.args.read_shortstr).returns('exchange')
-        expect(method_frame.args.read_shortstr).returns('routing_key')
-        expect(method_frame.args.read_long).returns(8675309)
+        self.klass._content = (header_frame, bytearray('x' * 100))
+        expect(method_frame.args.read_args).args(
+            BasicClass.DELIVERY_ARGS[False, True]).returns(
+            ('dtag', 'no', 'exchange', 'routing_key', 8675309))
         expect(Message).args(
-            body=bytearray('x' * 100), delivery_info=delivery_info).returns('message')
+            body=bytearray('x' * 100), delivery_info=delivery_info,
+            raw_header='raw').returns('message')
 
         assert_equals('message', self.klass._read_msg(
             method_frame, with_message_count=True))
 
-    def test_read_returned_msg_raises_frameunderflow(self):
-        expect(self.klass.channel.next_frame).returns(None)
-        expect(self.klass.channel.requeue_frames).args(['method_frame'])
-        assert_raises(
-            self.klass.FrameUnderflow, self.klass._read_returned_msg,
-            'method_frame')
-
     def test_read_returned_msg(self):
         method_frame = mock()
         header_frame = mock()
         header_frame.properties = {}
+        header_frame.raw_payload = None
         return_info = {
             'channel': self.klass.channel,
             'reply_code': 500,
@@ -742,58 +1197,16 @@ class BasicClassTest(Chai):
 
         expect(self.klass._reap_msg_frames).args(method_frame).returns(
             (header_frame, bytearray('x' * 100)))
-        expect(method_frame.args.read_short).returns(500)
-        expect(method_frame.args.read_shortstr).returns('reply-text')
-        expect(method_frame.args.read_shortstr).returns('exchange-name')
-        expect(method_frame.args.read_shortstr).returns('routing-key')
+        expect(method_frame.args.read_args).args(
+            BasicClass.RETURN_ARGS).returns(
+            (500, 'reply-text', 'exchange-name', 'routing-key'))
         expect(Message).args(
             body=bytearray('x' * 100),
-            return_info=return_info).returns('message')
+            return_info=return_info, raw_header=None).returns('message')
 
         assert_equals('message', self.klass._read_returned_msg(method_frame))
 
-    def test_reap_msg_frames_raises_frameunderflow_when_no_header_frame(self):
-        expect(self.klass.channel.next_frame).returns(None)
-        expect(self.klass.channel.requeue_frames).args(['method_frame'])
-        assert_raises(
-            self.klass.FrameUnderflow, self.klass._reap_msg_frames,
-            'method_frame')
-
-    def test_reap_msg_frames_raises_frameunderflow_when_no_content_frames(self):
-        header_frame = mock()
-        header_frame.size = 1000000
-        expect(self.klass.channel.next_frame).returns(header_frame)
-        expect(self.klass.channel.next_frame).returns(None)
-        expect(self.klass.channel.requeue_frames).args(
-            deque([header_frame, 'method_frame']))
-        assert_raises(
-            self.klass.FrameUnderflow, self.klass._reap_msg_frames,
-            'method_frame')
-
-    def test_reap_msg_frames_when_body_length_0(self):
-        method_frame = mock()
-        header_frame = mock()
-        header_frame.size = 0
-        header_frame.properties = {'foo': 'bar'}
-
-        expect(self.klass.channel.next_frame).returns(header_frame)
-
-        assert_equals((header_frame, bytearray()), self.klass._reap_msg_frames(
-            method_frame))
-
-    def test_reap_msg_frames_when_body_length_greater_than_0(self):
-        method_frame = mock()
-        header_frame = mock()
-        header_frame.size = 100
-        header_frame.properties = {}
-        cframe1 = mock()
-        cframe2 = mock()
-
-        expect(self.klass.channel.next_frame).returns(header_frame)
-        expect(self.klass.channel.next_frame).returns(cframe1)
-        expect(cframe1.payload.buffer).returns('x' * 50)
-        expect(self.klass.channel.next_frame).returns(cframe2)
-        expect(cframe2.payload.buffer).returns('x' * 50)
-
-        assert_equals((header_frame, 'x' * 100), self.klass._reap_msg_frames(
-            method_frame))
+    def test_reap_msg_frames(self):
+        self.klass._content = ('header_frame', 'body')
+        assert_equals(('header_frame', 'body'),
+                      self.klass._reap_msg_frames('method_frame'))
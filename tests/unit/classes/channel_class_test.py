@@ -166,6 +166,15 @@ class ChannelClassTest(Chai):
             'method_id': 'mid',
         }, self.klass.channel._close_info)
 
+    def test_close_flushes_batched_acks(self):
+        self.klass.channel._ack_batcher = mock()
+        expect(self.klass.channel._ack_batcher.flush)
+        expect(self.klass.send_frame)
+        expect(self.klass.channel.add_synchronous_cb)
+
+        self.klass.close()
+        assert_true(self.klass.channel._closed)
+
     def test_close_when_closed(self):
         self.klass.channel._closed = True
         stub(self.klass.send_frame)
@@ -212,10 +221,8 @@ class ChannelClassTest(Chai):
 
     def test_recv_close(self):
         rframe = mock()
-        expect(rframe.args.read_short).returns('rcode')
-        expect(rframe.args.read_shortstr).returns('reason')
-        expect(rframe.args.read_short).returns('cid')
-        expect(rframe.args.read_short).returns('mid')
+        expect(rframe.args.read_args).args(ChannelClass.CLOSE_ARGS).returns(
+            ('rcode', 'reason', 'cid', 'mid'))
 
         expect(mock(channel_class, 'MethodFrame')).args(
             42, 20, 41).returns('frame')
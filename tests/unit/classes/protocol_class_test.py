@@ -20,7 +20,7 @@ class ProtocolClassTest(Chai):
         klass = ProtocolClass(ch)
         klass.dispatch_map = {42: 'method'}
 
-        with expect(ch.clear_synchronous_cb).args('method').returns(mock()) as cb:
+        with expect(ch.clear_synchronous_cb).args('method', frame).returns(mock()) as cb:
             expect(cb).args(frame)
 
         klass.dispatch(frame)
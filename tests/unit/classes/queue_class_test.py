@@ -118,9 +118,8 @@ class QueueClassTest(Chai):
         self.klass._declare_cb.append(cb)
         self.klass._declare_cb.append(mock())  # assert not called
 
-        expect(rframe.args.read_shortstr).returns('queue')
-        expect(rframe.args.read_long).returns(32)
-        expect(rframe.args.read_long).returns(5)
+        expect(rframe.args.read_args).args(
+            QueueClass.DECLARE_OK_ARGS).returns(('queue', 32, 5))
         expect(cb).args('queue', 32, 5)
 
         assert_equals(('queue', 32, 5), self.klass._recv_declare_ok(rframe))
@@ -133,9 +132,8 @@ class QueueClassTest(Chai):
         self.klass._declare_cb.append(None)
         self.klass._declare_cb.append(cb)
 
-        expect(rframe.args.read_shortstr).returns('queue')
-        expect(rframe.args.read_long).returns(32)
-        expect(rframe.args.read_long).returns(5)
+        expect(rframe.args.read_args).args(
+            QueueClass.DECLARE_OK_ARGS).returns(('queue', 32, 5))
 
         assert_equals(('queue', 32, 5), self.klass._recv_declare_ok(rframe))
         assert_equals(1, len(self.klass._declare_cb))
@@ -22,6 +22,7 @@ class TransactionClassTest(Chai):
         ch = mock()
         ch.channel_id = 42
         ch.logger = mock()
+        ch._ack_batcher = None
         self.klass = TransactionClass(ch)
 
     def test_init(self):
@@ -115,6 +116,15 @@ class TransactionClassTest(Chai):
         self.klass.commit()
         assert_equals(deque([None]), self.klass._commit_cb)
 
+    def test_commit_flushes_batched_acks(self):
+        self.klass._enabled = True
+        self.klass.channel._ack_batcher = mock()
+
+        expect(self.klass.channel._ack_batcher.flush)
+        expect(self.klass.send_frame)
+        expect(self.klass.channel.add_synchronous_cb)
+        self.klass.commit()
+
     def test_commit_when_enabled_with_cb(self):
         self.klass._enabled = True
 
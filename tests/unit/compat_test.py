@@ -0,0 +1,42 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+import sys
+
+from chai import Chai
+
+from haigha2 import compat
+
+
+class CompatTest(Chai):
+
+    def test_buffer_helpers(self):
+        buf = compat.as_buffer(bytearray('hello world'))
+        view = compat.buffer_slice(buf, 6, 5)
+        assert_equals('world', compat.buffer_bytes(view))
+        assert_equals('world', compat.buffer_text(view))
+        assert_true(isinstance(compat.buffer_bytes(view), compat.binary_type))
+
+    def test_iteritems(self):
+        assert_equals([('a', 1)], list(compat.iteritems({'a': 1})))
+
+    def test_reraise_keeps_traceback(self):
+        def fail():
+            raise KeyError('foo')
+
+        try:
+            try:
+                fail()
+            except KeyError as e:
+                compat.reraise(ValueError, ValueError(str(e)),
+                               sys.exc_info()[-1])
+        except ValueError:
+            tb = sys.exc_info()[-1]
+            while tb.tb_next:
+                tb = tb.tb_next
+            assert_equals('fail', tb.tb_frame.f_code.co_name)
+        else:
+            assert_true(False, 'ValueError not raised')
@@ -4,7 +4,10 @@ Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
 https://github.com/agoragames/haigha/blob/master/LICENSE.txt
 '''
 
+import gc
 import logging
+import weakref
+from collections import deque
 from chai import Chai
 
 from haigha2 import connection, __version__
@@ -21,12 +24,104 @@ from haigha2.classes.exchange_class import ExchangeClass
 from haigha2.classes.queue_class import QueueClass
 from haigha2.classes.transaction_class import TransactionClass
 from haigha2.classes.protocol_class import ProtocolClass
+from haigha2.metrics import Metrics
+from haigha2.profiling import StageProfiler
+from haigha2.tracing import Tracer
+from haigha2.transports.transport import Transport
 
 from haigha2.transports import event_transport
 from haigha2.transports import gevent_transport
+from haigha2.transports import capture_transport
+from haigha2.transports import replay_transport
+from haigha2.transports import selector_transport
 from haigha2.transports import socket_transport
 
 
+class IdleTransport(Transport):
+
+    '''
+    A transport that never connects, to build connections without mocks.
+    '''
+
+    def __init__(self, connection):
+        super(IdleTransport, self).__init__(connection)
+        self._synchronous = False
+
+    def connect(self, (host, port)):
+        pass
+
+
+class ConnectionInitTest(Chai):
+
+    '''
+    Builds real connections, so that the arguments passed from a Connection
+    to its channels and transport are checked.
+    '''
+
+    def test_init(self):
+        conn = Connection(transport=IdleTransport(None))
+        assert_false(conn.closed)
+        assert_true(isinstance(conn._channels[0], ConnectionChannel))
+
+    def test_init_with_metrics(self):
+        conn = Connection(transport=IdleTransport(None), metrics=True)
+        assert_true(conn._channels[0]._metrics is not None)
+        ch = conn.channel()
+        assert_true(ch._metrics is not None)
+
+    def test_metrics_are_named_per_connection(self):
+        metrics = Metrics()
+        conn1 = Connection(transport=IdleTransport(None), metrics=metrics)
+        conn2 = Connection(transport=IdleTransport(None), metrics=metrics)
+        # channel.open waits for the connection to open
+        conn1.channel()._metrics.published.inc()
+
+        snapshot = metrics.snapshot()
+        assert_equals(1, snapshot['connection.1.write_queue_depth'])
+        assert_equals(0, snapshot['connection.2.write_queue_depth'])
+        assert_equals(1, snapshot['connection.1.channel.1.published'])
+        assert_equals(0, snapshot['connection.2.channel.0.published'])
+        assert_false('connection.2.channel.1.published' in snapshot)
+
+    def test_gauges_removed_on_close(self):
+        metrics = Metrics()
+        conn = Connection(transport=IdleTransport(None), metrics=metrics)
+        conn.channel()
+        conn.close(disconnect=True)
+        snapshot = metrics.snapshot()
+        assert_false('connection.1.write_queue_depth' in snapshot)
+        assert_false('connection.1.write_queue_bytes' in snapshot)
+        assert_false('connection.1.channel.0.published' in snapshot)
+        assert_false('connection.1.channel.1.published' in snapshot)
+        assert_equals({}, metrics._channels)
+
+    def test_channel_metrics_removed_when_channel_closes(self):
+        metrics = Metrics()
+        conn = Connection(transport=IdleTransport(None), metrics=metrics)
+        ch = conn.channel()
+        conn._channel_closed(ch)
+        snapshot = metrics.snapshot()
+        assert_false('connection.1.channel.1.published' in snapshot)
+        assert_true('connection.1.channel.0.published' in snapshot)
+        assert_equals([('connection.1.', 0)], list(metrics._channels))
+
+    def test_gauges_do_not_keep_connection_alive(self):
+        metrics = Metrics()
+        conn = Connection(transport=IdleTransport(None), metrics=metrics)
+        ref = weakref.ref(conn)
+        del conn
+        gc.collect()
+        assert_equals(None, ref())
+        assert_false('connection.1.write_queue_bytes' in metrics.snapshot())
+        assert_equals({}, metrics._channels)
+
+    def test_init_with_tracer(self):
+        tracer = Tracer()
+        conn = Connection(transport=IdleTransport(None), tracer=tracer)
+        assert_equals(tracer, conn._channels[0]._tracer)
+        assert_equals(tracer, conn.channel()._tracer)
+
+
 class ConnectionTest(Chai):
 
     def setUp(self):
@@ -45,6 +140,7 @@ class ConnectionTest(Chai):
         self.connection._heartbeat = None
         self.connection._open_cb = self.mock()
         self.connection._close_cb = self.mock()
+        self.connection._drain_cb = None
         self.connection._login_method = 'AMQPLAIN'
         self.connection._locale = 'en_US'
         self.connection._client_properties = None
@@ -70,6 +166,13 @@ class ConnectionTest(Chai):
         self.connection._frame_max = 65535
         self.connection._frames_read = 0
         self.connection._frames_written = 0
+        self.connection._metrics = None
+        self.connection._metrics_prefix = None
+        self.connection._gauges = ()
+        self.connection._tracer = None
+        self.connection._profiler = None
+        self.connection._heartbeat_timer = None
+        self.connection._reads = 0
         self.connection._strategy = self.mock()
         self.connection._output_frame_buffer = []
         self.connection._transport = mock()
@@ -83,7 +186,8 @@ class ConnectionTest(Chai):
         mock(connection, 'ConnectionChannel')
 
         expect(connection.ConnectionChannel).args(
-            conn, 0, {}).returns('connection_channel')
+            conn, 0, {}, metrics=None, tracer=None,
+            profiler=None).returns('connection_channel')
         expect(socket_transport.SocketTransport).args(conn).returns(transport)
         expect(conn.connect).args('localhost', 5672)
 
@@ -102,6 +206,7 @@ class ConnectionTest(Chai):
         assert_equal(None, conn._heartbeat)
         assert_equal(None, conn._open_cb)
         assert_equal(None, conn._close_cb)
+        assert_equal(None, conn._drain_cb)
         assert_equal('AMQPLAIN', conn._login_method)
         assert_equal('en_US', conn._locale)
         assert_equal(None, conn._client_properties)
@@ -146,12 +251,50 @@ class ConnectionTest(Chai):
         mock(connection, 'ConnectionChannel')
 
         expect(connection.ConnectionChannel).args(
-            conn, 0, {}).returns('connection_channel')
+            conn, 0, {}, metrics=None, tracer=None,
+            profiler=None).returns('connection_channel')
         expect(event_transport.EventTransport).args(conn).returns(transport)
         expect(conn.connect).args('localhost', 5672)
 
         conn.__init__(transport='event')
 
+    def test_init_with_selector_transport(self):
+        conn = Connection.__new__(Connection)
+        transport = mock()
+
+        mock(connection, 'ConnectionChannel')
+
+        expect(connection.ConnectionChannel).args(
+            conn, 0, {}, metrics=None, tracer=None,
+            profiler=None).returns('connection_channel')
+        expect(selector_transport.SelectorTransport).args(
+            conn, transport='selector', selector='s').returns(transport)
+        expect(conn.connect).args('localhost', 5672)
+
+        conn.__init__(transport='selector', selector='s')
+        assert_equal(transport, conn._transport)
+
+    def test_init_with_replay_transport_and_capture(self):
+        conn = Connection.__new__(Connection)
+        transport = mock()
+        capture = mock()
+
+        mock(connection, 'ConnectionChannel')
+
+        expect(connection.ConnectionChannel).args(
+            conn, 0, {}, metrics=None, tracer=None,
+            profiler=None).returns('connection_channel')
+        expect(replay_transport.ReplayTransport).args(
+            conn, transport='replay', replay='in.hcap',
+            capture='out.hcap').returns(transport)
+        expect(capture_transport.CaptureTransport).args(
+            conn, transport, 'out.hcap').returns(capture)
+        expect(conn.connect).args('localhost', 5672)
+
+        conn.__init__(transport='replay', replay='in.hcap',
+                      capture='out.hcap')
+        assert_equal(capture, conn._transport)
+
     def test_properties(self):
         assert_equal(self.connection._logger, self.connection.logger)
         assert_equal(self.connection._debug, self.connection.debug)
@@ -322,6 +465,19 @@ class ConnectionTest(Chai):
         assert_equals(0, self.connection._close_info['class_id'])
         assert_equals(0, self.connection._close_info['method_id'])
 
+    def test_transport_drained(self):
+        self.connection.transport_drained()
+
+        self.connection._drain_cb = mock()
+        expect(self.connection._drain_cb)
+        self.connection.transport_drained()
+
+    def test_queued_bytes(self):
+        self.connection._transport.queued = 42
+        assert_equals(42, self.connection.queued_bytes)
+        self.connection._transport = None
+        assert_equals(0, self.connection.queued_bytes)
+
     def test_next_channel_id_when_less_than_max(self):
         self.connection._channel_counter = 32
         self.connection._channel_max = 23423
@@ -337,7 +493,8 @@ class ConnectionTest(Chai):
         expect(self.connection._next_channel_id).returns(1)
         mock(connection, 'Channel')
         expect(connection.Channel).args(
-            self.connection, 1, self.connection._class_map, synchronous=False).returns(ch)
+            self.connection, 1, self.connection._class_map, synchronous=False,
+            metrics=None, tracer=None, profiler=None).returns(ch)
         expect(ch.add_close_listener).args(self.connection._channel_closed)
         expect(ch.open)
 
@@ -349,7 +506,8 @@ class ConnectionTest(Chai):
         expect(self.connection._next_channel_id).returns(1)
         mock(connection, 'Channel')
         expect(connection.Channel).args(
-            self.connection, 1, self.connection._class_map, synchronous=True).returns(ch)
+            self.connection, 1, self.connection._class_map, synchronous=True,
+            metrics=None, tracer=None, profiler=None).returns(ch)
         expect(ch.add_close_listener).args(self.connection._channel_closed)
         expect(ch.open)
 
@@ -366,7 +524,8 @@ class ConnectionTest(Chai):
         expect(self.connection._next_channel_id).returns(3)
         mock(connection, 'Channel')
         expect(connection.Channel).args(
-            self.connection, 3, self.connection._class_map, synchronous=False).returns(ch)
+            self.connection, 3, self.connection._class_map, synchronous=False,
+            metrics=None, tracer=None, profiler=None).returns(ch)
         expect(ch.add_close_listener).args(self.connection._channel_closed)
         expect(ch.open)
 
@@ -462,10 +621,65 @@ class ConnectionTest(Chai):
         self.connection.read_frames()
         assert_equals(0, self.connection._frames_read)
 
+    def test_read_frames_with_heartbeat_timer(self):
+        self.connection._heartbeat = 3
+        self.connection._heartbeat_timer = mock()
+        self.connection._last_octet_time = 0
+        expect(self.connection._channels[0].send_heartbeat).times(0)
+        expect(self.connection._transport.read).args(3).returns(None)
+        self.connection.read_frames()
+        assert_equals(0, self.connection._reads)
+
+        expect(self.connection._transport.read).args(3).returns('data')
+        expect(self.connection._process_data).args('data', None)
+        self.connection.read_frames()
+        assert_equals(1, self.connection._reads)
+        assert_equals(0, self.connection._last_octet_time)
+
+    def test_read_frames_raises_when_heartbeat_timer_expires(self):
+        self.connection._heartbeat = 3
+        heartbeat_timer = self.connection._heartbeat_timer = mock()
+        heartbeat_timer.expired = True
+        self.connection._close_info['reply_text'] = 'Heartbeats not received'
+        transport = self.connection._transport
+
+        def expire(timeout):
+            self.connection._transport = None
+        expect(transport.read).args(3).side_effect(expire)
+        assert_raises(ConnectionClosed, self.connection.read_frames)
+
+    def test_start_heartbeat(self):
+        self.connection._heartbeat = 10
+        heartbeat_timer = mock()
+        mock(connection, 'Heartbeat')
+        expect(connection.Heartbeat).args(self.connection, 10).returns(
+            heartbeat_timer)
+        expect(heartbeat_timer.start).returns(True)
+        self.connection._start_heartbeat()
+        assert_equals(heartbeat_timer, self.connection._heartbeat_timer)
+
+        expect(heartbeat_timer.stop)
+        self.connection._stop_heartbeat()
+        assert_equals(None, self.connection._heartbeat_timer)
+
+    def test_start_heartbeat_when_transport_has_no_timers(self):
+        self.connection._heartbeat = 10
+        heartbeat_timer = mock()
+        mock(connection, 'Heartbeat')
+        expect(connection.Heartbeat).args(self.connection, 10).returns(
+            heartbeat_timer)
+        expect(heartbeat_timer.start).returns(False)
+        self.connection._start_heartbeat()
+        assert_equals(None, self.connection._heartbeat_timer)
+
+    def test_start_heartbeat_when_disabled(self):
+        self.connection._heartbeat = 0
+        self.connection._start_heartbeat()
+        assert_equals(None, self.connection._heartbeat_timer)
+
     def test_read_frames_when_transport_when_frame_data_and_no_debug_and_no_buffer(self):
         reader = mock()
-        frame = mock()
-        frame.channel_id = 42
+        scan = mock()
         channel = mock()
         mock(connection, 'Reader')
         self.connection._heartbeat = 3
@@ -473,9 +687,10 @@ class ConnectionTest(Chai):
         expect(self.connection._channels[0].send_heartbeat)
         expect(self.connection._transport.read).args(3).returns('data')
         expect(connection.Reader).args('data').returns(reader)
-        expect(connection.Frame.read_frames).args(reader).returns([frame])
+        expect(connection.Frame.scan_frames).args(reader).returns(scan)
+        expect(scan.headers).returns([(1, 42)])
         expect(self.connection.channel).args(42).returns(channel)
-        expect(channel.buffer_frame).args(frame)
+        expect(channel.buffer_scanned).args(scan, 0)
         expect(self.connection._transport.process_channels).args(
             set([channel]))
         expect(reader.tell).returns(4)
@@ -485,8 +700,8 @@ class ConnectionTest(Chai):
 
     def test_read_frames_when_transport_when_frame_data_and_debug_and_buffer(self):
         reader = mock()
+        scan = mock()
         frame = mock()
-        frame.channel_id = 42
         channel = mock()
         mock(connection, 'Reader')
         self.connection._debug = 2
@@ -494,9 +709,11 @@ class ConnectionTest(Chai):
         expect(self.connection._channels[0].send_heartbeat)
         expect(self.connection._transport.read).args(None).returns('data')
         expect(connection.Reader).args('data').returns(reader)
-        expect(connection.Frame.read_frames).args(reader).returns([frame])
-        expect(self.connection.logger.debug).args('READ: %s', frame)
+        expect(connection.Frame.scan_frames).args(reader).returns(scan)
+        expect(scan.headers).returns([(1, 42)])
         expect(self.connection.channel).args(42).returns(channel)
+        expect(scan.frame).args(0).returns(frame)
+        expect(self.connection.logger.debug).args('READ: %s', frame)
         expect(channel.buffer_frame).args(frame)
         expect(self.connection._transport.process_channels).args(
             set([channel]))
@@ -506,6 +723,55 @@ class ConnectionTest(Chai):
         self.connection.read_frames()
         assert_equals(1, self.connection._frames_read)
 
+    def test_read_frames_records_metrics(self):
+        reader = mock()
+        scan = mock()
+        channel = mock()
+        mock(connection, 'Reader')
+        self.connection._metrics = Metrics()
+
+        expect(self.connection._channels[0].send_heartbeat)
+        expect(self.connection._transport.read).args(None).returns('data')
+        expect(connection.Reader).args('data').returns(reader)
+        expect(connection.Frame.scan_frames).args(reader).returns(scan)
+        expect(scan.headers).returns([(3, 42)])
+        expect(self.connection.channel).args(42).returns(channel)
+        expect(channel.buffer_scanned).args(scan, 0)
+        expect(self.connection._transport.process_channels).args(
+            set([channel]))
+        expect(reader.tell).times(3).returns(3)
+        expect(self.connection._transport.buffer).args('a')
+
+        self.connection.read_frames()
+        snapshot = self.connection.metrics.snapshot()
+        assert_equals(3, snapshot['connection.bytes_in'])
+        assert_equals(1, snapshot['connection.frames_in.content'])
+
+    def test_read_frames_profiles_stages(self):
+        reader = mock()
+        scan = mock()
+        channel = mock()
+        mock(connection, 'Reader')
+        self.connection._profiler = StageProfiler(sample_rate=1)
+
+        expect(self.connection._channels[0].send_heartbeat)
+        expect(self.connection._transport.read).args(None).returns('data')
+        expect(connection.Reader).args('data').returns(reader)
+        expect(connection.Frame.scan_frames).args(reader).returns(scan)
+        expect(scan.headers).returns([(1, 42)])
+        expect(self.connection.channel).args(42).returns(channel)
+        expect(channel.buffer_scanned).args(scan, 0)
+        expect(self.connection._transport.process_channels).args(
+            set([channel]))
+        expect(reader.tell).returns(4)
+
+        self.connection.read_frames()
+        snapshot = self.connection.profiler.snapshot()
+        assert_equals(1, snapshot['samples'])
+        assert_equals(1, snapshot['stages']['decode']['calls'])
+        assert_equals(1, snapshot['stages']['dispatch']['calls'])
+        assert_false(self.connection.profiler.sampling)
+
     def test_read_frames_when_read_frame_error(self):
         reader = mock()
         frame = mock()
@@ -517,7 +783,7 @@ class ConnectionTest(Chai):
         expect(self.connection._channels[0].send_heartbeat)
         expect(self.connection._transport.read).args(3).returns('data')
         expect(connection.Reader).args('data').returns(reader)
-        expect(connection.Frame.read_frames).args(
+        expect(connection.Frame.scan_frames).args(
             reader).raises(Frame.FrameError)
         stub(self.connection.channel)
         stub(channel.buffer_frame)
@@ -529,6 +795,20 @@ class ConnectionTest(Chai):
 
         assert_raises(ConnectionError, self.connection.read_frames)
 
+    def test_parse_frame(self):
+        scan = mock()
+        expect(scan.frame).args(3).returns('frame')
+        assert_equals('frame', self.connection._parse_frame(scan, 3))
+
+    def test_parse_frame_when_frame_error(self):
+        scan = mock()
+        expect(scan.frame).args(3).raises(Frame.FormatError('short'))
+        expect(self.connection.close).args(
+            reply_code=501, reply_text=str, class_id=0, method_id=0,
+            disconnect=True)
+
+        assert_raises(ConnectionClosed, self.connection._parse_frame, scan, 3)
+
     def test_flush_buffered_frames(self):
         self.connection._output_frame_buffer = ['frame1', 'frame2']
         expect(self.connection.send_frame).args('frame1')
@@ -547,6 +827,46 @@ class ConnectionTest(Chai):
         assert_true(isinstance(var('ba').value, bytearray))
         assert_equals(1, self.connection._frames_written)
 
+    def test_send_frame_records_metrics(self):
+        frame = mock()
+        expect(frame.write_frame).args(var('ba')).side_effect(
+            lambda buf: buf.extend('abcde'))
+        expect(frame.type).returns(1)
+        expect(self.connection._transport.write).args(var('ba'))
+        self.connection._metrics = Metrics()
+
+        self.connection._connected = True
+        self.connection.send_frame(frame)
+        snapshot = self.connection.metrics.snapshot()
+        assert_equals(5, snapshot['connection.bytes_out'])
+        assert_equals(1, snapshot['connection.frames_out.method'])
+
+    def test_send_frame_profiles_write(self):
+        frame = mock()
+        expect(frame.write_frame).args(var('ba'))
+        expect(self.connection._transport.write).args(var('ba'))
+        self.connection._profiler = StageProfiler(sample_rate=1)
+
+        self.connection._connected = True
+        self.connection.send_frame(frame)
+        snapshot = self.connection.profiler.snapshot()
+        assert_equals(1, snapshot['samples'])
+        assert_equals(1, snapshot['stages']['write']['calls'])
+
+    def test_write_queue_depth(self):
+        self.connection._output_frame_buffer = ['frame']
+        self.connection._channels[0]._pending_events = deque([
+            MethodFrame(0, 10, 11), 'cb', HeartbeatFrame(0)])
+        assert_equals(3, self.connection._write_queue_depth())
+
+    def test_channel_metrics(self):
+        assert_equals(None, self.connection._channel_metrics(3))
+
+        self.connection._metrics = Metrics()
+        self.connection._metrics_prefix = 'connection.1.'
+        assert_true(self.connection.metrics.channel(3, 'connection.1.') is
+                    self.connection._channel_metrics(3))
+
     def test_send_frame_when_not_connected_and_not_channel_0(self):
         frame = mock()
         frame.channel_id = 42
@@ -618,9 +938,9 @@ class ConnectionChannelTest(Chai):
     def test_init(self):
         mock(connection, 'super')
         with expect(connection, 'super').args(is_arg(ConnectionChannel), ConnectionChannel).returns(mock()) as s:
-            expect(s.__init__).args('a', 'b')
+            expect(s.__init__).args('a', 'b', metrics='m', tracer='t')
 
-        c = ConnectionChannel('a', 'b')
+        c = ConnectionChannel('a', 'b', metrics='m', tracer='t')
         assert_equals(c._method_map,
                       {
                           10: c._recv_start,
@@ -635,12 +955,22 @@ class ConnectionChannelTest(Chai):
 
     def test_dispatch_on_heartbeat_frame(self):
         frame = mock()
+        self.ch.connection._heartbeat_timer = None
 
         expect(frame.type).returns(HeartbeatFrame.type())
         expect(self.ch.send_heartbeat)
 
         self.ch.dispatch(frame)
 
+    def test_dispatch_on_heartbeat_frame_when_heartbeat_timer(self):
+        frame = mock()
+        self.ch.connection._heartbeat_timer = mock()
+
+        expect(frame.type).returns(HeartbeatFrame.type())
+        expect(self.ch.send_heartbeat).times(0)
+
+        self.ch.dispatch(frame)
+
     def test_dispatch_method_frame_class_10(self):
         frame = mock()
         frame.class_id = 10
@@ -660,7 +990,7 @@ class ConnectionChannelTest(Chai):
         cb = mock()
 
         expect(frame.type).returns(MethodFrame.type())
-        expect(self.ch.clear_synchronous_cb).args(method).returns(cb)
+        expect(self.ch.clear_synchronous_cb).args(method, frame).returns(cb)
         expect(cb).args(frame)
 
         self.ch.dispatch(frame)
@@ -768,12 +1098,13 @@ class ConnectionChannelTest(Chai):
         self.ch.connection._heartbeat = 8
 
         frame = mock()
-        expect(frame.args.read_short).returns(0)
-        expect(frame.args.read_long).returns(0)
+        expect(frame.args.read_args).args(
+            ConnectionChannel.TUNE_ARGS).returns((0, 0, 0))
 
         expect(self.ch._send_tune_ok)
         expect(self.ch._send_open)
         expect(self.ch.send_heartbeat)
+        expect(self.ch.connection._start_heartbeat)
 
         self.ch._recv_tune(frame)
         assert_equals(42, self.ch.connection._channel_max)
@@ -786,13 +1117,13 @@ class ConnectionChannelTest(Chai):
         self.ch.connection._heartbeat = None
 
         frame = mock()
-        expect(frame.args.read_short).returns(500)
-        expect(frame.args.read_long).returns(501)
-        expect(frame.args.read_short).returns(7)
+        expect(frame.args.read_args).args(
+            ConnectionChannel.TUNE_ARGS).returns((500, 501, 7))
 
         expect(self.ch._send_tune_ok)
         expect(self.ch._send_open)
         expect(self.ch.send_heartbeat)
+        expect(self.ch.connection._start_heartbeat)
 
         self.ch._recv_tune(frame)
         assert_equals(500, self.ch.connection._channel_max)
@@ -883,10 +1214,9 @@ class ConnectionChannelTest(Chai):
         self.ch.connection._closed = False
 
         frame = mock()
-        expect(frame.args.read_short).returns(42)
-        expect(frame.args.read_shortstr).returns('wrong answer')
-        expect(frame.args.read_short).returns(4)
-        expect(frame.args.read_short).returns(20)
+        expect(frame.args.read_args).args(
+            ConnectionChannel.CLOSE_ARGS).returns(
+            (42, 'wrong answer', 4, 20))
 
         expect(self.ch._send_close_ok)
         expect(self.ch.connection.disconnect)
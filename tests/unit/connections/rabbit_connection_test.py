@@ -11,6 +11,7 @@ from chai import Chai
 from haigha2.connections import rabbit_connection
 from haigha2.connections.rabbit_connection import *
 from haigha2.connection import Connection
+from haigha2.message import Message
 from haigha2.writer import Writer
 from haigha2.frames import *
 from haigha2.classes import *
@@ -287,6 +288,7 @@ class RabbitBasicClassTest(Chai):
         ch = mock()
         ch.channel_id = 42
         ch.logger = mock()
+        ch._ack_batcher = None
         self.klass = RabbitBasicClass(ch)
 
     def test_init(self):
@@ -314,32 +316,43 @@ class RabbitBasicClassTest(Chai):
         self.klass.set_nack_listener('foo')
         assert_equals('foo', self.klass._nack_listener)
 
-    def test_publish_when_not_confirming(self):
+    def test_send_publish_when_not_confirming(self):
         self.klass.channel.confirm._enabled = False
         with expect(mock(rabbit_connection, 'super')).args(
                 is_arg(RabbitBasicClass), RabbitBasicClass).returns(mock()) as klass:
-            expect(klass.publish).args('a', 'b', c='d')
+            expect(klass._send_publish).args('a', 'b', c='d')
 
-        assert_equals(0, self.klass.publish('a', 'b', c='d'))
+        assert_equals(0, self.klass._send_publish('a', 'b', c='d'))
         assert_equals(0, self.klass._msg_id)
 
-    def test_publish_when_confirming(self):
+    def test_send_publish_when_confirming(self):
         self.klass.channel.confirm._enabled = True
         with expect(mock(rabbit_connection, 'super')).args(
                 is_arg(RabbitBasicClass), RabbitBasicClass).returns(mock()) as klass:
-            expect(klass.publish).args('a', 'b', c='d')
+            expect(klass._send_publish).args('a', 'b', c='d')
 
-        assert_equals(1, self.klass.publish('a', 'b', c='d'))
+        assert_equals(1, self.klass._send_publish('a', 'b', c='d'))
         assert_equals(1, self.klass._msg_id)
 
+    def test_publish_and_publish_raw_share_message_ids(self):
+        self.klass.channel.confirm._enabled = True
+        self.klass.channel._tracer = None
+        self.klass.channel._metrics = None
+        self.klass.channel.connection.frame_max = 1024
+        expect(self.klass.send_frame).any_args().at_least(0)
+
+        assert_equals(1, self.klass.publish(Message('a'), 'ex', 'key'))
+        assert_equals(2, self.klass.publish_raw(Message('b'), 'ex', 'key'))
+        assert_equals(2, self.klass._msg_id)
+
     def test_recv_ack_no_listener(self):
         self.klass._recv_ack('frame')
 
     def test_recv_ack_with_listener_single_msg(self):
         self.klass._ack_listener = mock()
         frame = mock()
-        expect(frame.args.read_longlong).returns(42)
-        expect(frame.args.read_bit).returns(False)
+        expect(frame.args.read_args).args(
+            RabbitBasicClass.ACK_ARGS).returns((42, False))
         expect(self.klass._ack_listener).args(42)
 
         self.klass._recv_ack(frame)
@@ -349,8 +362,8 @@ class RabbitBasicClassTest(Chai):
         self.klass._ack_listener = mock()
         self.klass._last_ack_id = 40
         frame = mock()
-        expect(frame.args.read_longlong).returns(42)
-        expect(frame.args.read_bit).returns(True)
+        expect(frame.args.read_args).args(
+            RabbitBasicClass.ACK_ARGS).returns((42, True))
         expect(self.klass._ack_listener).args(41)
         expect(self.klass._ack_listener).args(42)
 
@@ -385,8 +398,8 @@ class RabbitBasicClassTest(Chai):
     def test_recv_nack_with_listener_single_msg(self):
         self.klass._nack_listener = mock()
         frame = mock()
-        expect(frame.args.read_longlong).returns(42)
-        expect(frame.args.read_bits).args(2).returns((False, False))
+        expect(frame.args.read_args).args(
+            RabbitBasicClass.NACK_ARGS).returns((42, False, False))
         expect(self.klass._nack_listener).args(42, False)
 
         self.klass._recv_nack(frame)
@@ -396,8 +409,8 @@ class RabbitBasicClassTest(Chai):
         self.klass._nack_listener = mock()
         self.klass._last_ack_id = 40
         frame = mock()
-        expect(frame.args.read_longlong).returns(42)
-        expect(frame.args.read_bits).args(2).returns((True, True))
+        expect(frame.args.read_args).args(
+            RabbitBasicClass.NACK_ARGS).returns((42, True, True))
         expect(self.klass._nack_listener).args(41, True)
         expect(self.klass._nack_listener).args(42, True)
 
@@ -409,7 +422,8 @@ class RabbitBasicClassTest(Chai):
         with expect(mock(rabbit_connection, 'super')).args(
                 is_arg(RabbitBasicClass), RabbitBasicClass).returns(mock()) as klass:
             expect(klass.consume).args(
-                'queue', consumer, 'ctag', False, True, False, True, None, None)
+                'queue', consumer, 'ctag', False, True, False, True, None, None,
+                False)
 
         expect(self.klass._generate_consumer_tag).args().returns('ctag')
 
@@ -422,7 +436,8 @@ class RabbitBasicClassTest(Chai):
         with expect(mock(rabbit_connection, 'super')).args(
                 is_arg(RabbitBasicClass), RabbitBasicClass).returns(mock()) as klass:
             expect(klass.consume).args(
-                'queue', consumer, 'ctag', False, True, False, True, None, None)
+                'queue', consumer, 'ctag', False, True, False, True, None, None,
+                False)
 
         expect(self.klass._generate_consumer_tag).args().returns('ctag')
 
@@ -435,7 +450,7 @@ class RabbitBasicClassTest(Chai):
                 is_arg(RabbitBasicClass), RabbitBasicClass).returns(mock()) as klass:
             expect(klass.consume).args(
                 'queue', consumer, 'user-ctag',
-                False, True, False, True, None, None)
+                False, True, False, True, None, None, False)
 
         expect(self.klass._generate_consumer_tag).times(0)
 
@@ -0,0 +1,628 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+import time
+
+from chai import Chai
+
+from haigha2.channel import SyncWrapper
+from haigha2.connection import Connection
+from haigha2.connections import recovering_connection
+from haigha2.connections.recovering_connection import *
+from haigha2.exceptions import ConnectionClosed
+from tests.fake_broker import FakeBroker
+from haigha2.frames.method_frame import MethodFrame
+from haigha2.message import Message
+from haigha2.outbox import Outbox
+from haigha2.reader import Reader
+from haigha2.transports.selector_transport import DefaultSelector, poll
+from haigha2.transports.transport import Transport
+from haigha2.writer import Writer
+
+
+class FakeTransport(Transport):
+
+    def __init__(self, connection):
+        super(FakeTransport, self).__init__(connection)
+        self._synchronous = False
+        self.hosts = []
+        self.timers = []
+
+    def connect(self, (host, port)):
+        self.hosts.append((host, port))
+
+    def call_later(self, delay, callback):
+        timer = FakeTimer(delay, callback)
+        self.timers.append(timer)
+        return timer
+
+
+class FakeTimer(object):
+
+    def __init__(self, delay, callback):
+        self.delay = delay
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TopologyTest(Chai):
+
+    def setUp(self):
+        super(TopologyTest, self).setUp()
+        self.topology = Topology()
+        self.topology.exchange_declared(
+            'ex', type='direct', durable=True, auto_delete=False,
+            internal=False, arguments=None)
+        self.topology.queue_declared(
+            'q', durable=True, exclusive=False, auto_delete=False,
+            arguments={})
+        self.topology.queue_bound('q', 'ex', 'a', {})
+        self.topology.exchange_bound('ex2', 'ex', 'b', {})
+
+    def test_record(self):
+        assert_equals(4, len(self.topology))
+        assert_equals(['ex'], self.topology.exchanges)
+        assert_equals(['q'], self.topology.queues)
+        assert_equals([('q', 'ex', 'a'), ('ex2', 'ex', 'b')],
+                      self.topology.bindings)
+
+    def test_bindings_differ_by_arguments(self):
+        self.topology.queue_bound('q', 'ex', 'a', {'x-match': 'all'})
+        assert_equals(3, len(self.topology.bindings))
+        self.topology.queue_unbound('q', 'ex', 'a', {})
+        self.topology.exchange_unbound('ex2', 'ex', 'b', {})
+        assert_equals([('q', 'ex', 'a')], self.topology.bindings)
+
+    def test_deleting_removes_bindings(self):
+        self.topology.queue_deleted('q')
+        assert_equals([], self.topology.queues)
+        assert_equals([('ex2', 'ex', 'b')], self.topology.bindings)
+        self.topology.exchange_deleted('ex')
+        assert_equals(0, len(self.topology))
+
+    def test_declare(self):
+        ch = mock()
+        ch.exchange = mock()
+        ch.queue = mock()
+        cb = mock()
+        expect(ch.exchange.declare).args(
+            exchange='ex', type='direct', durable=True, auto_delete=False,
+            internal=False, arguments=None)
+        expect(ch.queue.declare).args(
+            queue='q', durable=True, exclusive=False, auto_delete=False,
+            arguments={})
+        expect(ch.queue.bind).args(
+            queue='q', exchange='ex', routing_key='a', arguments={})
+        expect(ch.exchange.bind).args(
+            cb=cb, exchange='ex2', source='ex', routing_key='b',
+            arguments={})
+        assert_true(self.topology.declare(ch, cb))
+
+    def test_declare_when_empty(self):
+        assert_false(Topology().declare(mock(), mock()))
+
+    def test_forget_broker_named(self):
+        self.topology.queue_named('amq.gen-1')
+        self.topology.queue_bound('amq.gen-1', 'ex', 'a', {})
+        self.topology.queue_bound('', 'ex', 'a', {})
+        assert_equals(set(['amq.gen-1', '']),
+                      self.topology.forget_broker_named())
+        assert_equals([('q', 'ex', 'a'), ('ex2', 'ex', 'b')],
+                      self.topology.bindings)
+        assert_equals(set(['']), self.topology.forget_broker_named())
+
+
+class ChannelRecordTest(Chai):
+
+    def test_restore_and_resume(self):
+        record = ChannelRecord()
+        ch = mock()
+        ch.basic = mock()
+        ch.confirm = mock()
+        record.restore(ch)
+
+        consumer = mock()
+        record.qos = (0, 10, False)
+        record.confirm = True
+        record.consumers['tag'] = dict(queue='q', consumer=consumer)
+        expect(ch.basic.qos).args(0, 10, False)
+        expect(ch.confirm.select)
+        record.restore(ch)
+
+        expect(ch.basic.consume).args(
+            consumer_tag='tag', queue='q', consumer=consumer)
+        record.resume(ch)
+
+    def test_forget_consumers(self):
+        record = ChannelRecord()
+        record.consumers['a'] = dict(queue='amq.gen-1', consumer=mock())
+        record.consumers['b'] = dict(queue='q', consumer=mock())
+        record.consumers['c'] = dict(queue='', consumer=mock())
+        record.forget_consumers(set(['amq.gen-1', '']))
+        assert_equals(['b'], list(record.consumers))
+
+
+class RecoveringConnectionTest(Chai):
+
+    def setUp(self):
+        super(RecoveringConnectionTest, self).setUp()
+        self.open_cb = mock()
+        self.close_cb = mock()
+        self.recover_cb = mock()
+        self.transport = FakeTransport(None)
+        self.connection = RecoveringConnection(
+            transport=self.transport, hosts=['a:1', ('b', 2)],
+            open_cb=self.open_cb, close_cb=self.close_cb,
+            recover_cb=self.recover_cb, logger=mock())
+        self.transport._connection = self.connection
+        expect(self.connection.logger.warning).any_args().at_least(0)
+        expect(self.connection.logger.info).any_args().at_least(0)
+        expect(self.connection.logger.error).any_args().at_least(0)
+
+        # Open it as if the broker replied
+        self.connection._connected = True
+        self.ch = self.connection.channel()
+        self.ch._pending_events.clear()
+
+    def test_init(self):
+        assert_equals([('a', 1), ('b', 2)], self.connection.hosts)
+        assert_equals([('a', 1)], self.transport.hosts)
+        assert_equals('a:1', self.connection._host)
+        assert_true(isinstance(self.ch.exchange, RecoveringExchangeClass))
+        assert_true(isinstance(self.ch.queue, RecoveringQueueClass))
+        assert_true(isinstance(self.ch.basic, RecoveringBasicClass))
+        assert_true(isinstance(self.ch.confirm, RecoveringConfirmClass))
+        assert_false(self.connection.recovering)
+
+    def test_parse_host(self):
+        assert_equals(('host', 5672), recovering_connection._parse_host('host'))
+        assert_equals(('::1', 5673), recovering_connection._parse_host('::1:5673'))
+        assert_equals(('host', 1), recovering_connection._parse_host(['host', 1]))
+
+    def test_records_declarations(self):
+        consumer = mock()
+        self.ch.exchange.declare('ex', 'topic')
+        self.ch.exchange.declare('passive', 'topic', passive=True)
+        self.ch.queue.declare('q')
+        self.ch.queue.declare()
+        self.ch.queue.bind('q', 'ex', 'a.#')
+        self.ch.basic.qos(prefetch_count=10)
+        self.ch.basic.consume('q', consumer)
+        self.ch.confirm.select()
+
+        topology = self.connection.topology
+        assert_equals(['ex'], topology.exchanges)
+        assert_equals(['q'], topology.queues)
+        assert_equals([('q', 'ex', 'a.#')], topology.bindings)
+        record = self.connection._channel_records[self.ch.channel_id]
+        assert_equals((0, 10, False), record.qos)
+        assert_true(record.confirm)
+        assert_equals(['channel-1-1'], list(record.consumers))
+        assert_equals(consumer, record.consumers['channel-1-1']['consumer'])
+
+        self.ch.basic.cancel(consumer=consumer)
+        assert_equals({}, dict(record.consumers))
+
+    def test_does_not_recover_broker_named_queues(self):
+        self.ch.queue._declare_cb.append(None)
+        self.ch.queue._recv_declare_ok(MethodFrame(1, 50, 11, Reader(
+            Writer().write_shortstr('amq.gen-1').write_long(0).
+            write_long(0).buffer())))
+        for queue in ('amq.gen-1', '', 'q'):
+            self.ch.queue.bind(queue, 'ex', 'key')
+            self.ch.basic.consume(queue, mock())
+        self.connection.transport_closed(msg='gone')
+
+        assert_equals([('q', 'ex', 'key')], self.connection.topology.bindings)
+        record = self.connection._channel_records[self.ch.channel_id]
+        assert_equals(['channel-1-3'], list(record.consumers))
+
+    def test_records_consumers_cancelled_by_broker(self):
+        self.ch.basic.consume('q', mock(), consumer_tag='tag')
+        self.ch.basic._recv_cancel(MethodFrame(
+            1, 60, 30, Reader(Writer().write_shortstr('tag').buffer())))
+        record = self.connection._channel_records[self.ch.channel_id]
+        assert_equals({}, dict(record.consumers))
+
+    def test_closing_a_channel_forgets_its_record(self):
+        self.ch.basic.qos(prefetch_count=10)
+        self.connection._channel_closed(self.ch)
+        assert_equals({}, self.connection._channel_records)
+
+    def test_transport_closed_schedules_reconnect(self):
+        listener = mock()
+        self.ch.basic.set_return_listener(listener)
+        basic = self.ch.basic
+        wrapper = SyncWrapper(mock())
+        self.ch._pending_events.append(wrapper)
+        self.ch.basic.enable_ack_batching(max_pending=5)
+
+        self.connection.transport_closed(msg='gone')
+
+        assert_true(self.connection.recovering)
+        assert_false(self.connection.closed)
+        assert_true(self.connection.transport is None)
+        assert_false(wrapper._read)
+        assert_equals(0, len(self.ch._pending_events))
+        assert_true(self.ch.basic is not basic)
+        assert_equals(listener, self.ch.basic._return_listener)
+        assert_equals(5, self.ch._ack_batcher._max_pending)
+
+        timer, = self.transport.timers
+        assert_true(0 <= timer.delay <= 1.0)
+        assert_equals(self.connection._reconnect_timeout, timer.callback)
+
+    def test_writes_raise_while_recovering(self):
+        self.connection.transport_closed(msg='gone')
+        assert_raises(ConnectionClosed, self.ch.publish, Message('x'), 'ex',
+                      'key')
+        assert_raises(ConnectionClosed, self.connection.channel)
+        assert_equals(self.ch, self.connection.channel(1))
+
+    def test_reconnect_to_next_host(self):
+        self.connection.transport_closed(msg='gone')
+        transport = FakeTransport(self.connection)
+        expect(self.connection._create_transport).args(
+            self.connection._kwargs).returns(transport)
+        self.transport.timers[0].callback()
+
+        assert_equals([('b', 2)], transport.hosts)
+        assert_equals('b:2', self.connection._host)
+        assert_true(self.connection.recovering)
+
+    def test_failed_reconnect_backs_off(self):
+        self.connection.transport_closed(msg='gone')
+        expect(self.connection._create_transport).args(
+            self.connection._kwargs).raises(IOError('refused'))
+        self.mock(recovering_connection, 'random')
+        expect(recovering_connection.random.uniform).args(0, 2.0).returns(1.5)
+        self.transport.timers[0].callback()
+
+        assert_equals(2, len(self.transport.timers))
+        assert_equals(1.5, self.transport.timers[1].delay)
+        assert_true(self.connection.recovering)
+
+    def test_backoff_is_limited(self):
+        self.connection._attempts = 20
+        self.mock(recovering_connection, 'random')
+        expect(recovering_connection.random.uniform).args(0, 30.0).returns(3)
+        assert_equals(3, self.connection._backoff())
+
+    def test_gives_up_after_max_attempts(self):
+        self.connection._max_reconnect_attempts = 1
+        self.connection.transport_closed(msg='gone')
+        expect(self.connection._create_transport).args(
+            self.connection._kwargs).raises(IOError('refused'))
+        expect(self.close_cb)
+        self.transport.timers[0].callback()
+
+        assert_false(self.connection.recovering)
+        assert_true(self.connection.closed)
+        assert_equals(1, len(self.transport.timers))
+
+    def test_close_while_recovering(self):
+        self.connection.transport_closed(msg='gone')
+        expect(self.close_cb)
+        self.connection.close()
+
+        assert_true(self.transport.timers[0].cancelled)
+        assert_false(self.connection.recovering)
+        assert_true(self.connection.closed)
+
+    def test_recovers_when_broker_forces_close(self):
+        self.connection._closed = True
+        self.connection._close_info['reply_code'] = CONNECTION_FORCED
+        self.connection._callback_close()
+        assert_true(self.connection.recovering)
+        assert_false(self.connection.closed)
+
+    def test_closed_by_broker(self):
+        self.connection._closed = True
+        self.connection._close_info['reply_code'] = 530
+        expect(self.close_cb)
+        self.connection._callback_close()
+        assert_false(self.connection.recovering)
+
+    def test_recover(self):
+        self.ch.exchange.declare('ex', 'direct')
+        self.ch.basic.qos(prefetch_count=10)
+        self.ch.basic.consume('q', mock())
+        self.connection.transport_closed(msg='gone')
+
+        temp = mock()
+        expect(self.ch.open)
+        expect(self.ch.basic.qos).args(0, 10, False)
+        expect(self.connection.channel).returns(temp)
+        expect(temp.add_close_listener).args(
+            self.connection._declaring_channel_closed)
+        expect(temp.exchange.declare).args(
+            exchange='ex', type='direct', durable=False, auto_delete=True,
+            internal=False, arguments=None, cb=var('declared'))
+        expect(self.open_cb)
+        self.connection._connected = True
+        self.connection._flush_buffered_frames()
+        self.connection._callback_open()
+        assert_false(self.connection.recovering)
+
+        expect(temp.remove_close_listener).args(
+            self.connection._declaring_channel_closed)
+        expect(temp.close)
+        expect(self.ch.basic.consume).args(
+            consumer_tag='channel-1-1', queue='q', consumer=ignore_arg(),
+            no_local=False, no_ack=True, exclusive=False, cancel_cb=None,
+            stream=False)
+        expect(self.recover_cb)
+        var('declared').value('ex')
+
+    def test_recover_when_declaration_closes_channel(self):
+        self.ch.exchange.declare('ex', 'direct')
+        self.ch.basic.consume('q', mock())
+        self.connection.transport_closed(msg='gone')
+
+        expect(self.ch.open)
+        self.connection._transport = self.transport
+        self.connection._connected = True
+        self.connection._flush_buffered_frames()
+        temp = self.connection._channels[2]
+
+        # The broker refusing a declaration closes the temporary channel
+        # rather than one of the application, and the consumers resume
+        expect(self.ch.basic.consume).any_args()
+        expect(self.recover_cb)
+        temp.channel._recv_close(MethodFrame(2, 20, 40, Reader(
+            Writer().write_short(406).write_shortstr('PRECONDITION_FAILED').
+            write_short(40).write_short(10).buffer())))
+        assert_true(temp.closed)
+        assert_false(self.ch.closed)
+        assert_false(2 in self.connection._channels)
+
+    def test_recover_without_channels(self):
+        self.ch.exchange.declare('ex', 'direct')
+        self.connection._channel_closed(self.ch)
+        self.connection.transport_closed(msg='gone')
+
+        temp = mock()
+        expect(self.connection.channel).returns(temp)
+        expect(temp.add_close_listener).args(
+            self.connection._declaring_channel_closed)
+        expect(temp.exchange.declare).any_args().side_effect(
+            lambda **kwargs: kwargs['cb']())
+        expect(temp.remove_close_listener).args(
+            self.connection._declaring_channel_closed)
+        expect(temp.close)
+        expect(self.recover_cb)
+        self.connection._connected = True
+        self.connection._flush_buffered_frames()
+
+    def _deliver(self, delivery_tag):
+        return self.ch.basic._read_delivery_info(MethodFrame(
+            1, 60, 60, Reader(Writer().write_shortstr('ctag').
+                              write_longlong(delivery_tag).write_bit(False).
+                              write_shortstr('ex').write_shortstr('key').
+                              buffer())), with_consumer_tag=True)
+
+    def test_delivery_tags_increase_across_reconnects(self):
+        assert_equals(1, self._deliver(1)['delivery_tag'])
+        assert_equals(2, self._deliver(2)['delivery_tag'])
+        self.connection.transport_closed(msg='gone')
+        assert_equals(3, self._deliver(1)['delivery_tag'])
+        self.connection.transport_closed(msg='gone')
+        self.connection.transport_closed(msg='gone')
+        assert_equals(4, self._deliver(1)['delivery_tag'])
+
+    def test_acks_of_a_lost_connection_are_dropped(self):
+        self._deliver(2)
+        self.connection.transport_closed(msg='gone')
+        self._deliver(1)
+
+        basic = self.ch.basic
+        frames = []
+        expect(basic.send_frame).any_args().side_effect(
+            frames.append).times(3)
+        for delivery_tag in (1, 2):
+            basic.ack(delivery_tag)
+            basic.nack(delivery_tag)
+            basic.reject(delivery_tag)
+        basic.ack(3)
+        basic.nack(3, requeue=True)
+        basic.reject(3)
+        assert_equals([80, 120, 90], [f.method_id for f in frames])
+        assert_equals([1, 1, 1], [Reader(f.args.buffer()).read_longlong()
+                                  for f in frames])
+
+    def test_batched_acks_after_reconnect(self):
+        self.ch.basic.enable_ack_batching()
+        self._deliver(1)
+        self.connection.transport_closed(msg='gone')
+        self._deliver(1)
+        self._deliver(2)
+
+        expect(self.ch.basic._send_ack).args(2, True)
+        self.ch.basic.ack(1)
+        self.ch.basic.ack(2)
+        self.ch.basic.ack(3)
+        self.ch.basic.flush_acks()
+
+    def test_outbox_publishes_when_connected(self):
+        outbox = Outbox()
+        self.ch.basic.set_outbox(outbox)
+        expect(self.ch.basic.publish_raw).args(
+            is_a(Message), 'ex', 'key', False, False).side_effect(
+            lambda msg, *args: assert_equals(b'x', bytes(msg.body)))
+        assert_equals(1, self.ch.basic.publish(Message('x'), 'ex', 'key'))
+        # Without confirms, messages are removed once written
+        assert_equals(0, len(outbox))
+
+    def test_outbox_absorbs_publishes_while_recovering(self):
+        outbox = Outbox()
+        self.ch.basic.set_outbox(outbox)
+        self.connection.transport_closed(msg='gone')
+        assert_equals(outbox, self.ch.basic._outbox)
+        assert_equals(1, self.ch.basic.publish(Message('x'), 'ex', 'key'))
+        assert_equals(1, len(outbox))
+
+        expect(self.ch.open)
+        expect(self.ch.basic.publish_raw).args(
+            is_a(Message), 'ex', 'key', False, False)
+        expect(self.recover_cb)
+        self.connection._connected = True
+        self.connection._flush_buffered_frames()
+        assert_equals(0, len(outbox))
+
+    def test_outbox_removes_confirmed_messages(self):
+        ack_listener = mock()
+        nack_listener = mock()
+        outbox = Outbox()
+        self.ch.confirm.select()
+        self.ch.basic.set_outbox(outbox)
+        self.ch.basic.set_ack_listener(ack_listener)
+        self.ch.basic.set_nack_listener(nack_listener)
+        for body in ('a', 'b', 'c', 'd'):
+            self.ch.basic.publish(Message(body), 'ex', 'key')
+        assert_equals(4, len(outbox))
+
+        expect(ack_listener).args(1)
+        expect(ack_listener).args(2)
+        self.ch.basic._recv_ack(MethodFrame(1, 60, 80, Reader(
+            Writer().write_longlong(2).write_bit(True).buffer())))
+        expect(ack_listener).args(4)
+        self.ch.basic._recv_ack(MethodFrame(1, 60, 80, Reader(
+            Writer().write_longlong(4).write_bit(False).buffer())))
+        expect(nack_listener).args(3, True)
+        self.ch.basic._recv_nack(MethodFrame(1, 60, 120, Reader(
+            Writer().write_longlong(3).write_bits(False, True).buffer())))
+        assert_equals(0, len(outbox))
+
+    def test_outbox_publishes_unconfirmed_messages_again(self):
+        outbox = Outbox()
+        self.ch.confirm.select()
+        self.ch.basic.set_outbox(outbox)
+        self.ch.basic.publish(Message('a'), 'ex', 'key')
+        self.ch.basic.publish(Message('b'), 'ex', 'key')
+        self.ch.basic._recv_ack(MethodFrame(1, 60, 80, Reader(
+            Writer().write_longlong(1).write_bit(False).buffer())))
+        self.connection.transport_closed(msg='gone')
+        assert_equals(3, self.ch.basic.publish(Message('c'), 'ex', 'key'))
+
+        bodies = []
+        expect(self.ch.open)
+        expect(self.ch.basic.publish_raw).any_args().side_effect(
+            lambda msg, *args: bodies.append(bytes(msg.body)) or len(bodies)
+        ).times(2)
+        expect(self.recover_cb)
+        self.connection._transport = self.transport
+        self.connection._connected = True
+        self.connection._flush_buffered_frames()
+        assert_equals([b'b', b'c'], bodies)
+        assert_equals([(1, 2), (2, 3)], list(self.ch.basic._unconfirmed))
+        assert_equals(2, len(outbox))
+
+    def test_outbox_publish_raises_when_closed(self):
+        self.ch.basic.set_outbox(Outbox())
+        self.connection._closed = True
+        assert_raises(ConnectionClosed, self.ch.basic.publish, Message('x'),
+                      'ex', 'key')
+
+
+
+class RecoveringConnectionBrokerTest(Chai):
+
+    '''
+    Failover between two fake brokers, which forget everything declared
+    on the one that stops.
+    '''
+
+    def test_failover(self):
+        selector = DefaultSelector()
+        deliveries = []
+        recoveries = []
+        first = FakeBroker().start()
+        with FakeBroker() as second:
+            connection = RecoveringConnection(
+                hosts=[first.address, second.address], transport='selector',
+                selector=selector, reconnect_delay=0.1,
+                recover_cb=lambda: recoveries.append(connection._host))
+            ch = connection.channel()
+            ch.exchange.declare('ex', 'direct')
+            ch.queue.declare('q', auto_delete=False)
+            ch.queue.bind('q', 'ex', 'key')
+            ch.basic.qos(prefetch_count=10)
+            ch.basic.consume('q', deliveries.append)
+            for _ in range(5):
+                poll(selector, 0.05)
+
+            first.stop()
+            deadline = time.time() + 5
+            while not recoveries and time.time() < deadline:
+                poll(selector, 0.05)
+            assert_equals(['%s:%d' % second.address], recoveries)
+
+            publisher = Connection(
+                host=second.address[0], port=second.address[1],
+                transport='selector', selector=selector)
+            publisher.channel().basic.publish(Message('hello'), 'ex', 'key')
+            deadline = time.time() + 5
+            while not deliveries and time.time() < deadline:
+                poll(selector, 0.05)
+            assert_equals([b'hello'], [bytes(msg.body) for msg in deliveries])
+
+            connection.close()
+            publisher.close()
+            for _ in range(5):
+                poll(selector, 0.05)
+        assert_true(connection.closed)
+
+    def test_outbox_failover(self):
+        selector = DefaultSelector()
+        deliveries = []
+        recoveries = []
+        outbox = Outbox()
+        first = FakeBroker().start()
+        with FakeBroker() as second:
+            connection = RecoveringConnection(
+                hosts=[first.address, second.address], transport='selector',
+                selector=selector, reconnect_delay=0.1,
+                recover_cb=lambda: recoveries.append(connection._host))
+            connection.logger.disabled = True
+            ch = connection.channel()
+            ch.confirm.select()
+            ch.basic.set_outbox(outbox)
+            ch.exchange.declare('ex', 'direct')
+            ch.queue.declare('q', auto_delete=False)
+            ch.queue.bind('q', 'ex', 'key')
+            ch.basic.publish(Message('one'), 'ex', 'key')
+            deadline = time.time() + 5
+            while len(outbox) and time.time() < deadline:
+                poll(selector, 0.05)
+            assert_equals(0, len(outbox))
+
+            first.stop()
+            while not connection.recovering and time.time() < deadline:
+                poll(selector, 0.05)
+            ch.basic.publish(Message('two'), 'ex', 'key')
+            assert_equals(1, len(outbox))
+            while not recoveries and time.time() < deadline:
+                poll(selector, 0.05)
+            ch.basic.publish(Message('three'), 'ex', 'key')
+
+            consumer = Connection(
+                host=second.address[0], port=second.address[1],
+                transport='selector', selector=selector)
+            consumer.channel().basic.consume('q', deliveries.append)
+            while (len(deliveries) < 2 or len(outbox)) and \
+                    time.time() < deadline:
+                poll(selector, 0.05)
+            assert_equals([b'two', b'three'],
+                          [bytes(msg.body) for msg in deliveries])
+            assert_equals(0, len(outbox))
+
+            connection.close()
+            consumer.close()
+            for _ in range(5):
+                poll(selector, 0.05)
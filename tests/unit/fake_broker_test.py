@@ -0,0 +1,122 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+from chai import Chai
+
+from haigha2.connections.rabbit_connection import RabbitConnection
+from haigha2.message import Message
+from tests.fake_broker import FakeBroker, encode_content_header, \
+    CONTENT_HEADER
+
+
+class FakeBrokerTest(Chai):
+
+    '''
+    Runs a synchronous connection against the broker on loopback.
+    '''
+
+    def setUp(self):
+        super(FakeBrokerTest, self).setUp()
+        self.broker = FakeBroker().start()
+        host, port = self.broker.address
+        self.connection = RabbitConnection(host=host, port=port)
+        self.channel = self.connection.channel()
+
+    def tearDown(self):
+        if not self.connection.closed:
+            self.connection.close()
+        self.broker.stop()
+        super(FakeBrokerTest, self).tearDown()
+
+    def consume(self, queue, count):
+        received = []
+        self.channel.basic.consume(queue, received.append)
+        while len(received) < count:
+            self.connection.read_frames()
+        return received
+
+    def test_publish_and_consume(self):
+        assert_equals(('q', 0, 0), self.channel.queue.declare('q'))
+        for i in range(3):
+            self.channel.basic.publish(Message('m%d' % (i)), '', 'q')
+        assert_true(self.broker.wait_published(3, 5))
+
+        received = self.consume('q', 3)
+        assert_equals(['m0', 'm1', 'm2'], [str(m.body) for m in received])
+        assert_equals('q', received[0].delivery_info['routing_key'])
+        assert_equals(3, self.broker.delivered)
+
+    def test_stream_consume_on_synchronous_channel(self):
+        # The header and body arrive in one read, so the body is already
+        # buffered on the channel when the consumer reads it
+        bodies = []
+        self.channel.queue.declare('q')
+        self.channel.basic.publish(Message('streamed'), '', 'q')
+        assert_true(self.broker.wait_published(1, 5))
+
+        self.channel.basic.consume(
+            'q', lambda msg: bodies.append(msg.body.read()), stream=True)
+        while not bodies:
+            self.connection.read_frames()
+        assert_equals([b'streamed'], bodies)
+
+    def test_declare_generates_queue_name(self):
+        name, _, _ = self.channel.queue.declare()
+        assert_true(name.startswith('amq.gen-'))
+
+    def test_bindings_route_messages(self):
+        self.channel.exchange.declare('x', 'direct')
+        self.channel.queue.declare('q')
+        self.channel.queue.bind('q', 'x', 'key')
+        self.channel.basic.publish(Message('routed'), 'x', 'key')
+        self.channel.basic.publish(Message('dropped'), 'x', 'other')
+        self.broker.wait_published(2, 5)
+
+        assert_equals(1, self.broker.queue_depth('q'))
+        assert_equals('routed', str(self.channel.basic.get('q').body))
+
+    def test_get_from_empty_queue(self):
+        self.channel.queue.declare('q')
+        assert_equals(None, self.channel.basic.get('q'))
+
+    def test_confirms(self):
+        acked = []
+        self.channel.confirm.select()
+        self.channel.basic.set_ack_listener(acked.append)
+        for _ in range(3):
+            self.channel.basic.publish(Message('m'), '', 'unrouted')
+        while not acked or acked[-1] < 3:
+            self.connection.read_frames()
+        assert_equals(3, acked[-1])
+
+    def test_preload_large_messages(self):
+        body = 'x' * (3 * self.broker.frame_max)
+        self.broker.preload('q', body, 2, {'content_type': 'text/plain'})
+        assert_equals(2, self.broker.queue_depth('q'))
+
+        received = self.consume('q', 2)
+        assert_equals(body, str(received[1].body))
+        assert_equals('text/plain', received[1].properties['content_type'])
+
+    def test_ack(self):
+        self.broker.preload('q', 'm', 1)
+        received = []
+        self.channel.basic.consume('q', received.append, no_ack=False)
+        while not received:
+            self.connection.read_frames()
+        self.channel.basic.ack(received[0].delivery_info['delivery_tag'])
+        self.channel.queue.declare('q')
+        assert_equals(1, self.broker.acked)
+
+    def test_wait_published_times_out(self):
+        assert_false(self.broker.wait_published(1, 0.01))
+
+
+class EncodeContentHeaderTest(Chai):
+
+    def test_without_properties(self):
+        assert_equals((60, 0, 5, 0),
+                      CONTENT_HEADER.unpack(encode_content_header(5)))
@@ -9,8 +9,12 @@ import struct
 from collections import deque
 
 from haigha2.frames import frame
-from haigha2.frames.frame import Frame
+from haigha2.frames.frame import Frame, FrameScan
+from haigha2.frames.content_frame import ContentFrame
+from haigha2.frames.heartbeat_frame import HeartbeatFrame
+from haigha2.frames.method_frame import MethodFrame
 from haigha2.reader import Reader
+from haigha2.writer import Writer
 
 
 class FrameTest(Chai):
@@ -24,7 +28,10 @@ class FrameTest(Chai):
 
         assertEquals(None, Frame._frame_type_map.get(42))
         DummyFrame.register()
-        assertEquals(DummyFrame, Frame._frame_type_map[42])
+        try:
+            assertEquals(DummyFrame, Frame._frame_type_map[42])
+        finally:
+            del Frame._frame_type_map[42]
 
     def test_type_raises_not_implemented(self):
         assertRaises(NotImplementedError, Frame.type)
@@ -64,6 +71,65 @@ class FrameTest(Chai):
 
         self.assertRaises(Frame.FormatError, Frame.read_frames, reader)
 
+    def _frame_stream(self):
+        buf = bytearray()
+        MethodFrame(1, 60, 80, Writer().write_longlong(7).write_bit(False)).\
+            write_frame(buf)
+        HeartbeatFrame(0).write_frame(buf)
+        ContentFrame(2, b'hello').write_frame(buf)
+        return buf
+
+    def test_scan_frames(self):
+        buf = self._frame_stream()
+        reader = Reader(buf + buf[:10])
+
+        scan = Frame.scan_frames(reader)
+        assert_true(isinstance(scan, FrameScan))
+        assert_equals(3, len(scan))
+        assert_equals(len(buf), reader.tell())
+        assert_equals([(1, 1, 7, 13), (8, 0, 28, 0), (3, 2, 36, 5)],
+                      scan.entries())
+        assert_equals((8, 0, 28, 0), scan.entry(1))
+        assert_equals([(1, 1), (8, 0), (3, 2)], list(scan.headers()))
+
+        frames = list(scan)
+        assert_equals((60, 80), (frames[0].class_id, frames[0].method_id))
+        assert_equals(7, frames[0].args.read_longlong())
+        assert_true(isinstance(frames[1], HeartbeatFrame))
+        assert_equals(b'hello', bytes(frames[2].payload.buffer()))
+        assert_equals(2, scan.frame(2).channel_id)
+
+    def test_scan_frames_matches_read_frames(self):
+        buf = self._frame_stream() * 3
+        for cut in range(len(buf) + 1):
+            reader = Reader(buf[:cut])
+            scanned = [str(f) for f in Frame.scan_frames(reader)]
+            pos = reader.tell()
+
+            reader = Reader(buf[:cut])
+            assert_equals([str(f) for f in Frame.read_frames(reader)],
+                          scanned)
+            assert_equals(reader.tell(), pos)
+
+    def test_scan_frames_raises_formaterror_if_bad_footer(self):
+        buf = self._frame_stream()
+        buf[20] = 0
+        reader = Reader(buf)
+        assert_raises(Frame.FormatError, Frame.scan_frames, reader)
+
+    def test_scan_frames_raises_invalidframetype(self):
+        buf = self._frame_stream()
+        buf[21] = 54
+        reader = Reader(buf)
+        assert_raises(Frame.InvalidFrameType, Frame.scan_frames, reader)
+
+    def test_frame_scan_raises_formaterror_on_bad_payload(self):
+        # A method frame with a payload too short for its class and method
+        scan = Frame.scan_frames(
+            Reader(b'\x01\x00\x01\x00\x00\x00\x02\x00\x3c\xce'))
+        assert_equals(1, len(scan))
+        assert_raises(Frame.FormatError, scan.frame, 0)
+
     def test_read_frame_on_full_frame(self):
         class FrameReader(Frame):
 
@@ -80,9 +146,8 @@ class FrameTest(Chai):
         reader = self.mock()
         payload = self.mock()
 
-        expect(reader.read_octet).returns(45)  # frame type
-        expect(reader.read_short).returns(32)  # channel id
-        expect(reader.read_long).returns(42)  # size
+        # frame type, channel id, size
+        expect(reader.read_struct).args('>BHI').returns((45, 32, 42))
 
         expect(reader.tell).returns(5)
         expect(frame.Reader).args(reader, 5, 42).returns(payload)
@@ -97,9 +162,8 @@ class FrameTest(Chai):
         self.mock(frame, 'Reader')
         reader = self.mock()
 
-        expect(reader.read_octet).returns(45)  # frame type
-        expect(reader.read_short).returns(32)  # channel id
-        expect(reader.read_long).returns(42)  # size
+        # frame type, channel id, size
+        expect(reader.read_struct).args('>BHI').returns((45, 32, 42))
 
         expect(reader.tell).returns(5)
         expect(frame.Reader).args(reader, 5, 42).returns('payload')
@@ -112,9 +176,8 @@ class FrameTest(Chai):
         self.mock(frame, 'Reader')
         reader = self.mock()
 
-        expect(reader.read_octet).returns(45)  # frame type
-        expect(reader.read_short).returns(32)  # channel id
-        expect(reader.read_long).returns(42)  # size
+        # frame type, channel id, size
+        expect(reader.read_struct).args('>BHI').returns((45, 32, 42))
 
         expect(reader.tell).returns(5)
         expect(frame.Reader).args(reader, 5, 42).returns('payload')
@@ -128,9 +191,8 @@ class FrameTest(Chai):
         reader = self.mock()
         payload = self.mock()
 
-        expect(reader.read_octet).returns(54)  # frame type
-        expect(reader.read_short).returns(32)  # channel id
-        expect(reader.read_long).returns(42)  # size
+        # frame type, channel id, size
+        expect(reader.read_struct).args('>BHI').returns((54, 32, 42))
 
         expect(reader.tell).returns(5)
         expect(frame.Reader).args(reader, 5, 42).returns(payload)
@@ -11,7 +11,7 @@ from datetime import datetime
 
 from haigha2.frames import header_frame
 from haigha2.frames.header_frame import HeaderFrame
-from haigha2.reader import Reader
+from haigha2.reader import Reader, LazyTable
 from haigha2.writer import Writer
 
 
@@ -136,6 +136,52 @@ class HeaderFrameTest(Chai):
         assert_equals(6, frame._weight)
         assert_equals(7, frame._size)
 
+    def test_parse_with_lazy_tables(self):
+        headers = Writer().write_table({'foo': 'bar'}).buffer()
+        payload = Writer()
+        payload.write_short(5).\
+            write_short(6).\
+            write_longlong(7).\
+            write_short(1 << 13).\
+            write(headers)
+
+        HeaderFrame.LAZY_TABLES = True
+        try:
+            frame = HeaderFrame.parse(4, Reader(payload.buffer()))
+        finally:
+            HeaderFrame.LAZY_TABLES = False
+
+        table = frame.properties['application_headers']
+        assert_true(isinstance(table, LazyTable))
+        assert_equals({'foo': 'bar'}, table)
+        assert_equals(headers, table.encoded_table())
+
+    def test_parse_keeps_raw_payload(self):
+        payload = Writer()
+        payload.write_short(60).\
+            write_short(0).\
+            write_longlong(7).\
+            write_short(1 << 15).\
+            write_shortstr('text/plain')
+
+        frame = HeaderFrame.parse(4, Reader(payload.buffer()))
+        assert_equals(None, frame.raw_payload)
+
+        HeaderFrame.KEEP_RAW_PAYLOAD = True
+        try:
+            frame = HeaderFrame.parse(4, Reader(payload.buffer()))
+        finally:
+            HeaderFrame.KEEP_RAW_PAYLOAD = False
+        assert_equals(payload.buffer(), frame.raw_payload)
+        assert_equals({'content_type': 'text/plain'}, frame.properties)
+
+    def test_write_frame_with_raw_payload(self):
+        frame = HeaderFrame(42, 60, 0, 7, {'content_type': 'ignored'},
+                            raw_payload='raw-payload')
+        buf = bytearray()
+        frame.write_frame(buf)
+        assert_equals('\x02\x00\x2a\x00\x00\x00\x0braw-payload\xce', buf)
+
     def test_write_frame_fast_for_standard_properties(self):
         bit_field = 0
         properties = {}
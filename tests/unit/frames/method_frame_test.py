@@ -29,8 +29,8 @@ class MethodFrameTest(Chai):
 
     def test_parse(self):
         reader = mock()
-        expect(reader.read_short).returns('class_id')
-        expect(reader.read_short).returns('method_id')
+        expect(reader.read_struct).args('>HH').returns(
+            ('class_id', 'method_id'))
         frame = MethodFrame.parse(42, reader)
 
         assert_equals(42, frame.channel_id)
@@ -0,0 +1,127 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+import time
+
+from chai import Chai
+
+from haigha2.connections.rabbit_connection import RabbitConnection
+from haigha2.exceptions import ConnectionClosed
+from tests.fake_broker import FakeBroker
+from haigha2.frames.heartbeat_frame import HeartbeatFrame
+from haigha2.heartbeat import Heartbeat
+from haigha2.transports.selector_transport import DefaultSelector, poll
+
+
+class HeartbeatTest(Chai):
+
+    def setUp(self):
+        super(HeartbeatTest, self).setUp()
+        self.connection = mock()
+        self.connection.frames_written = 10
+        self.connection._reads = 5
+        self.connection.closed = False
+        self.connection._host = 'server:5672'
+        self.transport = mock()
+        self.connection.transport = self.transport
+        self.heartbeat = Heartbeat(self.connection, 30)
+
+    def start(self):
+        self.timer = mock()
+        expect(self.transport.call_later).args(
+            15.0, self.heartbeat._check).returns(self.timer)
+        assert_true(self.heartbeat.start())
+
+    def test_start_when_transport_has_no_timers(self):
+        expect(self.transport.call_later).args(
+            15.0, self.heartbeat._check).returns(None)
+        assert_false(self.heartbeat.start())
+
+    def test_stop(self):
+        self.start()
+        expect(self.timer.cancel)
+        self.heartbeat.stop()
+        self.heartbeat.stop()
+
+    def test_check_sends_heartbeat_when_nothing_written(self):
+        self.start()
+        self.connection._reads = 6
+        expect(self.connection.send_frame).args(HeartbeatFrame)
+        expect(self.transport.call_later).args(15.0, self.heartbeat._check)
+        self.heartbeat._check()
+
+    def test_check_skips_heartbeat_when_frames_written(self):
+        self.start()
+        self.connection.frames_written = 11
+        expect(self.connection.send_frame).times(0)
+        expect(self.transport.call_later).args(15.0, self.heartbeat._check)
+        self.heartbeat._check()
+        assert_equals(11, self.heartbeat._frames_written)
+
+    def test_check_closes_after_two_intervals_without_reads(self):
+        self.start()
+        expect(self.connection.send_frame).any_args().at_least(0)
+        expect(self.transport.call_later).args(
+            15.0, self.heartbeat._check).returns(self.timer).times(3)
+        for _ in range(3):
+            self.heartbeat._check()
+
+        expect(self.transport.disconnect)
+        expect(self.connection.transport_closed).args(
+            msg='Heartbeats not received from server:5672 for 60 seconds')
+        self.heartbeat._check()
+        assert_true(self.heartbeat.expired)
+
+        # Stopping after the transport closed doesn't cancel anything
+        self.heartbeat.stop()
+
+    def test_check_after_close(self):
+        self.start()
+        self.connection.closed = True
+        expect(self.connection.send_frame).times(0)
+        self.heartbeat._check()
+
+
+class HeartbeatBrokerTest(Chai):
+
+    '''
+    Heartbeats of an idle connection on the fake broker, which doesn't send
+    any of its own.
+    '''
+
+    def test_idle_connection_sends_heartbeats_and_closes(self):
+        selector = DefaultSelector()
+        with FakeBroker() as broker:
+            host, port = broker.address
+            connection = RabbitConnection(
+                host=host, port=port, transport='selector',
+                selector=selector, heartbeat=1, metrics=True)
+            deadline = time.time() + 5
+            while connection.transport is not None and \
+                    time.time() < deadline:
+                poll(selector, 1)
+
+        assert_true(connection._heartbeat_timer is None)
+        assert_true(connection.metrics.frames_out[8].value >= 1)
+        assert_equals('Heartbeats not received from %s:%d for 2 seconds' % (
+            host, port), connection.close_info['reply_text'])
+        assert_equals({}, dict(selector.get_map()))
+
+    def test_synchronous_read_raises_when_broker_is_silent(self):
+        with FakeBroker() as broker:
+            host, port = broker.address
+            connection = RabbitConnection(host=host, port=port, heartbeat=1)
+            assert_true(connection._heartbeat_timer is not None)
+            start = time.time()
+
+            def read_for_a_while():
+                while time.time() < start + 5:
+                    connection.read_frames()
+            assert_raises(ConnectionClosed, read_for_a_while)
+
+        assert_true(time.time() - start < 4)
+        assert_equals('Heartbeats not received from %s:%d for 2 seconds' % (
+            host, port), connection.close_info['reply_text'])
@@ -4,9 +4,14 @@ Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
 https://github.com/agoragames/haigha/blob/master/LICENSE.txt
 '''
 
+
 from chai import Chai
 
-from haigha2.message import Message
+from haigha2.message import Message, StreamingMessage, BodyStream
+from haigha2.exceptions import ChannelClosed
+from haigha2.frames.content_frame import ContentFrame
+from haigha2.frames.method_frame import MethodFrame
+from haigha2.reader import Reader
 
 
 class MessageTest(Chai):
@@ -17,6 +22,7 @@ class MessageTest(Chai):
         self.assertEquals(None, m._delivery_info)
         self.assertEquals(None, m.return_info)
         self.assertEquals({}, m._properties)
+        self.assertEquals(None, m.raw_header)
 
     def test_init_with_delivery_and_args(self):
         m = Message('foo', 'delivery', foo='bar')
@@ -99,3 +105,105 @@ class MessageTest(Chai):
     def test_str_with_return_info(self):
         m = Message('foo', return_info='returned', foo='bar')
         str(m)
+
+
+class StreamingMessageTest(Chai):
+
+    def test_init(self):
+        body = BodyStream(mock(), 10)
+        m = StreamingMessage(body, 'delivery', foo='bar')
+        assert_is(body, m.body)
+        assert_equals('delivery', m.delivery_info)
+        assert_equals({'foo': 'bar'}, m.properties)
+        assert_equals(10, len(m))
+
+    def test_init_requires_body_stream(self):
+        assert_raises(TypeError, StreamingMessage, 'foo')
+
+
+class BodyStreamTest(Chai):
+
+    def setUp(self):
+        super(BodyStreamTest, self).setUp()
+        self.ch = mock()
+        self.ch.synchronous = False
+        self.ch.closed = False
+        self.ch.peek_frame = lambda: None
+
+    def test_read_returns_what_has_arrived(self):
+        body = BodyStream(self.ch, 6)
+        assert_equals('', body.read())
+        body._feed('abc')
+        assert_equals(3, body.received)
+        assert_false(body.complete)
+        assert_equals('ab', body.read(2))
+        assert_equals('c', body.read())
+        body._feed('def')
+        assert_true(body.complete)
+        assert_equals('def', body.read(10))
+        assert_equals('', body.read())
+
+    def test_iter_yields_chunks(self):
+        body = BodyStream(self.ch, 6)
+        body._feed('abc')
+        body._feed('def')
+        assert_equals(['abc', 'def'], list(body))
+
+    def test_listener(self):
+        body = BodyStream(self.ch, 6)
+        chunks = []
+        body._feed('abc')
+        body.set_listener(chunks.append)
+        assert_equals(['abc'], chunks)
+
+        body._feed('def')
+        assert_equals(['abc', 'def', None], chunks)
+        assert_equals('', body.read())
+
+    def test_listener_on_complete_body(self):
+        body = BodyStream(self.ch, 0)
+        chunks = []
+        body.set_listener(chunks.append)
+        assert_equals([None], chunks)
+
+    def test_synchronous_read_waits_for_frames(self):
+        self.ch.synchronous = True
+        body = BodyStream(self.ch, 6)
+        expect(self.ch.connection.read_frames).side_effect(
+            lambda: body._feed('abc'))
+        expect(self.ch.connection.read_frames).side_effect(
+            lambda: body._feed('def'))
+
+        assert_equals('abcdef', body.read())
+
+    def test_synchronous_iter_waits_for_frames(self):
+        self.ch.synchronous = True
+        body = BodyStream(self.ch, 6)
+        expect(self.ch.connection.read_frames).side_effect(
+            lambda: body._feed('abc'))
+        expect(self.ch.connection.read_frames).side_effect(
+            lambda: body._feed('def'))
+
+        assert_equals(['abc', 'def'], list(body))
+
+    def test_synchronous_read_takes_buffered_frames(self):
+        self.ch.synchronous = True
+        body = BodyStream(self.ch, 6)
+        frames = [ContentFrame(1, Reader(b'abc')), MethodFrame(1, 60, 60)]
+        self.ch.peek_frame = lambda: frames[0]
+        self.ch.next_frame = lambda: frames.pop(0)
+        self.ch._content_receiver = lambda frame: body._feed(
+            bytes(frame.payload.buffer()))
+        expect(self.ch.connection.read_frames).side_effect(
+            lambda: body._feed(b'def'))
+
+        assert_equals(b'abcdef', body.read())
+        assert_equals(1, len(frames))
+
+    def test_synchronous_read_raises_when_closed(self):
+        self.ch.synchronous = True
+        self.ch.channel_id = 1
+        body = BodyStream(self.ch, 6)
+        self.ch.closed = True
+
+        assert_raises(ChannelClosed, body.read)
@@ -0,0 +1,177 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+import logging
+
+from chai import Chai
+
+from haigha2.metrics import Counter, Gauge, Histogram, Metrics, \
+    ChannelMetrics, Exporter, LoggingExporter
+
+
+class CounterTest(Chai):
+
+    def test_inc(self):
+        c = Counter('foo')
+        c.inc()
+        c.inc(41)
+        assert_equals('foo', c.name)
+        assert_equals(42, c.snapshot())
+
+
+class GaugeTest(Chai):
+
+    def test_snapshot_calls_func(self):
+        values = [3, 4]
+        g = Gauge('foo', values.pop)
+        assert_equals(4, g.snapshot())
+        assert_equals(3, g.snapshot())
+
+
+class HistogramTest(Chai):
+
+    def test_observe(self):
+        h = Histogram('foo', (1, 10))
+        for value in (0.5, 1, 2, 10, 11, 100):
+            h.observe(value)
+
+        assert_equals({
+            'count': 6,
+            'sum': 124.5,
+            'buckets': [(1, 2), (10, 2), (None, 2)],
+        }, h.snapshot())
+
+    def test_default_buckets(self):
+        h = Histogram('foo')
+        h.observe(0.003)
+        assert_equals(1, h.snapshot()['buckets'][5][1])
+        assert_equals(0.005, h.snapshot()['buckets'][5][0])
+
+
+class MetricsTest(Chai):
+
+    def test_init(self):
+        m = Metrics()
+        snapshot = m.snapshot()
+        assert_equals(0, snapshot['connection.bytes_in'])
+        assert_equals(0, snapshot['connection.frames_in.heartbeat'])
+        assert_equals(0, snapshot['connection.frames_out.other'])
+        assert_equals(0, snapshot['channel.sync_latency']['count'])
+
+    def test_frame_counters_by_type(self):
+        m = Metrics()
+        m.frames_in[1].inc()
+        m.frames_in[3].inc(2)
+        m.frames_in[42].inc()
+        m.frames_out[8].inc()
+
+        snapshot = m.snapshot()
+        assert_equals(1, snapshot['connection.frames_in.method'])
+        assert_equals(2, snapshot['connection.frames_in.content'])
+        assert_equals(1, snapshot['connection.frames_in.other'])
+        assert_equals(1, snapshot['connection.frames_out.heartbeat'])
+
+    def test_get_or_create(self):
+        m = Metrics()
+        assert_true(m.counter('foo') is m.counter('foo'))
+        assert_true(m.histogram('bar') is m.histogram('bar', (1, 2)))
+        assert_raises(ValueError, m.histogram, 'foo')
+
+    def test_gauge_replaces_func(self):
+        m = Metrics()
+        m.gauge('depth', lambda: 1)
+        m.gauge('depth', lambda: 2)
+        assert_equals(2, m.snapshot()['depth'])
+
+    def test_channel(self):
+        m = Metrics()
+        ch = m.channel(3)
+        assert_true(isinstance(ch, ChannelMetrics))
+        assert_true(ch is m.channel(3))
+        assert_true(ch.sync_latency is m.sync_latency)
+
+        ch.published.inc()
+        ch.delivered.inc(2)
+        ch.acked.inc(3)
+        snapshot = m.snapshot()
+        assert_equals(1, snapshot['channel.3.published'])
+        assert_equals(2, snapshot['channel.3.delivered'])
+        assert_equals(3, snapshot['channel.3.acked'])
+
+    def test_channel_with_prefix(self):
+        m = Metrics()
+        assert_equals('connection.1.', m.connection_prefix())
+        assert_equals('connection.2.', m.connection_prefix())
+
+        ch = m.channel(3, 'connection.2.')
+        assert_true(ch is m.channel(3, 'connection.2.'))
+        assert_false(ch is m.channel(3))
+        ch.published.inc()
+        assert_equals(1, m.snapshot()['connection.2.channel.3.published'])
+
+    def test_remove_channel(self):
+        m = Metrics()
+        ch = m.channel(3, 'connection.1.')
+        m.channel(4, 'connection.1.')
+        m.channel(3, 'connection.2.')
+        m.remove_channel(3, 'connection.1.')
+        m.remove_channel(3, 'connection.1.')
+
+        snapshot = m.snapshot()
+        assert_false('connection.1.channel.3.published' in snapshot)
+        assert_false('connection.1.channel.3.acked' in snapshot)
+        assert_true('connection.1.channel.4.published' in snapshot)
+        assert_true('connection.2.channel.3.published' in snapshot)
+        assert_false(ch is m.channel(3, 'connection.1.'))
+
+    def test_remove_channels(self):
+        m = Metrics()
+        m.channel(3, 'connection.1.')
+        m.channel(4, 'connection.1.')
+        m.channel(3, 'connection.2.')
+        m.remove_channels('connection.1.')
+
+        assert_equals([('connection.2.', 3)], list(m._channels))
+        assert_equals(['connection.2.channel.3.published'], [
+            name for name in m.snapshot() if name.endswith('.published')])
+
+    def test_remove(self):
+        m = Metrics()
+        m.gauge('depth', lambda: 1)
+        m.remove('depth')
+        m.remove('depth')
+        assert_false('depth' in m.snapshot())
+
+    def test_export(self):
+        exporter = mock()
+        m = Metrics(exporters=[exporter])
+        m.bytes_out.inc(5)
+
+        expect(exporter.export).args(m.snapshot())
+        assert_equals(5, m.export()['connection.bytes_out'])
+
+        m.remove_exporter(exporter)
+        m.export()
+
+    def test_add_exporter(self):
+        m = Metrics()
+        exporter = mock()
+        m.add_exporter(exporter)
+        expect(exporter.export).args(m.snapshot())
+        m.export()
+
+
+class ExporterTest(Chai):
+
+    def test_export_not_implemented(self):
+        assert_raises(NotImplementedError, Exporter().export, {})
+
+    def test_logging_exporter(self):
+        logger = mock()
+        exporter = LoggingExporter(logger, logging.DEBUG)
+        expect(logger.log).args(logging.DEBUG, 'metric %s %s', 'a', 1)
+        expect(logger.log).args(logging.DEBUG, 'metric %s %s', 'b', 2)
+        exporter.export({'b': 2, 'a': 1})
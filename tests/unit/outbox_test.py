@@ -0,0 +1,183 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+import os
+import random
+import shutil
+import tempfile
+
+from chai import Chai
+
+from haigha2.outbox import Outbox, MmapOutbox
+
+
+class OutboxTest(Chai):
+
+    def test_append_and_unsent(self):
+        outbox = Outbox()
+        assert_equals(1, outbox.append(b'one'))
+        assert_equals(2, outbox.append(b'two'))
+        assert_equals(2, len(outbox))
+        assert_equals(6, outbox.size)
+        assert_equals([(1, b'one'), (2, b'two')], list(outbox.unsent()))
+        assert_equals([], list(outbox.unsent()))
+
+        outbox.append(b'three')
+        assert_equals([(3, b'three')], list(outbox.unsent()))
+
+    def test_entry_handed_out_once_next_is_asked_for(self):
+        outbox = Outbox()
+        outbox.append(b'one')
+        outbox.append(b'two')
+        for seq, data in outbox.unsent():
+            break
+        assert_equals([(1, b'one'), (2, b'two')], list(outbox.unsent()))
+
+    def test_remove_and_rewind(self):
+        outbox = Outbox()
+        for data in (b'one', b'two', b'three'):
+            outbox.append(data)
+        list(outbox.unsent())
+
+        assert_true(outbox.remove(2))
+        assert_false(outbox.remove(2))
+        assert_equals(8, outbox.size)
+        outbox.rewind()
+        assert_equals([(1, b'one'), (3, b'three')], list(outbox.unsent()))
+
+    def test_removed_entries_are_skipped(self):
+        outbox = Outbox()
+        outbox.append(b'one')
+        outbox.append(b'two')
+        outbox.remove(1)
+        assert_equals([(2, b'two')], list(outbox.unsent()))
+
+    def test_max_messages(self):
+        outbox = Outbox(max_messages=2)
+        outbox.append(b'one')
+        outbox.append(b'two')
+        assert_raises(Outbox.Full, outbox.append, b'three')
+        outbox.remove(1)
+        assert_equals(3, outbox.append(b'three'))
+
+    def test_max_bytes(self):
+        outbox = Outbox(max_bytes=6)
+        outbox.append(b'one')
+        assert_raises(Outbox.Full, outbox.append, b'seven')
+        assert_raises(Outbox.Full, Outbox(max_bytes=6).append, b'sixsix!')
+        outbox.append(b'two')
+        assert_equals(6, outbox.size)
+
+    def test_drop_oldest(self):
+        outbox = Outbox(max_messages=2, drop_oldest=True)
+        for data in (b'one', b'two', b'three'):
+            outbox.append(data)
+        assert_equals(1, outbox.dropped)
+        assert_equals([(2, b'two'), (3, b'three')], list(outbox.unsent()))
+
+
+class MmapOutboxTest(Chai):
+
+    def setUp(self):
+        super(MmapOutboxTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'outbox')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(MmapOutboxTest, self).tearDown()
+
+    def test_append_and_remove(self):
+        outbox = MmapOutbox(self.path, capacity=1024)
+        assert_equals(1024 + MmapOutbox.HEADER.size,
+                      os.path.getsize(self.path))
+        outbox.append(b'one')
+        outbox.append(b'')
+        assert_equals([(1, b'one'), (2, b'')],
+                      [(seq, bytes(data)) for seq, data in outbox.unsent()])
+        outbox.remove(1)
+        outbox.remove(2)
+        assert_equals(0, len(outbox))
+        assert_equals((0, 0), (outbox._head, outbox._tail))
+        outbox.close()
+
+    def test_reopen_keeps_entries(self):
+        outbox = MmapOutbox(self.path, capacity=1024)
+        for data in (b'one', b'two', b'three'):
+            outbox.append(data)
+        list(outbox.unsent())
+        outbox.remove(2)
+        outbox.flush()
+        outbox.close()
+
+        outbox = MmapOutbox(self.path, capacity=1024)
+        assert_equals(2, len(outbox))
+        assert_equals(8, outbox.size)
+        assert_equals([(1, b'one'), (3, b'three')],
+                      [(seq, bytes(data)) for seq, data in outbox.unsent()])
+        assert_equals(4, outbox.append(b'four'))
+        outbox.close()
+
+    def test_reopen_with_other_capacity_starts_empty(self):
+        outbox = MmapOutbox(self.path, capacity=1024)
+        outbox.append(b'one')
+        outbox.close()
+
+        outbox = MmapOutbox(self.path, capacity=2048)
+        assert_equals(0, len(outbox))
+        assert_equals(1, outbox.append(b'one'))
+        outbox.close()
+
+    def test_full_until_oldest_removed(self):
+        record = MmapOutbox.RECORD.size + 10
+        outbox = MmapOutbox(self.path, capacity=3 * record)
+        for _ in range(3):
+            outbox.append(b'x' * 10)
+        assert_raises(Outbox.Full, outbox.append, b'x' * 10)
+        assert_raises(Outbox.Full, outbox.append, b'x' * 3 * record)
+
+        # Space is reused once the records before it are removed
+        outbox.remove(2)
+        assert_raises(Outbox.Full, outbox.append, b'x' * 10)
+        outbox.remove(1)
+        assert_equals(4, outbox.append(b'y' * 10))
+        assert_true(outbox._wrapped)
+        outbox.close()
+
+    def test_drop_oldest(self):
+        record = MmapOutbox.RECORD.size + 10
+        outbox = MmapOutbox(self.path, capacity=2 * record, drop_oldest=True)
+        for data in (b'a', b'b', b'c'):
+            outbox.append(data * 10)
+        assert_equals(1, outbox.dropped)
+        assert_equals([2, 3], [seq for seq, _data in outbox.unsent()])
+        outbox.close()
+
+    def test_ring_matches_model(self):
+        rand = random.Random(1)
+        outbox = MmapOutbox(self.path, capacity=1000)
+        model = {}
+        for i in range(5000):
+            if rand.random() < 0.55:
+                data = bytes(bytearray(rand.randint(0, 255)
+                                       for _ in range(rand.randint(0, 120))))
+                try:
+                    model[outbox.append(data)] = data
+                except Outbox.Full:
+                    pass
+            elif model:
+                seq = rand.choice(sorted(model)[:5])
+                outbox.remove(seq)
+                del model[seq]
+            if i % 250 == 0:
+                outbox.close()
+                outbox = MmapOutbox(self.path, capacity=1000)
+
+            outbox.rewind()
+            assert_equals(model, dict((seq, bytes(data))
+                                      for seq, data in outbox.unsent()))
+            assert_equals(sum(map(len, model.values())), outbox.size)
+        outbox.close()
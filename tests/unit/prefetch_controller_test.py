@@ -0,0 +1,169 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+from chai import Chai
+
+from haigha2 import prefetch_controller
+from haigha2.classes.basic_class import BasicClass
+from haigha2.prefetch_controller import PrefetchController
+from haigha2.reader import Reader
+
+
+class PrefetchControllerTest(Chai):
+
+    def setUp(self):
+        super(PrefetchControllerTest, self).setUp()
+        self.ch = mock()
+        self.consumer = mock()
+
+    def _msg(self, delivery_tag):
+        msg = mock()
+        msg.delivery_info = {'delivery_tag': delivery_tag}
+        return msg
+
+    def test_init(self):
+        expect(self.ch.basic.qos).args(prefetch_count=10, is_global=True)
+        pc = PrefetchController(self.ch, self.consumer)
+
+        assert_equals(10, pc.prefetch_count)
+        assert_equals(0, pc.in_flight)
+        assert_equals(0, pc.delivered)
+        assert_equals(0, pc.completed)
+        assert_equals(0.0, pc.processing_rate)
+
+    def test_qos_applies_to_the_channel(self):
+        frames = []
+        self.ch.channel_id = 1
+        self.ch.basic = BasicClass(self.ch)
+        expect(self.ch.send_frame).side_effect(frames.append)
+        expect(self.ch.add_synchronous_cb)
+        PrefetchController(self.ch, self.consumer, initial_prefetch=7)
+
+        frame, = frames
+        assert_equals((60, 10), (frame.class_id, frame.method_id))
+        args = Reader(frame.args.buffer())
+        assert_equals(0, args.read_long())
+        assert_equals(7, args.read_short())
+        # global, so that RabbitMQ applies it to running consumers
+        assert_true(args.read_bit())
+
+    def test_init_validates_bounds(self):
+        assert_raises(ValueError, PrefetchController, self.ch, self.consumer,
+                      initial_prefetch=0)
+        assert_raises(ValueError, PrefetchController, self.ch, self.consumer,
+                      initial_prefetch=5, max_prefetch=4)
+        assert_raises(ValueError, PrefetchController, self.ch, self.consumer,
+                      decrease=1.5)
+
+    def test_call_tracks_delivery_and_acks_explicitly(self):
+        expect(self.ch.basic.qos).any_args().at_least(0)
+        pc = PrefetchController(self.ch, self.consumer, initial_prefetch=5)
+        msg = self._msg(7)
+
+        expect(self.consumer).args(msg)
+        pc(msg)
+        assert_equals(1, pc.in_flight)
+        assert_equals(1, pc.delivered)
+
+        expect(self.ch.basic.ack).args(7, multiple=False)
+        pc.ack(7)
+        assert_equals(0, pc.in_flight)
+        assert_equals(1, pc.completed)
+
+    def test_call_with_auto_ack(self):
+        expect(self.ch.basic.qos).any_args().at_least(0)
+        pc = PrefetchController(self.ch, self.consumer, initial_prefetch=5,
+                                auto_ack=True)
+        msg = self._msg(3)
+
+        expect(self.consumer).args(msg)
+        expect(self.ch.basic.ack).args(3, multiple=False)
+        pc(msg)
+        assert_equals(0, pc.in_flight)
+
+    def test_call_with_auto_ack_skips_rejected_delivery(self):
+        expect(self.ch.basic.qos).any_args().at_least(0)
+        pc = PrefetchController(self.ch, self.consumer, initial_prefetch=5,
+                                auto_ack=True)
+        msg = self._msg(3)
+
+        expect(self.consumer).args(msg).side_effect(lambda m: pc.reject(3))
+        expect(self.ch.basic.reject).args(3, requeue=False)
+        pc(msg)
+        assert_equals(0, pc.in_flight)
+        assert_equals(1, pc.completed)
+
+    def test_ack_multiple(self):
+        expect(self.ch.basic.qos).any_args().at_least(0)
+        pc = PrefetchController(self.ch, self.consumer, initial_prefetch=5)
+        expect(self.consumer).any_args().at_least(0)
+        for tag in (1, 2, 3):
+            pc(self._msg(tag))
+
+        expect(self.ch.basic.ack).args(2, multiple=True)
+        pc.ack(2, multiple=True)
+        assert_equals(1, pc.in_flight)
+        assert_equals(2, pc.completed)
+
+    def test_ack_of_unknown_tag_is_not_counted(self):
+        expect(self.ch.basic.qos).any_args().at_least(0)
+        pc = PrefetchController(self.ch, self.consumer)
+
+        expect(self.ch.basic.ack).args(99, multiple=False)
+        pc.ack(99)
+        assert_equals(0, pc.completed)
+
+    def test_increases_prefetch_when_under_target(self):
+        expect(self.ch.basic.qos).args(prefetch_count=2, is_global=True)
+        pc = PrefetchController(self.ch, self.consumer, initial_prefetch=2,
+                                target_latency=10, increase=3,
+                                is_global=True, auto_ack=True)
+        expect(self.consumer).any_args().at_least(0)
+        expect(self.ch.basic.ack).any_args().at_least(0)
+
+        pc(self._msg(1))
+        expect(self.ch.basic.qos).args(prefetch_count=5, is_global=True)
+        pc(self._msg(2))
+
+        assert_equals(5, pc.prefetch_count)
+        assert_true(pc.processing_rate > 0)
+
+    def test_decreases_prefetch_when_over_target(self):
+        expect(self.ch.basic.qos).args(prefetch_count=8, is_global=True)
+        pc = PrefetchController(self.ch, self.consumer, initial_prefetch=8,
+                                min_prefetch=3, target_latency=1)
+        expect(self.consumer).any_args().at_least(0)
+        expect(self.ch.basic.ack).any_args().at_least(0)
+
+        now = prefetch_controller.time.time()
+        for tag in range(1, 9):
+            pc(self._msg(tag))
+            pc._in_flight[tag] = now - 2
+
+        expect(self.ch.basic.qos).args(prefetch_count=4, is_global=True)
+        pc.ack(8, multiple=True)
+        assert_equals(4, pc.prefetch_count)
+        assert_true(pc.avg_latency >= 2)
+
+        for tag in range(9, 13):
+            pc(self._msg(tag))
+            pc._in_flight[tag] = now - 2
+
+        # Clamped to min_prefetch
+        expect(self.ch.basic.qos).args(prefetch_count=3, is_global=True)
+        pc.ack(12, multiple=True)
+        assert_equals(3, pc.prefetch_count)
+
+    def test_does_not_reissue_qos_at_max(self):
+        expect(self.ch.basic.qos).args(prefetch_count=1, is_global=True)
+        pc = PrefetchController(self.ch, self.consumer, initial_prefetch=1,
+                                max_prefetch=1, auto_ack=True)
+        expect(self.consumer).any_args().at_least(0)
+        expect(self.ch.basic.ack).any_args().at_least(0)
+
+        pc(self._msg(1))
+        pc(self._msg(2))
+        assert_equals(1, pc.prefetch_count)
@@ -0,0 +1,117 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+import logging
+
+from chai import Chai
+
+from haigha2 import profiling
+from haigha2.profiling import *
+
+
+class StageProfilerTest(Chai):
+
+    def setUp(self):
+        super(StageProfilerTest, self).setUp()
+        # Wall and CPU clocks that advance by 1 and 0.5 on each reading
+        self.now = [0.0, 0.0]
+
+        def wall():
+            self.now[0] += 1.0
+            return self.now[0]
+
+        def cpu():
+            self.now[1] += 0.5
+            return self.now[1]
+
+        self.mock(profiling, 'default_timer')
+        self.mock(profiling, 'cpu_timer')
+        expect(profiling.default_timer).at_least(0).side_effect(wall)
+        expect(profiling.cpu_timer).at_least(0).side_effect(cpu)
+
+    def stage(self, snapshot, name):
+        stage = snapshot['stages'][name]
+        return stage['calls'], stage['wall'], stage['cpu']
+
+    def test_init(self):
+        profiler = StageProfiler()
+        assert_equals(0.01, profiler.sample_rate)
+        assert_false(profiler.sampling)
+        snapshot = profiler.snapshot()
+        assert_equals(0, snapshot['operations'])
+        assert_equals(0, snapshot['samples'])
+        assert_equals(set(STAGES), set(snapshot['stages']))
+
+    def test_begin_samples_at_rate(self):
+        profiler = StageProfiler(sample_rate=0.5)
+        profiler._random = mock()
+        expect(profiler._random).returns(0.7)
+        expect(profiler._random).returns(0.2)
+
+        assert_false(profiler.begin())
+        assert_false(profiler.sampling)
+        assert_true(profiler.begin())
+        assert_true(profiler.sampling)
+        profiler.end()
+        assert_false(profiler.sampling)
+        assert_equals(2, profiler.snapshot()['operations'])
+        assert_equals(1, profiler.snapshot()['samples'])
+
+    def test_stages_are_not_timed_unless_sampling(self):
+        profiler = StageProfiler(sample_rate=0)
+        assert_false(profiler.begin())
+        profiler.enter(DECODE)
+        profiler.exit()
+        assert_equals((0, 0.0, 0.0),
+                      self.stage(profiler.snapshot(), 'decode'))
+
+    def test_nested_stages_are_timed_apart(self):
+        profiler = StageProfiler(sample_rate=1)
+        assert_true(profiler.begin())
+        profiler.enter(DISPATCH)
+        profiler.enter(CALLBACK)
+        # A write from the callback, which ends its stage
+        assert_true(profiler.begin())
+        profiler.enter(WRITE)
+        profiler.end()
+        profiler.exit()
+        # Ends the dispatch stage
+        profiler.end()
+
+        snapshot = profiler.snapshot()
+        assert_equals(1, snapshot['samples'])
+        assert_equals((1, 2.0, 1.0), self.stage(snapshot, 'dispatch'))
+        assert_equals((1, 2.0, 1.0), self.stage(snapshot, 'callback'))
+        assert_equals((1, 1.0, 0.5), self.stage(snapshot, 'write'))
+        assert_false(profiler.sampling)
+
+    def test_reset(self):
+        profiler = StageProfiler(sample_rate=1)
+        profiler.begin()
+        profiler.enter(DECODE)
+        profiler.end()
+        profiler.reset()
+        snapshot = profiler.snapshot()
+        assert_equals(0, snapshot['samples'])
+        assert_equals((0, 0.0, 0.0), self.stage(snapshot, 'decode'))
+
+    def test_end_logs_summary_every_interval(self):
+        logger = mock()
+        profiler = StageProfiler(sample_rate=1, interval=5, logger=logger)
+        profiler.begin()
+        profiler.enter(DECODE)
+        profiler.end()
+
+        expect(logger.log).args(
+            logging.INFO, 'profile %d of %d operations: %s', 2, 2,
+            'decode 50.0% 500.000/250.000ms, '
+            'dispatch 0.0% 0.000/0.000ms, '
+            'reassembly 0.0% 0.000/0.000ms, '
+            'callback 50.0% 500.000/250.000ms, '
+            'write 0.0% 0.000/0.000ms')
+        profiler.begin()
+        profiler.enter(CALLBACK)
+        profiler.end()
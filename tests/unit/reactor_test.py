@@ -0,0 +1,153 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+from chai import Chai
+
+from haigha2 import reactor
+from haigha2.connections.rabbit_connection import RabbitConnection
+from tests.fake_broker import FakeBroker
+from haigha2.reactor import Reactor
+from haigha2.transports.selector_transport import EVENT_READ, EVENT_WRITE
+
+
+class ReactorTest(Chai):
+
+    def setUp(self):
+        super(ReactorTest, self).setUp()
+        self.selector = mock()
+        self.logger = mock()
+        self.reactor = Reactor(selector=self.selector, logger=self.logger)
+        self.now = 1000.0
+        self.mock(reactor, 'time')
+        expect(reactor.time.time).any_args().at_least(0).side_effect(
+            lambda: self.now)
+
+    def test_init(self):
+        assert_equals(self.selector, self.reactor.selector)
+        assert_false(self.reactor.running)
+        assert_equals([], self.reactor.transports)
+
+    def test_timers_run_in_order_when_due(self):
+        calls = []
+        self.reactor.call_later(2, calls.append, 'b')
+        self.reactor.call_later(1, calls.append, 'a')
+        timer = self.reactor.call_later(1.5, calls.append, 'cancelled')
+        timer.cancel()
+
+        self.now += 1
+        self.reactor._run_timers()
+        assert_equals(['a'], calls)
+        self.now += 1
+        self.reactor._run_timers()
+        assert_equals(['a', 'b'], calls)
+        assert_equals([], self.reactor._timers)
+
+    def test_call_every_reschedules(self):
+        calls = []
+        self.reactor.call_every(1, calls.append, 'tick')
+        self.now += 1
+        self.reactor._run_timers()
+        self.now += 5
+        self.reactor._run_timers()
+        assert_equals(['tick', 'tick'], calls)
+        # Missed intervals are skipped rather than run to catch up
+        assert_equals(1007.0, self.reactor._timers[0][0])
+
+    def test_timer_errors_are_logged(self):
+        def fail():
+            raise ValueError('oops')
+        self.reactor.call_later(0, fail)
+        expect(self.logger.exception).any_args()
+        self.reactor._run_timers()
+
+    def test_next_timeout_skips_cancelled_timers(self):
+        assert_equals(None, self.reactor._next_timeout())
+        self.reactor.call_later(1, lambda: None).cancel()
+        self.reactor.call_later(3, lambda: None)
+        assert_equals(3, self.reactor._next_timeout())
+
+    def test_run_once_waits_until_next_timer(self):
+        transport = mock()
+        key = mock()
+        key.data = transport
+        self.reactor.call_later(2, lambda: None)
+        expect(self.selector.select).args(2).returns(
+            [(key, EVENT_READ | EVENT_WRITE)])
+        expect(transport.handle_write)
+        expect(transport.handle_read)
+        assert_equals(1, self.reactor.run_once(5))
+
+    def test_run_once_logs_connection_errors(self):
+        transport = mock()
+        transport.connection = mock()
+        transport.connection._host = 'server'
+        key = mock()
+        key.data = transport
+        expect(self.selector.select).args(None).returns([(key, EVENT_READ)])
+        expect(transport.handle_read).raises(IOError('reset'))
+        expect(self.logger.exception).any_args()
+        assert_equals(1, self.reactor.run_once())
+
+    def test_run_until_stopped(self):
+        expect(self.selector.get_map).returns({1: 'key'}).at_least(1)
+        expect(self.selector.select).args(None).returns([]).side_effect(
+            lambda timeout: self.reactor.stop())
+        self.reactor.run()
+        assert_false(self.reactor.running)
+
+    def test_run_until_nothing_left(self):
+        calls = []
+        self.reactor.call_later(0, calls.append, 'a')
+        expect(self.selector.get_map).returns({}).at_least(1)
+        expect(self.selector.select).args(0).returns([])
+        self.reactor.run()
+        assert_equals(['a'], calls)
+
+    def test_add_and_remove_transport(self):
+        transport = mock()
+        self.reactor.add_transport(transport)
+        assert_equals([transport], self.reactor.transports)
+        self.reactor.remove_transport(transport)
+        assert_equals([], self.reactor.transports)
+        self.reactor.remove_transport(transport)
+
+
+class ReactorBrokerTest(Chai):
+
+    '''
+    Runs several connections on one reactor against the fake broker.
+    '''
+
+    def test_run_connections(self):
+        reactor = Reactor()
+        received = []
+        connections = []
+
+        def consumer(msg):
+            received.append(msg)
+            if len(received) == 30:
+                timeout.cancel()
+                for connection in connections:
+                    connection.close()
+
+        with FakeBroker() as broker:
+            host, port = broker.address
+            for i in range(3):
+                broker.preload('q%d' % (i), b'body', 10)
+                connection = RabbitConnection(
+                    host=host, port=port, transport='selector',
+                    reactor=reactor, heartbeat=60)
+                connection.channel().basic.consume('q%d' % (i), consumer)
+                connections.append(connection)
+            assert_equals(3, len(reactor.transports))
+
+            timeout = reactor.call_later(10, reactor.stop)
+            reactor.run()
+
+        assert_equals(30, len(received))
+        assert_true(all(c.closed for c in connections))
+        assert_equals([], reactor.transports)
+        assert_equals({}, dict(reactor.selector.get_map()))
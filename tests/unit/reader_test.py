@@ -9,10 +9,13 @@ from datetime import datetime
 from io import BytesIO
 from decimal import Decimal
 
-from haigha2.reader import Reader
+from haigha2.reader import Reader, LazyTable, ArgumentSchema
+from haigha2.writer import Writer
 import struct
 import operator
 
+from tests.unit import pure_python
+
 
 class ReaderTest(Chai):
 
@@ -96,6 +99,16 @@ class ReaderTest(Chai):
         r = Reader('hello world', 3, 5)
         self.assert_equals(buffer('lo wo'), r.buffer())
 
+    def test_init_with_memoryview(self):
+        r = Reader(memoryview(bytearray('hello')))
+        assert_equals('hello', r.read(5))
+
+    def test_buffer_does_not_copy(self):
+        data = bytearray('hello world')
+        r = Reader(data, 3, 5)
+        data[4] = 'X'
+        assert_equals('lX wo', str(r.buffer()))
+
     def test_read(self):
         b = Reader('foo')
         assert_equals('foo', b.read(3))
@@ -161,6 +174,43 @@ class ReaderTest(Chai):
         assert_equals(18374966859414961920L, b.read_longlong())
         assert_raises(Reader.BufferUnderflow, b.read_longlong)
 
+    def test_read_struct(self):
+        b = Reader('\x00\x0a\x00\x32\x01')
+        assert_equals((10, 50), b.read_struct('>HH'))
+        assert_equals(4, b.tell())
+        assert_true('>HH' in Reader._structs)
+        assert_raises(Reader.BufferUnderflow, b.read_struct, '>HH')
+        assert_equals(4, b.tell())
+        assert_equals((1,), b.read_struct('B'))
+
+    def test_read_args(self):
+        w = Writer()
+        w.write_shortstr('ctag').write_longlong(2 ** 40).write_bits(True)
+        w.write_shortstr('exchange').write_long(7).write_bits(False, True, True)
+        w.write_timestamp(datetime(2011, 1, 17, 22, 36, 33))
+        w.write_table({'foo': 'bar'}).write_octet(3)
+        schema = ArgumentSchema(
+            'shortstr', 'longlong', 'bit', 'shortstr', 'long', 'bit', 'bit',
+            'bit', 'timestamp', 'table', 'octet')
+
+        b = Reader(w.buffer())
+        assert_equals(
+            ('ctag', 2 ** 40, 1, 'exchange', 7, 0, 1, 1,
+             datetime(2011, 1, 17, 22, 36, 33), {'foo': 'bar'}, 3),
+            b.read_args(schema))
+        assert_equals(len(w.buffer()), b.tell())
+
+    def test_read_args_raises_bufferunderflow(self):
+        schema = ArgumentSchema('short', 'long')
+        b = Reader('\x00\x01\x00\x00\x00')
+        assert_raises(Reader.BufferUnderflow, b.read_args, schema)
+        assert_equals(0, b.tell())
+
+        schema = ArgumentSchema('shortstr')
+        assert_raises(Reader.BufferUnderflow, Reader('').read_args, schema)
+        assert_raises(Reader.BufferUnderflow, Reader('\x05abc').read_args,
+                      schema)
+
     def test_read_shortstr(self):
         b = Reader('\x05hello')
         assert_equals('hello', b.read_shortstr())
@@ -185,6 +235,7 @@ class ReaderTest(Chai):
 
         assert_equals(d, b.read_timestamp())
 
+    @pure_python
     def test_read_table(self):
         # mock everything to keep this simple
         r = Reader('')
@@ -204,7 +255,10 @@ class ReaderTest(Chai):
         r.field_type_map['Z'] = mock()
         expect(r.field_type_map['Z']).args(r)
 
-        r._read_field()
+        try:
+            r._read_field()
+        finally:
+            del r.field_type_map['Z']
 
     def test_read_field_raises_fielderror_on_unknown_type(self):
         r = Reader('X')
@@ -358,3 +412,107 @@ class ReaderTest(Chai):
     #      'T' : Reader._field_timestamp.im_func,
     #      'F' : Reader.read_table.im_func,
     #    }, Reader.field_type_map )
+
+
+class ArgumentSchemaTest(Chai):
+
+    def test_compiles_fixed_runs(self):
+        schema = ArgumentSchema('short', 'shortstr', 'short', 'short')
+        assert_equals(3, len(schema._steps))
+        assert_equals(2, schema._steps[0][0])
+        assert_equals((None, None, None), schema._steps[1])
+        assert_equals(4, schema._steps[2][0])
+
+        schema = ArgumentSchema('longstr', 'table')
+        assert_equals([(None, None, Reader.read_longstr),
+                       (None, None, Reader.read_table)], schema._steps)
+
+    def test_packs_consecutive_bits(self):
+        schema = ArgumentSchema('longlong', *(['bit'] * 9))
+        assert_equals(1, len(schema._steps))
+        assert_equals(10, schema._steps[0][0])
+
+        b = Reader('\x00' * 8 + '\xff\x01')
+        assert_equals((0,) + (1,) * 9, b.read_args(schema))
+
+    def test_unknown_type(self):
+        assert_raises(ValueError, ArgumentSchema, 'short', 'float')
+
+    def test_repr(self):
+        assert_equals("ArgumentSchema('short', 'bit')",
+                      repr(ArgumentSchema('short', 'bit')))
+
+
+class LazyTableTest(Chai):
+
+    TABLE = {
+        'str': 'foo',
+        'int': 42,
+        'long': 2 ** 40,
+        'float': 3.5,
+        'decimal': Decimal('1.50'),
+        'timestamp': datetime(2011, 1, 17, 22, 36, 33),
+        'none': None,
+        'bool': True,
+        'bytes': bytearray('bar'),
+        'table': {'inner': {'deep': 'value'}},
+    }
+
+    def _encode(self, d):
+        return str(Writer().write_table(d).buffer())
+
+    def test_read_lazy_table(self):
+        encoded = self._encode(self.TABLE)
+        r = Reader('xx' + encoded + 'yy')
+        r.read(2)
+        t = r.read_lazy_table()
+        assert_true(isinstance(t, LazyTable))
+        assert_equals(2 + len(encoded), r.tell())
+        assert_equals(None, t._offsets)
+        assert_equals('yy', r.read(2))
+
+    def test_read_lazy_table_raises_on_underflow(self):
+        encoded = self._encode(self.TABLE)
+        assert_raises(Reader.BufferUnderflow,
+                      Reader(encoded[:-1]).read_lazy_table)
+
+    def test_decodes_values_on_demand(self):
+        t = Reader(self._encode(self.TABLE)).read_lazy_table()
+        assert_equals('foo', t['str'])
+        assert_equals(1, len(t._values))
+        assert_equals(len(self.TABLE), len(t))
+        assert_equals(sorted(self.TABLE), sorted(t))
+        assert_raises(KeyError, t.__getitem__, 'missing')
+        assert_equals(None, t.get('missing'))
+
+        expect(Reader._read_field).times(0)
+        assert_equals('foo', t['str'])
+
+    def test_equals_eager_table(self):
+        encoded = self._encode(self.TABLE)
+        assert_equals(Reader(encoded).read_table(),
+                      Reader(encoded).read_lazy_table())
+
+    def test_nested_tables_are_lazy(self):
+        t = Reader(self._encode(self.TABLE)).read_lazy_table()
+        inner = t['table']['inner']
+        assert_true(isinstance(inner, LazyTable))
+        assert_equals({'deep': 'value'}, inner)
+
+    def test_encoded_table(self):
+        encoded = self._encode(self.TABLE)
+        t = Reader(encoded).read_lazy_table()
+        assert_equals(encoded, t.encoded_table())
+
+        w = Writer()
+        w.write_table(t)
+        assert_equals(encoded, w.buffer())
+
+        # Written as a nested table too
+        w = Writer()
+        w.write_table({'fwd': t})
+        assert_equals(self._encode({'fwd': self.TABLE}), w.buffer())
+
+    def test_unknown_field_type(self):
+        t = Reader('\x00\x00\x00\x03\x01aZ').read_lazy_table()
+        assert_raises(Reader.FieldError, len, t)
@@ -0,0 +1,239 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+from chai import Chai
+import struct
+import unittest
+from datetime import datetime
+from decimal import Decimal
+
+from haigha2 import speedups
+from haigha2.reader import Reader
+from haigha2.writer import Writer
+from haigha2.frames.frame import Frame
+from haigha2.frames.header_frame import HeaderFrame
+
+from tests.unit import reader_test, writer_test
+from tests.unit.frames import frame_test, header_frame_test
+
+
+# The codec tests run with the compiled codec where it's available, so run
+# them again with the pure-Python one.
+def _pure_python_test(base):
+    def setUp(self):
+        base.setUp(self)
+        self._codec = speedups.codec
+        speedups.codec = None
+
+    def tearDown(self):
+        speedups.codec = self._codec
+        base.tearDown(self)
+
+    name = 'PurePython' + base.__name__
+    return type(name, (base,), {'setUp': setUp, 'tearDown': tearDown})
+
+for _base in (reader_test.ReaderTest, reader_test.LazyTableTest,
+              writer_test.WriterTest, writer_test.FrozenTableTest,
+              frame_test.FrameTest, header_frame_test.HeaderFrameTest):
+    _test = _pure_python_test(_base)
+    globals()[_test.__name__] = _test
+del _base, _test
+
+
+class SpeedupsTest(Chai):
+
+    def setUp(self):
+        super(SpeedupsTest, self).setUp()
+        self._codecs = speedups.codec, speedups._codec
+
+    def tearDown(self):
+        speedups.codec, speedups._codec = self._codecs
+        super(SpeedupsTest, self).tearDown()
+
+    def test_enable_false(self):
+        speedups.enable(False)
+        assert_false(speedups.enabled())
+        assert_equals(None, speedups.codec)
+
+    def test_enable_when_unavailable(self):
+        speedups._codec = None
+        assert_false(speedups.available())
+        assert_raises(ImportError, speedups.enable)
+
+    def test_enable(self):
+        if not speedups.available():
+            raise unittest.SkipTest('haigha2._codec is not available')
+        speedups.enable(False)
+        speedups.enable()
+        assert_true(speedups.enabled())
+
+
+TABLE = {
+    'bool': True,
+    'short': -5,
+    'int': 2 ** 20,
+    'long': -2 ** 40,
+    'float': 2.5,
+    'decimal': Decimal('-3.14'),
+    'str': b'hello',
+    'unicode': u'caf\xe9',
+    'timestamp': datetime(2017, 4, 20, 12, 0, 0),
+    'table': {'a': {'b': None}, 'c': bytearray(b'\x00\xff')},
+    'array': [1, u'x'],
+}
+
+
+class CodecParityTest(Chai):
+
+    '''
+    Compares the compiled codec to the pure-Python one.
+    '''
+
+    def setUp(self):
+        super(CodecParityTest, self).setUp()
+        if not speedups.available():
+            raise unittest.SkipTest('haigha2._codec is not available')
+        self._codec = speedups.codec
+
+    def tearDown(self):
+        speedups.codec = self._codec
+        super(CodecParityTest, self).tearDown()
+
+    def both(self, func):
+        '''
+        Call func with the pure-Python codec and the compiled codec, and
+        return both results, or the types of the exceptions raised. Messages
+        of errors raised by struct and such are worded differently.
+        '''
+        results = []
+        for codec in (None, speedups._codec):
+            speedups.codec = codec
+            try:
+                results.append(func())
+            except Exception as e:
+                results.append(type(e))
+        return results
+
+    def assert_same(self, func):
+        pure, compiled = self.both(func)
+        assert_equals(pure, compiled)
+        assert_equals(type(pure), type(compiled))
+        return compiled
+
+    def test_write_table(self):
+        pure, compiled = self.both(
+            lambda: bytes(Writer().write_table(TABLE).buffer()))
+        # Dict ordering is the same, as both iterate over the same dict
+        assert_equals(pure, compiled)
+
+    def test_read_table(self):
+        encoded = bytes(Writer().write_table(TABLE).buffer())
+        table = self.assert_same(lambda: Reader(encoded).read_table())
+        for key, value in table.items():
+            assert_equals(type(value), type(self.both(
+                lambda: Reader(encoded).read_table()[key])[0]))
+
+    def test_read_table_field_types(self):
+        # Types the writer doesn't produce
+        fields = b'\x01bb\xfe' + b'\x01ff' + struct.pack('>f', 1.5) + \
+            b'\x01tt\x02'
+        encoded = struct.pack('>I', len(fields)) + fields
+        assert_equals({'b': -2, 'f': 1.5, 't': 0},
+                      self.assert_same(lambda: Reader(encoded).read_table()))
+
+    def test_read_table_errors(self):
+        for encoded in (
+                b'\x00\x00\x00',
+                b'\x00\x00\x00\x05\x01a',
+                b'\x00\x00\x00\x03\x01aZ',
+                b'\x00\x00\x00\x06\x01aI\x00\x00',
+                b'\x00\x00\x00\x02\x05a'):
+            self.assert_same(lambda: Reader(encoded).read_table())
+
+    def test_read_table_unknown_field_type(self):
+        def read():
+            try:
+                Reader(b'\x00\x00\x00\x03\x01aZ').read_table()
+            except Reader.FieldError as e:
+                return e.args
+        assert_equals(('Unknown field type %s', 'Z'), self.assert_same(read))
+
+    def test_read_table_position(self):
+        encoded = b'xx' + bytes(Writer().write_table(TABLE).buffer()) + b'yy'
+
+        def read():
+            reader = Reader(encoded)
+            reader.seek(2)
+            reader.read_table()
+            return reader.tell()
+        assert_equals(len(encoded) - 2, self.assert_same(read))
+
+    def test_write_table_errors(self):
+        self.assert_same(lambda: Writer().write_table({'a' * 256: 1}))
+        self.assert_same(lambda: bytes(Writer().write_table(
+            {'big': 2 ** 64}).buffer()))
+
+    def test_write_table_subclasses_use_fallback(self):
+        class Text(type(u'')):
+            pass
+        self.assert_same(lambda: bytes(Writer().write_table(
+            {'text': Text(u'abc'), 'set': set()}).buffer()))
+
+    def test_write_table_recursion(self):
+        table = {}
+        table['self'] = table
+        error = self.assert_same(lambda: Writer().write_table(table))
+        assert_true(issubclass(error, RuntimeError))
+
+    def test_read_table_recursion(self):
+        # {'a': {'a': ...}} nested 100000 deep, each level 7 bytes longer
+        depth = 100000
+        encoded = b''.join(
+            struct.pack('>I', 7 * level) + b'\x01aF'
+            for level in range(depth, 0, -1)) + b'\x00\x00\x00\x00'
+        error = self.assert_same(lambda: Reader(encoded).read_table())
+        assert_true(issubclass(error, RuntimeError))
+
+    def test_header_frame(self):
+        properties = {
+            'content_type': 'text/plain',
+            'delivery_mode': 2,
+            'priority': 300,
+            'application_headers': TABLE,
+            'timestamp': datetime(2017, 4, 20, 12, 0, 0),
+            'message_id': u'caf\xe9',
+        }
+
+        def write(properties):
+            buf = bytearray()
+            HeaderFrame(1, 60, 0, 100, properties).write_frame(buf)
+            return bytes(buf)
+        self.assert_same(lambda: write(properties))
+
+        del properties['priority']
+        encoded = self.assert_same(lambda: write(properties))
+
+        def read(encoded):
+            frame = Frame.read_frames(Reader(encoded))[0]
+            return (frame.channel_id, frame.size, frame.properties)
+        self.assert_same(lambda: read(encoded))
+        self.assert_same(lambda: read(encoded[:-1]))
+        self.assert_same(lambda: read(encoded[:-1] + b'\x00'))
+        self.assert_same(lambda: read(encoded[:-20]))
+
+    def test_scan_frames(self):
+        buf = bytearray()
+        for channel_id in range(1, 50):
+            HeaderFrame(channel_id, 60, 0, 100, {}).write_frame(buf)
+
+        def scan(data):
+            reader = Reader(data)
+            return Frame.scan_frames(reader).entries(), reader.tell()
+        for cut in (len(buf), len(buf) - 1, 100, 7, 0):
+            self.assert_same(lambda: scan(buf[:cut]))
+
+        buf[len(buf) // 2] = 0xff
+        self.assert_same(lambda: scan(buf))
@@ -0,0 +1,102 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+from chai import Chai
+
+from haigha2 import timer_wheel
+from haigha2.timer_wheel import TimerWheel
+
+
+class TimerWheelTest(Chai):
+
+    def setUp(self):
+        super(TimerWheelTest, self).setUp()
+        self.now = 1000.0
+        self.mock(timer_wheel, 'time')
+        expect(timer_wheel.time.time).any_args().at_least(0).side_effect(
+            lambda: self.now)
+        self.logger = mock()
+        self.wheel = TimerWheel(resolution=0.5, slots=8, logger=self.logger)
+
+    def test_init(self):
+        assert_equals(0.5, self.wheel.resolution)
+        assert_equals(0, len(self.wheel))
+        assert_equals(None, self.wheel.timeout())
+        assert_equals(0, self.wheel.advance())
+
+    def test_timers_run_in_order_when_due(self):
+        calls = []
+        self.wheel.schedule(2, calls.append, 'b')
+        self.wheel.schedule(1, calls.append, 'a')
+        self.wheel.schedule(1.5, calls.append, 'cancelled').cancel()
+        assert_equals(3, len(self.wheel))
+        assert_equals(1, self.wheel.timeout())
+
+        self.now += 0.9
+        assert_equals(0, self.wheel.advance())
+        self.now += 0.1
+        assert_equals(1, self.wheel.advance())
+        assert_equals(['a'], calls)
+
+        self.now += 1
+        assert_equals(1, self.wheel.advance())
+        assert_equals(['a', 'b'], calls)
+        assert_equals(0, len(self.wheel))
+        assert_equals(None, self.wheel.timeout())
+
+    def test_delays_are_rounded_up(self):
+        calls = []
+        self.wheel.schedule(0.2, calls.append, 'a')
+        self.now += 0.2
+        assert_equals(0, self.wheel.advance())
+        self.now += 0.3
+        assert_equals(1, self.wheel.advance())
+
+    def test_delays_longer_than_the_wheel(self):
+        calls = []
+        # 8 slots of 0.5 seconds go around in 4 seconds
+        self.wheel.schedule(10, calls.append, 'late')
+        self.wheel.schedule(1, calls.append, 'early')
+        self.now += 4
+        self.wheel.advance()
+        assert_equals(['early'], calls)
+        assert_equals(6, self.wheel.timeout())
+
+        self.now += 5
+        self.wheel.advance()
+        assert_equals(['early'], calls)
+        self.now += 1
+        self.wheel.advance()
+        assert_equals(['early', 'late'], calls)
+
+    def test_advance_far_ahead(self):
+        calls = []
+        for delay in (1, 3, 30):
+            self.wheel.schedule(delay, calls.append, delay)
+        self.now += 100
+        assert_equals(3, self.wheel.advance())
+        assert_equals([1, 3, 30], calls)
+
+    def test_timers_scheduled_by_timers(self):
+        calls = []
+
+        def reschedule():
+            calls.append(self.now)
+            self.wheel.schedule(1, reschedule)
+        self.wheel.schedule(1, reschedule)
+        for _ in range(3):
+            self.now += 1
+            self.wheel.advance()
+        assert_equals([1001.0, 1002.0, 1003.0], calls)
+        assert_equals(1, len(self.wheel))
+
+    def test_timer_errors_are_logged(self):
+        def fail():
+            raise ValueError('oops')
+        self.wheel.schedule(0, fail)
+        expect(self.logger.exception).any_args()
+        self.now += 0.5
+        assert_equals(1, self.wheel.advance())
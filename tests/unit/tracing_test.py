@@ -0,0 +1,64 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+import logging
+
+from chai import Chai
+
+from haigha2 import tracing
+from haigha2.tracing import Span, Tracer, LoggingTracer, method_name
+
+
+class MethodNameTest(Chai):
+
+    def test_known_method(self):
+        assert_equals('queue.declare', method_name(50, 10))
+        assert_equals('confirm.select', method_name(85, 10))
+
+    def test_unknown_method(self):
+        assert_equals('99.1', method_name(99, 1))
+
+
+class SpanTest(Chai):
+
+    def test_init(self):
+        expect(tracing.time.time).returns(5.0)
+        span = Span('sync', 1, 90, 20, bytes_out=3)
+        assert_equals('tx.commit', span.name)
+        assert_equals(1, span.channel_id)
+        assert_equals(5.0, span.start)
+        assert_equals(None, span.end)
+        assert_equals(None, span.duration)
+        assert_equals(3, span.bytes_out)
+        assert_equals(0, span.bytes_in)
+        assert_equals(None, span.error)
+
+    def test_duration(self):
+        span = Span('publish', 1, 60, 40)
+        span.start = 5.0
+        span.end = 5.5
+        assert_equals(0.5, span.duration)
+
+
+class TracerTest(Chai):
+
+    def test_hooks_do_nothing(self):
+        tracer = Tracer()
+        span = Span('sync', 1, 50, 10)
+        tracer.start(span)
+        tracer.end(span)
+
+
+class LoggingTracerTest(Chai):
+
+    def test_end_logs_span(self):
+        logger = mock()
+        span = Span('sync', 1, 50, 10)
+        expect(logger.log).args(logging.INFO, 'trace %s', span)
+
+        tracer = LoggingTracer(logger, logging.INFO)
+        tracer.start(span)
+        tracer.end(span)
@@ -0,0 +1,80 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+from io import BytesIO
+
+from chai import Chai
+
+from haigha2.capture import CaptureReader, CaptureWriter, INBOUND, OUTBOUND
+from haigha2.transports.capture_transport import *
+
+
+class CaptureTransportTest(Chai):
+
+    def setUp(self):
+        super(CaptureTransportTest, self).setUp()
+
+        self.connection = mock()
+        self.connection.transport = 'transport'
+        self.inner = mock()
+        self.file = BytesIO()
+        self.transport = CaptureTransport(
+            self.connection, self.inner, CaptureWriter(self.file))
+
+    def records(self):
+        return [(direction, data) for direction, _, data in
+                CaptureReader(BytesIO(self.file.getvalue()))]
+
+    def test_delegates_synchronous_and_attributes(self):
+        self.inner.synchronous = True
+        self.inner.pool = 'pool'
+        assert_true(self.transport.synchronous)
+        assert_equals('pool', self.transport.pool)
+        assert_equals(self.inner, self.transport.transport)
+
+    def test_connect(self):
+        expect(self.inner.connect).args(('host', 5672))
+        self.transport.connect(('host', 5672))
+
+    def test_write_records_outbound(self):
+        expect(self.inner.write).args(b'frame')
+        self.transport.write(b'frame')
+        assert_equals([(OUTBOUND, b'frame')], self.records())
+
+    def test_read_records_inbound(self):
+        expect(self.inner.read).args(3).returns(bytearray(b'abc'))
+        expect(self.inner.read).args(None).returns(None)
+        assert_equals(bytearray(b'abc'), self.transport.read(3))
+        assert_equals(None, self.transport.read())
+        assert_equals([(INBOUND, b'abc')], self.records())
+
+    def test_read_records_only_bytes_after_buffered(self):
+        expect(self.inner.buffer).args(b'ab')
+        expect(self.inner.read).args(None).returns(bytearray(b'abcd'))
+        expect(self.inner.read).args(None).returns(bytearray(b'ef'))
+        self.transport.buffer(b'ab')
+        self.transport.read()
+        self.transport.read()
+        assert_equals([(INBOUND, b'cd'), (INBOUND, b'ef')], self.records())
+
+    def test_read_closes_writer_when_transport_closed(self):
+        self.connection.transport = None
+        expect(self.inner.read).args(None).returns(None)
+        self.transport.read()
+        assert_true(self.transport.writer.closed)
+
+    def test_call_later(self):
+        expect(self.inner.call_later).args(5, 'cb').returns('timer')
+        assert_equals('timer', self.transport.call_later(5, 'cb'))
+
+    def test_process_channels(self):
+        expect(self.inner.process_channels).args('channels')
+        self.transport.process_channels('channels')
+
+    def test_disconnect_closes_writer(self):
+        expect(self.inner.disconnect).raises(IOError('boom'))
+        assert_raises(IOError, self.transport.disconnect)
+        assert_true(self.transport.writer.closed)
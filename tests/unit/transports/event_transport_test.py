@@ -62,6 +62,15 @@ class EventTransportTest(Chai):
         expect(self.transport._sock.read).returns('buffereddata')
         assert_equals('buffereddata', self.transport.read())
 
+    def test_call_later(self):
+        ev = mock()
+        mock(event_transport, 'event')
+        expect(event_transport.event.timeout).args(5, 'callback').returns(ev)
+
+        timer = self.transport.call_later(5, 'callback')
+        expect(ev.delete)
+        timer.cancel()
+
     def test_read_with_timeout_and_no_current_one(self):
         self.transport._heartbeat_timeout = None
         self.transport._sock = mock()
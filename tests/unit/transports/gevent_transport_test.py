@@ -35,6 +35,8 @@ class GeventTransportTest(Chai):
         assert_equals(bytearray(), self.transport._buffer)
         assert_true(isinstance(self.transport._read_lock, Semaphore))
         assert_true(isinstance(self.transport._write_lock, Semaphore))
+        assert_false(self.transport._write_queue)
+        assert_equals(0, self.transport.queued)
 
     def test_connect(self):
         with expect(mock(gevent_transport, 'super')).args(is_arg(GeventTransport), GeventTransport).returns(mock()) as parent:
@@ -109,6 +111,68 @@ class GeventTransportTest(Chai):
 
         assert_raises(Exception, self.transport.write, 'datas')
 
+    def test_call_later(self):
+        greenlet = mock()
+        self.mock(gevent_transport, 'gevent')
+        expect(gevent_transport.gevent.spawn_later).args(
+            5, 'callback').returns(greenlet)
+
+        timer = self.transport.call_later(5, 'callback')
+        expect(greenlet.kill).args(block=False)
+        timer.cancel()
+
+    def test_write_with_write_queue(self):
+        self.transport._write_queue = True
+        self.transport._sock = mock()
+        greenlet = mock()
+        self.mock(gevent_transport, 'gevent')
+        expect(gevent_transport.gevent.spawn).args(
+            self.transport._send_output).returns(greenlet)
+
+        self.transport.write(b'datas')
+        self.transport.write(b'more')
+        assert_equals(9, self.transport.queued)
+        assert_equals(greenlet, self.transport._writer)
+
+    def test_send_output(self):
+        self.transport._sock = mock()
+        self.transport._writer = 'writer'
+        self.transport._output.append(b'datas')
+        expect(self.transport._sock.send).args(b'datas').returns(2)
+        expect(self.transport._sock.send).args(b'tas').returns(3)
+        expect(self.connection.transport_drained)
+
+        self.transport._send_output()
+        assert_equals(0, self.transport.queued)
+        assert_equals(None, self.transport._writer)
+
+    def test_send_output_when_error(self):
+        self.transport._sock = mock()
+        self.transport._writer = 'writer'
+        self.transport._output.append(b'datas')
+        expect(self.transport._sock.send).raises(
+            socket.error(errno.EPIPE, 'pipe'))
+        expect(self.connection.logger.exception).args(
+            'error writing to server:1234')
+        expect(self.connection.transport_closed).args(
+            msg='error writing to server:1234')
+
+        self.transport._send_output()
+        assert_equals(0, self.transport.queued)
+        assert_equals(None, self.transport._writer)
+
+    def test_disconnect_waits_for_queued_output(self):
+        self.transport._sock = mock()
+        self.transport._writer = mock()
+        self.connection._connect_timeout = 5
+        self.mock(gevent_transport, 'gevent')
+        expect(gevent_transport.gevent.getcurrent).returns('current')
+        expect(self.transport._writer.join).args(5)
+        with expect(mock(gevent_transport, 'super')).args(is_arg(GeventTransport), GeventTransport).returns(mock()) as parent:
+            expect(parent.disconnect)
+
+        self.transport.disconnect()
+
 @unittest.skipIf(gevent is None, 'skipping gevent tests')
 class GeventPoolTransportTest(Chai):
 
@@ -0,0 +1,80 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+import errno
+import socket
+
+from chai import Chai
+
+from haigha2.transports import output_queue
+from haigha2.transports.output_queue import OutputQueue
+
+
+class OutputQueueTest(Chai):
+
+    def setUp(self):
+        super(OutputQueueTest, self).setUp()
+        self.queue = OutputQueue()
+        self.sock = mock()
+
+    def contents(self):
+        return b''.join(
+            segment.tobytes() for segment in self.queue._segments)
+
+    def test_append(self):
+        assert_equals(0, len(self.queue))
+        self.queue.append(b'frame')
+        self.queue.append(bytearray(b'second'), 3)
+        self.queue.append(b'')
+        assert_equals(8, len(self.queue))
+        assert_equals(2, self.queue.segments)
+        assert_equals(b'frameond', self.contents())
+
+        self.queue.clear()
+        assert_equals(0, len(self.queue))
+        assert_equals(0, self.queue.segments)
+
+    def test_append_does_not_copy(self):
+        data = bytearray(b'frame')
+        self.queue.append(data)
+        data[0:1] = b'F'
+        assert_equals(b'Frame', self.contents())
+
+    def test_send_everything(self):
+        self.queue.append(b'x' * 70000)
+        self.queue.append(b'y' * 70000)
+        expect(self.sock.send).args(b'x' * 70000).returns(70000)
+        expect(self.sock.send).args(b'y' * 70000).returns(70000)
+        assert_equals(140000, self.queue.send(self.sock))
+        assert_equals(0, len(self.queue))
+
+    def test_send_keeps_the_rest_of_partial_sends(self):
+        self.queue.append(b'x' * 70000)
+        self.queue.append(b'y' * 70000)
+        expect(self.sock.send).args(b'x' * 70000).returns(1000)
+        assert_equals(1000, self.queue.send(self.sock))
+        assert_equals(139000, len(self.queue))
+        assert_equals(b'x' * 69000 + b'y' * 70000, self.contents())
+
+    def test_send_coalesces_small_segments(self):
+        for frame in (b'one', b'two', b'three'):
+            self.queue.append(frame)
+        self.queue.append(b'z' * output_queue.COALESCE_SIZE)
+        expect(self.sock.send).args(b'onetwothree').returns(11)
+        expect(self.sock.send).args(
+            b'z' * output_queue.COALESCE_SIZE).returns(10)
+        assert_equals(21, self.queue.send(self.sock))
+        assert_equals(1, self.queue.segments)
+
+    def test_send_raises_errors(self):
+        self.queue.append(b'x' * 70000)
+        self.queue.append(b'y' * 70000)
+        expect(self.sock.send).args(b'x' * 70000).returns(70000)
+        expect(self.sock.send).raises(
+            socket.error(errno.EAGAIN, 'try again'))
+        assert_raises(socket.error, self.queue.send, self.sock)
+        assert_equals(70000, len(self.queue))
+        assert_equals(b'y' * 70000, self.contents())
@@ -0,0 +1,78 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+from io import BytesIO
+
+from chai import Chai
+
+from haigha2.capture import CaptureWriter, INBOUND, OUTBOUND
+from haigha2.transports import replay_transport
+from haigha2.transports.replay_transport import *
+
+
+class ReplayTransportTest(Chai):
+
+    def capture(self, *records):
+        f = BytesIO()
+        writer = CaptureWriter(f, start=10.0)
+        for direction, timestamp, data in records:
+            writer.record(direction, data, timestamp=timestamp)
+        return BytesIO(f.getvalue())
+
+    def test_init(self):
+        transport = ReplayTransport(mock(), replay=self.capture())
+        assert_false(transport.synchronous)
+        assert_false(transport.exhausted)
+        assert_raises(ValueError, ReplayTransport, mock(),
+                      replay=self.capture(), replay_timing='slow')
+
+    def test_read_returns_inbound_records(self):
+        outbound = []
+        transport = ReplayTransport(mock(), replay=self.capture(
+            (OUTBOUND, 10.0, b'AMQP'),
+            (INBOUND, 10.1, b'start'),
+            (OUTBOUND, 10.2, b'start_ok'),
+            (OUTBOUND, 10.2, b'open'),
+            (INBOUND, 10.3, b'open_ok'),
+        ), replay_outbound_cb=outbound.append)
+        transport.connect(('host', 5672))
+        transport.write(b'ignored')
+
+        assert_equals(b'start', transport.read())
+        assert_equals([b'AMQP'], outbound)
+        assert_equals(b'open_ok', transport.read())
+        assert_equals([b'AMQP', b'start_ok', b'open'], outbound)
+        assert_false(transport.exhausted)
+        assert_equals(None, transport.read())
+        assert_true(transport.exhausted)
+
+    def test_read_prepends_buffered_bytes(self):
+        transport = ReplayTransport(mock(), replay=self.capture(
+            (INBOUND, 10.0, b'cd'),
+        ))
+        transport.buffer(b'ab')
+        assert_equals(bytearray(b'abcd'), transport.read())
+
+    def test_original_timing_waits(self):
+        transport = ReplayTransport(mock(), replay=self.capture(
+            (INBOUND, 11.0, b'a'),
+            (INBOUND, 13.0, b'b'),
+        ), replay_timing='original', replay_speed=2.0)
+        time = self.mock(replay_transport, 'time')
+        expect(time.time).returns(100.0).times(2)
+        expect(time.time).returns(100.5)
+        expect(time.sleep).args(0.5)
+
+        assert_equals(b'a', transport.read())
+        assert_equals(b'b', transport.read())
+
+    def test_disconnect(self):
+        transport = ReplayTransport(mock(), replay=self.capture(
+            (INBOUND, 10.0, b'a'),
+        ))
+        transport.disconnect()
+        assert_true(transport.exhausted)
+        assert_equals(None, transport.read())
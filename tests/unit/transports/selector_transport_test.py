@@ -0,0 +1,330 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+import errno
+import socket
+import time
+
+from chai import Chai
+
+from haigha2.connections.rabbit_connection import RabbitConnection
+from tests.fake_broker import FakeBroker
+from haigha2.message import Message
+from haigha2.transports import selector_transport
+from haigha2.transports.socket_transport import SocketTransport
+from haigha2.transports.selector_transport import *
+from haigha2.transports.selector_transport import _EpollSelector, \
+    _SelectSelector
+
+
+class SelectorTransportTest(Chai):
+
+    def setUp(self):
+        super(SelectorTransportTest, self).setUp()
+
+        self.connection = mock()
+        self.connection.debug = False
+        self.selector = mock()
+        self.transport = SelectorTransport(
+            self.connection, selector=self.selector)
+        self.transport._host = 'server:1234'
+        self.transport._read_size = 4096
+        self.sock = mock()
+
+    def connected(self):
+        self.transport._sock = self.sock
+        self.transport._events = EVENT_READ
+
+    def output(self):
+        return b''.join(
+            segment.tobytes() for segment in self.transport._output._segments)
+
+    def test_init(self):
+        assert_false(self.transport.synchronous)
+        assert_equals(self.selector, self.transport.selector)
+        assert_equals(0, self.transport.queued)
+        assert_true(isinstance(SelectorTransport(mock()).selector,
+                               DefaultSelector))
+
+    def test_connect(self):
+        expect(SocketTransport.connect).args(('host', 5672)).side_effect(
+            lambda addr: setattr(self.transport, '_sock', self.sock))
+        expect(self.sock.setblocking).args(False)
+        expect(self.sock.getsockopt).args(
+            socket.SOL_SOCKET, socket.SO_RCVBUF).returns(8192)
+        expect(self.selector.register).args(
+            self.sock, EVENT_READ, self.transport)
+
+        self.transport.connect(('host', 5672))
+        assert_equals(8192, self.transport._read_size)
+
+    def test_connect_with_reactor(self):
+        reactor = mock()
+        reactor.selector = self.selector
+        transport = SelectorTransport(self.connection, reactor=reactor)
+        assert_equals(self.selector, transport.selector)
+
+        expect(SocketTransport.connect).args(('host', 5672)).side_effect(
+            lambda addr: setattr(transport, '_sock', self.sock))
+        expect(self.sock.setblocking).args(False)
+        expect(self.sock.getsockopt).args(
+            socket.SOL_SOCKET, socket.SO_RCVBUF).returns(8192)
+        expect(self.selector.register).args(
+            self.sock, EVENT_READ, transport)
+        expect(reactor.add_transport).args(transport)
+        transport.connect(('host', 5672))
+
+        expect(reactor.remove_transport).args(transport)
+        expect(self.selector.unregister).args(self.sock)
+        expect(self.sock.close)
+        transport.disconnect()
+
+    def test_handle_read_reads_without_waiting(self):
+        self.connected()
+        expect(self.connection.read_frames).side_effect(
+            lambda: assert_equals(b'data', self.transport.read()))
+        expect(self.sock.recv).args(4096).returns(b'data')
+
+        self.transport.handle_read()
+        assert_false(self.transport._readable)
+
+    def test_read_prepends_buffered_bytes(self):
+        self.connected()
+        self.transport._readable = True
+        self.transport.buffer(b'ab')
+        expect(self.sock.recv).args(4096).returns(b'cd')
+        assert_equals(bytearray(b'abcd'), self.transport.read())
+
+    def test_read_outside_poll_waits(self):
+        self.connected()
+        expect(selector_transport._wait).args(
+            self.sock, False, float).returns((False, False))
+        assert_equals(None, self.transport.read(3))
+
+    def test_read_outside_poll_flushes_output_while_waiting(self):
+        self.connected()
+        self.transport._output.append(b'out')
+        expect(selector_transport._wait).args(
+            self.sock, True, None).returns((False, True))
+        expect(self.sock.send).args(b'out').returns(3)
+        expect(self.selector.modify).args(
+            self.sock, EVENT_READ, self.transport)
+        expect(self.connection.transport_drained)
+        expect(selector_transport._wait).args(
+            self.sock, False, None).returns((True, False))
+        expect(self.sock.recv).args(4096).returns(b'data')
+
+        self.transport._events = EVENT_READ | EVENT_WRITE
+        assert_equals(b'data', self.transport.read())
+
+    def test_read_when_would_block(self):
+        self.connected()
+        self.transport._readable = True
+        expect(self.sock.recv).raises(
+            socket.error(errno.EAGAIN, 'try again'))
+        assert_equals(None, self.transport.read())
+
+    def test_read_when_closed_by_peer(self):
+        self.connected()
+        self.transport._readable = True
+        expect(self.sock.recv).returns(b'')
+        expect(self.selector.unregister).args(self.sock)
+        expect(self.sock.close)
+        expect(self.connection.transport_closed).args(
+            msg='connection to server:1234 closed')
+
+        assert_equals(None, self.transport.read())
+        assert_equals(None, self.transport._sock)
+
+    def test_read_when_error(self):
+        self.connected()
+        self.transport._readable = True
+        expect(self.sock.recv).raises(
+            socket.error(errno.ECONNRESET, 'reset'))
+        expect(self.connection.logger.exception).any_args()
+        expect(self.selector.unregister).args(self.sock)
+        expect(self.sock.close)
+        expect(self.connection.transport_closed).args(
+            msg='error reading from server:1234')
+
+        assert_equals(None, self.transport.read())
+
+    def test_write_sends_everything(self):
+        self.connected()
+        expect(self.sock.send).args(b'frame').returns(5)
+        self.transport.write(b'frame')
+        assert_equals(0, self.transport.queued)
+
+    def test_write_buffers_partial_writes(self):
+        self.connected()
+        expect(self.sock.send).args(b'frame').returns(2)
+        expect(self.selector.modify).args(
+            self.sock, EVENT_READ | EVENT_WRITE, self.transport)
+        self.transport.write(b'frame')
+        assert_equals(3, self.transport.queued)
+        assert_equals(b'ame', self.output())
+
+        # Later writes queue behind the buffered output
+        self.transport.write(b'next')
+        assert_equals(7, self.transport.queued)
+        assert_equals(2, self.transport._output.segments)
+        assert_equals(b'amenext', self.output())
+
+    def test_write_when_would_block(self):
+        self.connected()
+        expect(self.sock.send).raises(
+            socket.error(errno.EWOULDBLOCK, 'would block'))
+        expect(self.selector.modify).args(
+            self.sock, EVENT_READ | EVENT_WRITE, self.transport)
+        self.transport.write(b'frame')
+        assert_equals(b'frame', self.output())
+
+    def test_write_when_error(self):
+        self.connected()
+        expect(self.sock.send).raises(socket.error(errno.EPIPE, 'pipe'))
+        expect(self.connection.logger.exception).any_args()
+        expect(self.selector.unregister).args(self.sock)
+        expect(self.sock.close)
+        expect(self.connection.transport_closed).args(
+            msg='error writing to server:1234')
+        self.transport.write(b'frame')
+
+    def test_handle_write_flushes_output(self):
+        self.connected()
+        self.transport._events = EVENT_READ | EVENT_WRITE
+        self.transport._output.append(b'output')
+        expect(self.sock.send).args(b'output').returns(3)
+        self.transport.handle_write()
+        assert_equals(b'put', self.output())
+
+        expect(self.sock.send).args(b'put').returns(3)
+        expect(self.selector.modify).args(
+            self.sock, EVENT_READ, self.transport)
+        expect(self.connection.transport_drained)
+        self.transport.handle_write()
+        assert_equals(0, self.transport.queued)
+
+    def test_disconnect(self):
+        self.connected()
+        self.transport._output.append(b'output')
+        expect(self.sock.send).args(b'output').raises(
+            socket.error(errno.EAGAIN, 'try again'))
+        expect(self.selector.unregister).args(self.sock)
+        expect(self.sock.close)
+
+        self.transport.disconnect()
+        assert_equals(None, self.transport._sock)
+        self.transport.disconnect()
+
+    def test_poll_dispatches_events(self):
+        selector = mock()
+        t1 = mock()
+        t2 = mock()
+        expect(selector.select).args(2.0).returns([
+            (SelectorKey('s1', 1, EVENT_READ, t1), EVENT_READ),
+            (SelectorKey('s2', 2, EVENT_READ | EVENT_WRITE, t2),
+             EVENT_READ | EVENT_WRITE),
+        ])
+        expect(t1.handle_read)
+        expect(t2.handle_write)
+        expect(t2.handle_read)
+        assert_equals(2, poll(selector, 2.0))
+
+    def test_poll_runs_timers(self):
+        selector = mock()
+        calls = []
+        transport = SelectorTransport(mock(), selector=selector)
+        transport.call_later(0.5, lambda: calls.append('timer'))
+        assert_true(timer_wheel(selector) is transport._timers)
+
+        # Waits no longer than until the timer is due
+        expect(selector.select).args(float).side_effect(
+            lambda timeout: time.sleep(timeout)).returns([])
+        while not calls:
+            assert_equals(0, poll(selector, 2.0))
+        assert_equals(0, len(transport._timers))
+
+    def test_call_later_with_reactor(self):
+        reactor = mock()
+        transport = SelectorTransport(self.connection, reactor=reactor)
+        expect(reactor.call_later).args(5, 'callback').returns('timer')
+        assert_equals('timer', transport.call_later(5, 'callback'))
+        assert_equals(None, transport._timers)
+
+
+class FallbackSelectorTest(Chai):
+
+    '''
+    The selectors used where the selectors module isn't available.
+    '''
+
+    def check_selector(self, selector):
+        a, b = socket.socketpair()
+        try:
+            key = selector.register(a, EVENT_READ, 'data')
+            assert_equals(('data', EVENT_READ), (key.data, key.events))
+            assert_equals([], selector.select(0))
+
+            b.send(b'x')
+            assert_equals([(key, EVENT_READ)], selector.select(0))
+
+            key = selector.modify(a, EVENT_READ | EVENT_WRITE, 'data')
+            assert_equals([(key, EVENT_READ | EVENT_WRITE)],
+                          selector.select(0))
+
+            selector.unregister(a)
+            assert_equals({}, selector.get_map())
+            assert_equals([], selector.select(0))
+        finally:
+            selector.close()
+            a.close()
+            b.close()
+
+    def test_select_selector(self):
+        self.check_selector(_SelectSelector())
+
+    def test_epoll_selector(self):
+        if not hasattr(selector_transport.select, 'epoll'):
+            self.skipTest('no epoll')
+        self.check_selector(_EpollSelector())
+
+
+class SelectorTransportBrokerTest(Chai):
+
+    '''
+    Runs several connections on one selector against the fake broker.
+    '''
+
+    def test_connections_share_a_selector(self):
+        selector = DefaultSelector()
+        received = []
+        drained = []
+        connections = []
+        with FakeBroker() as broker:
+            host, port = broker.address
+            for i in range(3):
+                broker.preload('q%d' % (i), b'body', 10)
+                connection = RabbitConnection(
+                    host=host, port=port, transport='selector',
+                    selector=selector, drain_cb=lambda: drained.append(1))
+                channel = connection.channel()
+                channel.basic.consume('q%d' % (i), received.append)
+                # Larger than the socket buffers, so written in parts
+                channel.basic.publish(
+                    Message(b'x' * 4000000), '', 'unrouted')
+                connections.append(connection)
+
+            while len(received) < 30 or \
+                    any(c.queued_bytes for c in connections):
+                assert_true(poll(selector, 5) > 0)
+            assert_true(broker.wait_published(3, 5))
+            assert_true(drained)
+
+            for connection in connections:
+                connection.close()
+            while not all(c.closed for c in connections):
+                poll(selector, 5)
+        assert_equals({}, dict(selector.get_map()))
@@ -231,6 +231,34 @@ class SocketTransportTest(Chai):
 
         assert_equals('buffereddata', self.transport.read())
 
+    def test_read_runs_timers_and_waits_until_the_next(self):
+        self.transport._sock = mock()
+        self.transport.connection.debug = False
+        timers = self.transport._timers = mock()
+
+        expect(timers.__len__).returns(1)
+        expect(timers.advance)
+        expect(timers.timeout).returns(0.5)
+        expect(self.transport._sock.settimeout).args(0.5)
+        expect(self.transport._sock.getsockopt).any_args().returns(4095)
+        expect(self.transport._sock.recv).args(4095).returns('data')
+
+        assert_equals('data', self.transport.read(3))
+
+    def test_read_when_timers_disconnect(self):
+        self.transport._sock = mock()
+        timers = self.transport._timers = mock()
+
+        expect(timers.__len__).returns(1)
+        expect(timers.advance).side_effect(
+            lambda: setattr(self.transport, '_sock', None))
+        assert_equals(None, self.transport.read(3))
+
+    def test_call_later(self):
+        timers = self.transport._timers = mock()
+        expect(timers.schedule).args(5, 'callback').returns('timer')
+        assert_equals('timer', self.transport.call_later(5, 'callback'))
+
     def test_read_when_data_buffered(self):
         self.transport._sock = mock()
         self.transport.connection.debug = False
@@ -15,6 +15,8 @@ class TransportTest(Chai):
         t = Transport('conn')
         assert_equals('conn', t._connection)
         assert_equals('conn', t.connection)
+        assert_equals(0, t.queued)
+        assert_equals(None, t.call_later(5, 'callback'))
 
     def test_process_channels(self):
         t = Transport('conn')
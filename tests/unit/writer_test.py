@@ -8,7 +8,12 @@ from chai import Chai
 from datetime import datetime
 from decimal import Decimal
 
-from haigha2.writer import Writer
+from haigha2.writer import Writer, FrozenTable
+from haigha2.reader import Reader
+from haigha2.frames.frame import Frame
+from haigha2.frames.header_frame import HeaderFrame
+
+from tests.unit import pure_python
 
 
 class WriterTest(Chai):
@@ -147,16 +152,37 @@ class WriterTest(Chai):
 
         assert_equals('\x00\x00\x00\x00\x4d\x34\xc4\x71', w._output_buffer)
 
+    @pure_python
     def test_write_table(self):
         w = Writer()
-        expect(w._write_item).args('a', 'foo').any_order().side_effect(
-            lambda *args: (setattr(w, '_pos', 20), w._output_buffer.extend('afoo')))
-        expect(w._write_item).args('b', 'bar').any_order().side_effect(
-            lambda *args: (setattr(w, '_pos', 20), w._output_buffer.extend('bbar')))
+        expect(w._write_field).args('foo').any_order().side_effect(
+            lambda *args: w._output_buffer.extend('foo'))
+        expect(w._write_field).args('bar').any_order().side_effect(
+            lambda *args: w._output_buffer.extend('bar'))
 
         assert_true(w is w.write_table({'a': 'foo', 'b': 'bar'}))
-        assert_equals('\x00\x00\x00\x08', w._output_buffer[:4])
-        assert_equals(12, len(w._output_buffer))
+        assert_equals('\x00\x00\x00\x0a', w._output_buffer[:4])
+        assert_equals(14, len(w._output_buffer))
+        assert_true(w._output_buffer[4:] in ('\x01afoo\x01bbar',
+                                             '\x01bbar\x01afoo'))
+
+    def test_write_table_encodes_unicode_keys(self):
+        w = Writer()
+        w.write_table({u'D\xfcsseldorf': None})
+        assert_equals('\x00\x00\x00\x0d\x0bD\xc3\xbcsseldorfV',
+                      w._output_buffer)
+
+    def test_write_table_raises_on_long_key(self):
+        w = Writer()
+        assert_raises(ValueError, w.write_table, {'k' * 256: None})
+
+    def test_write_table_with_encoded_table(self):
+        class Encoded(dict):
+            def encoded_table(self):
+                return '\x00\x00\x00\x00'
+        w = Writer()
+        w.write_table(Encoded(a='foo'))
+        assert_equals('\x00\x00\x00\x00', w._output_buffer)
 
     def test_write_item(self):
         w = Writer()
@@ -167,12 +193,17 @@ class WriterTest(Chai):
     def test_write_field(self):
         w = Writer()
         unknown = mock()
-        expect(w._field_none).args(unknown)
         w._write_field(unknown)
+        assert_equals('V', w._output_buffer)
+        assert_equals(Writer._field_none.im_func,
+                      Writer._subclass_writers.pop(type(unknown)))
 
         Writer.field_type_map[type(unknown)] = unknown
         expect(unknown).args(w, unknown)
-        w._write_field(unknown)
+        try:
+            w._write_field(unknown)
+        finally:
+            del Writer.field_type_map[type(unknown)]
 
     def test_field_bool(self):
         w = Writer()
@@ -253,6 +284,15 @@ class WriterTest(Chai):
         w = Writer()
         w._write_field(SubString('foo'))
         assert_equals('S\x00\x00\x00\x03foo', w._output_buffer)
+        assert_equals(Writer._field_str.im_func,
+                      Writer._subclass_writers[SubString])
+
+        # Later lookups of the subclass don't scan field_type_map
+        expect(Writer._lookup_field_writer).times(0)
+        w._write_field(SubString('bar'))
+        assert_equals('S\x00\x00\x00\x03fooS\x00\x00\x00\x03bar',
+                      w._output_buffer)
+        del Writer._subclass_writers[SubString]
 
     def test_field_iterable(self):
         w = Writer()
@@ -291,3 +331,70 @@ class WriterTest(Chai):
                 type(None): Writer._field_none.im_func,
                 bytearray: Writer._field_bytearray.im_func,
             }, Writer.field_type_map)
+
+
+class FrozenTableTest(Chai):
+
+    def _encode(self, d):
+        return str(Writer().write_table(d).buffer())
+
+    def test_is_immutable(self):
+        t = FrozenTable(a=1)
+        assert_raises(TypeError, t.__setitem__, 'a', 2)
+        assert_raises(TypeError, t.__delitem__, 'a')
+        assert_raises(TypeError, t.update, {'b': 2})
+        assert_raises(TypeError, t.pop, 'a')
+        assert_raises(TypeError, t.setdefault, 'b', 2)
+        assert_raises(TypeError, t.popitem)
+        assert_raises(TypeError, t.clear)
+        assert_raises(TypeError, t.__ior__, {'b': 2})
+        assert_equals({'a': 1}, t)
+
+    def test_encoded_table_is_cached(self):
+        t = FrozenTable({'a': 'foo', 'b': 1})
+        encoded = t.encoded_table()
+        assert_equals(self._encode({'a': 'foo', 'b': 1}), encoded)
+        assert_is(encoded, t.encoded_table())
+
+    def test_write_table_writes_encoding(self):
+        t = FrozenTable({'a': 'foo'})
+        t._encoded = 'cached'
+        w = Writer()
+        w.write_table(t)
+        assert_equals('cached', w.buffer())
+
+    def test_nested(self):
+        inner = FrozenTable(b=2)
+        assert_equals(self._encode({'a': {'b': 2}}),
+                      self._encode(FrozenTable(a=inner)))
+        assert_equals(self._encode({'a': {'b': 2}}),
+                      self._encode({'a': inner}))
+
+    def test_merge_appends_overlay_encoding(self):
+        base = FrozenTable({'a': 'foo'})
+        merged = base.merge({'b': 1})
+        assert_true(isinstance(merged, FrozenTable))
+        assert_equals({'a': 'foo', 'b': 1}, merged)
+        assert_equals({'a': 'foo'}, base)
+        assert_equals(
+            '\x00\x00\x00\x0f\x01aS\x00\x00\x00\x03foo\x01bs\x00\x01',
+            merged.encoded_table())
+        assert_equals({'a': 'foo', 'b': 1},
+                      Reader(merged.encoded_table()).read_table())
+
+    def test_merge_with_replaced_key_reencodes(self):
+        base = FrozenTable({'a': 'foo', 'b': 1})
+        merged = base.merge({'b': 2})
+        assert_equals(None, merged._encoded)
+        assert_equals({'a': 'foo', 'b': 2},
+                      Reader(merged.encoded_table()).read_table())
+
+    def test_header_frame_writes_encoding(self):
+        headers = FrozenTable({'x-trace': 'abc'})
+        frame = HeaderFrame(1, 60, 0, 0, {'application_headers': headers})
+        buf = bytearray()
+        frame.write_frame(buf)
+        assert_true(headers.encoded_table() in buf)
+        parsed = Frame.read_frames(Reader(buf))[0]
+        assert_equals({'x-trace': 'abc'},
+                      parsed.properties['application_headers'])